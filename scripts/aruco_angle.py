@@ -3,6 +3,7 @@
 from geometry_msgs.msg import PoseStamped
 import rospy
 import numpy as np
+from rotation_kernel import quaternion_to_inverse_rotation
 
 class ArUcoAngle(object):
 
@@ -17,14 +18,10 @@ class ArUcoAngle(object):
 
 	def aruco_callback(self, msg):
 
-		w = msg.pose.orientation.w
-		x = msg.pose.orientation.x
-		y = msg.pose.orientation.y
-		z = msg.pose.orientation.z
+		orientation = msg.pose.orientation
 
-
-		# Convert quaternion to a rotation.
-		self.R = self.get_R_from_quaternion(w, x, y, z)
+		# Convert quaternion to a rotation (camera frame to marker frame).
+		self.R = np.array(quaternion_to_inverse_rotation(orientation.x, orientation.y, orientation.z, orientation.w))
 
 		vec = np.dot(self.R, np.array([[0], [0], [-1]]))
 
@@ -33,22 +30,6 @@ class ArUcoAngle(object):
 
 		print 'Angle: %f' % (180.0 - np.degrees(angle))
 
-	def get_R_from_quaternion(self, w, x, y, z):
-		
-		wx = w*x
-		wy = w*y
-		wz = w*z
-		xx = x*x
-		xy = x*y
-		xz = x*z
-		yy = y*y
-		yz = y*z
-		zz = z*z
-
-		return np.array([[1. - 2.*yy - 2.*zz, 2.*xy + 2.*wz, 2.*xz - 2.*wy],
-			             [2.*xy - 2.*wz, 1. - 2.*xx - 2.*zz, 2.*yz + 2.*wx],
-			             [2.*xz + 2.*wy, 2.*yz - 2.*wx, 1. - 2.*xx - 2.*yy]])
-
 
 
 
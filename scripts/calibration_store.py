@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+## Calibration cache, so a restarted state machine doesn't have to fly
+## WIND_CALIBRATION and HEADING_CORRECTION again. The state machine saves what
+## those stages found (StateMachineCore.calibration(): average roll and pitch,
+## wind offset, heading command and which stages are done) and loads it back at
+## startup if it's still within its validity window.
+##
+## The file is JSON:
+##   {"version": 1, "timestamp": <wall clock, s>, "validity": <s>, "test_name": ..., "calibration": {...}}
+## save() only hands the record to a background thread, which writes it to a
+## temporary file and renames it over the old one, so the command timer never
+## waits on the disk and a crash mid-write leaves the previous file intact. If
+## several saves queue up, only the latest one is written.
+##
+## StateMachineCore takes the store and does the saving and loading
+## (save_calibration(), load_calibration()). The nodes build it from their
+## parameters with store_from_params().
+
+import os
+import json
+import time
+import threading
+
+
+CALIBRATION_VERSION = 1
+
+
+class CalibrationStore(object):
+
+    def __init__(self, path, validity=600.0, test_name='', clock=time.time):
+
+        # file to keep the calibration in, how long it stays valid (s) and the wall clock for the timestamps
+        self.path = path
+        self.validity = validity
+        self.test_name = test_name
+        self.clock = clock
+
+        # latest record waiting for the writer, and how many records it wrote (or failed to)
+        self.pending = None
+        self.write_count = 0
+        self.error_count = 0
+        self.last_error = ''
+
+        self.condition = threading.Condition()
+        self.writer = None
+
+
+    def load(self):
+
+        # the stored calibration if there is a valid one, None otherwise
+        try:
+            with open(self.path, 'r') as f:
+                record = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if record.get('version') != CALIBRATION_VERSION:
+            return None
+
+        age = self.clock() - record.get('timestamp', 0.0)
+        if age < 0.0 or age > record.get('validity', 0.0):
+            return None
+
+        return record.get('calibration')
+
+
+    def age(self):
+
+        # age of the stored calibration (s), None if there isn't one
+        try:
+            with open(self.path, 'r') as f:
+                return self.clock() - json.load(f)['timestamp']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+
+    def save(self, calibration):
+
+        # queue a calibration dict for the background writer
+        record = {'version': CALIBRATION_VERSION,
+                  'timestamp': self.clock(),
+                  'validity': self.validity,
+                  'test_name': self.test_name,
+                  'calibration': calibration}
+
+        with self.condition:
+            self.pending = record
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop)
+                self.writer.daemon = True
+                self.writer.start()
+            self.condition.notify()
+
+
+    def flush(self, timeout=1.0):
+
+        # wait until the queued record is on disk, returns False if it isn't after timeout (s)
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.pending is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0.0:
+                    return False
+                self.condition.wait(remaining)
+
+        return True
+
+
+    def write_loop(self):
+
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                record = self.pending
+
+            self.write(record)
+
+            with self.condition:
+                if self.pending is record:
+                    self.pending = None
+                self.condition.notify_all()
+
+
+    def write(self, record):
+
+        tmp_path = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+            self.write_count += 1
+
+        except (IOError, OSError) as e:
+            self.error_count += 1
+            self.last_error = str(e)
+
+
+def store_from_params(get_param, test_name=''):
+
+    # CalibrationStore at ~calibration_file ($ROS_HOME/ibvs_calibration.json by default) valid for ~calibration_validity (s),
+    # None if the validity is 0 (cache off). get_param is rospy.get_param, this module doesn't need ROS
+    validity = get_param('~calibration_validity', 600.0)
+    if validity <= 0.0:
+        return None
+
+    ros_home = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+    return CalibrationStore(get_param('~calibration_file', os.path.join(ros_home, 'ibvs_calibration.json')), validity, test_name)
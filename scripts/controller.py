@@ -10,9 +10,13 @@ from nav_msgs.msg import Odometry
 from std_msgs.msg import Bool
 from rosflight_msgs.msg import Command
 from geometry_msgs.msg import Pose
-from simple_pid import PID
-import tf
-# import time
+from diagnostic_msgs.msg import DiagnosticArray
+from diagnostic_msgs.msg import DiagnosticStatus
+from diagnostic_msgs.msg import KeyValue
+from controller_core import ControllerCore
+from state_snapshot import StateSnapshot
+from loop_monitor import LoopMonitor, timer
+from rotation_kernel import quaternion_to_euler
 
 ## TODO: -finish initializing PID controllers in __init__  --done Jan 17
 ##       -add loading of applicable ros params in __init__ --done Jan 17
@@ -22,7 +26,7 @@ import tf
 ##       -add controller case for uvw commands (for IBVS)
 
 
-class Controller(object):
+class Controller(ControllerCore):
 
     def __init__(self):
 
@@ -60,80 +64,44 @@ class Controller(object):
         tau = rospy.get_param('~tau', 0.04)
 
         # quadcopter params
-        self.max_thrust = rospy.get_param('dynamics/max_F', 60.0)
-        self.mass = rospy.get_param('dynamics/mass', 3.0)
-        self.thrust_eq = (9.80665 * self.mass) / self.max_thrust
-        self.drag_constant = rospy.get_param('dynamics/linear_mu', 0.1)
-
-        # initialize state variables
-        self.pn = 0.0
-        self.pe = 0.0
-        self.pd = 0.0
-
-        self.phi = 0.0
-        self.theta = 0.0
-        self.psi = 0.0
-
-        self.u = 0.0
-        self.v = 0.0
-        self.w = 0.0
-
-        self.p = 0.0
-        self.q = 0.0
-        self.r = 0.0
-
-        self.ax = 0.0
-        self.ay = 0.0
-        self.az = 0.0
-
-        self.throttle = 0.0
-
-        # initialize command variables
-        self.xc_pn = 0.0
-        self.xc_pe = 0.0
-        self.xc_pd = 0.0
-
-        self.xc_phi = 0.0
-        self.xc_theta = 0.0
-        self.xc_psi = 0.0
-
-        self.xc_u = 0.0
-        self.xc_v = 0.0
-        self.xc_pd = 0.0
-        self.xc_r = 0.0
-
-        self.xc_ax = 0.0
-        self.xc_ay = 0.0
-        self.xc_az = 0.0
-        self.xc_r = 0.0
-
-        self.xc_throttle = 0.0
-
-        # initialize saturation values
-        self.max_roll = rospy.get_param('~max_roll', 0.15)
-        self.max_pitch = rospy.get_param('~max_pitch', 0.15)
-        self.max_yaw_rate = rospy.get_param('~max_yaw_rate', np.radians(45.0))
-        self.max_throttle = rospy.get_param('~max_throttle', 1.0)
-        self.max_u = rospy.get_param('~max_u', 1.0)
-        self.max_v = rospy.get_param('~max_v', 1.0)
-        self.max_w = rospy.get_param('~max_x', 1.0)
-
-        # initialize PID controllers
-        self.PID_u = PID(u_P, u_I, u_D, None, None, tau)
-        self.PID_v = PID(v_P, v_I, v_D, None, None, tau)
-        self.PID_w = PID(w_P, w_I, w_D, None, None, tau)
-        self.PID_x = PID(x_P, x_I, x_D, None, None, tau)
-        self.PID_y = PID(y_P, y_I, y_D, None, None, tau)
-        self.PID_z = PID(z_P, z_I, z_D, None, None, tau)
-        self.PID_psi = PID(psi_P, psi_I, psi_D, None, None, tau)
+        max_thrust = rospy.get_param('dynamics/max_F', 60.0)
+        mass = rospy.get_param('dynamics/mass', 3.0)
+        drag_constant = rospy.get_param('dynamics/linear_mu', 0.1)
+
+        # initialize the PID controllers, state and command variables and saturation values
+        ControllerCore.__init__(self, {'u': (u_P, u_I, u_D),
+                                       'v': (v_P, v_I, v_D),
+                                       'w': (w_P, w_I, w_D),
+                                       'x': (x_P, x_I, x_D),
+                                       'y': (y_P, y_I, y_D),
+                                       'z': (z_P, z_I, z_D),
+                                       'psi': (psi_P, psi_I, psi_D)}, tau=tau,
+                                mass=mass, max_thrust=max_thrust, drag_constant=drag_constant,
+                                max_roll=rospy.get_param('~max_roll', 0.15),
+                                max_pitch=rospy.get_param('~max_pitch', 0.15),
+                                max_yaw_rate=rospy.get_param('~max_yaw_rate', np.radians(45.0)),
+                                max_throttle=rospy.get_param('~max_throttle', 1.0),
+                                max_u=rospy.get_param('~max_u', 1.0),
+                                max_v=rospy.get_param('~max_v', 1.0),
+                                max_w=rospy.get_param('~max_x', 1.0))
+
+        # where each rosflight Command mode starts the control cascade
+        self.control_loops = {Command.MODE_XPOS_YPOS_YAW_ALTITUDE: 'position',
+                              Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE: 'velocity',
+                              Command.MODE_XACC_YACC_YAWRATE_AZ: 'acceleration',
+                              Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE: 'attitude'}
 
         # initialize other class variables
         self.prev_time = 0.0
         self.is_flying = False
         self.control_mode = 4  # MODE_XPOS_YPOS_YAW_ALTITUDE
-        self.ibvs_active = False
+        self.control_loop = self.control_loops.get(self.control_mode)
 
         self.command = Command()
+        self.command.mode = Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE
+
+        # state_callback writes every estimate here, send_command copies the latest one in before compute_control
+        self.state = StateSnapshot()
 
         # dynamic reconfigure
         self.server = Server(ControllerConfig, self.reconfigure_callback)
@@ -150,13 +118,20 @@ class Controller(object):
 
         # initialize timer
         self.update_rate = 200.0
+
+        # loop timing (period and compute_control histograms, skipped ticks, overruns, latency watermark) on loop_timing
+        self.loop_monitor = None
+        if rospy.get_param('~loop_diagnostics', True):
+            self.loop_monitor = LoopMonitor(self.update_rate)
+            self.loop_timing_pub = rospy.Publisher('loop_timing', DiagnosticArray, queue_size=1)
+            self.loop_timing_rate = rospy.get_param('~loop_diagnostics_rate', 1.0)
+            self.loop_timing_timer = rospy.Timer(rospy.Duration(1.0/self.loop_timing_rate), self.send_loop_timing)
+
         self.update_timer = rospy.Timer(rospy.Duration(1.0/self.update_rate), self.send_command)
 
 
     def send_command(self, event):
 
-        # t = time.time()  # for seeing how fast this runs
-
         if self.prev_time == 0:
             self.prev_time = rospy.get_time()
             return
@@ -166,47 +141,85 @@ class Controller(object):
         dt = now - self.prev_time
         self.prev_time = now
 
+        monitor = self.loop_monitor
+        if monitor is not None:
+            # dt <= 0 is counted, as are ticks the timer never delivered
+            monitor.add_tick(dt, now - event.current_expected.to_sec())
+
         if dt <= 0:
             return
 
         if self.is_flying:
-            self.compute_control(dt)
+            self.state.load(self)
+            start = timer()
+            if self.compute_control(dt):
+                # pack up and send the command
+                self.command.F = self.throttle_c
+                self.command.x = self.phi_c
+                self.command.y = self.theta_c
+                self.command.z = self.r_c
             self.command_pub.publish(self.command)
+            if monitor is not None:
+                monitor.add_compute(timer() - start)
         else:
-            reset_integrators()
+            self.reset_integrators()
             self.prev_time = rospy.get_time()
 
-        # elapsed = time.time() - t
-        # hz_approx = 1.0/elapsed
-        # print(hz_approx)
 
+    def send_loop_timing(self, event):
 
-    def state_callback(self, msg):
+        summary = self.loop_monitor.report()
+
+        diagnostics_msg = DiagnosticArray()
+        diagnostics_msg.header.stamp = rospy.get_rostime()
 
-        # this should already be coming in NED
-        self.pn = msg.pose.pose.position.x
-        self.pe = msg.pose.pose.position.y
-        self.pd = msg.pose.pose.position.z
+        status = DiagnosticStatus()
+        status.name = 'controller/loop_timing'
+        status.hardware_id = 'controller'
 
-        self.u = msg.twist.twist.linear.x
-        self.v = msg.twist.twist.linear.y
-        self.w = msg.twist.twist.linear.z
+        if summary['new_overruns'] > 0 or summary['new_skipped'] > 0:
+            status.level = DiagnosticStatus.WARN
+            status.message = '%d overruns, %d skipped ticks in the last %d' % (summary['new_overruns'], summary['new_skipped'], summary['new_ticks'])
+        elif summary['new_bad_dt'] > 0:
+            status.level = DiagnosticStatus.WARN
+            status.message = '%d ticks dropped with dt <= 0' % summary['new_bad_dt']
+        else:
+            status.level = DiagnosticStatus.OK
+            status.message = 'period p99 %.2f ms, compute p99 %.3f ms' % (1.0e3*summary['period_p99'], 1.0e3*summary['compute_p99'])
+
+        status.values = [KeyValue('rate_hz', '%.1f' % self.update_rate),
+                         KeyValue('ticks', str(summary['ticks'])),
+                         KeyValue('period_mean_ms', '%.3f' % (1.0e3*summary['period_mean'])),
+                         KeyValue('period_p50_ms', '%.2f' % (1.0e3*summary['period_p50'])),
+                         KeyValue('period_p99_ms', '%.2f' % (1.0e3*summary['period_p99'])),
+                         KeyValue('period_max_ms', '%.2f' % (1.0e3*summary['period_max'])),
+                         KeyValue('compute_mean_us', '%.1f' % (1.0e6*summary['compute_mean'])),
+                         KeyValue('compute_p50_us', '%.0f' % (1.0e6*summary['compute_p50'])),
+                         KeyValue('compute_p99_us', '%.0f' % (1.0e6*summary['compute_p99'])),
+                         KeyValue('compute_max_us', '%.0f' % (1.0e6*summary['compute_max'])),
+                         KeyValue('max_latency_ms', '%.2f' % (1.0e3*summary['max_latency'])),
+                         KeyValue('recent_max_latency_ms', '%.2f' % (1.0e3*summary['recent_max_latency'])),
+                         KeyValue('skipped_ticks', str(summary['skipped'])),
+                         KeyValue('overruns', str(summary['overruns'])),
+                         KeyValue('bad_dt', str(summary['bad_dt']))]
+        diagnostics_msg.status.append(status)
+
+        self.loop_timing_pub.publish(diagnostics_msg)
 
-        # convert quaternion to RPY
-        quaternion = (
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w)
 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
-        self.phi = euler[0]
-        self.theta = euler[1]
-        self.psi = euler[2]
+    def state_callback(self, msg):
+
+        # convert quaternion to RPY, once per estimate
+        orientation = msg.pose.pose.orientation
+        phi, theta, psi = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
-        self.p = msg.twist.twist.angular.x
-        self.q = msg.twist.twist.angular.y
-        self.r = msg.twist.twist.angular.z
+        # this should already be coming in NED. The whole estimate goes into the snapshot at once,
+        # so the timer never sees part of one estimate and part of the next
+        position = msg.pose.pose.position
+        linear = msg.twist.twist.linear
+        angular = msg.twist.twist.angular
+        self.state.write(msg.header.stamp.to_sec(), position.x, position.y, position.z, phi, theta, psi,
+                         linear.x, linear.y, linear.z, angular.x, angular.y, angular.z)
 
 
     def is_flying_callback(self, msg):
@@ -229,6 +242,7 @@ class Controller(object):
             self.xc_pd = msg.F
             self.xc_psi = msg.z
             self.control_mode = mode
+            self.control_loop = self.control_loops[mode]
 
         elif mode == Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE:
             self.xc_u = msg.x
@@ -236,6 +250,7 @@ class Controller(object):
             self.xc_pd = msg.F
             self.xc_r = msg.z
             self.control_mode = mode
+            self.control_loop = self.control_loops[mode]
 
         elif mode == Command.MODE_XACC_YACC_YAWRATE_AZ:
             self.xc_ax = msg.x
@@ -243,6 +258,7 @@ class Controller(object):
             self.xc_az = msg.F
             self.xc_r = msg.z
             self.control_mode = mode
+            self.control_loop = self.control_loops[mode]
 
         elif mode == Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE:
             self.xc_phi = msg.x
@@ -250,6 +266,7 @@ class Controller(object):
             self.xc_throttle = msg.F
             self.xc_r = msg.z
             self.control_mode = mode
+            self.control_loop = self.control_loops[mode]
 
         else:
             print('roscopter/controller: Unhandled command message of type {}'.format(mode))
@@ -257,49 +274,16 @@ class Controller(object):
 
     def reconfigure_callback(self, config, level):
 
-        tau = config.tau
-        P = config.u_P
-        I = config.u_I
-        D = config.u_D
-        self.PID_u.setGains(P, I, D, tau)
-
-        P = config.v_P
-        I = config.v_I
-        D = config.v_D
-        self.PID_v.setGains(P, I, D, tau)
-
-        P = config.w_P
-        I = config.w_I
-        D = config.w_D
-        self.PID_w.setGains(P, I, D, tau)
-
-        P = config.x_P
-        I = config.x_I
-        D = config.x_D
-        self.PID_x.setGains(P, I, D, tau)
-
-        P = config.y_P
-        I = config.y_I
-        D = config.y_D
-        self.PID_y.setGains(P, I, D, tau)
-
-        P = config.z_P
-        I = config.z_I
-        D = config.z_D
-        self.PID_z.setGains(P, I, D, tau)
-
-        P = config.psi_P
-        I = config.psi_I
-        D = config.psi_D
-        self.PID_psi.setGains(P, I, D, tau)
-
-        self.max_roll = config.max_roll
-        self.max_pitch = config.max_pitch
-        self.max_yaw_rate = config.max_yaw_rate
-        self.max_throttle = config.max_throttle
-        self.max_u = config.max_u
-        self.max_v = config.max_v
-        self.max_w = config.max_w
+        self.set_gains({'u': (config.u_P, config.u_I, config.u_D),
+                        'v': (config.v_P, config.v_I, config.v_D),
+                        'w': (config.w_P, config.w_I, config.w_D),
+                        'x': (config.x_P, config.x_I, config.x_D),
+                        'y': (config.y_P, config.y_I, config.y_D),
+                        'z': (config.z_P, config.z_I, config.z_D),
+                        'psi': (config.psi_P, config.psi_I, config.psi_D)}, config.tau)
+
+        self.set_limits(config.max_roll, config.max_pitch, config.max_yaw_rate, config.max_throttle,
+                        config.max_u, config.max_v, config.max_w)
 
         print('roscopter/controller: new gains')
 
@@ -308,114 +292,6 @@ class Controller(object):
         return config
 
 
-    def compute_control(self, dt):
-
-        if dt <= 0.0000001:  # messes up derivative calculation in PID controllers
-            return
-
-        mode_flag = self.control_mode
-
-        if mode_flag == Command.MODE_XPOS_YPOS_YAW_ALTITUDE:
-
-            # figure out desired velocities (in inertial frame)
-            # by running the position controllers
-            pndot_c = self.PID_x.computePID(self.xc_pn, self.pn, dt)
-            pedot_c = self.PID_y.computePID(self.xc_pe, self.pe, dt)
-
-            # calculate desired yaw rate
-            # first, determine the shortest direction to the commanded psi
-            if abs(self.xc_psi + 2.0*np.pi - self.psi) < abs(self.xc_psi - self.psi):
-                self.xc_psi += 2.0 * np.pi
-            elif abs(self.xc_psi - 2.0*np.pi - self.psi) < abs(self.xc_psi - self.psi):
-                self.xc_psi -= 2.0 * np.pi
-
-            self.xc_r = self.saturate(self.PID_psi.computePID(self.xc_psi, self.psi, dt), self.max_yaw_rate, -self.max_yaw_rate)
-
-            # rotate into body frame
-            # TODO: include pitch and role in this mapping
-            self.xc_u = self.saturate(pndot_c * np.cos(self.psi) + pedot_c * np.sin(self.psi), self.max_u, -self.max_u)
-            self.xc_v = self.saturate(-pndot_c * np.sin(self.psi) + pedot_c * np.cos(self.psi), self.max_v, -self.max_v)
-
-            mode_flag = Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE
-
-        if mode_flag == Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE:
-
-            max_ax = np.sin(np.arccos(self.thrust_eq))
-            max_ay = np.sin(np.arccos(self.thrust_eq))
-            self.xc_ax = self.saturate(self.PID_u.computePID(self.xc_u, self.u, dt) + self.drag_constant*self.u / (9.80665 * self.mass), max_ax, -max_ax)
-            self.xc_ay = self.saturate(self.PID_v.computePID(self.xc_v, self.v, dt) + self.drag_constant*self.v / (9.80665 * self.mass), max_ay, -max_ay)
-
-            # nested loop for altitude
-            pddot = -np.sin(self.theta) * self.u + np.sin(self.phi)*np.cos(self.theta)*self.v + np.cos(self.phi)*np.cos(self.theta)*self.w
-
-            # check to see if IBVS is active
-            if self.ibvs_active:
-                pddot_c = self.saturate(self.xc_pd, self.max_w, -self.max_w)  # this term should be coming in as w and here we are assuming w is close enough to pddot
-            else:
-                pddot_c = self.saturate(self.PID_w.computePID(self.xc_pd, self.pd, dt, pddot), self.max_w, -self.max_w)
-
-            self.xc_az = self.PID_z.computePID(pddot_c, pddot, dt)
-            # print statement if you want
-            mode_flag = Command.MODE_XACC_YACC_YAWRATE_AZ
-
-        if mode_flag == Command.MODE_XACC_YACC_YAWRATE_AZ:
-
-            # Model inversion (m[ax;ay;az] = m[0;0;g] + R'[0;0;-T]
-            # This model tends to pop the MAV up in the air when a large change
-            # in control is commanded as the MAV rotates to it's commanded attitude while also ramping up throttle.
-            # It works quite well, but it is a little oversimplified.
-            total_acc_c = np.sqrt((1.0-self.xc_az)*(1.0-self.xc_az) + self.xc_ax*self.xc_ax + self.xc_ay*self.xc_ay)  #(in g's)
-            # print('roscopter/controller: total_acc = {}'.format(total_acc_c))
-            if total_acc_c > 0.001:
-                self.xc_phi = np.arcsin(self.xc_ay / total_acc_c)
-                self.xc_theta = -1.0*np.arcsin(self.xc_ax / total_acc_c)
-            else:
-                self.xc_phi = 0.0
-                self.xc_theta = 0.0
-
-            # calculate actual throttle (saturate az to be falling at 1 g)
-            max_az = 1.0 / self.thrust_eq
-            self.xc_az = self.saturate(self.xc_az, 1.0, -max_az)
-            total_acc_c = np.sqrt((1.0-self.xc_az)*(1.0-self.xc_az) + self.xc_ax*self.xc_ax + self.xc_ay*self.xc_ay)  #(in g's)
-            self.xc_throttle = total_acc_c*self.thrust_eq  # calculate the total thrust in normalized units
-
-            # print '\nxc_az:', self.xc_az, '\nmax_az:', max_az, '\ntotal_acc_c:', total_acc_c, '\nthrottle:', self.xc_throttle
-
-            mode_flag = Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE
-
-        if mode_flag == Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE:
-
-            # pack up and send the command
-            self.command.mode = Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE
-            self.command.F = self.saturate(self.xc_throttle, self.max_throttle, 0.0)
-            self.command.x = self.saturate(self.xc_phi, self.max_roll, -self.max_roll)
-            self.command.y = self.saturate(self.xc_theta, self.max_pitch, -self.max_pitch)
-            self.command.z = self.saturate(self.xc_r, self.max_yaw_rate, -self.max_yaw_rate)
-
-
-    def reset_integrators(self):
-
-        self.PID_u.clearIntegrator()
-        self.PID_v.clearIntegrator()
-        self.PID_w.clearIntegrator()
-        self.PID_x.clearIntegrator()
-        self.PID_y.clearIntegrator()
-        self.PID_z.clearIntegrator()
-        self.PID_psi.clearIntegrator()
-
-    
-    def saturate(self, x, maximum, minimum):
-        if(x > maximum):
-            rVal = maximum
-        elif(x < minimum):
-            rVal = minimum
-        else:
-            rVal = x
-
-        return rVal
-
-
-
 
 def main():
     # initialize a node
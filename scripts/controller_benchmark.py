@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+
+## Deadline benchmark for the 200 Hz cascaded controller (controller.py /
+## controller_core.py). Replays a synthetic flight (a position-hold leg, an IBVS
+## leg in velocity mode with ibvs_active, then acceleration and attitude
+## commands) through the original compute_control (np.sin(np.arccos(...)) twice
+## per tick, np.sqrt/np.arcsin/np.cos on Python floats, the drag term
+## recomputed every tick) and through ControllerCore. Both see exactly the same
+## state and commands, so it also reports the largest difference between their
+## outputs.
+##
+## Every tick is timed on its own and the distribution is compared with the
+## 5 ms period of update_timer. Run it on the flight computer itself to get the
+## real headroom (it only needs numpy). On a desktop, odroid_factor scales the
+## timings to an estimate for an Odroid-class ARM board; the default of 8 is a
+## rough CPython slowdown of a Cortex-A15 core against a current x86 core. The
+## max is the benchmark process being preempted, which doesn't scale with the
+## CPU, so the estimate only scales the percentiles.
+##
+## Last, the loop instrumentation (loop_monitor.py): the same flight's dt and
+## compute times, with some dropped ticks, late wake-ups and dt <= 0 mixed in,
+## go through a LoopMonitor. It reports what the two calls per tick cost against
+## the period and checks the monitor's percentiles and counters against the
+## exact values.
+##
+## usage: ./controller_benchmark.py [ticks] [odroid_factor]
+
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+from simple_pid import PID
+from controller_core import ControllerCore, CONTROL_LOOPS
+from loop_monitor import LoopMonitor
+
+RATE = 200.0
+
+GAINS = {'u': (0.2, 0.0, 0.01),
+         'v': (0.2, 0.0, 0.01),
+         'w': (3.0, 0.05, 0.5),
+         'x': (0.5, 0.01, 0.1),
+         'y': (0.5, 0.01, 0.1),
+         'z': (1.0, 0.1, 0.4),
+         'psi': (0.5, 0.0, 0.0)}
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+
+class LegacyController(ControllerCore):
+
+    # compute_control the way controller.py used to do it (same state and output attributes, one SimplePID per loop)
+    def __init__(self, gains, tau=0.04):
+
+        ControllerCore.__init__(self, gains, tau)
+
+        self.PID_u = PID(gains['u'][0], gains['u'][1], gains['u'][2], None, None, tau)
+        self.PID_v = PID(gains['v'][0], gains['v'][1], gains['v'][2], None, None, tau)
+        self.PID_w = PID(gains['w'][0], gains['w'][1], gains['w'][2], None, None, tau)
+        self.PID_x = PID(gains['x'][0], gains['x'][1], gains['x'][2], None, None, tau)
+        self.PID_y = PID(gains['y'][0], gains['y'][1], gains['y'][2], None, None, tau)
+        self.PID_z = PID(gains['z'][0], gains['z'][1], gains['z'][2], None, None, tau)
+        self.PID_psi = PID(gains['psi'][0], gains['psi'][1], gains['psi'][2], None, None, tau)
+
+
+    def compute_control(self, dt):
+
+        if dt <= 0.0000001:  # messes up derivative calculation in PID controllers
+            return False
+
+        mode_flag = self.control_loop
+
+        if mode_flag == 'position':
+
+            pndot_c = self.PID_x.computePID(self.xc_pn, self.pn, dt)
+            pedot_c = self.PID_y.computePID(self.xc_pe, self.pe, dt)
+
+            if abs(self.xc_psi + 2.0*np.pi - self.psi) < abs(self.xc_psi - self.psi):
+                self.xc_psi += 2.0 * np.pi
+            elif abs(self.xc_psi - 2.0*np.pi - self.psi) < abs(self.xc_psi - self.psi):
+                self.xc_psi -= 2.0 * np.pi
+
+            self.xc_r = self.saturate(self.PID_psi.computePID(self.xc_psi, self.psi, dt), self.max_yaw_rate, -self.max_yaw_rate)
+
+            self.xc_u = self.saturate(pndot_c * np.cos(self.psi) + pedot_c * np.sin(self.psi), self.max_u, -self.max_u)
+            self.xc_v = self.saturate(-pndot_c * np.sin(self.psi) + pedot_c * np.cos(self.psi), self.max_v, -self.max_v)
+
+            mode_flag = 'velocity'
+
+        if mode_flag == 'velocity':
+
+            max_ax = np.sin(np.arccos(self.thrust_eq))
+            max_ay = np.sin(np.arccos(self.thrust_eq))
+            self.xc_ax = self.saturate(self.PID_u.computePID(self.xc_u, self.u, dt) + self.drag_constant*self.u / (9.80665 * self.mass), max_ax, -max_ax)
+            self.xc_ay = self.saturate(self.PID_v.computePID(self.xc_v, self.v, dt) + self.drag_constant*self.v / (9.80665 * self.mass), max_ay, -max_ay)
+
+            pddot = -np.sin(self.theta) * self.u + np.sin(self.phi)*np.cos(self.theta)*self.v + np.cos(self.phi)*np.cos(self.theta)*self.w
+
+            if self.ibvs_active:
+                pddot_c = self.saturate(self.xc_pd, self.max_w, -self.max_w)
+            else:
+                pddot_c = self.saturate(self.PID_w.computePID(self.xc_pd, self.pd, dt, pddot), self.max_w, -self.max_w)
+
+            self.xc_az = self.PID_z.computePID(pddot_c, pddot, dt)
+            mode_flag = 'acceleration'
+
+        if mode_flag == 'acceleration':
+
+            total_acc_c = np.sqrt((1.0-self.xc_az)*(1.0-self.xc_az) + self.xc_ax*self.xc_ax + self.xc_ay*self.xc_ay)
+            if total_acc_c > 0.001:
+                self.xc_phi = np.arcsin(self.xc_ay / total_acc_c)
+                self.xc_theta = -1.0*np.arcsin(self.xc_ax / total_acc_c)
+            else:
+                self.xc_phi = 0.0
+                self.xc_theta = 0.0
+
+            max_az = 1.0 / self.thrust_eq
+            self.xc_az = self.saturate(self.xc_az, 1.0, -max_az)
+            total_acc_c = np.sqrt((1.0-self.xc_az)*(1.0-self.xc_az) + self.xc_ax*self.xc_ax + self.xc_ay*self.xc_ay)
+            self.xc_throttle = total_acc_c*self.thrust_eq
+
+            mode_flag = 'attitude'
+
+        if mode_flag == 'attitude':
+
+            self.throttle_c = self.saturate(self.xc_throttle, self.max_throttle, 0.0)
+            self.phi_c = self.saturate(self.xc_phi, self.max_roll, -self.max_roll)
+            self.theta_c = self.saturate(self.xc_theta, self.max_pitch, -self.max_pitch)
+            self.r_c = self.saturate(self.xc_r, self.max_yaw_rate, -self.max_yaw_rate)
+            return True
+
+        return False
+
+
+    def saturate(self, x, maximum, minimum):
+        if(x > maximum):
+            rVal = maximum
+        elif(x < minimum):
+            rVal = minimum
+        else:
+            rVal = x
+
+        return rVal
+
+
+class Flight(object):
+
+    # precomputed state, commands and timer jitter, as plain floats
+    def __init__(self, ticks, seed=0):
+
+        rng = np.random.RandomState(seed)
+        t = np.arange(ticks)/RATE
+        self.dt = (1.0/RATE + rng.normal(0.0, 0.0003, ticks)).tolist()
+
+        self.pn = (3.0*np.sin(0.1*t)).tolist()
+        self.pe = (2.0*np.cos(0.13*t)).tolist()
+        self.pd = (-10.0 + 0.5*np.sin(0.2*t)).tolist()
+        self.phi = (0.08*np.sin(1.3*t) + rng.normal(0.0, 0.005, ticks)).tolist()
+        self.theta = (0.08*np.cos(1.1*t) + rng.normal(0.0, 0.005, ticks)).tolist()
+        self.psi = (np.pi*np.sin(0.05*t)).tolist()
+        self.uvw = (0.5*rng.normal(0.0, 1.0, (ticks, 3))).tolist()
+
+        # 40% position hold, 40% IBVS velocity commands, then acceleration and attitude commands
+        self.loops = []
+        for k in range(ticks):
+            f = float(k)/ticks
+            if f < 0.4:
+                self.loops.append('position')
+            elif f < 0.8:
+                self.loops.append('velocity')
+            elif f < 0.9:
+                self.loops.append('acceleration')
+            else:
+                self.loops.append('attitude')
+        self.commands = rng.uniform(-1.0, 1.0, (ticks, 4)).tolist()
+
+
+def fly(controller_class, flight):
+
+    controller = controller_class(GAINS)
+    ticks = len(flight.dt)
+    times = [0.0]*ticks
+    outputs = []
+
+    for k in range(ticks):
+        # what state_callback and cmd_callback hand over between ticks
+        c = controller
+        c.pn, c.pe, c.pd = flight.pn[k], flight.pe[k], flight.pd[k]
+        c.phi, c.theta, c.psi = flight.phi[k], flight.theta[k], flight.psi[k]
+        c.u, c.v, c.w = flight.uvw[k]
+        loop = flight.loops[k]
+        if loop != c.control_loop:
+            c.control_loop = loop
+            c.ibvs_active = loop == 'velocity'
+        x, y, F, z = flight.commands[k]
+        if loop == 'position':
+            c.xc_pn, c.xc_pe, c.xc_pd, c.xc_psi = 3.0*x, 3.0*y, -10.0 + F, z
+        elif loop == 'velocity':
+            c.xc_u, c.xc_v, c.xc_pd, c.xc_r = x, y, 0.3*F, 0.5*z
+        elif loop == 'acceleration':
+            c.xc_ax, c.xc_ay, c.xc_az, c.xc_r = 0.2*x, 0.2*y, 0.2*F, 0.5*z
+        else:
+            c.xc_phi, c.xc_theta, c.xc_throttle, c.xc_r = 0.1*x, 0.1*y, 0.5 + 0.1*F, 0.5*z
+
+        start = timer()
+        c.compute_control(flight.dt[k])
+        times[k] = timer() - start
+
+        outputs.append((c.phi_c, c.theta_c, c.r_c, c.throttle_c))
+
+    return np.array(times), outputs
+
+
+def report(name, times, factor):
+
+    period = 1.0/RATE
+    p50, p99, p999 = np.percentile(times, [50.0, 99.0, 99.9])
+    print('  %-8s p50 %6.2f us  p99 %6.2f us  p99.9 %6.2f us  max %7.2f us  (%.3f%% of the %.0f ms period at p99)' % (
+        name, 1.0e6*p50, 1.0e6*p99, 1.0e6*p999, 1.0e6*times.max(), 100.0*p99/period, 1.0e3*period))
+    print('  %-8s %d ticks over the period here, estimated on an Odroid (x%.1f): p99 %.1f us, p99.9 %.1f us, headroom %.0fx at p99.9' % (
+        '', int(np.sum(times > period)), factor, 1.0e6*factor*p99, 1.0e6*factor*p999, period/(factor*p999)))
+
+
+def check_monitor(flight, compute_times, repeats=5):
+
+    # the dt and compute time of every tick, with timer trouble mixed in
+    rng = np.random.RandomState(3)
+    ticks = len(flight.dt)
+    dt = np.array(flight.dt)
+    dropped = rng.rand(ticks) < 0.002
+    dt[dropped] += (1.0/RATE)*rng.randint(1, 4, ticks)[dropped]
+    dt[rng.rand(ticks) < 0.0005] = 0.0
+    wake = np.abs(rng.normal(0.0, 0.0002, ticks))
+    wake[rng.rand(ticks) < 0.001] += 1.0/RATE
+    dt_list = dt.tolist()
+    wake_list = wake.tolist()
+    compute_list = compute_times.tolist()
+
+    # best of a few runs of just the two monitor calls per tick
+    overhead = float('inf')
+    for repeat in range(repeats):
+        monitor = LoopMonitor(RATE)
+        add_tick = monitor.add_tick
+        add_compute = monitor.add_compute
+        start = timer()
+        for k in range(ticks):
+            add_tick(dt_list[k], wake_list[k])
+            if dt_list[k] > 0.0:
+                add_compute(compute_list[k])
+        overhead = min(overhead, (timer() - start)/ticks)
+
+    start = timer()
+    summary = monitor.report()
+    report_time = timer() - start
+
+    valid = dt > 0.0
+    latency = (wake + compute_times)[valid]
+    print('loop instrumentation: %.3f us per tick, %.4f%% of the %.0f ms period (%.1f%% of the compute_control p50), report %.0f us at %.0f Hz' % (
+        1.0e6*overhead, 100.0*overhead*RATE, 1.0e3/RATE, 100.0*overhead/np.percentile(compute_times, 50.0), 1.0e6*report_time, 1.0))
+    print('  period  p50 %.2f/%.2f ms, p99 %.2f/%.2f ms (monitor/exact)' % (
+        1.0e3*summary['period_p50'], 1.0e3*np.percentile(dt[valid], 50.0), 1.0e3*summary['period_p99'], 1.0e3*np.percentile(dt[valid], 99.0)))
+    print('  compute p50 %.1f/%.1f us, p99 %.1f/%.1f us' % (
+        1.0e6*summary['compute_p50'], 1.0e6*np.percentile(compute_times[valid], 50.0), 1.0e6*summary['compute_p99'], 1.0e6*np.percentile(compute_times[valid], 99.0)))
+    print('  skipped ticks %d/%d, overruns %d/%d, dt <= 0 %d/%d, max latency %.3f/%.3f ms' % (
+        summary['skipped'], int(np.sum(np.round(dt[valid]*RATE)[dt[valid] > 1.5/RATE] - 1)),
+        summary['overruns'], int(np.sum(latency > 1.0/RATE)), summary['bad_dt'], int(np.sum(~valid)),
+        1.0e3*summary['max_latency'], 1.0e3*latency.max()))
+
+
+def main():
+
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    factor = float(sys.argv[2]) if len(sys.argv) > 2 else 8.0
+    flight = Flight(ticks)
+
+    print('compute_control, %d ticks at %.0f Hz (%.0f s of flight)' % (ticks, RATE, ticks/RATE))
+
+    # warm up once, then keep the faster of two runs
+    results = {}
+    for name, controller_class in (('legacy', LegacyController), ('core', ControllerCore)):
+        fly(controller_class, Flight(2000))
+        runs = [fly(controller_class, flight) for i in range(2)]
+        results[name] = min(runs, key=lambda run: np.percentile(run[0], 50.0))
+        report(name, results[name][0], factor)
+
+    print('  speedup p50 %.2fx, p99 %.2fx' % (np.percentile(results['legacy'][0], 50.0)/np.percentile(results['core'][0], 50.0),
+                                              np.percentile(results['legacy'][0], 99.0)/np.percentile(results['core'][0], 99.0)))
+
+    legacy = np.array(results['legacy'][1])
+    core = np.array(results['core'][1])
+    print('  largest output difference: roll %.3g, pitch %.3g, yaw rate %.3g, throttle %.3g' % tuple(np.max(np.abs(legacy - core), axis=0)))
+
+    # time per tick of each cascade entry point
+    loops = np.array(flight.loops)
+    for loop in CONTROL_LOOPS:
+        mask = loops == loop
+        print('  %-12s legacy p50 %5.2f us, core p50 %5.2f us' % (
+            loop, 1.0e6*np.percentile(results['legacy'][0][mask], 50.0), 1.0e6*np.percentile(results['core'][0][mask], 50.0)))
+
+    check_monitor(flight, results['core'][0])
+
+
+if __name__ == '__main__':
+    main()
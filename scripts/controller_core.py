@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+## ROS-free core of the cascaded controller in controller.py, following the ROS
+## Copter controller structure:
+##
+##   position (x, y, psi PIDs) -> velocity (u, v PIDs, w/z PIDs for altitude)
+##   -> acceleration (model inversion) -> roll, pitch, yaw rate, throttle
+##
+## control_loop says where the cascade starts ('position', 'velocity',
+## 'acceleration' or 'attitude'), controller.py maps the rosflight Command modes
+## to it. compute_control() runs at 200 Hz, so it sticks to math-module scalar
+## ops and everything that only depends on the gains, limits or airframe is
+## folded once in fold_constants() (called whenever those change) instead of
+## every tick:
+##   thrust_eq = g*mass/max_thrust    hover throttle
+##   max_a = sin(acos(thrust_eq))     largest horizontal acceleration (g)
+##   drag_gain = mu/(g*mass)          drag feed-forward per m/s
+##   max_az = 1/thrust_eq             largest downward acceleration (g)
+## The result goes into phi_c, theta_c, r_c and throttle_c (saturated).
+##
+## The seven PID loops live in one PIDBank (pid_bank.py), ordered so every
+## stage of the cascade is a contiguous slice and runs in one update():
+##   x, y, psi (position) | u, v, w (velocity, w is the altitude loop) | z (vertical acceleration)
+
+import math
+from pid_bank import PIDBank
+
+GRAVITY = 9.80665
+TWO_PI = 2.0*math.pi
+
+# where compute_control starts the cascade
+CONTROL_LOOPS = ('position', 'velocity', 'acceleration', 'attitude')
+
+# PID loops in bank order and the slices of the cascade stages
+PID_LOOPS = ('x', 'y', 'psi', 'u', 'v', 'w', 'z')
+POSITION_PIDS = slice(0, 3)
+VELOCITY_PIDS = slice(3, 6)
+HORIZONTAL_VELOCITY_PIDS = slice(3, 5)
+ACCELERATION_PIDS = slice(6, 7)
+
+# the altitude loop uses the measured pddot as its derivative, the others their dirty derivative
+NAN = float('nan')
+
+
+def saturate(x, maximum, minimum):
+
+    if x > maximum:
+        return maximum
+    elif x < minimum:
+        return minimum
+    else:
+        return x
+
+
+class ControllerCore(object):
+
+    def __init__(self, gains, tau=0.04, mass=3.0, max_thrust=60.0, drag_constant=0.1,
+                 max_roll=0.15, max_pitch=0.15, max_yaw_rate=math.radians(45.0), max_throttle=1.0,
+                 max_u=1.0, max_v=1.0, max_w=1.0):
+
+        # gains: (P, I, D) for each of 'u', 'v', 'w', 'x', 'y', 'z' and 'psi'
+        self.pid = PIDBank(PID_LOOPS)
+        self.set_pid_gains(gains, tau)
+
+        # quadcopter params
+        self.mass = mass
+        self.max_thrust = max_thrust
+        self.drag_constant = drag_constant
+
+        # saturation values
+        self.max_roll = max_roll
+        self.max_pitch = max_pitch
+        self.max_yaw_rate = max_yaw_rate
+        self.max_throttle = max_throttle
+        self.max_u = max_u
+        self.max_v = max_v
+        self.max_w = max_w
+
+        # state (NED position, Euler angles, body velocities and rates)
+        self.pn = 0.0
+        self.pe = 0.0
+        self.pd = 0.0
+
+        self.phi = 0.0
+        self.theta = 0.0
+        self.psi = 0.0
+
+        self.u = 0.0
+        self.v = 0.0
+        self.w = 0.0
+
+        self.p = 0.0
+        self.q = 0.0
+        self.r = 0.0
+
+        # commands, the outer loops fill in the ones below them
+        self.xc_pn = 0.0
+        self.xc_pe = 0.0
+        self.xc_pd = 0.0
+
+        self.xc_phi = 0.0
+        self.xc_theta = 0.0
+        self.xc_psi = 0.0
+
+        self.xc_u = 0.0
+        self.xc_v = 0.0
+        self.xc_r = 0.0
+
+        self.xc_ax = 0.0
+        self.xc_ay = 0.0
+        self.xc_az = 0.0
+
+        self.xc_throttle = 0.0
+
+        # IBVS sends the altitude channel as a vertical velocity
+        self.ibvs_active = False
+        self.control_loop = 'position'
+
+        # saturated output
+        self.phi_c = 0.0
+        self.theta_c = 0.0
+        self.r_c = 0.0
+        self.throttle_c = 0.0
+
+        self.fold_constants()
+
+
+    def fold_constants(self):
+
+        # everything compute_control needs that doesn't change from tick to tick
+        self.thrust_eq = (GRAVITY*self.mass)/self.max_thrust
+        self.max_a = math.sqrt(1.0 - self.thrust_eq*self.thrust_eq) if self.thrust_eq < 1.0 else 0.0
+        self.drag_gain = self.drag_constant/(GRAVITY*self.mass)
+        self.max_az = 1.0/self.thrust_eq
+
+
+    def set_pid_gains(self, gains, tau):
+
+        # all seven loops in one array assignment
+        self.pid.set_gains([gains[name][0] for name in PID_LOOPS],
+                           [gains[name][1] for name in PID_LOOPS],
+                           [gains[name][2] for name in PID_LOOPS], tau)
+
+
+    def set_gains(self, gains, tau):
+
+        self.set_pid_gains(gains, tau)
+        self.fold_constants()
+
+
+    def set_limits(self, max_roll, max_pitch, max_yaw_rate, max_throttle, max_u, max_v, max_w):
+
+        self.max_roll = max_roll
+        self.max_pitch = max_pitch
+        self.max_yaw_rate = max_yaw_rate
+        self.max_throttle = max_throttle
+        self.max_u = max_u
+        self.max_v = max_v
+        self.max_w = max_w
+        self.fold_constants()
+
+
+    def set_dynamics(self, mass, max_thrust, drag_constant):
+
+        self.mass = mass
+        self.max_thrust = max_thrust
+        self.drag_constant = drag_constant
+        self.fold_constants()
+
+
+    def compute_control(self, dt):
+
+        # one tick of the cascade, returns True if it updated the output
+        if dt <= 0.0000001:  # messes up derivative calculation in PID controllers
+            return False
+
+        loop = self.control_loop
+
+        if loop == 'position':
+
+            # calculate desired yaw rate
+            # first, determine the shortest direction to the commanded psi
+            psi = self.psi
+            if abs(self.xc_psi + TWO_PI - psi) < abs(self.xc_psi - psi):
+                self.xc_psi += TWO_PI
+            elif abs(self.xc_psi - TWO_PI - psi) < abs(self.xc_psi - psi):
+                self.xc_psi -= TWO_PI
+
+            # figure out desired velocities (in inertial frame) and yaw rate
+            # by running the position controllers
+            pndot_c, pedot_c, r_c = self.pid.update(POSITION_PIDS, (self.xc_pn, self.xc_pe, self.xc_psi), (self.pn, self.pe, psi), dt)
+
+            self.xc_r = saturate(r_c, self.max_yaw_rate, -self.max_yaw_rate)
+
+            # rotate into body frame
+            # TODO: include pitch and role in this mapping
+            cpsi = math.cos(psi)
+            spsi = math.sin(psi)
+            self.xc_u = saturate(pndot_c*cpsi + pedot_c*spsi, self.max_u, -self.max_u)
+            self.xc_v = saturate(-pndot_c*spsi + pedot_c*cpsi, self.max_v, -self.max_v)
+
+            loop = 'velocity'
+
+        if loop == 'velocity':
+
+            # nested loop for altitude
+            sphi = math.sin(self.phi)
+            cphi = math.cos(self.phi)
+            stheta = math.sin(self.theta)
+            ctheta = math.cos(self.theta)
+            pddot = -stheta*self.u + sphi*ctheta*self.v + cphi*ctheta*self.w
+
+            # u and v loops, and the altitude loop with them unless IBVS is active
+            if self.ibvs_active:
+                ax_c, ay_c = self.pid.update(HORIZONTAL_VELOCITY_PIDS, (self.xc_u, self.xc_v), (self.u, self.v), dt)
+                pddot_c = saturate(self.xc_pd, self.max_w, -self.max_w)  # this term should be coming in as w and here we are assuming w is close enough to pddot
+            else:
+                ax_c, ay_c, pddot_c = self.pid.update(VELOCITY_PIDS, (self.xc_u, self.xc_v, self.xc_pd), (self.u, self.v, self.pd), dt, (NAN, NAN, pddot))
+                pddot_c = saturate(pddot_c, self.max_w, -self.max_w)
+
+            max_a = self.max_a
+            self.xc_ax = saturate(ax_c + self.drag_gain*self.u, max_a, -max_a)
+            self.xc_ay = saturate(ay_c + self.drag_gain*self.v, max_a, -max_a)
+
+            self.xc_az = self.pid.update(ACCELERATION_PIDS, (pddot_c,), (pddot,), dt)[0]
+
+            loop = 'acceleration'
+
+        if loop == 'acceleration':
+
+            # Model inversion (m[ax;ay;az] = m[0;0;g] + R'[0;0;-T]
+            # This model tends to pop the MAV up in the air when a large change
+            # in control is commanded as the MAV rotates to it's commanded attitude while also ramping up throttle.
+            # It works quite well, but it is a little oversimplified.
+            ax = self.xc_ax
+            ay = self.xc_ay
+            az = self.xc_az
+            horizontal = ax*ax + ay*ay
+            total_acc_c = math.sqrt((1.0 - az)*(1.0 - az) + horizontal)  # (in g's)
+            if total_acc_c > 0.001:
+                self.xc_phi = math.asin(ay/total_acc_c)
+                self.xc_theta = -math.asin(ax/total_acc_c)
+            else:
+                self.xc_phi = 0.0
+                self.xc_theta = 0.0
+
+            # calculate actual throttle (saturate az to be falling at 1 g)
+            az_sat = saturate(az, 1.0, -self.max_az)
+            if az_sat != az:
+                total_acc_c = math.sqrt((1.0 - az_sat)*(1.0 - az_sat) + horizontal)
+            self.xc_az = az_sat
+            self.xc_throttle = total_acc_c*self.thrust_eq  # calculate the total thrust in normalized units
+
+            loop = 'attitude'
+
+        if loop == 'attitude':
+
+            self.throttle_c = saturate(self.xc_throttle, self.max_throttle, 0.0)
+            self.phi_c = saturate(self.xc_phi, self.max_roll, -self.max_roll)
+            self.theta_c = saturate(self.xc_theta, self.max_pitch, -self.max_pitch)
+            self.r_c = saturate(self.xc_r, self.max_yaw_rate, -self.max_yaw_rate)
+            return True
+
+        return False
+
+
+    def reset_integrators(self):
+
+        self.pid.clear_integrators()
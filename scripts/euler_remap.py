@@ -1,96 +1,148 @@
 #! /usr/bin/env python
 
-import numpy as np
+## Roll/pitch remap for the HEADING_CORRECTION state (see heading_remap.py).
+## Solves one remap with the closed form and with the original fsolve, then
+## sweeps a whole roll/pitch/heading grid with the batched closed form and
+## checks it: the body z-axis has to come out the same at the new heading, and
+## a random subset of the grid is solved with fsolve as well.
+##
+## usage: ./euler_remap.py [grid_points_per_axis] [num_fsolve_checks]
+
+import sys
 import time
+import numpy as np
 from scipy.optimize import fsolve
+from heading_remap import body_z_axis, body_z_axis_batch, remap_euler, remap_euler_batch
+
+# angles are wrapped before comparing, differences below this (rad) count as the same solution
+CHECK_TOLERANCE = 1.0e-6
+
 
 class EulerRemap(object):
 
-    def __init__(self):
+    def __init__(self, phi, theta, psi):
 
-    	# Original Euler Angles
-    	self.phi = np.radians(15.0)
-    	self.theta = np.radians(-10.0)
-    	self.psi = np.radians(45.0)
+        # Original Euler Angles
+        self.phi = phi
+        self.theta = theta
+        self.psi = psi
 
-        # Desired Heading angle
-    	# self.psi_des = np.radians(-45.0)
+        # The z-axis unit vector resulting from the euler angles.
+        self.z_unit = np.array(body_z_axis(phi, theta, psi)).reshape(3,1)
 
-    	# Pre-evaluate sines and cosines
-    	sphi = np.sin(self.phi)
-    	cphi = np.cos(self.phi)
 
-    	stheta = np.sin(self.theta)
-    	ctheta = np.cos(self.theta)
+    def find_remaped_euler(self, euler_angles, psi_des):
 
-    	spsi = np.sin(self.psi)
-    	cpsi = np.cos(self.psi)
+        # The equations ibvs_state_machine.py used to solve with fsolve
+        phi = euler_angles[0]
+        theta = euler_angles[1]
+        psi = psi_des
 
-    	# The z-axis unit vector resulting from the euler angles. 
-    	self.z_unit = np.array([[cphi*stheta*cpsi + sphi*spsi],
-    		                    [cphi*stheta*spsi - sphi*cpsi],
-    		                    [cphi*ctheta]])
+        # Pre-evaluate sines and cosines
+        sphi = np.sin(phi)
+        cphi = np.cos(phi)
 
-    def find_remaped_euler(self, euler_angles, psi_des):
+        stheta = np.sin(theta)
+        ctheta = np.cos(theta)
 
-    	# print euler_angles
-    	self.psi_des = psi_des
+        spsi = np.sin(psi)
+        cpsi = np.cos(psi)
 
-    	# Euler angles passed in
-    	phi = euler_angles[0]
-    	theta = euler_angles[1]
-    	psi = psi_des
+        vec = np.array([[cphi*stheta*cpsi + sphi*spsi],
+                        [cphi*stheta*spsi - sphi*cpsi],
+                        [cphi*ctheta]])
 
-    	# Pre-evaluate sines and cosines
-    	sphi = np.sin(phi)
-    	cphi = np.cos(phi)
+        F = vec - self.z_unit
 
-    	stheta = np.sin(theta)
-    	ctheta = np.cos(theta)
+        return F.flatten()
 
-    	spsi = np.sin(psi)
-    	cpsi = np.cos(psi)
 
-    	vec = np.array([[cphi*stheta*cpsi + sphi*spsi],
-    		            [cphi*stheta*spsi - sphi*cpsi],
-    		            [cphi*ctheta]])
+    def solve(self, psi_des):
 
-    	F = vec - self.z_unit
+        x = fsolve(self.find_remaped_euler, np.zeros(3), (psi_des))
 
-    	F = F.flatten()
+        return x[0], x[1]
 
-    	return F
 
+def wrap(angle):
 
-def main():
+    return np.arctan2(np.sin(angle), np.cos(angle))
 
-    # create instance of LevelFrameMapper class
-    mapper = EulerRemap()
 
-    then = time.time()
-    x = fsolve(mapper.find_remaped_euler, np.zeros(3), (np.radians(-20.0)))
-    now = time.time()
+def main():
 
-    print "dt: %f" % (now-then)
+    grid_points = 25
+    num_checks = 500
 
-    phi = np.degrees(x[0])
-    theta = np.degrees(x[1])
+    if len(sys.argv) > 1:
+        grid_points = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_checks = int(sys.argv[2])
 
+    # The single example this script used to solve
+    phi = np.radians(15.0)
+    theta = np.radians(-10.0)
+    psi = np.radians(45.0)
+    psi_des = np.radians(-20.0)
+    mapper = EulerRemap(phi, theta, psi)
 
+    then = time.time()
+    phi_fsolve, theta_fsolve = mapper.solve(psi_des)
+    t_fsolve = time.time() - then
 
-    print "Original Euler Angles:"
-    print "Phi: %f" % np.degrees(mapper.phi)
-    print "Theta: %f" % np.degrees(mapper.theta)
-    print "Psi: %f" % np.degrees(mapper.psi)
-    print "\n"
-    print "New Euler Angles:"
-    print "Phi: %f" % phi
-    print "Theta: %f" % theta
-    print "Psi: %f" % np.degrees(mapper.psi_des)
+    then = time.time()
+    phi_closed, theta_closed = remap_euler(phi, theta, psi, psi_des)
+    t_closed = time.time() - then
+
+    print("Original Euler Angles: phi %f  theta %f  psi %f" % (np.degrees(phi), np.degrees(theta), np.degrees(psi)))
+    print("New Euler Angles (psi %f):" % np.degrees(psi_des))
+    print("  fsolve:       phi %f  theta %f  (%.1f us)" % (np.degrees(phi_fsolve), np.degrees(theta_fsolve), 1.0e6*t_fsolve))
+    print("  closed form:  phi %f  theta %f  (%.1f us)" % (np.degrees(phi_closed), np.degrees(theta_closed), 1.0e6*t_closed))
+
+    # Sweep roll and pitch over +/-30 deg and both headings all the way around
+    angles = np.radians(np.linspace(-30.0, 30.0, grid_points))
+    headings = np.radians(np.linspace(-180.0, 180.0, grid_points))
+    phi, theta, psi, psi_des = np.meshgrid(angles, angles, headings, headings, indexing='ij')
+    phi = phi.ravel()
+    theta = theta.ravel()
+    psi = psi.ravel()
+    psi_des = psi_des.ravel()
 
-    
+    then = time.time()
+    phi_new, theta_new = remap_euler_batch(phi, theta, psi, psi_des)
+    t_batch = time.time() - then
+
+    # The body z-axis at the new heading has to match the original one
+    z_old = np.array(body_z_axis_batch(phi, theta, psi))
+    z_new = np.array(body_z_axis_batch(phi_new, theta_new, psi_des))
+    z_error = np.max(np.abs(z_new - z_old))
+
+    print("Grid of %d remaps: batched closed form %.2f ms (%.3f us per remap), max z-axis error %.2e"
+          % (len(phi), 1.0e3*t_batch, 1.0e6*t_batch/len(phi), z_error))
+
+    # fsolve on a random subset
+    np.random.seed(0)
+    max_error = 0.0
+    mismatches = 0
+    t_fsolve = 0.0
+    for i in np.random.choice(len(phi), min(num_checks, len(phi)), replace=False):
+        mapper = EulerRemap(phi[i], theta[i], psi[i])
+
+        then = time.time()
+        phi_fsolve, theta_fsolve = mapper.solve(psi_des[i])
+        t_fsolve += time.time() - then
+
+        # the scalar closed form should agree with the batched one
+        phi_closed, theta_closed = remap_euler(phi[i], theta[i], psi[i], psi_des[i])
+        error = max(abs(wrap(phi_fsolve - phi_new[i])), abs(wrap(theta_fsolve - theta_new[i])),
+                    abs(phi_closed - phi_new[i]), abs(theta_closed - theta_new[i]))
+        max_error = max(max_error, error)
+        if error > CHECK_TOLERANCE:
+            mismatches += 1
+
+    print("fsolve check on %d grid points: max difference %.2e rad, %d over %.0e rad, fsolve %.1f us per remap"
+          % (min(num_checks, len(phi)), max_error, mismatches, CHECK_TOLERANCE, 1.0e6*t_fsolve/min(num_checks, len(phi))))
 
-    # suff here
 
 if __name__ == '__main__':
     main()
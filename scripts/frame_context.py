@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+## Heading geometry shared by the state machine command builders, computed once
+## per state update instead of once per use. update() takes the heading of the
+## copter and only recomputes its sine and cosine when it changes, so a
+## send_commands tick (or an IBVS command forwarded between ticks) pays for the
+## trig at most once. Everything is plain floats: the vectors here have two
+## elements, and numpy's per-call overhead is far bigger than the math.
+##
+##   heading:      cpsi, spsi, and the NE target velocity in the heading-aligned
+##                 frame for the IBVS feed-forward (forward/right for ROScopter,
+##                 right/forward for the ENU-mapped MAVROS body setpoint)
+## The frame conversions (body_to_inertial, ned_to_enu, ...) are in
+## rotation_kernel.py.
+
+import math
+
+
+class FrameContext(object):
+
+    def __init__(self):
+
+        self.psi = None
+
+        self.cpsi = 1.0
+        self.spsi = 0.0
+        self.update(0.0)
+
+
+    def update(self, psi):
+
+        # new heading (rad), returns False if nothing changed
+        if psi == self.psi:
+            return False
+
+        self.cpsi = math.cos(psi)
+        self.spsi = math.sin(psi)
+        self.psi = psi
+
+        return True
+
+
+    def heading_forward_right(self, v_n, v_e):
+
+        # NE vector rotated into the heading-aligned frame, (forward, right)
+        return self.cpsi*v_n + self.spsi*v_e, self.cpsi*v_e - self.spsi*v_n
+
+
+    def heading_right_forward(self, v_n, v_e):
+
+        # the same as (right, forward), the order of the ENU-mapped IBVS commands sent to MAVROS
+        return self.cpsi*v_e - self.spsi*v_n, self.cpsi*v_n + self.spsi*v_e
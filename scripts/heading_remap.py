@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+## Closed-form roll/pitch remap for the HEADING_CORRECTION state. The average
+## roll and pitch from WIND_CALIBRATION hold the copter against the wind at the
+## heading it calibrated at. After yawing to a new heading, the thrust vector
+## (body z-axis in the vehicle frame) has to stay the same, so we need the
+## roll and pitch that give that z-axis at the new heading.
+##
+## With ZYX Euler angles the body z-axis in the vehicle frame is
+##   z = Rz(psi) * [cos(phi)*sin(theta), -sin(phi), cos(phi)*cos(theta)].T
+## so un-yawing z by the new heading gives w = Rz(-psi_des) * z and
+##   phi_des = asin(-w_y),  theta_des = atan2(w_x, w_z)
+## That is the solution with |phi| <= 90 deg, the one fsolve finds from zero
+## initial angles. euler_remap.py checks it against fsolve.
+
+import math
+import numpy as np
+
+
+def body_z_axis(phi, theta, psi):
+
+    # z-axis unit vector of the body frame expressed in the vehicle frame
+    sphi = math.sin(phi)
+    cphi = math.cos(phi)
+    stheta = math.sin(theta)
+    ctheta = math.cos(theta)
+    spsi = math.sin(psi)
+    cpsi = math.cos(psi)
+
+    return (cphi*stheta*cpsi + sphi*spsi,
+            cphi*stheta*spsi - sphi*cpsi,
+            cphi*ctheta)
+
+
+def body_z_axis_batch(phi, theta, psi):
+
+    # body_z_axis for arrays, returns the (x, y, z) components as arrays
+    sphi = np.sin(phi)
+    cphi = np.cos(phi)
+    stheta = np.sin(theta)
+    ctheta = np.cos(theta)
+    spsi = np.sin(psi)
+    cpsi = np.cos(psi)
+
+    return (cphi*stheta*cpsi + sphi*spsi,
+            cphi*stheta*spsi - sphi*cpsi,
+            cphi*ctheta)
+
+
+def remap_euler(phi, theta, psi, psi_des):
+
+    # roll and pitch at heading psi_des with the same body z-axis as (phi, theta, psi)
+    z_x, z_y, z_z = body_z_axis(phi, theta, psi)
+
+    spsi = math.sin(psi_des)
+    cpsi = math.cos(psi_des)
+    w_x = cpsi*z_x + spsi*z_y
+    w_y = -spsi*z_x + cpsi*z_y
+
+    # clip round-off before the asin
+    return math.asin(max(-1.0, min(1.0, -w_y))), math.atan2(w_x, z_z)
+
+
+def remap_euler_batch(phi, theta, psi, psi_des):
+
+    # Same as remap_euler for arrays (broadcast against each other), returns (phi_des, theta_des) arrays
+    sphi = np.sin(phi)
+    cphi = np.cos(phi)
+    stheta = np.sin(theta)
+    ctheta = np.cos(theta)
+
+    # rotating z by psi and back by psi_des is one yaw by psi - psi_des
+    dpsi = np.asarray(psi) - np.asarray(psi_des)
+    sdpsi = np.sin(dpsi)
+    cdpsi = np.cos(dpsi)
+
+    # w = Rz(-psi_des) * Rz(psi) * [cphi*stheta, -sphi, cphi*ctheta].T
+    v_x = cphi*stheta
+    v_y = -sphi
+    w_x = cdpsi*v_x - sdpsi*v_y
+    w_y = sdpsi*v_x + cdpsi*v_y
+
+    return np.arcsin(np.clip(-w_y, -1.0, 1.0)), np.arctan2(w_x, cphi*ctheta)
@@ -16,10 +16,12 @@ from aruco_localization.msg import FloatList
 from std_msgs.msg import Float32
 from geometry_msgs.msg import PoseStamped
 from geometry_msgs.msg import Twist
+from geometry_msgs.msg import TwistStamped
 import numpy as np
 import cv2
 import tf
 import time
+from ibvs_kernel import InteractionMatrix
 
 
 class ImageBasedVisualServoing(object):
@@ -100,9 +102,19 @@ class ImageBasedVisualServoing(object):
         # initialize rotation from virtual level frame to body frame
         self.R_vlc_b = np.zeros((3,3))
 
+        # initialize the image Jacobian kernel (preallocated 8x6 or 8x2)
+        if self.six_dof:
+            self.ibvs_kernel = InteractionMatrix(6, 4)
+        else:
+            self.ibvs_kernel = InteractionMatrix(2, 4)
+
         # initialize velocity command
         self.vel_cmd_msg = Twist()
 
+        # the same command stamped with the image time of the corners it came from (for latency tracing)
+        self.vel_cmd_stamped_msg = TwistStamped()
+        self.vel_cmd_stamped_msg.twist = self.vel_cmd_msg
+
         # initialize subscribers
         self.uv_bar_des_sub = rospy.Subscriber('/ibvs/pdes', FloatList, self.level_frame_desired_corners_callback)
         self.uv_bar_sub = rospy.Subscriber('/aruco/marker_corners', FloatList, self.level_frame_corners_callback)
@@ -112,6 +124,7 @@ class ImageBasedVisualServoing(object):
 
         # initialize publishers
         self.vel_cmd_pub = rospy.Publisher('/ibvs/vel_cmd', Twist, queue_size=1)
+        self.vel_cmd_stamped_pub = rospy.Publisher(rospy.resolve_name('/ibvs/vel_cmd') + '_stamped', TwistStamped, queue_size=1)  # follows any remap of /ibvs/vel_cmd
 
 
     def level_frame_corners_callback(self, msg):
@@ -122,67 +135,20 @@ class ImageBasedVisualServoing(object):
         # z_c = self.compute_dist(msg.data)
 
         # Level-frame corners are elements 8 to 15 on this topic
-        if self.six_dof:
-            # formulate image Jacobians according to eq(5)
-            u1 = msg.data[8]
-            v1 = msg.data[9]
-            Jp1 = np.array([[-self.f/self.z_c, 0.0, u1/self.z_c, u1*v1/self.f, -(self.f**2 + u1**2)/self.f, v1],
-                            [0.0, -self.f/self.z_c, v1/self.z_c, (self.f**2 + v1**2)/self.f, -u1*v1/self.f, -u1]])  # 2x6
-        
-            u2 = msg.data[10]
-            v2 = msg.data[11]
-            Jp2 = np.array([[-self.f/self.z_c, 0.0, u2/self.z_c, u2*v2/self.f, -(self.f**2 + u2**2)/self.f, v2],
-                            [0.0, -self.f/self.z_c, v2/self.z_c, (self.f**2 + v2**2)/self.f, -u2*v2/self.f, -u2]])  # 2x6
-
-            u3 = msg.data[12]
-            v3 = msg.data[13]
-            Jp3 = np.array([[-self.f/self.z_c, 0.0, u3/self.z_c, u3*v3/self.f, -(self.f**2 + u3**2)/self.f, v3],
-                            [0.0, -self.f/self.z_c, v3/self.z_c, (self.f**2 + v3**2)/self.f, -u3*v3/self.f, -u3]])  # 2x6
-
-            u4 = msg.data[14]
-            v4 = msg.data[15]
-            Jp4 = np.array([[-self.f/self.z_c, 0.0, u4/self.z_c, u4*v4/self.f, -(self.f**2 + u4**2)/self.f, v4],
-                            [0.0, -self.f/self.z_c, v4/self.z_c, (self.f**2 + v4**2)/self.f, -u4*v4/self.f, -u4]])  # 2x6
-
-        else:
-            # formulate image Jacobians according to eq(5) but ignore the angular x and y velocity terms
-            u1 = msg.data[8]
-            v1 = msg.data[9]
-            Jp1 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x3
-        
-            u2 = msg.data[10]
-            v2 = msg.data[11]
-            Jp2 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x3
-
-            u3 = msg.data[12]
-            v3 = msg.data[13]
-            Jp3 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x3
-
-            u4 = msg.data[14]
-            v4 = msg.data[15]
-            Jp4 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x3
-
-        # stack the Jacobians
-        Jp = np.vstack((Jp1, Jp2, Jp3, Jp4))  # 8x4
-
-        # formulate the error term e = p - p_des
-        p = np.array([u1, v1, u2, v2, u3, v3, u4, v4]).reshape(8,1)
-        # e = p - self.p_des  # 8x1
+        # formulate the stacked image Jacobians according to eq(5) (keeping only the 2-dof
+        # terms when six_dof is False) and the corner vector p in place
+        self.ibvs_kernel.update(msg.data, self.f, self.z_c, 8)
 
         # formulate the desired camera velocity vector rdot_des
         if self.inverse_method:
-            e = self.p_des - p
+            # e = p_des - p
             # v = lambda * pinv(Jp) * e
-            rdot_des = self.lam * np.linalg.pinv(Jp).dot(e)
+            rdot_des = self.ibvs_kernel.solve(self.p_des, self.lam)
             # NOTE: In the future, I may want to try Corke's 2nd Order Jacobian (eq. 15.12)
         else:
-            e = p - self.p_des
+            # e = p - p_des
             # rdot_des = -self.W * Jp.T * e
-            rdot_des = - self.W.dot(Jp.T).dot(e)  # Lee eq. 10
+            rdot_des = self.ibvs_kernel.solve_transpose(self.p_des, self.W)  # Lee eq. 10
 
         # e_avg = np.mean(e)
         # # print "Average pixel error: %f" % e_avg
@@ -222,6 +188,9 @@ class ImageBasedVisualServoing(object):
         # publish
         self.vel_cmd_pub.publish(self.vel_cmd_msg)
 
+        self.vel_cmd_stamped_msg.header.stamp = msg.header.stamp
+        self.vel_cmd_stamped_pub.publish(self.vel_cmd_stamped_msg)
+
 
     def level_frame_desired_corners_callback(self, msg):
 
@@ -16,10 +16,12 @@ from aruco_localization.msg import FloatList
 from std_msgs.msg import Float32
 from geometry_msgs.msg import PoseStamped
 from geometry_msgs.msg import Twist
+from geometry_msgs.msg import TwistStamped
 import numpy as np
 import cv2
 import tf
 import time
+from ibvs_law import AdaptiveIBVSLaw
 
 
 class ImageBasedVisualServoing(object):
@@ -34,21 +36,10 @@ class ImageBasedVisualServoing(object):
         lambda_vz = rospy.get_param('~lambda_vz', 0.7)
         lambda_wz = rospy.get_param('~lambda_wz', 0.5)
 
-        ## initialize other class variables
-
-        # if set to True, IBVS is computed according to eq. 15.11 from Corke
-        # if set to False, IBVS is computed according to eq. 10 from Lee
-        self.inverse_method = True
+        # the control law itself lives in ibvs_law.py (shared with the fused pipeline)
+        self.law = AdaptiveIBVSLaw(lambda_vx, lambda_vy, lambda_vz, lambda_wz, self.adaptive)
 
-        # if set True, IBVS is computed using the whole 2x6 image Jacobian (standard)
-        # if set False, IBVS is computed using the reduced 2x4 4-dof image Jacobian (way better in this case!)
-        self.six_dof = False
-
-        # IBVS saturation values (very conservative)
-        self.u_max = 10.0
-        self.v_max = 10.0
-        self.w_max = 7.0
-        self.psidot_max = np.radians(22.5)
+        ## initialize other class variables
 
         # image size
         # Initialize to something non-zero
@@ -72,25 +63,6 @@ class ImageBasedVisualServoing(object):
         # self.theta = 0.0
         self.altitude = 0.0
 
-        # distance (height) to the ArUco
-        self.z_c = 10.0  # initialize to be greater than zero
-
-        # lambda from Corke eq. 15.11 (turning param)
-        self.lam2DOF = np.array([lambda_vx, lambda_vy], dtype=np.float32).reshape(2,1)  # 2x1
-        self.lam4DOF = np.array([lambda_vx, lambda_vy, lambda_vz, lambda_wz], dtype=np.float32).reshape(4,1)  # 4x1
-
-        self.p_centroid = np.array([0.0, 0.0], dtype=np.float32).reshape(2,1)
-        self.p_des_centroid = np.array([0.0, 0.0], dtype=np.float32).reshape(2,1)
-        self.radius_pix = 0.0
-        self.centroid_radius_inner = 100.0
-        self.centroid_radius_outer = 200.0
-        self.mode_flag = 'IBVS_2DOF'
-
-
-        # desired pixel coords 
-        # [u1, v1, u2, v2, u3, v3, u4, v4].T  8x1
-        self.p_des = np.zeros((8,1), dtype=np.float32)  # 8x1
-
         # rotation from the virtual level frame to the vehicle 1 frame
         self.R_vlc_v1 = np.array([[0., -1., 0.],
                                   [1., 0., 0.],
@@ -105,9 +77,12 @@ class ImageBasedVisualServoing(object):
         # initialize velocity command
         self.vel_cmd_msg = Twist()
 
+        # the same command stamped with the image time of the corners it came from (for latency tracing)
+        self.vel_cmd_stamped_msg = TwistStamped()
+        self.vel_cmd_stamped_msg.twist = self.vel_cmd_msg
+
         # Initialize error msg
         self.ibvs_ave_error_msg = Float32()
-        self.error_ave = 1000.0
 
         # initialize subscribers
         self.uv_bar_des_sub = rospy.Subscriber('/ibvs/pdes', FloatList, self.level_frame_desired_corners_callback)
@@ -118,189 +93,42 @@ class ImageBasedVisualServoing(object):
 
         # initialize publishers
         self.vel_cmd_pub = rospy.Publisher('/ibvs/vel_cmd', Twist, queue_size=1)
+        self.vel_cmd_stamped_pub = rospy.Publisher(rospy.resolve_name('/ibvs/vel_cmd') + '_stamped', TwistStamped, queue_size=1)  # follows any remap of /ibvs/vel_cmd
         self.ibvs_error_pub = rospy.Publisher('/ibvs/ibvs_error', Float32, queue_size=1)
 
 
     def level_frame_corners_callback(self, msg):
 
-        # Level-frame corners are elements 8 to 15 on this topic
-        u1 = msg.data[8]
-        v1 = msg.data[9]
-
-        u2 = msg.data[10]
-        v2 = msg.data[11]
-
-        u3 = msg.data[12]
-        v3 = msg.data[13]
-
-        u4 = msg.data[14]
-        v4 = msg.data[15]
-
-        # compute the centroid of the corners
-        u_centroid = (u1 + u2 + u3 + u4) / 4.0
-        v_centroid = (v1 + v2 + v3 + v4) / 4.0
-
-        if self.adaptive:
-            # Compute distance between the centroid, and the centroid of p_des and get appropriate IBVS flag
-            self.mode_flag = self.set_ibvs_mode(u_centroid, v_centroid)
-        else:
-            self.mode_flag = 'IBVS_4DOF'
-        # print self.mode_flag
-
         # t = time.time()
 
         # compute z_c according to eq(15)
         # z_c = self.compute_dist(msg.data)
 
-        if self.mode_flag == 'IBVS_2DOF':
-            # formulate 2 DOF image Jacobians according to eq(5) but ignore all but the vx and vy terms
-            Jp1 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x2
-
-            Jp2 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x2
-
-            Jp3 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x2
-
-            Jp4 = np.array([[-self.f/self.z_c, 0.0],
-                            [0.0, -self.f/self.z_c]])  # 2x2
-
-        else:
-            # formulate image Jacobians according to eq(5) but ignore the angular x and y velocity terms
-            Jp1 = np.array([[-self.f/self.z_c, 0.0, u1/self.z_c, v1],
-                            [0.0, -self.f/self.z_c, v1/self.z_c, -u1]])  # 2x4
-        
-            Jp2 = np.array([[-self.f/self.z_c, 0.0, u2/self.z_c, v2],
-                            [0.0, -self.f/self.z_c, v2/self.z_c, -u2]])  # 2x4
-
-            Jp3 = np.array([[-self.f/self.z_c, 0.0, u3/self.z_c, v3],
-                            [0.0, -self.f/self.z_c, v3/self.z_c, -u3]])  # 2x4
-
-            Jp4 = np.array([[-self.f/self.z_c, 0.0, u4/self.z_c, v4],
-                            [0.0, -self.f/self.z_c, v4/self.z_c, -u4]])  # 2x4
-
-        # stack the Jacobians
-        Jp = np.vstack((Jp1, Jp2, Jp3, Jp4))  # 8x4
-
-        # formulate the error term e = p - p_des
-        p = np.array([u1, v1, u2, v2, u3, v3, u4, v4]).reshape(8,1)
-        # e = p - self.p_des  # 8x1
-
-        # formulate the desired camera velocity vector rdot_des
-        if self.mode_flag == 'IBVS_2DOF':
-            e = self.p_des - p
-            self.error_ave = np.linalg.norm(e) / 2.0
-            # v = lambda * pinv(Jp) * e
-            rdot_des = self.lam2DOF * np.linalg.pinv(Jp).dot(e)  # 2x1
-            # NOTE: In the future, I may want to try Corke's 2nd Order Jacobian (eq. 15.12)
-        else:
-            e = self.p_des - p
-            self.error_ave = np.linalg.norm(e) / 2.0
-            # v = lambda * pinv(Jp) * e
-            rdot_des = self.lam4DOF * np.linalg.pinv(Jp).dot(e)  # 4x1
-
-        # e_avg = np.mean(e)
-        # # print "Average pixel error: %f" % e_avg
-        # print "error: "
-        # print(e)
-        # print "\n"
-        # print "Jp inverse: "
-        # print(np.linalg.pinv(Jp))
-        # print "\n"
-        
-        # saturate and fill out the velocity command message
-        if self.mode_flag == 'IBVS_2DOF':
-            # Augment with a '0' to make a 3x1 (so we can rotate it).
-            v_des_linear = np.array([[rdot_des[0][0]],
-                                     [rdot_des[1][0]],
-                                     [0.0]])
-
-            # Rotate into the vehicle-1 frame
-            v_des_v1_linear = np.dot(self.R_vlc_v1, v_des_linear)  # 3x1
-
-            # Fill out the message
-            self.vel_cmd_msg.linear.x = self.saturate(v_des_v1_linear[0][0], self.u_max, -self.u_max)
-            self.vel_cmd_msg.linear.y = self.saturate(v_des_v1_linear[1][0], self.v_max, -self.v_max)
-            self.vel_cmd_msg.linear.z = 0.0  # this term is always zero anyway in 2DOF mode
-
-            # No angular velocities in this case
-            self.vel_cmd_msg.angular.x = 0.0
-            self.vel_cmd_msg.angular.y = 0.0
-            self.vel_cmd_msg.angular.z = 0.0
-
-        else:
-            v_des_linear = np.array([[rdot_des[0][0]],
-                                     [rdot_des[1][0]],
-                                     [rdot_des[2][0]]])
-
-            # Rotate into the vehicle-1 frame
-            v_des_v1_linear = np.dot(self.R_vlc_v1, v_des_linear)  # 3x1
+        # Level-frame corners are elements 8 to 15 on this topic
+        vel_cmd = self.law.compute(msg.data, 8)
 
-            # Fill out the message
-            self.vel_cmd_msg.linear.x = self.saturate(v_des_v1_linear[0][0], self.u_max, -self.u_max)
-            self.vel_cmd_msg.linear.y = self.saturate(v_des_v1_linear[1][0], self.v_max, -self.v_max)
-            self.vel_cmd_msg.linear.z = self.saturate(v_des_v1_linear[2][0], self.w_max, -self.w_max)
+        # fill out the velocity command message (already rotated into the vehicle-1 frame and saturated)
+        self.vel_cmd_msg.linear.x = vel_cmd[0]
+        self.vel_cmd_msg.linear.y = vel_cmd[1]
+        self.vel_cmd_msg.linear.z = vel_cmd[2]
 
-            self.vel_cmd_msg.angular.x = 0.0
-            self.vel_cmd_msg.angular.y = 0.0
-            self.vel_cmd_msg.angular.z = self.saturate(rdot_des[3][0], self.psidot_max, -self.psidot_max)
+        self.vel_cmd_msg.angular.x = 0.0
+        self.vel_cmd_msg.angular.y = 0.0
+        self.vel_cmd_msg.angular.z = vel_cmd[3]
 
         # publish
         self.vel_cmd_pub.publish(self.vel_cmd_msg)
 
-        self.ibvs_ave_error_msg.data = self.error_ave
+        self.vel_cmd_stamped_msg.header.stamp = msg.header.stamp
+        self.vel_cmd_stamped_pub.publish(self.vel_cmd_stamped_msg)
+
+        self.ibvs_ave_error_msg.data = self.law.error_ave
         self.ibvs_error_pub.publish(self.ibvs_ave_error_msg)
 
 
     def level_frame_desired_corners_callback(self, msg):
 
-        self.p_des[0][0] = msg.data[0]
-        self.p_des[1][0] = msg.data[1]
-
-        self.p_des[2][0] = msg.data[2]
-        self.p_des[3][0] = msg.data[3]
-
-        self.p_des[4][0] = msg.data[4]
-        self.p_des[5][0] = msg.data[5]
-
-        self.p_des[6][0] = msg.data[6]
-        self.p_des[7][0] = msg.data[7]
-
-        self.p_des_centroid[0][0] = (msg.data[0] + msg.data[2] + msg.data[4] + msg.data[6]) / 4.0
-        self.p_des_centroid[1][0] = (msg.data[1] + msg.data[3] + msg.data[5] + msg.data[7]) / 4.0
-
-
-    def set_ibvs_mode(self, u_centroid, v_centroid):
-
-        self.p_centroid[0][0] = u_centroid
-        self.p_centroid[1][0] = v_centroid
-
-        # compute the pixel distance from the center of the corners to the center of the desired corner locations
-        self.radius_pix = np.linalg.norm(self.p_centroid - self.p_des_centroid)
-
-        # decide which mode we should be in based on how far away we are from the centroid of p_des
-        if self.mode_flag == 'IBVS_2DOF':
-
-            if self.radius_pix <= self.centroid_radius_inner:
-
-                self.mode_flag = 'IBVS_4DOF'
-
-                return self.mode_flag
-            else:
-                # Don't change the mode
-                return self.mode_flag
-
-        else:
-
-            if self.radius_pix >= self.centroid_radius_outer:
-
-                self.mode_flag = 'IBVS_2DOF'
-
-                return self.mode_flag
-            else:
-                # Don't change the mode
-                return self.mode_flag
+        self.law.set_desired_corners(msg.data)
 
 
     def compute_dist(self, corners):
@@ -318,7 +146,7 @@ class ImageBasedVisualServoing(object):
         Ls = (Ls_1_2 + Ls_2_3 + Ls_3_4 + Ls_4_1) / 4.0
 
         # compute distance to the target z_c (eq 15)
-        z_c = (self.Lc * self.f) / Ls
+        z_c = (self.Lc * self.law.f) / Ls
 
         return z_c
 
@@ -340,6 +168,7 @@ class ImageBasedVisualServoing(object):
         self.cy = self.K[1][2]
 
         self.f = (self.fx + self.fy) / 2.0
+        self.law.f = self.f
 
         self.img_w = msg.width
         self.img_h = msg.height
@@ -367,9 +196,9 @@ class ImageBasedVisualServoing(object):
         z_c = msg.data
 
         if self.square_root_dist:
-            self.z_c = np.sqrt(z_c)
+            self.law.z_c = np.sqrt(z_c)
         else:
-            self.z_c = z_c
+            self.law.z_c = z_c
 
 
     def saturate(self, x, maximum, minimum):
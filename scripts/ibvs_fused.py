@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+## In-process vision-to-command pipeline for one ArUco marker. Used by
+## ibvs_state_machine.py when ~fused_pipeline is set: the corner callback runs
+## the level-frame mapping (level_frame.py) and the IBVS law (ibvs_law.py) and
+## hands the stamped Twist straight to the state machine callback, so a detection
+## doesn't go through level_frame_mapper.py and ibvs_adaptive.py as separate
+## nodes (and two extra serialization hops) before it becomes a setpoint.
+##
+## Params (private, under ~outer/ and ~inner/ of the state machine node):
+##   map_level_frame   undistort and rotate the raw corners here (like level_frame_mapper.py)
+##                     instead of using the level-frame corners that come with /aruco/marker_corners
+##   undistort_lut     undistort with the lookup table in level_frame.py (True) or cv2.undistortPoints (False)
+##   adaptive, square_root_dist, lambda_vx, lambda_vy, lambda_vz, lambda_wz   same as ibvs_adaptive.py
+##   publish_commands  still publish the Twist and pixel error (after the state machine has them) for logging
+
+import rospy
+from sensor_msgs.msg import CameraInfo
+from aruco_localization.msg import FloatList
+from std_msgs.msg import Float32
+from geometry_msgs.msg import Twist
+from geometry_msgs.msg import TwistStamped
+import numpy as np
+from level_frame import LevelFrameTransform
+from ibvs_law import AdaptiveIBVSLaw
+
+
+class FusedIBVSPipeline(object):
+
+    def __init__(self, name, command_callback, error_callback, vel_cmd_topic, error_topic):
+
+        # name is 'outer' or 'inner', the callbacks are the state machine's TwistStamped and Float32 callbacks
+        ns = '~' + name + '/'
+
+        # load ROS params
+        self.map_level_frame = rospy.get_param(ns + 'map_level_frame', False)
+        undistort_lut = rospy.get_param(ns + 'undistort_lut', True)
+        self.square_root_dist = rospy.get_param(ns + 'square_root_dist', False)
+        self.publish_commands = rospy.get_param(ns + 'publish_commands', True)
+        adaptive = rospy.get_param(ns + 'adaptive', True)
+        lambda_vx = rospy.get_param(ns + 'lambda_vx', 0.5)
+        lambda_vy = rospy.get_param(ns + 'lambda_vy', 0.5)
+        lambda_vz = rospy.get_param(ns + 'lambda_vz', 0.7)
+        lambda_wz = rospy.get_param(ns + 'lambda_wz', 0.5)
+
+        self.name = name
+        self.command_callback = command_callback
+        self.error_callback = error_callback
+
+        # the same math as the level_frame_mapper.py and ibvs_adaptive.py nodes
+        self.transform = LevelFrameTransform(use_lut=undistort_lut)
+        self.law = AdaptiveIBVSLaw(lambda_vx, lambda_vy, lambda_vz, lambda_wz, adaptive)
+
+        # level-frame corners [u1, v1, ... u4, v4] when we do the mapping ourselves
+        self.level_corners = np.zeros(8)
+
+        # messages handed to the state machine (reused, never serialized), the command carries the image stamp
+        self.vel_cmd_msg = Twist()
+        self.vel_cmd_stamped_msg = TwistStamped()
+        self.vel_cmd_stamped_msg.twist = self.vel_cmd_msg
+        self.ibvs_ave_error_msg = Float32()
+
+        # initialize subscribers
+        self.corners_sub = rospy.Subscriber('/aruco/marker_corners_' + name, FloatList, self.corners_callback, queue_size=1)
+        self.p_des_sub = rospy.Subscriber('/ibvs/pdes_' + name, FloatList, self.desired_corners_callback)
+        self.aruco_sub = rospy.Subscriber('/aruco/distance_' + name, Float32, self.aruco_distance_callback)
+        self.camera_info_sub = rospy.Subscriber('/quadcopter/camera/camera_info', CameraInfo, self.camera_info_callback)
+
+        # initialize publishers
+        if self.publish_commands:
+            self.vel_cmd_pub = rospy.Publisher(vel_cmd_topic, Twist, queue_size=1)
+            self.vel_cmd_stamped_pub = rospy.Publisher(vel_cmd_topic + '_stamped', TwistStamped, queue_size=1)
+            self.ibvs_error_pub = rospy.Publisher(error_topic, Float32, queue_size=1)
+
+
+    def corners_callback(self, msg):
+
+        if self.map_level_frame:
+            # can't undistort until we have the camera matrix
+            if not self.transform.has_camera_info:
+                return
+
+            # raw corners are elements 0 to 7 on this topic
+            self.level_corners[:] = self.transform.map_corners(msg.data, 0, msg.header.stamp.to_sec()).reshape(8)
+            vel_cmd = self.law.compute(self.level_corners)
+        else:
+            # Level-frame corners are elements 8 to 15 on this topic
+            vel_cmd = self.law.compute(msg.data, 8)
+
+        self.vel_cmd_msg.linear.x = vel_cmd[0]
+        self.vel_cmd_msg.linear.y = vel_cmd[1]
+        self.vel_cmd_msg.linear.z = vel_cmd[2]
+        self.vel_cmd_msg.angular.z = vel_cmd[3]
+        self.ibvs_ave_error_msg.data = self.law.error_ave
+
+        # hand the command straight to the state machine
+        self.vel_cmd_stamped_msg.header.stamp = msg.header.stamp
+        self.command_callback(self.vel_cmd_stamped_msg)
+        self.error_callback(self.ibvs_ave_error_msg)
+
+        if self.publish_commands:
+            self.vel_cmd_pub.publish(self.vel_cmd_msg)
+            self.vel_cmd_stamped_pub.publish(self.vel_cmd_stamped_msg)
+            self.ibvs_error_pub.publish(self.ibvs_ave_error_msg)
+
+
+    def desired_corners_callback(self, msg):
+
+        self.law.set_desired_corners(msg.data)
+
+
+    def aruco_distance_callback(self, msg):
+
+        if self.square_root_dist:
+            self.law.z_c = np.sqrt(msg.data)
+        else:
+            self.law.z_c = msg.data
+
+
+    def camera_info_callback(self, msg):
+
+        self.transform.set_camera_info(msg.K, msg.D, msg.width, msg.height)
+        self.law.f = self.transform.f
+
+        # just get this data once
+        self.camera_info_sub.unregister()
+        print("Fused IBVS (%s): Got camera info!" % self.name)
+
+
+    def set_attitude(self, phi, theta, stamp):
+
+        # roll and pitch history for the level-frame mapping (the state machine already has them)
+        self.transform.set_attitude(phi, theta, stamp)
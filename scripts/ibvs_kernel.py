@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+## Shared image-based visual servoing kernel used by all of the IBVS nodes.
+## Fills the stacked image Jacobian (interaction matrix) and the corner/error
+## vectors for N corners in place so a corner callback doesn't allocate a new
+## set of 2xDOF Jacobians, a vstack and a reshape on every message.
+##
+## For the reduced 2, 3 and 4 DOF Jacobians the least-squares solve
+## pinv(Jp) * e = inv(Jp.T * Jp) * Jp.T * e is done in closed form (no SVD).
+## Because of the structure of Jp, eliminating the [vx, vy] block of Jp.T * Jp
+## leaves a diagonal Schur complement whose entries are scaled versions of
+##   M = sum(|p_i - p_centroid|^2)
+## i.e. the spread of the corners about their centroid. The closed form is
+## only used when f/z_c is non-zero and M is not tiny relative to sum(|p_i|^2),
+## otherwise we fall back on np.linalg.pinv.
+##
+## Sources:
+## Lee et al. "Autonomous Landing of a VTOL UAV on a Moving Platform Using Image-based Visual Servoing" eq. 5
+## Corke, Peter "Robotics, Vision and Control" eq. 15.6 and 15.11
+
+import numpy as np
+
+
+# Supported column layouts of the image Jacobian
+#   2 DOF: [vx, vy]
+#   3 DOF: [vx, vy, wz]
+#   4 DOF: [vx, vy, vz, wz]
+#   6 DOF: [vx, vy, vz, wx, wy, wz]
+SUPPORTED_DOF = (2, 3, 4, 6)
+
+# the closed-form solve falls back on pinv when the corner spread M is smaller than this fraction of sum(|p_i|^2)
+DEFAULT_RCOND = 1.0e-9
+
+
+class InteractionMatrix(object):
+
+    def __init__(self, dof=4, num_corners=4, rcond=DEFAULT_RCOND):
+
+        if dof not in SUPPORTED_DOF:
+            raise ValueError('InteractionMatrix: unsupported dof %s' % str(dof))
+
+        self.dof = dof
+        self.num_corners = num_corners
+        self.rows = 2*num_corners
+
+        # everything is kept in float64 so that no dtype promotion (and temporary) happens in the hot path
+        self.dtype = np.float64
+
+        # stacked image Jacobian  (2N x DOF)
+        self.Jp = np.zeros((self.rows, dof), dtype=self.dtype)
+
+        # corner pixel coords [u1, v1, u2, v2, ... uN, vN].T  (2N x 1)
+        self.p = np.zeros((self.rows, 1), dtype=self.dtype)
+
+        # error term e = p_des - p  (2N x 1)
+        self.e = np.zeros((self.rows, 1), dtype=self.dtype)
+
+        # desired camera velocity rdot_des  (DOF x 1)
+        self.rdot = np.zeros((dof, 1), dtype=self.dtype)
+
+        # views of the u and v coordinates inside p and e (no copies)
+        self.u = self.p[0::2, 0]
+        self.v = self.p[1::2, 0]
+        self.e_u = self.e[0::2, 0]
+        self.e_v = self.e[1::2, 0]
+
+        # conditioning guard for the closed-form solve and a count of how often it sent us to pinv
+        self.rcond = rcond
+        self.fallback_count = 0
+
+        # current -f/z_c and 1/z_c (set by update)
+        self.f_z = 0.0
+        self.inv_z = 0.0
+
+        # scratch space
+        self.Jp_T_e = np.zeros((dof, 1), dtype=self.dtype)
+        self.tmp = np.zeros(num_corners, dtype=self.dtype)
+
+
+    def update(self, data, f, z_c, offset=0):
+
+        # data is a flat sequence of corner pixel coords (i.e. FloatList.data), the corners of interest
+        # start at element 'offset'
+        self.p[:, 0] = data[offset:offset + self.rows]
+
+        Jp = self.Jp
+        u = self.u
+        v = self.v
+
+        # the -f/z_c terms are common to every DOF layout
+        f_z = -f / z_c
+        Jp[0::2, 0] = f_z
+        Jp[1::2, 1] = f_z
+
+        self.f_z = f_z
+        self.inv_z = 1.0 / z_c
+
+        if self.dof == 2:
+            return Jp
+
+        if self.dof == 3:
+            Jp[0::2, 2] = v
+            np.negative(u, out=Jp[1::2, 2])
+            return Jp
+
+        # linear z column
+        inv_z = self.inv_z
+        np.multiply(u, inv_z, out=Jp[0::2, 2])
+        np.multiply(v, inv_z, out=Jp[1::2, 2])
+
+        if self.dof == 4:
+            Jp[0::2, 3] = v
+            np.negative(u, out=Jp[1::2, 3])
+            return Jp
+
+        # full 6 DOF, angular x and y columns
+        inv_f = 1.0 / f
+        f_sq = f*f
+
+        np.multiply(u, v, out=self.tmp)
+        np.multiply(self.tmp, inv_f, out=Jp[0::2, 3])    # u*v/f
+        np.negative(Jp[0::2, 3], out=Jp[1::2, 4])        # -u*v/f
+
+        np.multiply(v, v, out=self.tmp)
+        self.tmp += f_sq
+        np.multiply(self.tmp, inv_f, out=Jp[1::2, 3])    # (f^2 + v^2)/f
+
+        np.multiply(u, u, out=self.tmp)
+        self.tmp += f_sq
+        np.multiply(self.tmp, -inv_f, out=Jp[0::2, 4])   # -(f^2 + u^2)/f
+
+        # angular z column
+        Jp[0::2, 5] = v
+        np.negative(u, out=Jp[1::2, 5])
+
+        return Jp
+
+
+    def compute_error(self, p_des):
+
+        # e = p_des - p
+        np.subtract(p_des, self.p, out=self.e)
+
+        return self.e
+
+
+    def solve(self, p_des, lam):
+
+        # v = lambda * pinv(Jp) * e, without the SVD when the Jacobian structure allows it
+        self.compute_error(p_des)
+
+        if self.dof == 6 or not self.solve_closed_form():
+            np.dot(np.linalg.pinv(self.Jp), self.e, out=self.rdot)
+
+        np.multiply(self.rdot, lam, out=self.rdot)
+
+        return self.rdot
+
+
+    def solve_closed_form(self):
+
+        # Least-squares solution of Jp * rdot = e for the reduced Jacobians (see notes at the top).
+        # Returns False (and leaves rdot alone) if Jp is too close to singular.
+        a = self.f_z
+        n = self.num_corners
+
+        # Jp.T * Jp for the [vx, vy] block is n*a^2 * I
+        n_a_sq = n*a*a
+        if n_a_sq == 0.0 or not np.isfinite(n_a_sq):
+            self.fallback_count += 1
+            return False
+
+        # Jp.T * e for the [vx, vy] block
+        g0 = a*self.e_u.sum()
+        g1 = a*self.e_v.sum()
+
+        if self.dof == 2:
+            self.rdot[0, 0] = g0 / n_a_sq
+            self.rdot[1, 0] = g1 / n_a_sq
+            return True
+
+        u = self.u
+        v = self.v
+
+        sum_u = u.sum()
+        sum_v = v.sum()
+        sum_sq = u.dot(u) + v.dot(v)
+
+        # spread of the corners about their centroid (the Schur complement, up to a 1/z_c^2 for the vz term)
+        M = sum_sq - (sum_u*sum_u + sum_v*sum_v) / n
+        if M <= self.rcond*sum_sq or M <= 0.0:
+            self.fallback_count += 1
+            return False
+
+        # wz term (column [v, -u])
+        g_wz = v.dot(self.e_u) - u.dot(self.e_v)
+        x_wz = (g_wz - a*(sum_v*g0 - sum_u*g1) / n_a_sq) / M
+
+        if self.dof == 3:
+            self.rdot[0, 0] = (g0 - a*sum_v*x_wz) / n_a_sq
+            self.rdot[1, 0] = (g1 + a*sum_u*x_wz) / n_a_sq
+            self.rdot[2, 0] = x_wz
+            return True
+
+        # vz term (column [u/z_c, v/z_c])
+        inv_z = self.inv_z
+        g_vz = inv_z*(u.dot(self.e_u) + v.dot(self.e_v))
+        x_vz = (g_vz - a*inv_z*(sum_u*g0 + sum_v*g1) / n_a_sq) / (M*inv_z*inv_z)
+
+        self.rdot[0, 0] = (g0 - a*(inv_z*sum_u*x_vz + sum_v*x_wz)) / n_a_sq
+        self.rdot[1, 0] = (g1 - a*(inv_z*sum_v*x_vz - sum_u*x_wz)) / n_a_sq
+        self.rdot[2, 0] = x_vz
+        self.rdot[3, 0] = x_wz
+
+        return True
+
+
+    def solve_pinv(self, p_des, lam):
+
+        # Corke eq. 15.11: v = lambda * pinv(Jp) * e
+        self.compute_error(p_des)
+        np.dot(np.linalg.pinv(self.Jp), self.e, out=self.rdot)
+        np.multiply(self.rdot, lam, out=self.rdot)
+
+        return self.rdot
+
+
+    def solve_transpose(self, p_des, W):
+
+        # Lee eq. 10: v = -W * Jp.T * (p - p_des) = W * Jp.T * (p_des - p)
+        self.compute_error(p_des)
+        np.dot(self.Jp.T, self.e, out=self.Jp_T_e)
+        np.dot(W, self.Jp_T_e, out=self.rdot)
+
+        return self.rdot
+
+
+def solve_batch(corners, p_des, f, z_c, dof=4, rcond=DEFAULT_RCOND):
+
+    # Batched version of InteractionMatrix.solve (without lambda) for offline work.
+    # corners and p_des are (K x 2N) arrays of [u1, v1, ... uN, vN] rows, z_c is a scalar or a length K array.
+    # Returns the K x DOF array of pinv(Jp) * e, rows where the closed form is ill-conditioned are
+    # solved with pinv one at a time.
+    corners = np.asarray(corners, dtype=np.float64)
+    p_des = np.asarray(p_des, dtype=np.float64)
+    num_frames, rows = corners.shape
+    n = rows // 2
+
+    if dof not in (2, 3, 4):
+        raise ValueError('solve_batch: unsupported dof %s' % str(dof))
+
+    z_c = np.broadcast_to(np.asarray(z_c, dtype=np.float64), (num_frames,))
+    inv_z = 1.0 / z_c
+    a = -f * inv_z
+    n_a_sq = n*a*a
+
+    u = corners[:, 0::2]
+    v = corners[:, 1::2]
+    e_u = p_des[:, 0::2] - u
+    e_v = p_des[:, 1::2] - v
+
+    rdot = np.zeros((num_frames, dof))
+
+    g0 = a*e_u.sum(axis=1)
+    g1 = a*e_v.sum(axis=1)
+
+    sum_u = u.sum(axis=1)
+    sum_v = v.sum(axis=1)
+    sum_sq = (u*u).sum(axis=1) + (v*v).sum(axis=1)
+    M = sum_sq - (sum_u*sum_u + sum_v*sum_v) / n
+
+    # same conditioning guard as InteractionMatrix.solve_closed_form
+    bad = ~np.isfinite(n_a_sq) | (n_a_sq == 0.0)
+    if dof != 2:
+        bad |= (M <= rcond*sum_sq) | (M <= 0.0)
+    good = ~bad
+
+    # keep the bad rows from producing warnings, they get overwritten below
+    n_a_sq = np.where(good, n_a_sq, 1.0)
+    M = np.where(good, M, 1.0)
+
+    if dof == 2:
+        rdot[:, 0] = g0 / n_a_sq
+        rdot[:, 1] = g1 / n_a_sq
+
+    else:
+        g_wz = (v*e_u).sum(axis=1) - (u*e_v).sum(axis=1)
+        x_wz = (g_wz - a*(sum_v*g0 - sum_u*g1) / n_a_sq) / M
+
+        if dof == 3:
+            rdot[:, 0] = (g0 - a*sum_v*x_wz) / n_a_sq
+            rdot[:, 1] = (g1 + a*sum_u*x_wz) / n_a_sq
+            rdot[:, 2] = x_wz
+
+        else:
+            g_vz = inv_z*((u*e_u).sum(axis=1) + (v*e_v).sum(axis=1))
+            x_vz = (g_vz - a*inv_z*(sum_u*g0 + sum_v*g1) / n_a_sq) / (M*inv_z*inv_z)
+
+            rdot[:, 0] = (g0 - a*(inv_z*sum_u*x_vz + sum_v*x_wz)) / n_a_sq
+            rdot[:, 1] = (g1 - a*(inv_z*sum_v*x_vz - sum_u*x_wz)) / n_a_sq
+            rdot[:, 2] = x_vz
+            rdot[:, 3] = x_wz
+
+    # pinv fallback for the ill-conditioned rows
+    if np.any(bad):
+        kernel = InteractionMatrix(dof, n)
+        for i in np.nonzero(bad)[0]:
+            kernel.update(corners[i], f, z_c[i])
+            kernel.compute_error(p_des[i].reshape(rows, 1))
+            rdot[i, :] = np.dot(np.linalg.pinv(kernel.Jp), kernel.e)[:, 0]
+
+    return rdot
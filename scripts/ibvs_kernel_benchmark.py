@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+
+## Micro-benchmark for the IBVS corner callback math. Times the original
+## per-corner np.array/vstack/pinv formulation against the preallocated
+## InteractionMatrix kernel (pinv and closed-form solves) on synthetic
+## level-frame corners (no ROS needed).
+##
+## With --check it instead replays the level-frame corners and p_des of a
+## recorded .mat log (see save_mat_data.py) through both the pinv and the
+## closed-form solves and reports the worst disagreement.
+##
+## usage: ./ibvs_kernel_benchmark.py [num_iterations]
+##        ./ibvs_kernel_benchmark.py --check ../matlab/ibvs4dof_data_outer.mat [more.mat ...]
+
+import sys
+import timeit
+import numpy as np
+import scipy.io
+from ibvs_kernel import InteractionMatrix
+
+# relative tolerance for the --check equivalence test
+CHECK_TOLERANCE = 1.0e-9
+
+
+def legacy_ibvs(data, f, z_c, p_des, lam, dof):
+
+    # This is the corner callback math the way ibvs.py/ibvs_adaptive.py used to do it
+    u1 = data[8]
+    v1 = data[9]
+    u2 = data[10]
+    v2 = data[11]
+    u3 = data[12]
+    v3 = data[13]
+    u4 = data[14]
+    v4 = data[15]
+
+    if dof == 2:
+        Jp1 = np.array([[-f/z_c, 0.0],
+                        [0.0, -f/z_c]])  # 2x2
+        Jp2 = np.array([[-f/z_c, 0.0],
+                        [0.0, -f/z_c]])  # 2x2
+        Jp3 = np.array([[-f/z_c, 0.0],
+                        [0.0, -f/z_c]])  # 2x2
+        Jp4 = np.array([[-f/z_c, 0.0],
+                        [0.0, -f/z_c]])  # 2x2
+
+    elif dof == 4:
+        Jp1 = np.array([[-f/z_c, 0.0, u1/z_c, v1],
+                        [0.0, -f/z_c, v1/z_c, -u1]])  # 2x4
+        Jp2 = np.array([[-f/z_c, 0.0, u2/z_c, v2],
+                        [0.0, -f/z_c, v2/z_c, -u2]])  # 2x4
+        Jp3 = np.array([[-f/z_c, 0.0, u3/z_c, v3],
+                        [0.0, -f/z_c, v3/z_c, -u3]])  # 2x4
+        Jp4 = np.array([[-f/z_c, 0.0, u4/z_c, v4],
+                        [0.0, -f/z_c, v4/z_c, -u4]])  # 2x4
+
+    else:
+        Jp1 = np.array([[-f/z_c, 0.0, u1/z_c, u1*v1/f, -(f**2 + u1**2)/f, v1],
+                        [0.0, -f/z_c, v1/z_c, (f**2 + v1**2)/f, -u1*v1/f, -u1]])  # 2x6
+        Jp2 = np.array([[-f/z_c, 0.0, u2/z_c, u2*v2/f, -(f**2 + u2**2)/f, v2],
+                        [0.0, -f/z_c, v2/z_c, (f**2 + v2**2)/f, -u2*v2/f, -u2]])  # 2x6
+        Jp3 = np.array([[-f/z_c, 0.0, u3/z_c, u3*v3/f, -(f**2 + u3**2)/f, v3],
+                        [0.0, -f/z_c, v3/z_c, (f**2 + v3**2)/f, -u3*v3/f, -u3]])  # 2x6
+        Jp4 = np.array([[-f/z_c, 0.0, u4/z_c, u4*v4/f, -(f**2 + u4**2)/f, v4],
+                        [0.0, -f/z_c, v4/z_c, (f**2 + v4**2)/f, -u4*v4/f, -u4]])  # 2x6
+
+    Jp = np.vstack((Jp1, Jp2, Jp3, Jp4))
+    p = np.array([u1, v1, u2, v2, u3, v3, u4, v4]).reshape(8,1)
+    e = p_des - p
+
+    return lam * np.linalg.pinv(Jp).dot(e)
+
+
+def kernel_ibvs_pinv(kernel, data, f, z_c, p_des, lam):
+
+    kernel.update(data, f, z_c, 8)
+    return kernel.solve_pinv(p_des, lam)
+
+
+def kernel_ibvs(kernel, data, f, z_c, p_des, lam):
+
+    kernel.update(data, f, z_c, 8)
+    return kernel.solve(p_des, lam)
+
+
+def synthetic_corners():
+
+    # raw corners (unused by IBVS) followed by level-frame corners, like /aruco/marker_corners
+    level_corners = [-180.0, -210.0, 220.0, -190.0, 205.0, 215.0, -195.0, 185.0]
+    return tuple([0.0]*8 + level_corners)
+
+
+def benchmark(iterations):
+
+    data = synthetic_corners()
+    f = 1000.0
+    z_c = 8.0
+    p_des = np.array([-200, -200, 200, -200, 200, 200, -200, 200], dtype=np.float32).reshape(8,1)
+
+    print("IBVS corner callback benchmark (%d iterations)" % iterations)
+    print("%6s %14s %14s %14s %10s %12s" % ('dof', 'before (us)', 'pinv (us)', 'closed (us)', 'speedup', 'max |diff|'))
+
+    for dof in (2, 4, 6):
+
+        lam = np.full((dof, 1), 0.5, dtype=np.float32)
+        kernel = InteractionMatrix(dof, 4)
+
+        # make sure all of the formulations agree before timing them
+        rdot_before = legacy_ibvs(data, f, z_c, p_des, lam, dof)
+        diff = max(np.max(np.abs(rdot_before - kernel_ibvs_pinv(kernel, data, f, z_c, p_des, lam))),
+                   np.max(np.abs(rdot_before - kernel_ibvs(kernel, data, f, z_c, p_des, lam))))
+
+        t_before = timeit.timeit(lambda: legacy_ibvs(data, f, z_c, p_des, lam, dof), number=iterations)
+        t_pinv = timeit.timeit(lambda: kernel_ibvs_pinv(kernel, data, f, z_c, p_des, lam), number=iterations)
+        t_closed = timeit.timeit(lambda: kernel_ibvs(kernel, data, f, z_c, p_des, lam), number=iterations)
+
+        us_before = 1.0e6 * t_before / iterations
+        us_pinv = 1.0e6 * t_pinv / iterations
+        us_closed = 1.0e6 * t_closed / iterations
+
+        print("%6d %14.2f %14.2f %14.2f %9.2fx %12.3e" % (dof, us_before, us_pinv, us_closed, us_before / us_closed, diff))
+
+
+def check(filenames):
+
+    # The logs don't record z_c or f, so sweep a few representative values. The corner streams are what
+    # exercise the conditioning of Jp.
+    f_values = (800.0, 1000.0, 1700.0)
+    z_values = (0.3, 1.0, 5.0, 15.0)
+
+    passed = True
+
+    for filename in filenames:
+
+        arr = scipy.io.loadmat(filename)['arr']
+
+        # drop the unused rows at the end of a log that wasn't trimmed
+        arr = arr[arr[:, 0] != 0.0]
+
+        # level-frame corners are columns 13 to 20 and p_des is columns 21 to 28 (see save_mat_data.py)
+        corners = arr[:, 13:21]
+        p_des = arr[:, 21:29]
+
+        for dof in (2, 3, 4):
+
+            kernel = InteractionMatrix(dof, 4)
+            lam = np.ones((dof, 1))
+            worst = 0.0
+
+            for i in range(corners.shape[0]):
+                p_des_i = p_des[i].reshape(8,1)
+
+                for f in f_values:
+                    for z_c in z_values:
+                        kernel.update(corners[i], f, z_c)
+                        rdot_pinv = kernel.solve_pinv(p_des_i, lam).copy()
+                        rdot = kernel.solve(p_des_i, lam)
+
+                        scale = max(np.max(np.abs(rdot_pinv)), 1.0e-12)
+                        worst = max(worst, np.max(np.abs(rdot - rdot_pinv)) / scale)
+
+            ok = worst <= CHECK_TOLERANCE
+            passed = passed and ok
+
+            print("%s: dof %d, %d frames, max relative diff %.3e, pinv fallbacks %d  %s"
+                  % (filename, dof, corners.shape[0], worst, kernel.fallback_count, 'OK' if ok else 'FAIL'))
+
+    return passed
+
+
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--check':
+        if not check(sys.argv[2:]):
+            sys.exit(1)
+        return
+
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    else:
+        iterations = 20000
+
+    benchmark(iterations)
+
+
+if __name__ == '__main__':
+    main()
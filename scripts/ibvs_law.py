@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+## ROS-free version of the adaptive IBVS control law from ibvs_adaptive.py.
+## Takes level-frame corner pixels, switches between the 2DOF and 4DOF image
+## Jacobians based on how far the corner centroid is from the p_des centroid
+## and returns a saturated [vx, vy, vz, wz] command in the vehicle 1 frame.
+##
+## Used by the ibvs_adaptive.py node and by the fused pipeline in
+## ibvs_fused.py, so both run exactly the same math.
+##
+## Sources:
+## Lee et al. "Autonomous Landing of a VTOL UAV on a Moving Platform Using Image-based Visual Servoing"
+## Corke, Peter "Robotics, Vision and Control"
+
+import numpy as np
+from ibvs_kernel import InteractionMatrix
+
+
+class AdaptiveIBVSLaw(object):
+
+    def __init__(self, lambda_vx=0.5, lambda_vy=0.5, lambda_vz=0.7, lambda_wz=0.5, adaptive=True):
+
+        self.adaptive = adaptive
+
+        # IBVS saturation values (very conservative)
+        self.u_max = 10.0
+        self.v_max = 10.0
+        self.w_max = 7.0
+        self.psidot_max = np.radians(22.5)
+
+        # focal length and distance (height) to the ArUco, initialize to be greater than zero
+        self.f = 1000.0
+        self.z_c = 10.0
+
+        # lambda from Corke eq. 15.11 (turning param)
+        self.lam2DOF = np.array([lambda_vx, lambda_vy], dtype=np.float32).reshape(2,1)  # 2x1
+        self.lam4DOF = np.array([lambda_vx, lambda_vy, lambda_vz, lambda_wz], dtype=np.float32).reshape(4,1)  # 4x1
+
+        self.p_centroid = np.array([0.0, 0.0], dtype=np.float32).reshape(2,1)
+        self.p_des_centroid = np.array([0.0, 0.0], dtype=np.float32).reshape(2,1)
+        self.radius_pix = 0.0
+        self.centroid_radius_inner = 100.0
+        self.centroid_radius_outer = 200.0
+        self.mode_flag = 'IBVS_2DOF'
+
+        # desired pixel coords
+        # [u1, v1, u2, v2, u3, v3, u4, v4].T  8x1
+        self.p_des = np.zeros((8,1), dtype=np.float32)  # 8x1
+
+        # image Jacobian kernels (preallocated 8x2 and 8x4)
+        self.ibvs_kernel_2dof = InteractionMatrix(2, 4)
+        self.ibvs_kernel_4dof = InteractionMatrix(4, 4)
+
+        # velocity command [vx, vy, vz, wz] in the vehicle 1 frame and the average pixel error
+        self.vel_cmd = np.zeros(4)
+        self.error_ave = 1000.0
+
+
+    def set_desired_corners(self, data):
+
+        self.p_des[:, 0] = data[0:8]
+
+        self.p_des_centroid[0][0] = (data[0] + data[2] + data[4] + data[6]) / 4.0
+        self.p_des_centroid[1][0] = (data[1] + data[3] + data[5] + data[7]) / 4.0
+
+
+    def compute(self, data, offset=0):
+
+        # data holds the level-frame corners [u1, v1, ... u4, v4] starting at element 'offset'
+        u_centroid = (data[offset] + data[offset + 2] + data[offset + 4] + data[offset + 6]) / 4.0
+        v_centroid = (data[offset + 1] + data[offset + 3] + data[offset + 5] + data[offset + 7]) / 4.0
+
+        if self.adaptive:
+            # Compute distance between the centroid, and the centroid of p_des and get appropriate IBVS flag
+            self.mode_flag = self.set_ibvs_mode(u_centroid, v_centroid)
+        else:
+            self.mode_flag = 'IBVS_4DOF'
+
+        if self.mode_flag == 'IBVS_2DOF':
+            # 2 DOF image Jacobians according to eq(5) but ignore all but the vx and vy terms
+            self.ibvs_kernel_2dof.update(data, self.f, self.z_c, offset)  # 8x2
+
+            # e = p_des - p
+            # v = lambda * pinv(Jp) * e
+            rdot_des = self.ibvs_kernel_2dof.solve(self.p_des, self.lam2DOF)  # 2x1
+            self.error_ave = np.linalg.norm(self.ibvs_kernel_2dof.e) / 2.0
+
+            # rotate into the vehicle-1 frame (R_vlc_v1 maps [x, y, z] to [-y, x, z]) and saturate,
+            # vz and wz are always zero in 2DOF mode
+            self.vel_cmd[0] = self.saturate(-rdot_des[1][0], self.u_max, -self.u_max)
+            self.vel_cmd[1] = self.saturate(rdot_des[0][0], self.v_max, -self.v_max)
+            self.vel_cmd[2] = 0.0
+            self.vel_cmd[3] = 0.0
+
+        else:
+            # image Jacobians according to eq(5) but ignore the angular x and y velocity terms
+            self.ibvs_kernel_4dof.update(data, self.f, self.z_c, offset)  # 8x4
+
+            # e = p_des - p
+            # v = lambda * pinv(Jp) * e
+            rdot_des = self.ibvs_kernel_4dof.solve(self.p_des, self.lam4DOF)  # 4x1
+            self.error_ave = np.linalg.norm(self.ibvs_kernel_4dof.e) / 2.0
+
+            self.vel_cmd[0] = self.saturate(-rdot_des[1][0], self.u_max, -self.u_max)
+            self.vel_cmd[1] = self.saturate(rdot_des[0][0], self.v_max, -self.v_max)
+            self.vel_cmd[2] = self.saturate(rdot_des[2][0], self.w_max, -self.w_max)
+            self.vel_cmd[3] = self.saturate(rdot_des[3][0], self.psidot_max, -self.psidot_max)
+
+        return self.vel_cmd
+
+
+    def set_ibvs_mode(self, u_centroid, v_centroid):
+
+        self.p_centroid[0][0] = u_centroid
+        self.p_centroid[1][0] = v_centroid
+
+        # compute the pixel distance from the center of the corners to the center of the desired corner locations
+        self.radius_pix = np.linalg.norm(self.p_centroid - self.p_des_centroid)
+
+        # decide which mode we should be in based on how far away we are from the centroid of p_des
+        if self.mode_flag == 'IBVS_2DOF':
+            if self.radius_pix <= self.centroid_radius_inner:
+                self.mode_flag = 'IBVS_4DOF'
+        else:
+            if self.radius_pix >= self.centroid_radius_outer:
+                self.mode_flag = 'IBVS_2DOF'
+
+        return self.mode_flag
+
+
+    def saturate(self, x, maximum, minimum):
+        if(x > maximum):
+            rVal = maximum
+        elif(x < minimum):
+            rVal = minimum
+        else:
+            rVal = x
+
+        return rVal
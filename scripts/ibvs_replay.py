@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+
+## Offline IBVS replay over recorded corner logs (the .mat files written by
+## save_mat_data.py, e.g. matlab/ibvs_data_outer.mat). Runs the same control
+## law as ibvs_adaptive.py (and ibvs.py with --no-adaptive) over the whole log
+## as one batched NumPy computation. No ROS master, no per-message loop.
+##
+## The 2DOF and 4DOF solutions pinv(Jp) * e are computed once per log. The
+## adaptive mode switch, lambda and the saturation limits are then applied
+## element-wise, so re-tuning them over thousands of frames takes milliseconds.
+##
+## Log columns (see save_mat_data.py):
+##   0 time, 1-4 corner errors, 5-12 raw corners, 13-20 level-frame corners,
+##   21-28 p_des, 29 phi, 30 theta, 31 state machine mode, 32 ibvs mode (newer logs)
+##
+## usage: ./ibvs_replay.py ../matlab/ibvs4dof_data_outer.mat --lambda_vx 0.6 --centroid_radius_inner 80
+
+import argparse
+import time
+import numpy as np
+import scipy.io
+from ibvs_kernel import solve_batch
+
+
+class IBVSReplay(object):
+
+    def __init__(self, arr, f=1000.0, z_c=10.0, marker_size=None):
+
+        # drop the unused rows at the end of a log that wasn't trimmed
+        arr = arr[arr[:, 0] != 0.0]
+
+        self.t = arr[:, 0]
+        self.raw_corners = arr[:, 5:13]
+        self.corners = arr[:, 13:21]
+        self.p_des = arr[:, 21:29]
+        self.phi = arr[:, 29]
+        self.theta = arr[:, 30]
+        self.num_frames = arr.shape[0]
+        self.f = f
+
+        # the logs don't record the ArUco distance, so either use a constant or estimate it from the
+        # apparent size of the marker like ImageBasedVisualServoing.compute_dist (eq 15)
+        if marker_size is not None:
+            self.z_c = self.compute_dist(marker_size)
+        else:
+            self.z_c = np.full(self.num_frames, z_c)
+
+        # centroid of the corners and of p_des (used by the adaptive 2DOF/4DOF switch)
+        self.u_centroid = self.corners[:, 0::2].mean(axis=1)
+        self.v_centroid = self.corners[:, 1::2].mean(axis=1)
+        self.u_des_centroid = self.p_des[:, 0::2].mean(axis=1)
+        self.v_des_centroid = self.p_des[:, 1::2].mean(axis=1)
+        self.radius_pix = np.hypot(self.u_centroid - self.u_des_centroid, self.v_centroid - self.v_des_centroid)
+
+        # error term e = p_des - p
+        self.error_ave = np.linalg.norm(self.p_des - self.corners, axis=1) / 2.0
+
+        # unscaled solutions pinv(Jp) * e for both Jacobians (these don't depend on any of the tuning params)
+        self.rdot_2dof = solve_batch(self.corners, self.p_des, self.f, self.z_c, 2)
+        self.rdot_4dof = solve_batch(self.corners, self.p_des, self.f, self.z_c, 4)
+
+
+    def compute_dist(self, marker_size):
+
+        # average side length of the marker in pixels (raw corners)
+        u = self.raw_corners[:, 0::2]
+        v = self.raw_corners[:, 1::2]
+        Ls = np.hypot(u - np.roll(u, -1, axis=1), v - np.roll(v, -1, axis=1)).mean(axis=1)
+
+        # compute distance to the target z_c (eq 15), guard against frames without corners
+        return marker_size * self.f / np.maximum(Ls, 1.0)
+
+
+    def ibvs_mode(self, adaptive=True, centroid_radius_inner=100.0, centroid_radius_outer=200.0):
+
+        # Vectorized version of ImageBasedVisualServoing.set_ibvs_mode. The mode only changes when the radius
+        # drops inside the inner radius (-> 4DOF) or leaves the outer radius (-> 2DOF), so the mode on any frame
+        # is set by the most recent of those events (the node starts out in 2DOF).
+        if not adaptive:
+            return np.ones(self.num_frames, dtype=bool)
+
+        enter_4dof = self.radius_pix <= centroid_radius_inner
+        enter_2dof = self.radius_pix >= centroid_radius_outer
+
+        event_idx = np.where(enter_4dof | enter_2dof, np.arange(self.num_frames), -1)
+        last_event = np.maximum.accumulate(event_idx)
+
+        return np.where(last_event >= 0, enter_4dof[np.maximum(last_event, 0)], False)
+
+
+    def run(self, lambda_vx=0.5, lambda_vy=0.5, lambda_vz=0.7, lambda_wz=0.5,
+            u_max=10.0, v_max=10.0, w_max=7.0, psidot_max=np.radians(22.5),
+            adaptive=True, centroid_radius_inner=100.0, centroid_radius_outer=200.0):
+
+        # returns a dict with the velocity commands [vx, vy, vz, wz] (vehicle-1 frame, like /ibvs/vel_cmd),
+        # the 4DOF mode flag and the average pixel error for every frame
+        mode_4dof = self.ibvs_mode(adaptive, centroid_radius_inner, centroid_radius_outer)
+
+        rdot = np.zeros((self.num_frames, 4))
+        rdot[:, 0:2] = np.where(mode_4dof[:, None], self.rdot_4dof[:, 0:2], self.rdot_2dof)
+        rdot[:, 2:4] = np.where(mode_4dof[:, None], self.rdot_4dof[:, 2:4], 0.0)
+        rdot *= np.array([lambda_vx, lambda_vy, lambda_vz, lambda_wz])
+
+        # rotate from the virtual level camera frame into the vehicle 1 frame (R_vlc_v1) and saturate
+        vel_cmd = np.empty((self.num_frames, 4))
+        vel_cmd[:, 0] = np.clip(-rdot[:, 1], -u_max, u_max)
+        vel_cmd[:, 1] = np.clip(rdot[:, 0], -v_max, v_max)
+        vel_cmd[:, 2] = np.clip(rdot[:, 2], -w_max, w_max)
+        vel_cmd[:, 3] = np.clip(rdot[:, 3], -psidot_max, psidot_max)
+
+        return {'t': self.t,
+                'vel_cmd': vel_cmd,
+                'mode_4dof': mode_4dof,
+                'error_ave': self.error_ave,
+                'radius_pix': self.radius_pix,
+                'z_c': self.z_c}
+
+
+def print_summary(result, limits):
+
+    vel_cmd = result['vel_cmd']
+    mode_4dof = result['mode_4dof']
+
+    print("frames: %d  (%.1f s of log)" % (vel_cmd.shape[0], result['t'][-1] - result['t'][0]))
+    print("4DOF fraction: %.3f  mode switches: %d" % (np.mean(mode_4dof), np.count_nonzero(np.diff(mode_4dof.astype(int)))))
+    print("average pixel error: mean %.1f  final %.1f" % (np.mean(result['error_ave']), result['error_ave'][-1]))
+
+    for i, name in enumerate(('vx', 'vy', 'vz', 'wz')):
+        saturated = np.mean(np.abs(vel_cmd[:, i]) >= limits[i])
+        print("%s: mean |cmd| %.3f  max |cmd| %.3f  saturated %.3f" % (name, np.mean(np.abs(vel_cmd[:, i])), np.max(np.abs(vel_cmd[:, i])), saturated))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Replay the IBVS control law over a recorded corner log.')
+    parser.add_argument('logfile', help='.mat log written by save_mat_data.py')
+    parser.add_argument('--f', type=float, default=1000.0, help='focal length in pixels')
+    parser.add_argument('--z_c', type=float, default=10.0, help='constant distance to the ArUco (m)')
+    parser.add_argument('--marker_size', type=float, default=None, help='estimate z_c from the marker size (m) instead')
+    parser.add_argument('--lambda_vx', type=float, default=0.5)
+    parser.add_argument('--lambda_vy', type=float, default=0.5)
+    parser.add_argument('--lambda_vz', type=float, default=0.7)
+    parser.add_argument('--lambda_wz', type=float, default=0.5)
+    parser.add_argument('--u_max', type=float, default=10.0)
+    parser.add_argument('--v_max', type=float, default=10.0)
+    parser.add_argument('--w_max', type=float, default=7.0)
+    parser.add_argument('--psidot_max', type=float, default=22.5, help='(deg/s)')
+    parser.add_argument('--centroid_radius_inner', type=float, default=100.0)
+    parser.add_argument('--centroid_radius_outer', type=float, default=200.0)
+    parser.add_argument('--no-adaptive', dest='adaptive', action='store_false', help='always use 4DOF (like ibvs.py)')
+    parser.add_argument('--save', default=None, help='save the replayed commands to this .mat file')
+    args = parser.parse_args()
+
+    arr = scipy.io.loadmat(args.logfile)['arr']
+
+    then = time.time()
+    replay = IBVSReplay(arr, args.f, args.z_c, args.marker_size)
+    setup_time = time.time() - then
+
+    then = time.time()
+    result = replay.run(args.lambda_vx, args.lambda_vy, args.lambda_vz, args.lambda_wz,
+                        args.u_max, args.v_max, args.w_max, np.radians(args.psidot_max),
+                        args.adaptive, args.centroid_radius_inner, args.centroid_radius_outer)
+    run_time = time.time() - then
+
+    print("IBVS replay of %s" % args.logfile)
+    print("setup (batched solve): %.2f ms  control law: %.2f ms" % (1.0e3*setup_time, 1.0e3*run_time))
+    print_summary(result, (args.u_max, args.v_max, args.w_max, np.radians(args.psidot_max)))
+
+    if args.save is not None:
+        scipy.io.savemat(args.save, mdict={'t': result['t'],
+                                           'vel_cmd': result['vel_cmd'],
+                                           'mode_4dof': result['mode_4dof'].astype(float),
+                                           'error_ave': result['error_ave'],
+                                           'z_c': result['z_c']})
+        print("saved %s" % args.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,18 +10,30 @@ from std_msgs.msg import Float32
 from std_msgs.msg import String
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Twist
+from geometry_msgs.msg import TwistStamped
 from geometry_msgs.msg import Point
 from geometry_msgs.msg import Point32
 from geometry_msgs.msg import PoseStamped
+from geometry_msgs.msg import Vector3Stamped
 from rosflight_msgs.msg import Command
 from mavros_msgs.msg import PositionTarget
 from mavros_msgs.msg import AttitudeTarget
 from mavros_msgs.srv import SetMode
 from mavros_msgs.srv import CommandBool
+from diagnostic_msgs.msg import DiagnosticArray
+from diagnostic_msgs.msg import DiagnosticStatus
+from diagnostic_msgs.msg import KeyValue
 import numpy as np
-import tf
-from collections import deque
-from scipy.optimize import fsolve
+import threading
+from ibvs_fused import FusedIBVSPipeline
+from latency_monitor import LatencyMonitor
+from wind_estimator import OnlineWindEstimator
+from intercept_planner import InterceptPlanner
+from state_machine_core import StateMachineCore
+from state_machine_publishers import StateMachinePublishers
+from rotation_kernel import ned_to_enu
+from rotation_kernel import quaternion_to_euler
+from calibration_store import store_from_params
 
 
 
@@ -40,7 +52,7 @@ from scipy.optimize import fsolve
 
 
 
-class StateMachine():
+class StateMachine(StateMachinePublishers, StateMachineCore):
 
     def __init__(self):
 
@@ -49,23 +61,64 @@ class StateMachine():
         # Set flag for interfacing with ROScopter or MAVROS
         self.mode_flag = rospy.get_param('~mode', 'mavros')
 
-        # Initialize status flags
-        self.status_flag = 'RENDEZVOUS'
-        self.prev_status = 'MISSION'
-        self.status_flag_msg = String()
-        self.status_flag_msg.data = self.status_flag
-        self.ibvs_status_flag_msg = String()
+        # if set True, the level-frame mapping and IBVS run inside this node (see ibvs_fused.py)
+        # instead of coming in from the ibvs_adaptive.py nodes on /ibvs/vel_cmd and /ibvs_inner/vel_cmd
+        self.fused_pipeline = rospy.get_param('~fused_pipeline', False)
+
+        # Online wind estimate from the transit to the rendezvous point. Once it knows the hover roll and pitch to
+        # within wind_calc_tolerance, RENDEZVOUS uses it and skips the WIND_CALIBRATION hover (see wind_estimator.py).
+        # velocity_frame says which frame the twist of the state estimate is in ('body' or 'ned')
+        self.online_wind_estimation = rospy.get_param('~online_wind_estimation', False)
+        self.velocity_frame = rospy.get_param('~velocity_frame', 'body')
+        wind_estimator = None
+        if self.online_wind_estimation:
+            wind_estimator = OnlineWindEstimator(rospy.get_param('~wind_estimator_tau', 0.5),
+                                                 rospy.get_param('~wind_estimator_memory', 20.0))
+
+        # if set True, the rendezvous point is where the copter can meet the moving target at intercept_speed (m/s),
+        # using the target EKF velocity, instead of its last reported position (see intercept_planner.py)
+        intercept_planner = None
+        if rospy.get_param('~intercept_planner', False):
+            intercept_planner = InterceptPlanner(rospy.get_param('~intercept_speed', 3.0),
+                                                 rospy.get_param('~intercept_horizon', 30.0))
 
-        # Initialize current target flag
-        self.current_target = 'aruco_outer'
-
-        # Initialize visibility flags
-        self.outer_target_is_visible = False
-        self.inner_target_is_visible = False
-        self.current_target_is_visible = False
-        self.other_target_is_visible = False
+        self.test_name = rospy.get_param('~test_name', 'test1')
 
+        # The wind offset, average attitude and heading correction are saved to calibration_file as they're found and
+        # loaded back at startup if they're less than calibration_validity (s) old, so a restart doesn't fly the
+        # calibration stages again (see calibration_store.py). A validity of 0 turns the cache off.
+        calibration_store = store_from_params(rospy.get_param, self.test_name)
+
+        # The mission logic lives in StateMachineCore (state_machine_core.py), this node feeds it and carries out its commands.
+        # Wind calibration ends once the average roll and pitch are known to within wind_calc_tolerance (deg),
+        # but not before wind_calc_min_duration and no later than wind_calc_duration (s)
+        StateMachineCore.__init__(self, clock=rospy.get_time,
+                                  rendezvous_height=rospy.get_param('~rendezvous_height', 10.0),
+                                  wp_threshold=rospy.get_param('~wp_threshold', 1.0),
+                                  landing_distance_threshold=rospy.get_param('~landing_distance_threshold', 0.4),
+                                  p_des_error_outer_threshold=rospy.get_param('~p_des_error_outer_threshold', 50.0),
+                                  p_des_error_inner_threshold=rospy.get_param('~p_des_error_inner_threshold', 50.0),
+                                  inner_error_condition=rospy.get_param('~inner_error_condition', False),
+                                  max_boat_angle=15.0,
+                                  wind_calc_completed=rospy.get_param('~wind_calc_completed', False),
+                                  heading_correction_completed=rospy.get_param('~heading_correction_completed', False),
+                                  wind_window_seconds=rospy.get_param('~wind_window_seconds', 5.0),
+                                  wind_calc_duration=rospy.get_param('~wind_calc_duration', 10.0),
+                                  wind_calc_min_duration=rospy.get_param('~wind_calc_min_duration', 3.0),
+                                  wind_calc_tolerance=np.radians(rospy.get_param('~wind_calc_tolerance', 0.5)),
+                                  wind_estimator=wind_estimator,
+                                  visibility_timeout=rospy.get_param('~visibility_timeout', 1.0),
+                                  visibility_tau=rospy.get_param('~visibility_tau', 1.0),
+                                  visibility_enter_rate=rospy.get_param('~visibility_enter_rate', 5.0),
+                                  visibility_exit_rate=rospy.get_param('~visibility_exit_rate', 2.0),
+                                  intercept_planner=intercept_planner,
+                                  intercept_rate=rospy.get_param('~intercept_rate', 10.0),
+                                  calibration_store=calibration_store)
+        self.load_calibration()
 
+        self.status_flag_msg = String()
+        self.status_flag_msg.data = self.status_flag
+        self.ibvs_status_flag_msg = String()
 
         # Velocity saturation values
         self.u_max = rospy.get_param('~u_max', 0.5)
@@ -76,79 +129,39 @@ class StateMachine():
         self.v_max_inner = rospy.get_param('~v_max_inner', 0.2)
         self.w_max_inner = rospy.get_param('~w_max_inner', 0.2)
 
-        self.rendezvous_height = rospy.get_param('~rendezvous_height', 10.0)
-        self.wp_threshold = rospy.get_param('~wp_threshold', 1.0)
-
-        self.landing_distance_threshold = rospy.get_param('~landing_distance_threshold', 0.4)
-        self.p_des_error_outer_threshold = rospy.get_param('~p_des_error_outer_threshold', 50.0)
-        self.p_des_error_inner_threshold = rospy.get_param('~p_des_error_inner_threshold', 50.0)
-
-        self.inner_error_condition = rospy.get_param('~inner_error_condition', False)
-
-        self.test_name = rospy.get_param('~test_name', 'test1')
-
         self.landing_thrust0 = rospy.get_param('~landing_thrust', 0.45)
         self.thrust_val = self.landing_thrust0
 
-        self.wp_error = 1.0e3
-        self.p_des_error_outer = 1.0e3
-        self.p_des_error_inner = 1.0e3
-
-        # initialize target location and velocity
-        self.target_N = 0.0
-        self.target_E = 0.0
-        self.target_VN = 0.0
-        self.target_VE = 0.0
-
-        # Initialize waypoint setpoint
-        self.wp_N = 5.0
-        self.wp_E = 5.0
-        self.wp_D = -self.rendezvous_height
-        self.heading_command = np.radians(0.0)
-
-        self.relative_heading = 0.0
-
-        self.wind_calc_completed = rospy.get_param('~wind_calc_completed', False)
-        self.wind_window_seconds = 5
-        self.wind_calc_duration = 10.0
-        self.wind_offset = np.zeros((3,1), dtype=np.float32)
-
-        self.heading_correction_completed = rospy.get_param('~heading_correction_completed', False)
-
-        self.z_unit = np.zeros((3,1))
-
-        # Initialize queues
-        if self.mode_flag == 'mavros':
-            # this assumes state estimates at ~60 hz which gives us 5 seconds of data
-            self.queue_length = 60*self.wind_window_seconds
-        else:
-            # this assumes we're in roscopter mode and state comes in at ~170 hz
-            self.queue_length = 170*self.wind_window_seconds
-
-        self.phi_queue = deque(maxlen=self.queue_length)
-        self.theta_queue = deque(maxlen=self.queue_length)
-
-        # Average roll and pitch values in the wind
-        self.roll_avg = 0.0
-        self.pitch_avg = 0.0
+        # At touchdown the thrust ramps down to ramp_down_thrust over ramp_down_time (s), one step per send_commands
+        # tick, then a background thread disarms. landing_stage goes RAMP_DOWN -> DISARMING -> DISARMED (or
+        # DISARM_FAILED, retried up to disarm_attempts times after disarm_retry_delay (s), doubling every attempt,
+        # and DISARM_ABORTED once they're used up) and is published on /landing_status with its timing.
+        self.ramp_down_time = rospy.get_param('~ramp_down_time', 1.0)
+        self.ramp_down_thrust = rospy.get_param('~ramp_down_thrust', 0.2)
+        self.disarm_attempts = rospy.get_param('~disarm_attempts', 3)
+        self.disarm_retry_delay = rospy.get_param('~disarm_retry_delay', 0.5)
+        self.landing_stage = ''
+        self.landing_start_time = None
+        self.ramp_down_start_thrust = self.landing_thrust0
+        self.disarm_thread = None
+        self.disarm_attempt = 0
+        self.disarm_request_time = None
+        self.disarm_response_time = None
+        self.disarm_retry_time = None
+
+        # if set True, the IBVS feed-forward uses the fixed-rate target prediction from target_ekf.py
+        # (/target_ekf/prediction) instead of the low-pass filtered velocity it publishes after each measurement
+        self.use_target_prediction = rospy.get_param('~use_target_prediction', False)
+
+        self.wind_attitude_msg = Vector3Stamped()
+        self.wind_uncertainty_msg = Vector3Stamped()
+        self.wind_estimate_msg = Vector3Stamped()
+        self.hover_attitude_msg = Vector3Stamped()
+        self.intercept_msg = Vector3Stamped()
 
         # Rotation matrix to hold ArUco attitude data
         self.R_aruco = np.eye(3, dtype=np.float32)
 
-        # Max attitude angle between target and camera frame (degrees)
-        self.max_boat_angle = 15.0
-
-        # Flag for wheter or not is is a good time to land
-        self.safe_to_land = False
-
-        # Initialize state variables
-        self.pn = 0.0
-        self.pe = 0.0
-        self.pd = 0.0
-        self.phi = 0.0
-        self.theta = 0.0
-        self.psi = 0.0
-
         # ibvs parameters
         # outer
         self.ibvs_x = 0.0
@@ -156,42 +169,33 @@ class StateMachine():
         self.ibvs_F = 0.0
         self.ibvs_z = 0.0
 
-        self.visibility_queue_length = 5
-        self.ibvs_count = 0
-        self.ibvs_time_outer = rospy.get_time() - 100.0  # In the past
-        self.ibvs_time_queue_outer = deque(maxlen=self.visibility_queue_length)
-
         # inner
         self.ibvs_x_inner = 0.0
         self.ibvs_y_inner = 0.0
         self.ibvs_F_inner = 0.0
         self.ibvs_z_inner = 0.0
 
-        self.ibvs_count_inner = 0
-        self.ibvs_time_inner = rospy.get_time() - 100.0  # In the past
-        self.ibvs_time_queue_inner = deque(maxlen=self.visibility_queue_length)
-
-        # Fill up the queues with 'old' timestamps
-        for x in range(0,self.visibility_queue_length):
-            self.ibvs_time_queue_outer.appendleft(self.ibvs_time_outer)
-            self.ibvs_time_queue_inner.appendleft(self.ibvs_time_inner)
+        # image stamp of the corners behind the latest IBVS commands and the time we got them (s)
+        self.ibvs_stamp_outer = 0.0
+        self.ibvs_receive_time_outer = 0.0
+        self.ibvs_stamp_inner = 0.0
+        self.ibvs_receive_time_inner = 0.0
 
-        self.distance = 10.0
+        # if set True, a new IBVS command is sent on to MAVROS/ROScopter as soon as it comes in while in IBVS, instead of
+        # waiting for the next command timer tick. The timer keeps sending setpoints as the keep-alive for offboard mode
+        # and still makes every transition. The 'forward' latency stage on /ibvs/latency shows what either mode costs.
+        self.event_driven_ibvs = rospy.get_param('~event_driven_ibvs', False)
 
-        # self.land_mode_sent = False
-
-        self.ned_vel_vec_inner = np.array([[0.0],
-                                           [0.0],
-                                           [0.0]], dtype=np.float32)
+        # step() runs under command_lock on the timer thread. The IBVS callbacks take it too, to update the marker
+        # visibility (which step() reads) and to forward commands.
+        self.command_lock = threading.Lock()
 
-        self.ned_vel_vec_outer = np.array([[0.0],
-                                           [0.0],
-                                           [0.0]], dtype=np.float32)
+        # image-to-setpoint latency tracing, setpoints built from images older than stale_command_age (s) are counted as stale
+        self.stale_command_age = rospy.get_param('~stale_command_age', 0.2)
+        self.latency_monitor = LatencyMonitor(500, self.stale_command_age)
+        self.latency_msg = Float32()
 
-        # Initialize rotation from NED to ENU (for MAVROS).
-        self.R_ned_enu = np.array([[0., 1., 0.],
-                                   [1., 0., 0.],
-                                   [0., 0., -1.]])
+        # self.land_mode_sent = False
 
         # Create a mask of PositionTarget msg fields we wish to ignore.
         # Here we have 'OR'ed together all of the fields we don't want
@@ -214,20 +218,55 @@ class StateMachine():
                             | PositionTarget.FORCE
                             | PositionTarget.IGNORE_YAW_RATE)
 
+        # position with a velocity feed-forward, for a rendezvous point that moves with the target
+        self.ned_pos_vel_mask = (PositionTarget.IGNORE_AFX
+                            | PositionTarget.IGNORE_AFY
+                            | PositionTarget.IGNORE_AFZ
+                            | PositionTarget.FORCE
+                            | PositionTarget.IGNORE_YAW_RATE)
+
+        # Command messages are filled in and re-published instead of allocated every tick (rospy serializes them in publish())
+        self.ibvs_command_msg_mavros = PositionTarget()
+        self.ibvs_command_msg_mavros.coordinate_frame = PositionTarget.FRAME_BODY_NED
+        self.ibvs_command_msg_mavros.type_mask = self.velocity_mask
+
+        self.ibvs_command_msg_roscopter = Command()
+        self.ibvs_command_msg_roscopter.mode = Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE
+
+        self.waypoint_command_msg_mavros = PositionTarget()
+        self.waypoint_command_msg_mavros.coordinate_frame = PositionTarget.FRAME_LOCAL_NED
+        self.waypoint_command_msg_mavros.type_mask = self.ned_pos_vel_mask if self.intercept_planner is not None else self.ned_pos_mask
+
+        self.waypoint_command_msg_roscopter = Command()
+        self.waypoint_command_msg_roscopter.mode = Command.MODE_XPOS_YPOS_YAW_ALTITUDE
+
         self.attitude_mask = (AttitudeTarget.IGNORE_ATTITUDE)
 
+        # Body rates stay zero and the attitude is masked out, so only the stamp and thrust change per tick
+        self.attitude_command_msg_mavros = AttitudeTarget()
+        self.attitude_command_msg_mavros.type_mask = self.attitude_mask
+
         # Set Up Publishers and Subscribers
         self.target_sub = rospy.Subscriber('/target_position', Odometry, self.target_callback, queue_size=1)
-        self.ibvs_sub = rospy.Subscriber('/ibvs/vel_cmd', Twist, self.ibvs_velocity_cmd_callback, queue_size=1)
-        self.ibvs_inner_sub = rospy.Subscriber('/ibvs_inner/vel_cmd', Twist, self.ibvs_velocity_cmd_inner_callback, queue_size=1)
+        if self.fused_pipeline:
+            self.fused_outer = FusedIBVSPipeline('outer', self.ibvs_velocity_cmd_stamped_callback, self.ibvs_ave_error_callback,
+                                                 '/ibvs/vel_cmd', '/ibvs/ibvs_error_outer')
+            self.fused_inner = FusedIBVSPipeline('inner', self.ibvs_velocity_cmd_inner_stamped_callback, self.ibvs_ave_error_inner_callback,
+                                                 '/ibvs_inner/vel_cmd', '/ibvs/ibvs_error_inner')
+        else:
+            self.ibvs_sub = rospy.Subscriber('/ibvs/vel_cmd_stamped', TwistStamped, self.ibvs_velocity_cmd_stamped_callback, queue_size=1)
+            self.ibvs_inner_sub = rospy.Subscriber('/ibvs_inner/vel_cmd_stamped', TwistStamped, self.ibvs_velocity_cmd_inner_stamped_callback, queue_size=1)
+            self.ibvs_ave_error_sub = rospy.Subscriber('/ibvs/ibvs_error_outer', Float32, self.ibvs_ave_error_callback)
+            self.ibvs_ave_error_inner_sub = rospy.Subscriber('/ibvs/ibvs_error_inner', Float32, self.ibvs_ave_error_inner_callback)
         self.aruco_sub = rospy.Subscriber('/aruco/distance_inner', Float32, self.aruco_inner_distance_callback)
         # self.aruco_att_sub = rospy.Subscriber('/aruco/estimate', PoseStamped, self.aruco_att_callback)
         self.aruco_angle_sub = rospy.Subscriber('/aruco/k_angle', Float32, self.aruco_angle_callback)
         self.aruco_heading_sub = rospy.Subscriber('/aruco/heading_outer', Float32, self.aruco_relative_heading_callback)
         self.state_sub = rospy.Subscriber('estimate', Odometry, self.state_callback)
-        self.ibvs_ave_error_sub = rospy.Subscriber('/ibvs/ibvs_error_outer', Float32, self.ibvs_ave_error_callback)
-        self.ibvs_ave_error_inner_sub = rospy.Subscriber('/ibvs/ibvs_error_inner', Float32, self.ibvs_ave_error_inner_callback)
-        self.target_velocity_sub = rospy.Subscriber('/target_ekf/velocity_lpf', Point32, self.target_velocity_callback)
+        if self.use_target_prediction:
+            self.target_velocity_sub = rospy.Subscriber('/target_ekf/prediction', Odometry, self.target_prediction_callback, queue_size=1)
+        else:
+            self.target_velocity_sub = rospy.Subscriber('/target_ekf/velocity_lpf', Point32, self.target_velocity_callback)
 
 
         self.command_pub_roscopter = rospy.Publisher('high_level_command', Command, queue_size=5, latch=True)
@@ -237,10 +276,19 @@ class StateMachine():
         self.ibvs_active_pub_ = rospy.Publisher('/quadcopter/ibvs_active', Bool, queue_size=1)
         self.status_flag_pub = rospy.Publisher('/status_flag', String, queue_size=1)
         self.ibvs_status_flag_pub = rospy.Publisher('/ibvs_status_flag', String, queue_size=1)
+        self.latency_pub = rospy.Publisher('/ibvs/corner_to_setpoint_latency', Float32, queue_size=1)
+        self.latency_diagnostics_pub = rospy.Publisher('/ibvs/latency', DiagnosticArray, queue_size=1)
+        self.landing_status_pub = rospy.Publisher('/landing_status', DiagnosticArray, queue_size=1)
+        self.marker_visibility_pub = rospy.Publisher('/marker_visibility', DiagnosticArray, queue_size=1)
+        self.wind_attitude_pub = rospy.Publisher('/wind_calibration/attitude', Vector3Stamped, queue_size=1)
+        self.wind_uncertainty_pub = rospy.Publisher('/wind_calibration/uncertainty', Vector3Stamped, queue_size=1)
+        self.wind_estimate_pub = rospy.Publisher('/wind_estimator/wind', Vector3Stamped, queue_size=1)
+        self.hover_attitude_pub = rospy.Publisher('/wind_estimator/hover_attitude', Vector3Stamped, queue_size=1)
+        self.intercept_pub = rospy.Publisher('/rendezvous/intercept', Vector3Stamped, queue_size=1)
 
         # Set Up Service Proxy
         self.set_mode_srv = rospy.ServiceProxy('/mavros/set_mode', SetMode)
-        self.arm_srv = rospy.ServiceProxy('/mavros/cmd/arming', CommandBool)
+        self.arm_srv = rospy.ServiceProxy('/mavros/cmd/arming', CommandBool, persistent=True)
 
         self.ibvs_active_msg = Bool()
         self.ibvs_active_msg.data = False
@@ -255,154 +303,28 @@ class StateMachine():
         self.command_update_rate = 20.0
         self.update_timer = rospy.Timer(rospy.Duration(1.0/self.command_update_rate), self.send_commands)
 
+        self.latency_update_rate = 1.0
+        self.latency_timer = rospy.Timer(rospy.Duration(1.0/self.latency_update_rate), self.send_latency_diagnostics)
+
 
     def send_commands(self, event):
 
         # then = rospy.get_time()
-        self.update_marker_visibility_status()
-
-        self.update_state_machine_status_and_send_command()
+        with self.command_lock:
+            self.step()
+        self.publish_marker_visibility(self.marker_visibility_pub, rospy.get_rostime(), 'ibvs_state_machine')
         # now = rospy.get_time()
         # secs = now - then
         # print 'Loop seconds: %f' % secs
 
 
-    def update_state_machine_status_and_send_command(self):
-        # print self.status_flag
-
-        self.update_wp_error()
-
-        if self.status_flag == 'RENDEZVOUS':
-
-            # Is a target in view?
-            if self.outer_target_is_visible or self.inner_target_is_visible:
-
-                # Were we just in IBVS mode?
-                if self.prev_status == 'IBVS':
+    def publish_ibvs_active(self, active):
 
-                    # Go back into IBVS
-                    self.status_flag = 'IBVS'
-                    self.prev_status = 'RENDEZVOUS'
+        self.ibvs_active_msg.data = active
+        self.ibvs_active_pub_.publish(self.ibvs_active_msg)
 
-        # RENDEZVOUS MODE
-        if self.status_flag == 'RENDEZVOUS':
-
-            # Is waypoint error sufficiently small?
-            if self.wp_error <= self.wp_threshold:
-
-                # Has Wind Calibration occured yet?
-                if self.wind_calc_completed == False:
-
-                    # Switch to wind calibration status
-                    self.status_flag = 'WIND_CALIBRATION'
-                    self.prev_status = 'RENDEZVOUS'
-                    self.wind_calc_time = rospy.get_time()
-
-
-                elif self.wind_calc_completed == True and self.heading_correction_completed == False:
-                    
-                    # Perform initial heading correction
-                    self.status_flag = 'HEADING_CORRECTION'
-                    self.prev_status = 'RENDEZVOUS'
-
-                else:
-
-                    # Is the target in view?
-                    if self.outer_target_is_visible:
-
-                        # Enter IBVS Mode
-                        self.status_flag = 'IBVS'
-                        self.prev_status = 'RENDEZVOUS'
-
-                    else:
-
-                        print "Fail. Returning to mode RENDEZVOUS"
-
-
-            else:
-                self.status_flag = 'RENDEZVOUS'
-
-
-        # WIND CALIBRATION MODE
-        if self.status_flag == 'WIND_CALIBRATION':
-
-            now = rospy.get_time()
-            if now - self.wind_calc_time > self.wind_calc_duration:
-                self.roll_avg = sum(self.phi_queue)/len(self.phi_queue)
-                self.pitch_avg = sum(self.theta_queue)/len(self.theta_queue)
-                self.wind_offset = self.compute_rendezvous_offset(self.roll_avg, self.pitch_avg)
-                self.wp_N = self.target_N + self.wind_offset[0][0]
-                self.wp_E = self.target_E + self.wind_offset[1][0]
-                self.wind_calc_completed = True
-                self.status_flag = 'RENDEZVOUS'
-                self.prev_status = 'WIND_CALIBRATION'
-                print "Average roll angle (pre-hc): %f \nAverage pitch angle  (pre-hc): %f" % (np.degrees(self.roll_avg), np.degrees(self.pitch_avg))
-                # self.write_ave_att_file(self.roll_avg, self.pitch_avg)
-
-        
-        # HEADING CORRECTION MODE
-        if self.status_flag == 'HEADING_CORRECTION':
-
-            if self.heading_correction_completed == False:
-                des_heading = self.psi + self.relative_heading
-                while des_heading > np.radians(180.0):  des_heading = des_heading - np.radians(360.0)
-                while des_heading < np.radians(-180.0):  des_heading = des_heading + np.radians(360.0)
-                self.heading_command = des_heading
-
-                # Pre-evaluate sines and cosines.
-                sphi = np.sin(self.roll_avg)
-                cphi = np.cos(self.roll_avg)
-
-                stheta = np.sin(self.pitch_avg)
-                ctheta = np.cos(self.pitch_avg)
-
-                spsi = np.sin(self.psi)
-                cpsi = np.cos(self.psi)
-
-                # The z-axis unit vector resulting from the average euler angles.
-                self.z_unit[0][0] = cphi*stheta*cpsi + sphi*spsi
-                self.z_unit[1][0] = cphi*stheta*spsi - sphi*cpsi
-                self.z_unit[2][0] = cphi*ctheta 
-
-                # Update average roll and pitch angles after the yaw manuver
-                x = fsolve(self.find_remaped_euler, np.zeros(3), (des_heading))
-                self.roll_avg = x[0]
-                self.pitch_avg = x[1]
-                self.write_ave_att_file(self.roll_avg, self.pitch_avg)
-                print "Average roll angle (post-hc): %f \nAverage pitch angle  (post-hc): %f" % (np.degrees(self.roll_avg), np.degrees(self.pitch_avg))
-
-                # print "Average roll angle: %f \nAverage pitch angle: %f" % (np.degrees(self.roll_avg), np.degrees(self.pitch_avg))
-
-                self.heading_correction_completed = True
-            if abs(self.relative_heading) <= np.radians(30.0):
-                self.status_flag = 'RENDEZVOUS'
-                self.prev_status = 'HEADING_CORRECTION'
-
-        
-        # IMAGE-BASED VISUAL SERVOING MODE
-        if self.status_flag == 'IBVS':
-
-            self.ibvs_active_msg.data = True
-            self.ibvs_active_pub_.publish(self.ibvs_active_msg)
-            self.enter_ibvs_state_machine()
-
-        # WAYPOINT MODE (RENDEZVOUS, etc.)
-        elif self.status_flag == 'RENDEZVOUS' or self.status_flag == 'WIND_CALIBRATION' or self.status_flag == 'HEADING_CORRECTION':
-
-            self.ibvs_active_msg.data = False
-            self.ibvs_active_pub_.publish(self.ibvs_active_msg)
-            self.send_waypoint_command()
-
-        # LAND MODE
-        else:
-
-            self.ibvs_active_msg.data = False
-            self.ibvs_active_pub_.publish(self.ibvs_active_msg)
-
-            # if self.mode_flag == 'mavros':
-            #     # We use the AttitudeTarget message to do the final landing manuver.
-            #     self.send_attitude_command()
 
+    def publish_status(self):
 
         self.status_flag_msg.data = self.status_flag
         self.status_flag_pub.publish(self.status_flag_msg)
@@ -411,331 +333,290 @@ class StateMachine():
         self.ibvs_status_flag_pub.publish(self.ibvs_status_flag_msg)
 
 
+    def update_landing(self):
 
-    def enter_ibvs_state_machine(self):
-
-        # Is the current target still visible?
-        if self.current_target_is_visible:
-
-            if self.current_target == 'aruco_outer':
-
-                # Is the inner target visible?
-                if self.inner_target_is_visible:
-
-                    # Has the outer target been driven to its desired location?
-                    if self.p_des_error_outer <= self.p_des_error_outer_threshold:
-
-                        # Switch to controlling off of the inner ArUco
-                        self.execute_ibvs('inner')
-                    else:
-
-                        # Execute IBVS(outer)
-                        self.execute_ibvs('outer')
+        if self.mode_flag == 'mavros':
+            self.ramp_down_motors()
+        self.send_landing_status()
 
-                else:
 
-                    # Execute IBVS(outer)
-                    self.execute_ibvs('outer')
+    def execute_landing(self):
+        
+        if self.mode_flag == 'mavros':
 
-            elif self.current_target == 'aruco_inner':
+            # Update the status flag.
+            self.status_flag = 'LAND'
 
-                # Execute IBVS(inner)
-                self.execute_ibvs('inner')
+            # Start ramping down the motors, send_commands steps the ramp and disarms from here on.
+            self.start_ramp_down(self.landing_thrust0)
 
-            else:
+            
+            # rospy.wait_for_service('/mavros/set_mode')
+            # try:
+            #     isModeChanged = self.set_mode_srv(custom_mode='AUTO.LAND')
+            
+            #     if isModeChanged:
+            #         self.land_mode_sent = True
+            #         print "mode %s sent." % 'AUTO.LAND'
+            #         self.status_flag = 'LAND'
 
-                print "State Machine: Invalid current_target flag."
+            # except rospy.ServiceException, e:
+            #     print "service call set_mode failed: %s" % e
 
         else:
+            
+            command_msg = Command()
+            command_msg.x = 0.0
+            command_msg.y = 0.0
+            command_msg.F = 0.0
+            command_msg.z = 0.0
+            command_msg.mode = Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE
+            self.command_pub_roscopter.publish(command_msg)
+            self.status_flag = 'LAND'
+            self.landing_start_time = rospy.get_time()
+            self.landing_stage = 'THROTTLE_CUT'
 
-            # Is the other target visible?
-            if self.other_target_is_visible:
-
-                # Execute IBVS(other)
-                self.execute_ibvs('other')
-
-            else:
 
-                # Return to mode RENDEZVOUS
-                self.status_flag = 'RENDEZVOUS'
-                self.prev_status = 'IBVS'
+    def start_ramp_down(self, start_thrust):
 
-                # Maybe should set current_target = 'aruco_outer' here
+        self.landing_start_time = rospy.get_time()
+        self.landing_stage = 'RAMP_DOWN'
+        self.ramp_down_start_thrust = start_thrust
+        self.ramp_down_motors()
 
 
-    def execute_ibvs(self, target_flag):
+    def ramp_down_motors(self):
 
-        # Is target flag == 'outer'
-        if target_flag == 'outer':
+        # One step of the ramp down, called every send_commands tick while in LAND mode
+        if self.landing_start_time is None:
+            return
 
-            # Set the current target flag
-            self.current_target = 'aruco_outer'
+        elapsed = rospy.get_time() - self.landing_start_time
 
-            # Send the command
-            self.send_ibvs_command('outer')
+        if self.landing_stage == 'RAMP_DOWN':
+            fraction = min(elapsed/self.ramp_down_time, 1.0)
+            self.thrust_val = self.ramp_down_start_thrust - fraction*(self.ramp_down_start_thrust - self.ramp_down_thrust)
 
-        # Is target flag == 'inner'
-        elif target_flag == 'inner':
+            if fraction >= 1.0:
+                self.start_disarm()
 
-            # Is the distance to the ArUco sufficiently small?
-            if self.distance <= self.landing_distance_threshold:
+        elif self.landing_stage == 'DISARM_FAILED':
+            if self.disarm_attempt < self.disarm_attempts:
+                if rospy.get_time() >= self.disarm_retry_time:
+                    self.start_disarm()
+            else:
+                self.landing_stage = 'DISARM_ABORTED'
+                print "Disarm failed %d times, giving up and stopping the setpoint stream" % self.disarm_attempt
 
-                # Is the target sufficiently level?
-                if self.safe_to_land:
+        # Keep the setpoint stream going until we're disarmed so PX4 doesn't fall out of offboard. If we gave up on
+        # disarming, stop it instead of holding ramp_down_thrust forever and leave the copter to PX4's failsafe
+        # (and its auto-disarm on the ground).
+        if self.landing_stage not in ('DISARMED', 'DISARM_ABORTED'):
+            self.send_attitude_command()
 
-                    # Execute Landing!!!
-                    self.execute_landing()
 
-                else:
-                    # Set the current target flag
-                    self.current_target = 'aruco_inner'
+    def start_disarm(self):
 
-                    # Send the command
-                    self.send_ibvs_command('inner')
+        # Don't stack calls on a disarm that's still waiting for mavros
+        if self.disarm_thread is not None and self.disarm_thread.is_alive():
+            return
 
-            else:
+        self.landing_stage = 'DISARMING'
+        self.disarm_attempt += 1
+        self.disarm_request_time = rospy.get_time()
+        self.disarm_thread = threading.Thread(target=self.disarm)
+        self.disarm_thread.daemon = True
+        self.disarm_thread.start()
 
-                # Set the current target flag
-                self.current_target = 'aruco_inner'
 
-                # Send the command
-                self.send_ibvs_command('inner')
+    def disarm(self):
 
-        # Target flag == 'other'
+        # Runs in its own thread so the service call can't stall the send_commands timer
+        try:
+            rospy.wait_for_service('/mavros/cmd/arming', timeout=1.0)
+            response = self.arm_srv(value=False)
+            success = response.success
+        except (rospy.ServiceException, rospy.ROSException), e:
+            print "service call disarm failed: %s" % e
+            success = False
+
+            # a persistent proxy doesn't reconnect by itself
+            self.arm_srv.close()
+            self.arm_srv = rospy.ServiceProxy('/mavros/cmd/arming', CommandBool, persistent=True)
+
+        self.disarm_response_time = rospy.get_time()
+
+        if success:
+            self.landing_stage = 'DISARMED'
+            print "Disarm. Touchdown sequence took %.3f s (disarm call %.3f s)" % (
+                self.disarm_response_time - self.landing_start_time, self.disarm_response_time - self.disarm_request_time)
         else:
+            # back off before the next attempt: disarm_retry_delay, 2*disarm_retry_delay, 4*disarm_retry_delay, ...
+            self.disarm_retry_time = self.disarm_response_time + self.disarm_retry_delay*2**(self.disarm_attempt - 1)
+            self.landing_stage = 'DISARM_FAILED'
 
-            # Send other ibvs
-            if self.current_target == 'aruco_outer':
-
-                self.current_target = 'aruco_inner'
-                self.send_ibvs_command('inner')
-
-            else:
-
-                self.current_target = 'aruco_outer'
-                self.send_ibvs_command('outer')
 
+    def send_landing_status(self):
 
-    def update_marker_visibility_status(self):
+        # Landing stage and timing (s) relative to the start of the landing
+        if self.landing_start_time is None:
+            return
 
         now = rospy.get_time()
 
-        if now - self.ibvs_time_queue_outer[-1] <= 1.0:
-            self.outer_target_is_visible = True
-        else:
-            self.outer_target_is_visible = False
-
-        if now - self.ibvs_time_queue_inner[-1] <= 1.0:
-            self.inner_target_is_visible = True
+        status = DiagnosticStatus()
+        status.name = 'landing'
+        status.hardware_id = 'ibvs_state_machine'
+        status.message = self.landing_stage
+        if self.landing_stage == 'DISARM_ABORTED':
+            status.level = DiagnosticStatus.ERROR
+        elif self.landing_stage == 'DISARM_FAILED':
+            status.level = DiagnosticStatus.WARN
         else:
-            self.inner_target_is_visible = False
+            status.level = DiagnosticStatus.OK
 
-        # If current_target == 'aruco_outer'
-        if self.current_target == 'aruco_outer':
+        status.values = [KeyValue('stage', self.landing_stage),
+                         KeyValue('start_time', '%.3f' % self.landing_start_time),
+                         KeyValue('elapsed', '%.3f' % (now - self.landing_start_time)),
+                         KeyValue('thrust', '%.3f' % self.thrust_val),
+                         KeyValue('disarm_attempts', str(self.disarm_attempt))]
 
-            if self.outer_target_is_visible:
+        if self.disarm_request_time is not None:
+            status.values.append(KeyValue('disarm_request', '%.3f' % (self.disarm_request_time - self.landing_start_time)))
+        if self.landing_stage == 'DISARM_FAILED' and self.disarm_attempt < self.disarm_attempts:
+            status.values.append(KeyValue('retry_in', '%.3f' % max(self.disarm_retry_time - now, 0.0)))
+        if self.landing_stage == 'DISARMED':
+            status.values.append(KeyValue('disarm_call', '%.3f' % (self.disarm_response_time - self.disarm_request_time)))
+            status.values.append(KeyValue('touchdown', '%.3f' % (self.disarm_response_time - self.landing_start_time)))
 
-                self.current_target_is_visible = True
+        diagnostics_msg = DiagnosticArray()
+        diagnostics_msg.header.stamp = rospy.get_rostime()
+        diagnostics_msg.status.append(status)
 
-                if self.inner_target_is_visible:
+        self.landing_status_pub.publish(diagnostics_msg)
 
-                    self.other_target_is_visible = True
 
-                else:
-
-                    self.other_target_is_visible = False
-
-            else:
-
-                self.current_target_is_visible = False
-
-                if self.inner_target_is_visible:
-
-                    self.other_target_is_visible = True
-
-                else:
-
-                    self.other_target_is_visible = False
-
-        
-        # If current_target == 'aruco_inner'
-        elif self.current_target == 'aruco_inner':
-
-            if self.inner_target_is_visible:
-
-                self.current_target_is_visible = True
-
-                if self.outer_target_is_visible:
-
-                    self.other_target_is_visible = True
-
-                else:
-
-                    self.other_target_is_visible = False
-
-            else:
-
-                self.current_target_is_visible = False
-
-                if self.outer_target_is_visible:
-
-                    self.other_target_is_visible = True
-
-                else:
-
-                    self.other_target_is_visible = False
+    def send_ibvs_command(self, flag):
 
+        if flag == 'inner':
+            x = self.saturate(self.ibvs_x_inner, self.u_max_inner, -self.u_max_inner)
+            y = self.saturate(self.ibvs_y_inner, self.v_max_inner, -self.v_max_inner)
+            F = self.saturate(self.ibvs_F_inner, self.w_max_inner, -self.w_max_inner)
+            z = self.ibvs_z_inner
+        elif flag == 'outer':
+            x = self.saturate(self.ibvs_x, self.u_max, -self.u_max)
+            y = self.saturate(self.ibvs_y, self.v_max, -self.v_max)
+            F = self.saturate(self.ibvs_F, self.w_max, -self.w_max)
+            z = self.ibvs_z
         else:
+            return
 
-            print 'State Machine: Invalid target flag.'
-
-
-    def execute_landing(self):
-        
+        # target velocity feed-forward in the heading-aligned frame, the heading trig comes from this tick's frame context
         if self.mode_flag == 'mavros':
+            ff_x, ff_y = self.frame.heading_right_forward(self.target_VN, self.target_VE)
 
-            # Update the status flag.
-            self.status_flag = 'LAND'
-
-            # Ramp down the motors.
-            self.ramp_down_motors(self.landing_thrust0)
+            ibvs_command_msg = self.ibvs_command_msg_mavros
+            ibvs_command_msg.header.stamp = rospy.get_rostime()
+            ibvs_command_msg.velocity.x = x + ff_x
+            ibvs_command_msg.velocity.y = y + ff_y
+            ibvs_command_msg.velocity.z = F
+            ibvs_command_msg.yaw_rate = z
 
-            
-            # rospy.wait_for_service('/mavros/set_mode')
-            # try:
-            #     isModeChanged = self.set_mode_srv(custom_mode='AUTO.LAND')
-            
-            #     if isModeChanged:
-            #         self.land_mode_sent = True
-            #         print "mode %s sent." % 'AUTO.LAND'
-            #         self.status_flag = 'LAND'
-
-            # except rospy.ServiceException, e:
-            #     print "service call set_mode failed: %s" % e
+            # Publish.
+            self.command_pub_mavros.publish(ibvs_command_msg)
 
         else:
-            
-            command_msg = Command()
-            command_msg.x = 0.0
-            command_msg.y = 0.0
-            command_msg.F = 0.0
-            command_msg.z = 0.0
-            command_msg.mode = Command.MODE_ROLL_PITCH_YAWRATE_THROTTLE
-            self.command_pub_roscopter.publish(command_msg)
-            self.status_flag = 'LAND'
-
-
-    def ramp_down_motors(self, start_thrust):
-
-        self.thrust_val = start_thrust
-
-        # We want the ramp down to take place in 1.0 seconds
-        ramp_time = 1.0
-        decrement = (start_thrust - 0.2) / 10.0
+            ff_x, ff_y = self.frame.heading_forward_right(self.target_VN, self.target_VE)
 
-        for x in range(0, 10):
+            ibvs_command_msg = self.ibvs_command_msg_roscopter
+            ibvs_command_msg.x = x + ff_x
+            ibvs_command_msg.y = y + ff_y
+            ibvs_command_msg.F = F
+            ibvs_command_msg.z = z
+            self.command_pub_roscopter.publish(ibvs_command_msg)
 
-            self.thrust_val -= decrement
-            # print self.thrust_val
-            # print "there"
+        self.trace_ibvs_setpoint(flag)
 
-            # Send the attitude and thrust setpoint message.
-            self.send_attitude_command()
-
-            # Wait a sec since we want the ramp down to happen in 0.5 seconds.
-            rospy.sleep(ramp_time / 10.0)
-
-        # Disarm Here
-        rospy.sleep(0.05)
-        rospy.wait_for_service('/mavros/cmd/arming')
-        try:
-            success = self.arm_srv(value=False)
 
-            if success:
-                print "Disarm."
-        except rospy.ServiceException, e:
-                print "service call disarm failed: %s" % e
+    def trace_ibvs_setpoint(self, flag):
 
+        if flag == 'inner':
+            stamp = self.ibvs_stamp_inner
+            receive_time = self.ibvs_receive_time_inner
+        elif flag == 'outer':
+            stamp = self.ibvs_stamp_outer
+            receive_time = self.ibvs_receive_time_outer
+        else:
+            return
 
-    def send_ibvs_command(self, flag):
-
-        if self.mode_flag == 'mavros':
-            if flag == 'inner':
-
-                ibvs_command_msg = PositionTarget()
-                ibvs_command_msg.header.stamp = rospy.get_rostime()
-                ibvs_command_msg.coordinate_frame = ibvs_command_msg.FRAME_BODY_NED
-                ibvs_command_msg.type_mask = self.velocity_mask
+        # no stamped commands yet
+        if stamp == 0.0:
+            return
 
-                ibvs_command_msg.velocity.x = self.saturate(self.ibvs_x_inner, self.u_max_inner, -self.u_max_inner) + self.target_VE*np.cos(self.psi) - self.target_VN*np.sin(self.psi)
-                ibvs_command_msg.velocity.y = self.saturate(self.ibvs_y_inner, self.v_max_inner, -self.v_max_inner) + self.target_VN*np.cos(self.psi) + self.target_VE*np.sin(self.psi)
-                ibvs_command_msg.velocity.z = self.saturate(self.ibvs_F_inner, self.w_max_inner, -self.w_max_inner)
+        # time from the camera image to the setpoint we just sent
+        self.latency_msg.data = self.latency_monitor.add_setpoint(stamp, receive_time, rospy.get_time())
+        self.latency_pub.publish(self.latency_msg)
 
-                ibvs_command_msg.yaw_rate = self.ibvs_z_inner
 
-                # Publish.
-                self.command_pub_mavros.publish(ibvs_command_msg)
+    def send_latency_diagnostics(self, event):
 
-            elif flag == 'outer':
+        diagnostics_msg = DiagnosticArray()
+        diagnostics_msg.header.stamp = rospy.get_rostime()
 
-                ibvs_command_msg = PositionTarget()
-                ibvs_command_msg.header.stamp = rospy.get_rostime()
-                ibvs_command_msg.coordinate_frame = ibvs_command_msg.FRAME_BODY_NED
-                ibvs_command_msg.type_mask = self.velocity_mask
+        for stage, count, p50, p95, p99, max_latency in self.latency_monitor.summary():
 
-                ibvs_command_msg.velocity.x = self.saturate(self.ibvs_x, self.u_max, -self.u_max) + self.target_VE*np.cos(self.psi) - self.target_VN*np.sin(self.psi)
-                ibvs_command_msg.velocity.y = self.saturate(self.ibvs_y, self.v_max, -self.v_max) + self.target_VN*np.cos(self.psi) + self.target_VE*np.sin(self.psi)
-                ibvs_command_msg.velocity.z = self.saturate(self.ibvs_F, self.w_max, -self.w_max)
+            status = DiagnosticStatus()
+            status.name = 'ibvs_latency/' + stage
+            status.hardware_id = 'ibvs_state_machine'
 
-                ibvs_command_msg.yaw_rate = self.ibvs_z
+            if stage == 'total' and p95 > self.stale_command_age:
+                status.level = DiagnosticStatus.WARN
+                status.message = 'p95 older than %.0f ms' % (1.0e3*self.stale_command_age)
+            else:
+                status.level = DiagnosticStatus.OK
+                status.message = 'p50 %.1f ms' % (1.0e3*p50)
 
-                # Publish.
-                self.command_pub_mavros.publish(ibvs_command_msg)
+            status.values = [KeyValue('count', str(count)),
+                             KeyValue('p50_ms', '%.2f' % (1.0e3*p50)),
+                             KeyValue('p95_ms', '%.2f' % (1.0e3*p95)),
+                             KeyValue('p99_ms', '%.2f' % (1.0e3*p99)),
+                             KeyValue('max_ms', '%.2f' % (1.0e3*max_latency))]
 
-            else:
-                pass
+            diagnostics_msg.status.append(status)
 
-        else:
-            if flag == 'inner':
-
-                ibvs_command_msg = Command()
-                ibvs_command_msg.x = self.saturate(self.ibvs_x_inner, self.u_max_inner, -self.u_max_inner) + self.target_VN*np.cos(self.psi) + self.target_VE*np.sin(self.psi)
-                ibvs_command_msg.y = self.saturate(self.ibvs_y_inner, self.v_max_inner, -self.v_max_inner) + self.target_VE*np.cos(self.psi) - self.target_VN*np.sin(self.psi)
-                ibvs_command_msg.F = self.saturate(self.ibvs_F_inner, self.w_max_inner, -self.w_max_inner)
-                ibvs_command_msg.z = self.ibvs_z_inner
-                ibvs_command_msg.mode = Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE
-                self.command_pub_roscopter.publish(ibvs_command_msg)
-
-            elif flag == 'outer':
-
-                ibvs_command_msg = Command()
-                ibvs_command_msg.x = self.saturate(self.ibvs_x, self.u_max, -self.u_max) + self.target_VN*np.cos(self.psi) + self.target_VE*np.sin(self.psi)
-                ibvs_command_msg.y = self.saturate(self.ibvs_y, self.v_max, -self.v_max) + self.target_VE*np.cos(self.psi) - self.target_VN*np.sin(self.psi)
-                ibvs_command_msg.F = self.saturate(self.ibvs_F, self.w_max, -self.w_max)
-                ibvs_command_msg.z = self.ibvs_z
-                ibvs_command_msg.mode = Command.MODE_XVEL_YVEL_YAWRATE_ALTITUDE
-                self.command_pub_roscopter.publish(ibvs_command_msg)
+        status = DiagnosticStatus()
+        status.name = 'ibvs_latency/stale_commands'
+        status.hardware_id = 'ibvs_state_machine'
+        status.level = DiagnosticStatus.OK if self.latency_monitor.stale_count == 0 else DiagnosticStatus.WARN
+        status.message = '%d of %d setpoints' % (self.latency_monitor.stale_count, self.latency_monitor.setpoint_count)
+        status.values = [KeyValue('stale_count', str(self.latency_monitor.stale_count)),
+                         KeyValue('setpoint_count', str(self.latency_monitor.setpoint_count)),
+                         KeyValue('stale_age_ms', '%.0f' % (1.0e3*self.stale_command_age)),
+                         KeyValue('forwarding', 'event' if self.event_driven_ibvs else 'timer')]
+        diagnostics_msg.status.append(status)
 
-            else:
-                pass
+        self.latency_diagnostics_pub.publish(diagnostics_msg)
 
 
     def send_waypoint_command(self):
 
         if self.mode_flag == 'mavros':
-            waypoint_command_msg = PositionTarget()
+            waypoint_command_msg = self.waypoint_command_msg_mavros
             waypoint_command_msg.header.stamp = rospy.get_rostime()
-            waypoint_command_msg.coordinate_frame = waypoint_command_msg.FRAME_LOCAL_NED
-            waypoint_command_msg.type_mask = self.ned_pos_mask
 
             waypoint_command_msg.position.x = self.wp_E  # E
             waypoint_command_msg.position.y = self.wp_N  # N
             waypoint_command_msg.position.z = self.rendezvous_height  # U
 
+            if self.intercept_planner is not None:
+                waypoint_command_msg.velocity.x = self.wp_VE  # E
+                waypoint_command_msg.velocity.y = self.wp_VN  # N
+                waypoint_command_msg.velocity.z = 0.0  # U
+
             # This converts an NED heading command into an ENU heading command
-            yaw = -self.heading_command + np.radians(90.0)
-            while yaw > np.radians(180.0):  yaw = yaw - np.radians(360.0)
-            while yaw < np.radians(-180.0):  yaw = yaw + np.radians(360.0)
+            yaw = -self.heading_command + 0.5*np.pi
+            while yaw > np.pi:  yaw = yaw - 2.0*np.pi
+            while yaw < -np.pi:  yaw = yaw + 2.0*np.pi
 
             waypoint_command_msg.yaw = yaw
 
@@ -743,12 +624,11 @@ class StateMachine():
             self.command_pub_mavros.publish(waypoint_command_msg)
 
         else:
-            wp_command_msg = Command()
+            wp_command_msg = self.waypoint_command_msg_roscopter
             wp_command_msg.x = self.wp_N
             wp_command_msg.y = self.wp_E
             wp_command_msg.F = -self.rendezvous_height
             wp_command_msg.z = self.heading_command
-            wp_command_msg.mode = Command.MODE_XPOS_YPOS_YAW_ALTITUDE
 
             # Publish.
             self.command_pub_roscopter.publish(wp_command_msg)
@@ -756,14 +636,8 @@ class StateMachine():
 
     def send_attitude_command(self):
 
-        command_msg = AttitudeTarget()
+        command_msg = self.attitude_command_msg_mavros
         command_msg.header.stamp = rospy.get_rostime()
-        command_msg.type_mask = self.attitude_mask
-
-        command_msg.body_rate.x = 0.0
-        command_msg.body_rate.y = 0.0
-        command_msg.body_rate.z = 0.0
-
         command_msg.thrust = self.thrust_val
 
         # Publish.
@@ -781,83 +655,66 @@ class StateMachine():
         self.avg_attitude_pub.publish(avg_attitude_msg)
 
 
-    def compute_rendezvous_offset(self, phi, theta):
-
-        # Flat-earth geolocation to compute the rendezvous offset
-        sphi = np.sin(phi)
-        cphi = np.cos(phi)
-        stheta = np.sin(theta)
-        ctheta = np.cos(theta)
-        spsi = np.sin(self.psi)
-        cpsi = np.cos(self.psi)
-
-        # mounting angle offsets
-        phi_m = 0.0    # roll relative to the body frame
-        theta_m = 0.0  # pitch '...'
-        psi_m = 0.0    # yaw '...'
-
-        ## define fixed rotations
-        sphi_m = np.sin(phi_m)
-        cphi_m = np.cos(phi_m)
-        stheta_m = np.sin(theta_m)
-        ctheta_m = np.cos(theta_m)
-        spsi_m = np.sin(psi_m )
-        cpsi_m = np.cos(psi_m )
-
-        # Define rotations.
-        # R_b_i = R_i_b transpose
-        R_b_i = np.array([[ctheta*cpsi, ctheta*spsi, -stheta],
-                          [sphi*stheta*cpsi - cphi*spsi, sphi*stheta*spsi + cphi*cpsi, sphi*ctheta],
-                          [cphi*stheta*cpsi + sphi*spsi, cphi*stheta*spsi - sphi*cpsi, cphi*ctheta]]).T
-        R_m_b = np.array([[ctheta_m*cpsi_m, ctheta_m*spsi_m, -stheta_m],
-                          [sphi_m*stheta_m*cpsi_m-cphi_m*spsi_m, sphi_m*stheta_m*spsi_m+cphi_m*cpsi_m, sphi_m*ctheta_m],
-                          [cphi_m*stheta_m*cpsi_m+sphi_m*spsi_m, cphi_m*stheta_m*spsi_m-sphi_m*cpsi_m, cphi_m*ctheta_m]]).T
-        R_c_m = np.array([[0., 1., 0.],
-                          [-1., 0., 0.],
-                          [0., 0., 1.]]).T
-
-        R_c_i = R_b_i.dot(R_m_b.dot(R_c_m))
-
-        # From eq 13.9 in UAV book but we want the target at the center of the image frame and thus the unit
-        # vector el_hat_c is simply:
-        el_hat_c = np.array([[0.0],
-                             [0.0],
-                             [1.0]])
-        # Vector aligned with inertial k (down) axis
-        k_i = np.array([[0.0],
-                        [0.0],
-                        [1.0]])
-
-        # Derrived from EQ 13.18
-        numerator = R_c_i.dot(el_hat_c)
-        denominator = np.dot(k_i.T, numerator)
-
-        P_target = np.array([[0.0],
-                             [0.0],
-                             [0.0]])
-
-        # EQ 13.18 rearranged
-        P_uav = P_target - self.rendezvous_height*numerator/denominator
-
-        return P_uav
+    def send_wind_calibration(self):
+
+        # Live average roll and pitch and how far off they could be (rad)
+        now = rospy.get_rostime()
+        self.wind_attitude_msg.header.stamp = now
+        self.wind_attitude_msg.vector.x, self.wind_attitude_msg.vector.y = self.wind_calibration.mean()
+
+        self.wind_uncertainty_msg.header.stamp = now
+        self.wind_uncertainty_msg.vector.x, self.wind_uncertainty_msg.vector.y = self.wind_calibration.uncertainty()
+
+        self.wind_attitude_pub.publish(self.wind_attitude_msg)
+        self.wind_uncertainty_pub.publish(self.wind_uncertainty_msg)
+
+
+    def send_wind_estimate(self):
+
+        # Wind (N, E in m/s, drag coefficient in 1/s) and the roll and pitch that hold the rendezvous point with its uncertainty (rad)
+        now = rospy.get_rostime()
+        self.wind_estimate_msg.header.stamp = now
+        self.wind_estimate_msg.vector.x, self.wind_estimate_msg.vector.y = self.wind_estimator.wind()
+        self.wind_estimate_msg.vector.z = self.wind_estimator.k
+
+        self.hover_attitude_msg.header.stamp = now
+        self.hover_attitude_msg.vector.x, self.hover_attitude_msg.vector.y = self.wind_estimator.hover_attitude(
+            self.psi, self.target_VN, self.target_VE)
+        self.hover_attitude_msg.vector.z = self.wind_estimator.tilt_uncertainty(self.target_VN, self.target_VE)
+
+        self.wind_estimate_pub.publish(self.wind_estimate_msg)
+        self.hover_attitude_pub.publish(self.hover_attitude_msg)
+
+
+    def send_intercept(self):
+
+        # the intercept point update_intercept just planned, on /rendezvous/intercept
+        self.publish_intercept(self.intercept_pub, self.intercept_msg, rospy.get_rostime())
+
+
+    def ibvs_velocity_cmd_stamped_callback(self, msg):
+
+        # keep the image stamp of the corners behind this command for the latency monitor
+        self.ibvs_stamp_outer = msg.header.stamp.to_sec()
+        self.ibvs_receive_time_outer = rospy.get_time()
+
+        self.ibvs_velocity_cmd_callback(msg.twist)
+
+
+    def ibvs_velocity_cmd_inner_stamped_callback(self, msg):
+
+        self.ibvs_stamp_inner = msg.header.stamp.to_sec()
+        self.ibvs_receive_time_inner = rospy.get_time()
+
+        self.ibvs_velocity_cmd_inner_callback(msg.twist)
 
 
     def ibvs_velocity_cmd_callback(self, msg):
 
         if self.mode_flag == 'mavros':
-            # fill out the NED velocity vector
-            self.ned_vel_vec_outer[0][0] = msg.linear.x
-            self.ned_vel_vec_outer[1][0] = msg.linear.y
-            self.ned_vel_vec_outer[2][0] = msg.linear.z
+            # rotate into the enu frame and update state variables with the ENU data
+            self.ibvs_x, self.ibvs_y, self.ibvs_F = ned_to_enu(msg.linear.x, msg.linear.y, msg.linear.z)
 
-            # rotate into the enu frame
-            enu_vec = self.ned_to_enu(self.ned_vel_vec_outer)
-        
-            # update state variables with the ENU data
-            self.ibvs_x = enu_vec[0][0]
-            self.ibvs_y = enu_vec[1][0]
-            self.ibvs_F = enu_vec[2][0]
-        
             # here we just flip the sign for yawrate to work with mavros FLU coord frame
             self.ibvs_z = -msg.angular.z
 
@@ -870,27 +727,20 @@ class StateMachine():
 
         # print '\nx_vel:', self.ibvs_x, '\ny_vel:', self.ibvs_y, '\nz_vel:', self.ibvs_F
 
-        # Make sure we've seen the marker at least 5 times within the last second
-        # get the time
-        self.ibvs_time_outer = rospy.get_time()
-        self.ibvs_time_queue_outer.appendleft(self.ibvs_time_outer)
+        # Count the command towards the marker's detection rate (see marker_visibility.py), under command_lock so
+        # step() never sees the new rate with the old detection time
+        with self.command_lock:
+            self.marker_seen('outer')
+
+            if self.event_driven_ibvs:
+                self.forward_ibvs_command('outer')
 
 
     def ibvs_velocity_cmd_inner_callback(self, msg):
 
         if self.mode_flag == 'mavros':
-            # fill out the NED velocity vector
-            self.ned_vel_vec_inner[0][0] = msg.linear.x
-            self.ned_vel_vec_inner[1][0] = msg.linear.y
-            self.ned_vel_vec_inner[2][0] = msg.linear.z
-
-            # rotate into the enu frame
-            enu_vec = self.ned_to_enu(self.ned_vel_vec_inner)
-
-            # update state variables with the ENU data
-            self.ibvs_x_inner = enu_vec[0][0]
-            self.ibvs_y_inner = enu_vec[1][0]
-            self.ibvs_F_inner = enu_vec[2][0]
+            # rotate into the enu frame and update state variables with the ENU data
+            self.ibvs_x_inner, self.ibvs_y_inner, self.ibvs_F_inner = ned_to_enu(msg.linear.x, msg.linear.y, msg.linear.z)
 
             # here we just flip the sign for yawrate to work with mavros FLU coord frame
             self.ibvs_z_inner = -msg.angular.z
@@ -905,10 +755,13 @@ class StateMachine():
             self.ibvs_z_inner = msg.angular.z
 
 
-        # Make sure we've seen the marker at least 5 times within the last second
-        # get the time
-        self.ibvs_time_inner = rospy.get_time()
-        self.ibvs_time_queue_inner.appendleft(self.ibvs_time_inner)
+        # Count the command towards the marker's detection rate (see marker_visibility.py), under command_lock so
+        # step() never sees the new rate with the old detection time
+        with self.command_lock:
+            self.marker_seen('inner')
+
+            if self.event_driven_ibvs:
+                self.forward_ibvs_command('inner')
 
 
     def ibvs_ave_error_callback(self, msg):
@@ -932,7 +785,7 @@ class StateMachine():
 
     # def aruco_att_callback(self, msg):
 
-    #     self.R_aruco = self.get_R_from_quaternion(msg.pose.orientation.w, msg.pose.orientation.x, msg.pose.orientation.y, msg.pose.orientation.z)
+    #     self.R_aruco = np.array(quaternion_to_inverse_rotation(msg.pose.orientation.x, msg.pose.orientation.y, msg.pose.orientation.z, msg.pose.orientation.w))
 
     #     vec = np.dot(self.R_aruco, np.array([[0], [0], [-1]]))
 
@@ -957,71 +810,52 @@ class StateMachine():
 
     def aruco_angle_callback(self, msg):
 
-        angle = msg.data
-        # print(angle)
-
-        if self.inner_error_condition:
-            if (angle <= self.max_boat_angle) and (self.p_des_error_inner <= self.p_des_error_inner_threshold):
-                self.safe_to_land = True
-            else:
-                self.safe_to_land = False
-        else:
-            if angle <= self.max_boat_angle:
-                self.safe_to_land = True
-            else:
-                self.safe_to_land = False
+        # angle in degrees, compared with max_boat_angle
+        self.set_marker_angle(msg.data)
 
 
     def target_callback(self, msg):
 
-        self.target_N = msg.pose.pose.position.x
-        self.target_E = msg.pose.pose.position.y
-
-        self.wp_N = self.target_N + self.wind_offset[0][0]
-        self.wp_E = self.target_E + self.wind_offset[1][0]
+        self.set_target(msg.pose.pose.position.x, msg.pose.pose.position.y)
 
 
     def state_callback(self, msg):
 
-        # this should already be coming in NED
-        self.pn = msg.pose.pose.position.x
-        self.pe = msg.pose.pose.position.y
-        self.pd = msg.pose.pose.position.z
-
         # convert quaternion to RPY
-        quaternion = (
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w)
+        orientation = msg.pose.pose.orientation
+        phi, theta, psi = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
-        self.phi = euler[0]
-        self.theta = euler[1]
-        self.psi = euler[2]
+        # this should already be coming in NED, also updates our roll and pitch statistics.
+        # Goes into the state snapshot, the send_commands timer picks it up on its next tick
+        self.set_state(msg.pose.pose.position.x, msg.pose.pose.position.y, msg.pose.pose.position.z,
+                       phi, theta, psi)
+
+        # the fused pipeline needs roll and pitch for the level-frame mapping
+        if self.fused_pipeline:
+            stamp = msg.header.stamp.to_sec()
+            self.fused_outer.set_attitude(phi, theta, stamp)
+            self.fused_inner.set_attitude(phi, theta, stamp)
 
         # update wp_error
         # self.wp_error = np.sqrt((self.pn - self.wp_N)**2 + (self.pe - self.wp_E)**2
             # + (-self.pd - self.rendezvous_height)**2)
 
-        # update our attitude queues
-        self.phi_queue.appendleft(self.phi)
-        self.theta_queue.appendleft(self.theta)
+        # and the online wind estimate
+        if self.online_wind_estimation:
+            self.set_velocity(msg.header.stamp.to_sec(), msg.twist.twist.linear.x, msg.twist.twist.linear.y,
+                              msg.twist.twist.linear.z, self.velocity_frame != 'ned')
 
 
     def target_velocity_callback(self, msg):
 
         # Pull of the target velocity data
-        self.target_VN = msg.x
-        self.target_VE = msg.y
-
+        self.set_target_velocity(msg.x, msg.y)
 
-    def update_wp_error(self):
-
-        self.wp_error = np.sqrt((self.pn - self.wp_N)**2 + (self.pe - self.wp_E)**2
-            + (-self.pd - self.rendezvous_height)**2)
 
+    def target_prediction_callback(self, msg):
 
+        # Pull of the predicted target velocity
+        self.set_target_velocity(msg.twist.twist.linear.x, msg.twist.twist.linear.y)
 
 
     def saturate(self, value, up_limit, low_limit):
@@ -1037,74 +871,6 @@ class StateMachine():
         return rVal
 
 
-    def ned_to_enu(self, ned_vec):
-
-        enu_vec = np.dot(self.R_ned_enu, ned_vec)
-        return enu_vec
-
-
-    def get_R_from_quaternion(self, w, x, y, z):
-        
-        wx = w*x
-        wy = w*y
-        wz = w*z
-        xx = x*x
-        xy = x*y
-        xz = x*z
-        yy = y*y
-        yz = y*z
-        zz = z*z
-
-        return np.array([[1. - 2.*yy - 2.*zz, 2.*xy + 2.*wz, 2.*xz - 2.*wy],
-                         [2.*xy - 2.*wz, 1. - 2.*xx - 2.*zz, 2.*yz + 2.*wx],
-                         [2.*xz + 2.*wy, 2.*yz - 2.*wx, 1. - 2.*xx - 2.*yy]])
-
-
-    def find_remaped_euler(self, euler_angles, psi_des):
-
-        # Euler angles passed in
-        phi = euler_angles[0]
-        theta = euler_angles[1]
-        psi = psi_des
-
-        # Pre-evaluate sines and cosines
-        sphi = np.sin(phi)
-        cphi = np.cos(phi)
-
-        stheta = np.sin(theta)
-        ctheta = np.cos(theta)
-
-        spsi = np.sin(psi)
-        cpsi = np.cos(psi)
-
-        vec = np.array([[cphi*stheta*cpsi + sphi*spsi],
-                        [cphi*stheta*spsi - sphi*cpsi],
-                        [cphi*ctheta]])
-
-        F = vec - self.z_unit
-
-        F = F.flatten()
-
-        return F
-
-
-    def write_ave_att_file(self, roll_ave, pitch_ave):
-
-        if self.mode_flag == 'mavros':
-
-            try:
-                path = '/home/nvidia/' + self.test_name + '_att_ave.txt'
-                text_file = open(path, 'w')
-                text_file.write('Average Roll (deg): %s' % str(np.degrees(roll_ave)))
-                text_file.write('\n')
-                text_file.write('Average Pitch (deg): %s' % str(np.degrees(pitch_ave)))
-                text_file.close()
-            except:
-                print "State Machine: Error saving average attitude file."
-        else:
-            pass
-
-
 
 def main():
     # initialize a node
@@ -2,7 +2,7 @@
 
 import numpy as np
 
-import rospy, tf
+import rospy
 
 from std_msgs.msg import Bool
 from std_msgs.msg import Float32
@@ -11,6 +11,7 @@ from geometry_msgs.msg import Twist
 from geometry_msgs.msg import PoseStamped
 from rosflight_msgs.msg import Command
 from roscopter_msgs.srv import AddWaypoint, RemoveWaypoint, SetWaypointsFromFile
+from rotation_kernel import quaternion_to_euler
 
 # TODO:
 # -add approximate distance calculation (for when ArUco NaNs)
@@ -179,7 +180,7 @@ class WaypointManager():
             # print "following waypoints"
             # Get error between waypoint and current state
             current_waypoint = np.array(self.waypoint_list[self.current_waypoint_index])
-            (r, p, y) = tf.transformations.euler_from_quaternion([msg.pose.pose.orientation.x, msg.pose.pose.orientation.y, msg.pose.pose.orientation.z, msg.pose.pose.orientation.w])
+            (r, p, y) = quaternion_to_euler(msg.pose.pose.orientation.x, msg.pose.pose.orientation.y, msg.pose.pose.orientation.z, msg.pose.pose.orientation.w)
             current_position = np.array([msg.pose.pose.position.x,
                                          msg.pose.pose.position.y,
                                          msg.pose.pose.position.z])
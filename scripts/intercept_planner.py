@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+## Rendezvous point for a moving target. Flying to the last reported target
+## position means chasing a point that is already behind the target, so the
+## waypoint error only closes at the difference of the two speeds.
+##
+## The target (last position, the time it was reported and its EKF velocity)
+## is propagated to now, then the planner finds the earliest time t at which a
+## copter flying straight at 'speed' meets it:
+##   |d + v*t| = speed*t,  d = target - copter,  v = target velocity
+##   (|v|^2 - speed^2)*t^2 + 2*(d.v)*t + |d|^2 = 0
+## and the intercept point is target + v*t. As the copter closes in, t goes to
+## zero and the point becomes the (propagated) target itself. If the target is
+## too fast to catch, or the intercept is further out than 'horizon' seconds,
+## the point is where the target will be 'horizon' seconds from now.
+##
+## The rendezvous offset (wind) rides along with the target, so it is added to
+## the target position by the caller.
+
+import math
+
+
+class InterceptPlanner(object):
+
+    def __init__(self, speed=3.0, horizon=30.0):
+
+        # horizontal speed the copter flies to the rendezvous point at (m/s) and the longest intercept time (s)
+        self.speed = speed
+        self.horizon = horizon
+
+        # latest plan: intercept point NE (m) and time to intercept (s)
+        self.intercept_N = 0.0
+        self.intercept_E = 0.0
+        self.time_to_intercept = 0.0
+
+
+    def time_to_go(self, d_N, d_E, v_N, v_E):
+
+        # earliest t >= 0 with |d + v*t| = speed*t, None if there is none
+        a = v_N*v_N + v_E*v_E - self.speed*self.speed
+        b = d_N*v_N + d_E*v_E
+        c = d_N*d_N + d_E*d_E
+
+        if c == 0.0:
+            return 0.0
+
+        # a == 0: target exactly as fast as the copter
+        if abs(a) < 1.0e-9:
+            if b >= 0.0:
+                return None
+            return -c/(2.0*b)
+
+        # the roots of a*t^2 + 2*b*t + c, with a < 0 there is exactly one positive one
+        discriminant = b*b - a*c
+        if discriminant < 0.0:
+            return None
+
+        root = math.sqrt(discriminant)
+        if a < 0.0:
+            return (-b - root)/a
+
+        # faster target: both roots positive (take the first) only if it's coming towards us
+        t = (-b - root)/a
+        if t < 0.0:
+            return None
+        return t
+
+
+    def plan(self, now, p_N, p_E, target_N, target_E, target_time, v_N, v_E):
+
+        # copter at (p_N, p_E), target reported at (target_N, target_E) at target_time moving at (v_N, v_E)
+        age = max(now - target_time, 0.0)
+        target_N += v_N*age
+        target_E += v_E*age
+
+        t = self.time_to_go(target_N - p_N, target_E - p_E, v_N, v_E)
+        if t is None or t > self.horizon:
+            t = self.horizon
+
+        self.intercept_N = target_N + v_N*t
+        self.intercept_E = target_E + v_E*t
+        self.time_to_intercept = t
+
+        return self.intercept_N, self.intercept_E
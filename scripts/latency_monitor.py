@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+## Latency bookkeeping for the vision-to-setpoint path. Every IBVS command
+## carries the stamp of the camera image its corners came from (the
+## TwistStamped on /ibvs/vel_cmd_stamped, or the fused pipeline in
+## ibvs_fused.py), so for each setpoint we can split the age of the data into
+##   command:  image stamp -> IBVS command received by the state machine
+##             (ArUco detection, level-frame mapping, IBVS and transport)
+##   hold:     IBVS command received -> setpoint sent (waiting on the command timer)
+##   forward:  IBVS command received -> first setpoint built from it (only counted
+##             once per command, so it shows what forwarding costs, timer or event driven)
+##   total:    image stamp -> setpoint sent
+## Each stage keeps a rolling window of samples in a preallocated ring buffer
+## and reports its p50/p95/p99. A setpoint built from an image older than
+## stale_age is counted as stale.
+
+import numpy as np
+
+
+# stages tracked by LatencyMonitor, in the order they're reported
+LATENCY_STAGES = ('command', 'hold', 'forward', 'total')
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, window=500):
+
+        # the last 'window' samples (s)
+        self.samples = np.zeros(window)
+        self.window = window
+        self.index = 0
+        self.count = 0
+        self.max = 0.0
+
+
+    def add(self, latency):
+
+        self.samples[self.index] = latency
+        self.index = (self.index + 1) % self.window
+        self.count += 1
+
+        if latency > self.max:
+            self.max = latency
+
+
+    def percentiles(self, q=(50.0, 95.0, 99.0)):
+
+        n = min(self.count, self.window)
+        if n == 0:
+            return [0.0 for x in q]
+
+        return np.percentile(self.samples[:n], q)
+
+
+    def reset(self):
+
+        self.index = 0
+        self.count = 0
+        self.max = 0.0
+
+
+class LatencyMonitor(object):
+
+    def __init__(self, window=500, stale_age=0.2):
+
+        self.histograms = dict((stage, LatencyHistogram(window)) for stage in LATENCY_STAGES)
+
+        # setpoints built from images older than this (s) count as stale
+        self.stale_age = stale_age
+        self.stale_count = 0
+        self.setpoint_count = 0
+
+        # receive time of the last command that went out, so 'forward' sees each command once
+        self.forwarded_receive_time = None
+
+
+    def add_setpoint(self, stamp, receive_time, send_time):
+
+        # stamp: image stamp of the command (s), receive_time: when the state machine got the command,
+        # send_time: when the setpoint went out. Returns the total latency.
+        total = send_time - stamp
+
+        self.histograms['command'].add(receive_time - stamp)
+        self.histograms['hold'].add(send_time - receive_time)
+        self.histograms['total'].add(total)
+
+        if receive_time != self.forwarded_receive_time:
+            self.histograms['forward'].add(send_time - receive_time)
+            self.forwarded_receive_time = receive_time
+
+        self.setpoint_count += 1
+        if total > self.stale_age:
+            self.stale_count += 1
+
+        return total
+
+
+    def summary(self):
+
+        # list of (stage, count, p50, p95, p99, max) with the latencies in seconds
+        rows = []
+        for stage in LATENCY_STAGES:
+            histogram = self.histograms[stage]
+            p50, p95, p99 = histogram.percentiles()
+            rows.append((stage, histogram.count, p50, p95, p99, histogram.max))
+
+        return rows
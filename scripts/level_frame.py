@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+
+## ROS-free version of the level_frame_mapper.py math. Undistorts the raw
+## ArUco corner pixels and rotates them into the virtual level camera frame
+## using the copter roll and pitch (eq. 14 in Lee et al.).
+##
+## Used by the level_frame_mapper.py node and by the fused pipeline in
+## ibvs_fused.py.
+##
+## The calibration never changes once we have the CameraInfo, so instead of
+## running the iterative cv2.undistortPoints on every message we undistort a
+## grid over the whole image once (UndistortionLUT) and bilinearly interpolate
+## the corners in it. The grid is refined until the interpolation error,
+## measured against cv2.undistortPoints at the cell centers and edge
+## midpoints (where the bilinear error of a smooth map peaks), is below
+## DEFAULT_LUT_TOLERANCE pixels. Corners off the table fall back on cv2.
+## The table only pays off per message, where the four-corner lookup is about
+## 1.2x faster than cv2 (undistort_benchmark.py). For large arrays of points
+## cv2.undistortPoints is as fast or faster, so interpolate() is only used to
+## check the table's accuracy.
+##
+## The corners are rotated with the attitude at the image stamp, not whatever
+## attitude came in last. Each attitude sample goes into a fixed-size ring
+## buffer together with its camera to virtual level frame rotation R_c_vlc
+## (so the trig is done once per attitude sample, not per corner message),
+## and the rotation for a corner message is found by binary search on the
+## stamps and linear interpolation between the two samples around it.
+## Element-wise interpolation of the two rotation matrices is off from the
+## true rotation by O(dangle^2), i.e. ~1e-4 for the 0.01 rad between estimator
+## samples during an aggressive correction. The attitude and corner subscribers
+## run in different threads, so the buffer is written and searched under a lock
+## (the trig for a new sample is done before taking it).
+##
+## Sources:
+## Lee et al. "Autonomous Landing of a VTOL UAV on a Moving Platform Using Image-based Visual Servoing"
+
+import threading
+import numpy as np
+import cv2
+import yaml
+
+
+# starting grid spacing (pixels) of the undistortion lookup table and the largest interpolation error (pixels) we accept
+DEFAULT_LUT_STEP = 16.0
+DEFAULT_LUT_TOLERANCE = 0.05
+
+# tables already built, keyed by the calibration (the outer and inner marker transforms share one)
+lut_cache = {}
+
+# number of attitude samples kept for the image stamp lookup (~3 s of the 60 Hz estimate)
+DEFAULT_ATTITUDE_HISTORY = 180
+
+
+def load_camera_yaml(filename):
+
+    # camera_info YAML (like the ones in params/) -> K, d, width, height
+    with open(filename) as f:
+        calib = yaml.safe_load(f)
+
+    K = np.array(calib['camera_matrix']['data'], dtype=np.float32).reshape((3,3))
+    d = np.array(calib['distortion_coefficients']['data'], dtype=np.float32)
+
+    return K, d, calib['image_width'], calib['image_height']
+
+
+def get_undistortion_lut(K, d, width, height, step=DEFAULT_LUT_STEP, tolerance=DEFAULT_LUT_TOLERANCE):
+
+    key = (tuple(np.ravel(K).tolist()), tuple(np.ravel(d).tolist()), width, height, step, tolerance)
+
+    if key not in lut_cache:
+        lut_cache[key] = UndistortionLUT(K, d, width, height, step, tolerance)
+
+    return lut_cache[key]
+
+
+class UndistortionLUT(object):
+
+    def __init__(self, K, d, width, height, step=DEFAULT_LUT_STEP, tolerance=DEFAULT_LUT_TOLERANCE, min_step=1.0):
+
+        self.K = np.array(K, dtype=np.float32).reshape((3,3))
+        self.d = np.array(d, dtype=np.float32)
+        self.fx = float(self.K[0][0])
+        self.fy = float(self.K[1][1])
+        self.width = width
+        self.height = height
+        self.tolerance = tolerance
+
+        # halve the grid spacing until the interpolation error is small enough
+        step = float(step)
+        while True:
+            self.build(step)
+            self.max_error = self.measure_error()
+
+            if self.max_error <= tolerance or step <= min_step:
+                break
+
+            step /= 2.0
+
+
+    def exact(self, u, v):
+
+        # cv2 undistortion of pixel coords u, v, de-normalized but still relative to the image center (N x 2)
+        points = np.empty((len(u), 1, 2))
+        points[:, 0, 0] = u
+        points[:, 0, 1] = v
+
+        undist = cv2.undistortPoints(points, self.K, self.d).reshape(-1, 2)
+        undist[:, 0] *= self.fx
+        undist[:, 1] *= self.fy
+
+        return undist
+
+
+    def build(self, step):
+
+        self.step = step
+        self.inv_step = 1.0 / step
+
+        # grid nodes cover the whole image (the last row/column may hang over the edge)
+        nx = int(np.ceil(self.width / step)) + 1
+        ny = int(np.ceil(self.height / step)) + 1
+        u, v = np.meshgrid(np.arange(nx) * step, np.arange(ny) * step)
+
+        table = self.exact(u.ravel(), v.ravel()).reshape(ny, nx, 2)
+
+        # per-cell bilinear coefficients, the value at (tx, ty) in [0, 1]^2 inside a cell is
+        # a + b*tx + c*ty + e*tx*ty for each of the two coordinates
+        a = table[:-1, :-1]
+        b = table[:-1, 1:] - a
+        c = table[1:, :-1] - a
+        e = table[1:, 1:] - table[:-1, 1:] - table[1:, :-1] + a
+        self.coef = np.concatenate((a, b, c, e), axis=2).reshape(-1, 8)   # [a_u, a_v, b_u, b_v, c_u, c_v, e_u, e_v]
+
+        # the per-message lookup only touches four cells, plain Python tuples are cheaper to index than numpy rows
+        self.cells = [tuple(row) for row in self.coef.tolist()]
+
+        self.num_cells_x = nx - 1
+        self.i_max = nx - 2
+        self.j_max = ny - 2
+        self.u_max = (nx - 1) * step
+        self.v_max = (ny - 1) * step
+
+
+    def measure_error(self):
+
+        # cell centers and the midpoints of the horizontal and vertical cell edges inside the image
+        half = 0.5 * self.step
+        u_mid = np.arange(half, self.width, self.step)
+        v_mid = np.arange(half, self.height, self.step)
+        u_node = np.arange(0.0, self.width, self.step)
+        v_node = np.arange(0.0, self.height, self.step)
+
+        u = []
+        v = []
+        for us, vs in ((u_mid, v_mid), (u_mid, v_node), (u_node, v_mid)):
+            uu, vv = np.meshgrid(us, vs)
+            u.append(uu.ravel())
+            v.append(vv.ravel())
+
+        u = np.concatenate(u)
+        v = np.concatenate(v)
+
+        return np.max(np.abs(self.interpolate(u, v) - self.exact(u, v)))
+
+
+    def interpolate(self, u, v):
+
+        # vectorized lookup for arrays of pixel coords (must lie on the table), returns N x 2. Only for the accuracy
+        # checks, it is no faster than exact() on big arrays
+        gx = np.asarray(u, dtype=np.float64) * self.inv_step
+        gy = np.asarray(v, dtype=np.float64) * self.inv_step
+
+        i = np.minimum(gx.astype(np.intp), self.i_max)
+        j = np.minimum(gy.astype(np.intp), self.j_max)
+
+        tx = (gx - i)[:, None]
+        ty = (gy - j)[:, None]
+
+        coef = self.coef[j*self.num_cells_x + i]
+
+        return coef[:, 0:2] + coef[:, 2:4]*tx + coef[:, 4:6]*ty + coef[:, 6:8]*(tx*ty)
+
+
+    def undistort_corners(self, data, offset, out):
+
+        # Per-message lookup of the four corners [u1, v1, ... u4, v4] starting at element 'offset' into out (4x2).
+        # Returns False if a corner is off the table (out is then only partly filled).
+        inv_step = self.inv_step
+        cells = self.cells
+        num_cells_x = self.num_cells_x
+        i_max = self.i_max
+        j_max = self.j_max
+        u_max = self.u_max
+        v_max = self.v_max
+
+        for k in range(4):
+            u = data[offset + 2*k]
+            v = data[offset + 2*k + 1]
+
+            if u < 0.0 or v < 0.0 or u > u_max or v > v_max:
+                return False
+
+            gx = u * inv_step
+            gy = v * inv_step
+            i = int(gx)
+            j = int(gy)
+            if i > i_max:
+                i = i_max
+            if j > j_max:
+                j = j_max
+
+            tx = gx - i
+            ty = gy - j
+            txy = tx * ty
+
+            a_u, a_v, b_u, b_v, c_u, c_v, e_u, e_v = cells[j*num_cells_x + i]
+            out[k, 0] = a_u + b_u*tx + c_u*ty + e_u*txy
+            out[k, 1] = a_v + b_v*tx + c_v*ty + e_v*txy
+
+        return True
+
+
+class LevelFrameTransform(object):
+
+    def __init__(self, phi_m=0.0, theta_m=0.0, psi_m=0.0, use_lut=True, history_length=DEFAULT_ATTITUDE_HISTORY):
+
+        # phi_m, theta_m and psi_m are the camera mounting angle offsets relative to the body frame
+
+        # matrices to hold corner data
+        self.corners = np.zeros((4,1,2))
+        self.corners_undist = np.zeros((4,2))
+        self.uv_bar_lf = np.zeros((4,2))  # pixel coords (u,v) of the corner points in the virtual level frame
+
+        # corners augmented with the focal length [u; v; f] (3x4)
+        self.uvf = np.zeros((3,4))
+
+        # camera params
+        self.K = np.zeros((3,3))
+        self.d = np.zeros(5)
+        self.fx = 0.0
+        self.fy = 0.0
+        self.f = 0.0
+        self.has_camera_info = False
+
+        # undistortion lookup table (built once we know the image size)
+        self.use_lut = use_lut
+        self.lut = None
+
+        # copter attitude roll and pitch (latest sample)
+        self.phi = 0.0
+        self.theta = 0.0
+
+        # attitude history ring buffer: stamps (s) and R_c_vlc of each attitude sample, num_samples counts every
+        # sample ever added so the newest one is at (num_samples - 1) % history_length
+        self.history_length = history_length
+        self.stamps = np.zeros(history_length)
+        self.R_history = np.zeros((history_length, 3, 3))
+        self.num_samples = 0
+        self.history_lock = threading.Lock()
+
+        # corner messages stamped outside of the history (clamped to the oldest/newest sample)
+        self.stamp_too_old_count = 0
+        self.stamp_too_new_count = 0
+
+        ## define fixed rotations
+        sphi_m = np.sin(phi_m)
+        cphi_m = np.cos(phi_m)
+        stheta_m = np.sin(theta_m)
+        ctheta_m = np.cos(theta_m)
+        spsi_m = np.sin(psi_m)
+        cpsi_m = np.cos(psi_m)
+
+        # rotation from the virtual level frame to the vehicle 1 frame
+        self.R_vlc_v1 = np.array([[0., -1., 0.],
+                                  [1., 0., 0.],
+                                  [0., 0., 1.]])
+
+        # rotation from the body frame to the camera mount frame (same form as rotation from the vehicle to the body frame)
+        self.R_b_m = np.array([[ctheta_m*cpsi_m, ctheta_m*spsi_m, -stheta_m],
+                               [sphi_m*stheta_m*cpsi_m-cphi_m*spsi_m, sphi_m*stheta_m*spsi_m+cphi_m*cpsi_m, sphi_m*ctheta_m],
+                               [cphi_m*stheta_m*cpsi_m+sphi_m*spsi_m, cphi_m*stheta_m*spsi_m-sphi_m*cpsi_m, cphi_m*ctheta_m]])
+
+        # rotation from the mount frame to the camera frame
+        self.R_m_c = np.array([[0., 1., 0.],
+                               [-1., 0., 0.],
+                               [0., 0., 1.]])
+
+        # fixed part of the rotation from the virtual level frame to the camera frame
+        self.R_m_b = self.R_m_c.dot(self.R_b_m)
+
+        # rotation from camera frame to virtual level frame (level until we get an attitude)
+        self.R_c_vlc = self.compute_R_c_vlc(0.0, 0.0)
+
+
+    def set_camera_info(self, K, d, width=0, height=0):
+
+        # get the Camera Matrix K and distortion params d
+        self.K = np.array(K, dtype=np.float32).reshape((3,3))
+        self.d = np.array(d, dtype=np.float32)
+
+        self.fx = self.K[0][0]
+        self.fy = self.K[1][1]
+
+        self.f = (self.fx + self.fy) / 2.0
+
+        self.uvf[2, :] = self.f
+        self.has_camera_info = True
+
+        if self.use_lut and width > 0 and height > 0:
+            self.lut = get_undistortion_lut(self.K, self.d, width, height)
+
+
+    def set_attitude(self, phi, theta, stamp):
+
+        # add an attitude sample (stamp in seconds), samples are expected in stamp order
+        R_c_vlc = self.compute_R_c_vlc(phi, theta)
+
+        with self.history_lock:
+            if self.num_samples > 0 and stamp < self.stamps[(self.num_samples - 1) % self.history_length]:
+                return
+
+            self.phi = phi
+            self.theta = theta
+
+            index = self.num_samples % self.history_length
+            self.stamps[index] = stamp
+            self.R_history[index] = R_c_vlc
+            self.num_samples += 1
+
+
+    def compute_R_c_vlc(self, phi, theta):
+
+        # pre-evaluate sines and cosines for rotation matrix
+        sphi = np.sin(phi)
+        cphi = np.cos(phi)
+        stheta = np.sin(theta)
+        ctheta = np.cos(theta)
+
+        R_v1_v2 = np.array([[ctheta, 0., -stheta],
+                            [0., 1., 0.],
+                            [stheta, 0., ctheta]])
+
+        R_v2_b = np.array([[1., 0., 0.],
+                           [0., cphi, sphi],
+                           [0., -sphi, cphi]])
+
+        R_v1_b = np.dot(R_v2_b, R_v1_v2)
+
+        # compute the whole rotation from camera frame to the virtual level frame
+        return self.R_m_b.dot(R_v1_b.dot(self.R_vlc_v1)).T    # R_c_vlc = R_vlc_c.T
+
+
+    def rotation_at(self, stamp=None):
+
+        # R_c_vlc at the given stamp (s), interpolated between the attitude samples on either side of it.
+        # With no stamp (None or 0) we use the newest sample.
+        with self.history_lock:
+            n = min(self.num_samples, self.history_length)
+            if n == 0:
+                return self.R_c_vlc
+
+            N = self.history_length
+            oldest = (self.num_samples - n) % N
+            newest = (self.num_samples - 1) % N
+
+            if not stamp or stamp >= self.stamps[newest]:
+                if stamp and stamp > self.stamps[newest]:
+                    self.stamp_too_new_count += 1
+                self.R_c_vlc[:] = self.R_history[newest]
+                return self.R_c_vlc
+
+            if stamp <= self.stamps[oldest]:
+                self.stamp_too_old_count += 1
+                self.R_c_vlc[:] = self.R_history[oldest]
+                return self.R_c_vlc
+
+            # binary search for the last sample at or before the stamp (the buffer is in stamp order starting at oldest)
+            lo = 0
+            hi = n - 1
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if self.stamps[(oldest + mid) % N] <= stamp:
+                    lo = mid
+                else:
+                    hi = mid
+
+            i0 = (oldest + lo) % N
+            i1 = (oldest + hi) % N
+            alpha = (stamp - self.stamps[i0]) / (self.stamps[i1] - self.stamps[i0])
+
+            # R = R0 + alpha*(R1 - R0)
+            np.subtract(self.R_history[i1], self.R_history[i0], out=self.R_c_vlc)
+            self.R_c_vlc *= alpha
+            self.R_c_vlc += self.R_history[i0]
+
+            return self.R_c_vlc
+
+
+    def undistort(self, data, offset=0):
+
+        # interpolate in the lookup table if we have one and all the corners are on it
+        if self.lut is not None and self.lut.undistort_corners(data, offset, self.corners_undist):
+            return self.corners_undist
+
+        # populate corners matrix from the flat [u1, v1, ... u4, v4] list starting at element 'offset'
+        self.corners[:, 0, 0] = data[offset:offset + 8:2]
+        self.corners[:, 0, 1] = data[offset + 1:offset + 8:2]
+
+        # undistort the corner locations
+        corners_undist = cv2.undistortPoints(self.corners, self.K, self.d)
+
+        # NOTE at this point we have normalized pixel coordinates
+        # We want to de-normalize (multiply by focal length) but still want corner locations wrt image center
+        corners_undist = corners_undist.reshape(4,2)
+        corners_undist[:, 0] *= self.fx
+        corners_undist[:, 1] *= self.fy
+
+        return corners_undist
+
+
+    def transform_to_vlf(self, corners, stamp=None):
+
+        # corners is a 4x2 matirx of undistorted center-relative corner pixel locations, stamp is the image stamp (s)
+        # store in a 3x4 matrix augmented with focal length (for convienience)
+        self.uvf[0:2, :] = corners.T    # 3x4
+
+        # rotation from the camera frame to the virtual level frame at the image stamp
+        R_c_vlc = self.rotation_at(stamp)
+
+        # pass pixel locations through the rotation same way it's done in eq(14), all four corners at the same time
+        hom = np.dot(R_c_vlc, self.uvf) # 3x4
+
+        # populate the matrix of (u,v) pixel coordinates in the virtual-level-frame
+        self.uv_bar_lf[:, 0] = self.f * (hom[0] / hom[2])
+        self.uv_bar_lf[:, 1] = self.f * (hom[1] / hom[2])
+
+        return self.uv_bar_lf
+
+
+    def map_corners(self, data, offset=0, stamp=None):
+
+        # raw corner pixels in, 4x2 level-frame corners out (this is a view of uv_bar_lf, copy it to keep it)
+        return self.transform_to_vlf(self.undistort(data, offset), stamp)
@@ -10,8 +10,9 @@ from nav_msgs.msg import Odometry
 from aruco_localization.msg import FloatList
 import numpy as np
 import cv2
-import tf
 import time
+from level_frame import LevelFrameTransform, load_camera_yaml
+from rotation_kernel import quaternion_to_euler
 
 
 class LevelFrameMapper(object):
@@ -20,69 +21,26 @@ class LevelFrameMapper(object):
 
         # load ROS params
         p_des = rospy.get_param('~p_des', [0., 0., 0., 0., 0., 0., 0., 0.])
+        undistort_lut = rospy.get_param('~undistort_lut', True)  # False to call cv2.undistortPoints on every message
 
-        ## initialize other class variables
-        
-        # matrices to hold corner data
-        self.corners = np.zeros((4,1,2))
-        self.uv_bar_lf = np.zeros((4,2))  # pixel coords (u,v) of the corner points in the virtual level frame 
-
-        self.f_row = np.zeros((1,4))
+        # camera_info YAML (a path, or the file:// camera_info_url given to the aruco node). If set, the calibration and
+        # the undistortion table come from it at startup instead of from the first CameraInfo message
+        camera_info_file = rospy.get_param('~camera_info_file', '')
 
-        # self.matrix = np.zeros((2,2), dtype=np.float32)
+        ## initialize other class variables
 
-        # camera params
-        self.K = np.zeros((3,3))
-        self.d = np.zeros(5)
-        self.fx = 0.0
-        self.fy = 0.0
-        self.cx = 0.0
-        self.cy = 0.0
-        self.f = 0.0
+        # undistortion and level-frame rotation math (shared with the fused pipeline in ibvs_fused.py)
+        self.transform = LevelFrameTransform(use_lut=undistort_lut)
+        if camera_info_file:
+            if camera_info_file.startswith('file://'):
+                camera_info_file = camera_info_file[len('file://'):]
+            self.transform.set_camera_info(*load_camera_yaml(camera_info_file))
+            print("Level_frame_mapper: Got camera info from " + camera_info_file)
 
         # desired pixel coords 
         # [u1, v1, u2, v2, u3, v3, u4, v4].T  8x1
         self.p_des = np.array(p_des, dtype=np.float32).reshape(4,2)
 
-        # copter attitude roll and pitch
-        self.phi = 0.0
-        self.theta = 0.0 
-
-        # mounting angle offsets
-        phi_m = 0.0    # roll relative to the body frame
-        theta_m = 0.0  # pitch '...'
-        psi_m = 0.0    # yaw '...'
-
-        ## define fixed rotations
-        sphi_m = np.sin(phi_m)
-        cphi_m = np.cos(phi_m)
-        stheta_m = np.sin(theta_m)
-        ctheta_m = np.cos(theta_m)
-        spsi_m = np.sin(psi_m )
-        cpsi_m = np.cos(psi_m )
-
-        # rotation from the virtual level frame to the vehicle 1 frame
-        self.R_vlc_v1 = np.array([[0., -1., 0.],
-                                  [1., 0., 0.],
-                                  [0., 0., 1.]])
-
-        # rotation from the body frame to the camera mount frame (same form as rotation from the vehicle to the body frame)
-        self.R_b_m = np.array([[ctheta_m*cpsi_m, ctheta_m*spsi_m, -stheta_m],
-                               [sphi_m*stheta_m*cpsi_m-cphi_m*spsi_m, sphi_m*stheta_m*spsi_m+cphi_m*cpsi_m, sphi_m*ctheta_m],
-                               [cphi_m*stheta_m*cpsi_m+sphi_m*spsi_m, cphi_m*stheta_m*spsi_m-sphi_m*cpsi_m, cphi_m*ctheta_m]])
-
-        # rotation from the mount frame to the camera frame
-        self.R_m_c = np.array([[0., 1., 0.],
-                               [-1., 0., 0.],
-                               [0., 0., 1.]])
-
-
-        # rotation from the vehicle 1 frame to the body frame (just initialize it--will update later)
-        # self.R_v1_b = np.eye(3)
-
-        # initialize rotation from camera frame to virtual level frame
-        self.R_c_vlc = np.zeros((3,3))
-
         # initialize publishers
         self.uv_bar_pub = rospy.Publisher('/ibvs/uv_bar_lf', FloatList, queue_size=1)
         self.uv_bar_des_pub = rospy.Publisher('/ibvs/uv_bar_des', FloatList, queue_size=1)
@@ -92,55 +50,20 @@ class LevelFrameMapper(object):
         # initialize subscribers
         self.corner_pix_sub = rospy.Subscriber('/aruco/marker_corners', FloatList, self.corners_callback)
         self.attitude_sub = rospy.Subscriber('/quadcopter/estimate', Odometry, self.attitude_callback)
-        self.camera_info_sub = rospy.Subscriber('/quadcopter/camera/camera_info', CameraInfo, self.camera_info_callback)
+        if not camera_info_file:
+            self.camera_info_sub = rospy.Subscriber('/quadcopter/camera/camera_info', CameraInfo, self.camera_info_callback)
 
 
     def corners_callback(self, msg):
 
         # t = time.time()
 
-        # populate corners matrix
-        self.corners[0][0][0] = msg.data[0]
-        self.corners[0][0][1] = msg.data[1]
-
-        self.corners[1][0][0] = msg.data[2]
-        self.corners[1][0][1] = msg.data[3]
-
-        self.corners[2][0][0] = msg.data[4]
-        self.corners[2][0][1] = msg.data[5]
-
-        self.corners[3][0][0] = msg.data[6]
-        self.corners[3][0][1] = msg.data[7]
-
-        # undistort the corner locations
-        corners_undist = cv2.undistortPoints(self.corners, self.K, self.d)
-
-        # NOTE at this point we have normalized pixel coordinates
-        # We want to de-normalize (multiply by focal length) but still want corner locations wrt image center
-
-        # TODO vectorize this instead of corner by corner?? implemented below on 145 maybe it's not actually faster...
-
-        corners_undist[0][0][0] = corners_undist[0][0][0]*self.fx
-        corners_undist[0][0][1] = corners_undist[0][0][1]*self.fy
-
-        corners_undist[1][0][0] = corners_undist[1][0][0]*self.fx
-        corners_undist[1][0][1] = corners_undist[1][0][1]*self.fy
-
-        corners_undist[2][0][0] = corners_undist[2][0][0]*self.fx
-        corners_undist[2][0][1] = corners_undist[2][0][1]*self.fy
-
-        corners_undist[3][0][0] = corners_undist[3][0][0]*self.fx
-        corners_undist[3][0][1] = corners_undist[3][0][1]*self.fy
-
-        # corners_undist = np.dot(corners_undist.reshape(4,2), self.matrix)
-
-        corners_undist = corners_undist.reshape(4,2)
+        # undistort the corners and transform them into the VLF with the attitude at the image stamp
+        # (returns a 4x2 matrix of corners)
+        actual_corners_vlf = self.transform.map_corners(msg.data, 0, msg.header.stamp.to_sec())
 
         # Transform the desired marker corner locations into the VLF 
-        # desired_corners_vlf = self.transform_to_vlf(self.p_des)
-
-        # Transform the actual marker corners into the VLF (input is 4x2 matrix of corners)
-        actual_corners_vlf = self.transform_to_vlf(corners_undist)
+        # desired_corners_vlf = self.transform.transform_to_vlf(self.p_des)
 
         # fill out the FloatList messages
         # Desired corner loctions
@@ -162,83 +85,14 @@ class LevelFrameMapper(object):
         # print(hz_approx)
 
 
-    def transform_to_vlf(self, corners):
-
-        # corners is a 4x2 matirx of undistorted center-relative corner pixel locations
-        # store in a 3x4 matrix augmented with focal length (for convienience) and save for later
-        uvf = np.concatenate((corners.T, self.f_row), axis=0)    # 3x4
-
-        # setup rotations
-
-        # pre-evaluate sines and cosines for rotation matrix
-        sphi = np.sin(self.phi)
-        cphi = np.cos(self.phi)
-        stheta = np.sin(self.theta)
-        ctheta = np.cos(self.theta)
-
-        R_v1_v2 = np.array([[ctheta, 0., -stheta],
-                            [0., 1., 0.],
-                            [stheta, 0., ctheta]])
-
-        R_v2_b = np.array([[1., 0., 0.],
-                           [0., cphi, sphi],
-                           [0., -sphi, cphi]])
-
-        R_v1_b = np.dot(R_v2_b, R_v1_v2)
-
-        # compute the whole rotation from camera frame to the virtual level frame
-        self.R_c_vlc = self.R_m_c.dot(self.R_b_m.dot(R_v1_b.dot(self.R_vlc_v1))).T    # R_c_vlc = R_vlc_c.T
-
-        # pass pixel locations through the rotation same way it's done in eq(14)
-        
-        # first, get the terms of eq(14)
-
-        # this is how you'd do it one pixel (u, v) at a time:  
-        # hom = np.dot(self.R_c_vlc, np.array([[corners_undist[0][0]],[corners_undist[0][1]],[self.f]]))  # this is a homography?? 3x1
-        # x_term = hom[0][0]
-        # y_term = hom[1][0]
-        # denom = hom[2][0]
-
-        # u_bar = self.f * (x_term/denom)
-        # v_bar = self.f * (y_term/denom)
-
-        # we'll do it all four corners at the same time:
-        hom = np.dot(self.R_c_vlc, uvf) # 3x4
-        
-        # populate the matrix of (u,v) pixel coordinates in the virtual-level-frame
-        self.uv_bar_lf[0][0] = self.f * (hom[0][0]/hom[2][0])   # u1
-        self.uv_bar_lf[0][1] = self.f * (hom[1][0]/hom[2][0])   # v1
-
-        self.uv_bar_lf[1][0] = self.f * (hom[0][1]/hom[2][1])   # u2
-        self.uv_bar_lf[1][1] = self.f * (hom[1][1]/hom[2][1])   # v2
-
-        self.uv_bar_lf[2][0] = self.f * (hom[0][2]/hom[2][2])   # u3
-        self.uv_bar_lf[2][1] = self.f * (hom[1][2]/hom[2][2])   # v3
-
-        self.uv_bar_lf[3][0] = self.f * (hom[0][3]/hom[2][3])   # u4
-        self.uv_bar_lf[3][1] = self.f * (hom[1][3]/hom[2][3])   # v4
-
-        # return a copy of 
-        return self.uv_bar_lf.copy()
-
-
-
-
     def attitude_callback(self, msg):
 
-        # get the quaternion orientation from the message
-        quaternion = (
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w)
-
-        # convert to euler angles 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
+        # get the quaternion orientation from the message and convert to euler angles
+        orientation = msg.pose.pose.orientation
+        euler = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
-        # update class variables
-        self.phi = euler[0]
-        self.theta = euler[1]
+        # add to the attitude history used by the level-frame transform
+        self.transform.set_attitude(euler[0], euler[1], msg.header.stamp.to_sec())
         # print "roll: " + str(np.degrees(euler[0]))
         # print "pitch: " + str(np.degrees(euler[1]))
 
@@ -246,20 +100,7 @@ class LevelFrameMapper(object):
     def camera_info_callback(self, msg):
 
         # get the Camera Matrix K and distortion params d
-        self.K = np.array(msg.K, dtype=np.float32).reshape((3,3))
-        self.d = np.array(msg.D, dtype=np.float32)
-
-        self.fx = self.K[0][0]
-        self.fy = self.K[1][1]
-        self.cx = self.K[0][2]
-        self.cy = self.K[1][2]
-
-        self.f = (self.fx + self.fy) / 2.0
-
-        self.f_row[0][:] = self.f
-
-        # self.matrix[0][0] = self.fx
-        # self.matrix[1][1] = self.fy
+        self.transform.set_camera_info(msg.K, msg.D, msg.width, msg.height)
 
         # just get this data once
         self.camera_info_sub.unregister()
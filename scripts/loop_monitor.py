@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+## Timing instrumentation for a fixed-rate control loop (the 200 Hz timer in
+## controller.py). Every tick hands over its dt and how late the timer fired,
+## and every tick that runs the controller hands over how long compute_control
+## took. Kept per tick:
+##   period:   time between ticks (the dt the PIDs see), histogram
+##   compute:  compute_control and publishing the command, histogram
+##   latency:  expected tick time -> command sent (timer wake-up + compute),
+##             max since start (the watermark) and since the last report
+##   skipped:  ticks the timer never delivered (dt more than 1.5 periods)
+##   overruns: ticks whose command went out after the next tick was due
+##   bad_dt:   ticks dropped because dt <= 0 (clock jumps, sim time resets)
+## The histograms have fixed bins in preallocated lists, so a tick costs a few
+## multiplies and list increments and nothing is allocated in the loop. The
+## percentiles are read off the bins (to within one bin width) when a report
+## is built, at the diagnostics rate.
+
+import time
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+
+class FixedHistogram(object):
+
+    def __init__(self, bin_width, bins):
+
+        # bins of bin_width (s) from 0, plus one overflow bin
+        self.bin_width = bin_width
+        self.inverse_width = 1.0/bin_width
+        self.bins = bins
+        self.counts = [0]*(bins + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, x):
+
+        k = int(x*self.inverse_width)
+        if k > self.bins:
+            k = self.bins
+        elif k < 0:
+            k = 0
+        self.counts[k] += 1
+        self.count += 1
+        self.total += x
+        if x > self.max:
+            self.max = x
+
+
+    def mean(self):
+
+        if self.count == 0:
+            return 0.0
+        return self.total/self.count
+
+
+    def percentiles(self, q=(50.0, 99.0)):
+
+        # upper edge of the bin holding each percentile, the max if it falls in the overflow bin
+        if self.count == 0:
+            return [0.0 for x in q]
+
+        values = []
+        for percent in q:
+            rank = percent/100.0*self.count
+            cumulative = 0
+            for k, n in enumerate(self.counts):
+                cumulative += n
+                if cumulative >= rank and n > 0:
+                    break
+            values.append(self.max if k == self.bins else min((k + 1)*self.bin_width, self.max))
+
+        return values
+
+
+    def reset(self):
+
+        self.counts = [0]*(self.bins + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class LoopMonitor(object):
+
+    def __init__(self, rate, period_bin=0.00002, compute_bin=0.000001):
+
+        # nominal rate (Hz), periods binned up to 4 periods and compute times up to 1 period
+        self.rate = rate
+        self.period = 1.0/rate
+        self.skip_period = 1.5*self.period
+
+        self.periods = FixedHistogram(period_bin, int(4.0*self.period/period_bin + 0.5))
+        self.compute_times = FixedHistogram(compute_bin, int(self.period/compute_bin + 0.5))
+
+        self.reset()
+
+
+    def reset(self):
+
+        self.periods.reset()
+        self.compute_times.reset()
+
+        self.tick_count = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.bad_dt = 0
+
+        # latency watermarks, since start and since the last report()
+        self.max_latency = 0.0
+        self.recent_max_latency = 0.0
+
+        # counters at the last report, for the per-interval deltas
+        self.reported = (0, 0, 0, 0)
+
+        # wake-up latency of the current tick, until add_compute() closes it
+        self.wake_latency = 0.0
+
+
+    def add_tick(self, dt, wake_latency=0.0):
+
+        # once per timer callback: dt since the previous tick and how late this one fired (s)
+        self.tick_count += 1
+        self.wake_latency = wake_latency
+
+        if dt <= 0.0:
+            self.bad_dt += 1
+            return
+
+        self.periods.add(dt)
+        if dt > self.skip_period:
+            self.skipped += int(dt*self.rate + 0.5) - 1
+
+
+    def add_compute(self, compute_time):
+
+        # once per tick that ran the controller: time from the start of compute_control to the command going out (s)
+        self.compute_times.add(compute_time)
+
+        latency = self.wake_latency + compute_time
+        if latency > self.recent_max_latency:
+            self.recent_max_latency = latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        if latency > self.period:
+            self.overruns += 1
+
+
+    def report(self):
+
+        # dict of the counters and percentiles (times in s), plus what changed since the last report
+        period_p50, period_p99 = self.periods.percentiles()
+        compute_p50, compute_p99 = self.compute_times.percentiles()
+        last_ticks, last_skipped, last_overruns, last_bad_dt = self.reported
+
+        summary = {'ticks': self.tick_count,
+                   'period_mean': self.periods.mean(),
+                   'period_p50': period_p50,
+                   'period_p99': period_p99,
+                   'period_max': self.periods.max,
+                   'compute_mean': self.compute_times.mean(),
+                   'compute_p50': compute_p50,
+                   'compute_p99': compute_p99,
+                   'compute_max': self.compute_times.max,
+                   'max_latency': self.max_latency,
+                   'recent_max_latency': self.recent_max_latency,
+                   'skipped': self.skipped,
+                   'overruns': self.overruns,
+                   'bad_dt': self.bad_dt,
+                   'new_ticks': self.tick_count - last_ticks,
+                   'new_skipped': self.skipped - last_skipped,
+                   'new_overruns': self.overruns - last_overruns,
+                   'new_bad_dt': self.bad_dt - last_bad_dt}
+
+        self.reported = (self.tick_count, self.skipped, self.overruns, self.bad_dt)
+        self.recent_max_latency = 0.0
+
+        return summary
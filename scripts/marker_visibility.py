@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+## Marker visibility from the rate of IBVS commands for that marker. The state
+## machine used to call a marker visible if the fifth-latest command was less
+## than a second old, which flickers when detections are sparse or bursty.
+##
+## Each detection adds an exponential kernel exp(-(t - t_k)/tau)/tau to the rate
+## estimate, so the estimate is the detection rate (Hz) averaged over about tau
+## seconds. It only has to be decayed from the last detection, so adding a
+## detection or reading the rate is O(1). The time since the last detection (and
+## the gap between the last two) is tracked as well.
+##
+## Visibility has hysteresis: a marker becomes visible once the rate reaches
+## enter_rate and stops being visible when the rate falls below exit_rate or
+## nothing has come in for max_gap seconds.
+
+import math
+
+
+class MarkerVisibility(object):
+
+    def __init__(self, tau=1.0, enter_rate=5.0, exit_rate=2.0, max_gap=1.0):
+
+        # averaging time constant (s), rate thresholds (Hz) and the longest time without a detection (s)
+        self.tau = tau
+        self.enter_rate = enter_rate
+        self.exit_rate = exit_rate
+        self.max_gap = max_gap
+
+        self.reset()
+
+
+    def reset(self):
+
+        # rate estimate (Hz) right after the last detection
+        self.rate_last = 0.0
+        self.t_last = None
+
+        # gap between the last two detections (s)
+        self.gap = float('inf')
+
+        self.visible = False
+        self.detection_count = 0
+        self.transition_count = 0
+
+
+    def add(self, t):
+
+        # a detection at time t (s), out-of-order ones are dropped
+        if self.t_last is not None:
+            dt = t - self.t_last
+            if dt < 0.0:
+                return
+
+            self.rate_last *= math.exp(-dt/self.tau)
+            self.gap = dt
+
+        self.rate_last += 1.0/self.tau
+        self.t_last = t
+        self.detection_count += 1
+
+
+    def rate(self, t):
+
+        # detection rate (Hz) at time t
+        if self.t_last is None:
+            return 0.0
+
+        return self.rate_last*math.exp(-max(t - self.t_last, 0.0)/self.tau)
+
+
+    def age(self, t):
+
+        # time since the last detection (s)
+        if self.t_last is None:
+            return float('inf')
+
+        return t - self.t_last
+
+
+    def update(self, t):
+
+        # visibility at time t with hysteresis
+        rate = self.rate(t)
+        age = self.age(t)
+
+        if self.visible:
+            visible = rate >= self.exit_rate and age <= self.max_gap
+        else:
+            visible = rate >= self.enter_rate and age <= self.max_gap
+
+        if visible != self.visible:
+            self.visible = visible
+            self.transition_count += 1
+
+        return visible
@@ -9,7 +9,9 @@ from geometry_msgs.msg import PoseStamped
 from geometry_msgs.msg import TwistStamped
 from nav_msgs.msg import Odometry
 import numpy as np
-import tf
+from rotation_kernel import quaternion_to_euler
+from rotation_kernel import euler_to_quaternion
+from rotation_kernel import flu_to_frd
 
 # Coordinate Frame Explanations
 # Mavros takes linear data (positions and linear velocities) and transforms them to be w.r.t. the ENU coordinate frame.
@@ -29,7 +31,6 @@ class MavrosNED(object):
         self.px4_estimate_msg = Odometry()
 
         # Create arrays to hold data coming from mavros.
-        self.euler_vec_flu = np.zeros((3,1), dtype=np.float32)
         self.position_vec_enu = np.zeros((3,1), dtype=np.float32)
         self.velocity_vec_lin_rfu = np.zeros((3,1), dtype=np.float32)
         self.velocity_vec_ang_flu = np.zeros((3,1), dtype=np.float32)
@@ -105,26 +106,12 @@ class MavrosNED(object):
         # Rotate the vector from ENU to NED and store in class variable for use later.
         self.position_vec_ned = self.enu_to_ned(self.position_vec_enu)
         
-        # Get the quaternion orientation from the message.
-        quaternion = (
-            msg.pose.orientation.x,
-            msg.pose.orientation.y,
-            msg.pose.orientation.z,
-            msg.pose.orientation.w)
+        # Get the quaternion orientation from the message and convert it to euler angles (FLU).
+        orientation = msg.pose.orientation
+        roll, pitch, yaw = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
-        # Convert the quaternion to euler angles. 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
-
-        # Populate the FLU vector.
-        self.euler_vec_flu[0][0] = euler[0]
-        self.euler_vec_flu[1][0] = euler[1]
-        self.euler_vec_flu[2][0] = euler[2]
-
-        # Rotate from FLU to FRD and store in class variable for use later.
-        euler_vec_frd = self.flu_to_frd(self.euler_vec_flu)
-
-        # Convert back to quaternion and store in class variable for use later.
-        self.quaternion_frd = tf.transformations.quaternion_from_euler(euler_vec_frd[0][0], euler_vec_frd[1][0], euler_vec_frd[2][0])
+        # Rotate from FLU to FRD, convert back to quaternion and store in class variable for use later.
+        self.quaternion_frd = euler_to_quaternion(*flu_to_frd(roll, pitch, yaw))
         # now = rospy.get_time()
         # delay = now - then
         # print(delay)
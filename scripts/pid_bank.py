@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+## A bank of PID loops with the same math as simple_pid.PID (rosflight_utils
+## SimplePID: dirty derivative with time constant tau, trapezoidal integrator,
+## anti-windup against the saturation limits), but with the gains, integrators
+## and derivative states of all the loops in arrays. Loops are named and
+## indexed in the order given, so the ones that run together (a stage of a
+## cascade) can be contiguous and updated in one update() call on a slice.
+##
+## With vehicles=N every array is a numpy array with a leading vehicle axis,
+## (N, loops), and update() runs the same loops of all N vehicles at once
+## (batched simulation, gain sweeps). Gains can be set per loop or per vehicle
+## and loop.
+##
+## Without vehicles (one vehicle, the 200 Hz controller) the arrays are plain
+## lists of floats and update() is a scalar pass over the selected loops:
+## numpy's per-call overhead is several times the math on 1 to 3 loops.
+## Both paths are checked against each other and against SimplePID in
+## pid_bank_benchmark.py.
+##
+## Differences from calling PID.computePID on each loop:
+##   - dt is one number for the whole call (the vehicles share a clock)
+##   - x_dot (the measured derivative, used instead of the dirty derivative)
+##     is a sequence, NaN where a loop has none
+##   - limits are +/-inf instead of None when there are none
+## set_gains(), set_limits() and clear_integrators() on all loops or on a
+## contiguous run of them (a slice, see loops()) assign each array in one step,
+## a numpy assignment or a list slice assignment. On scattered loops (an index
+## array) the one-vehicle path assigns them one at a time. set_gains() also
+## refolds the derived gains of every loop, so a gain change costs more than
+## SimplePID.setGains on each loop (pid_bank_benchmark.py times both); reset()
+## is one assignment per state array.
+
+import numpy as np
+
+# errors larger than this are ignored (output 0, state untouched), like SimplePID
+MAX_ERROR = 9999999.0
+
+INF = float('inf')
+NAN = float('nan')
+
+
+def is_scalar(value):
+
+    # np.ndim costs microseconds on the plain floats and lists the controller passes, check those first
+    if isinstance(value, (int, float)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return False
+    return np.ndim(value) == 0
+
+
+class PIDBank(object):
+
+    def __init__(self, names, p=0.0, i=0.0, d=0.0, tau=0.05, max_=None, min_=None, vehicles=None):
+
+        # loop names in array order, and their index
+        self.names = tuple(names)
+        self.index = dict((name, k) for k, name in enumerate(self.names))
+        self.vehicles = vehicles
+
+        n = len(self.names)
+        self.shape = (n,) if vehicles is None else (vehicles, n)
+
+        # gains, filter time constants and limits, see set_gains/set_limits
+        self.kp = self.new_array(0.0)
+        self.ki = self.new_array(0.0)
+        self.kd = self.new_array(0.0)
+        self.tau = self.new_array(0.0)
+        self.upper = self.new_array(INF)
+        self.lower = self.new_array(-INF)
+
+        # loop state
+        self.integrator = self.new_array(0.0)
+        self.differentiator = self.new_array(0.0)
+        self.last_error = self.new_array(0.0)
+        self.last_state = self.new_array(0.0)
+
+        # last output of every loop
+        self.output = self.new_array(0.0)
+
+        self.set_gains(p, i, d, tau)
+        self.set_limits(max_, min_)
+
+
+    def new_array(self, value):
+
+        if self.vehicles is None:
+            return [value]*self.shape[0]
+        return np.full(self.shape, value)
+
+
+    def assign(self, array, loops, value):
+
+        # array[loops] = value, value a scalar or one value per selected loop
+        if self.vehicles is not None:
+            array[..., loops] = value
+            return
+
+        # a slice (all loops, or a contiguous run from loops()) is one list slice assignment
+        if isinstance(loops, slice):
+            n = len(array[loops])
+            if is_scalar(value):
+                array[loops] = [float(value)]*n
+                return
+
+            # a list slice assignment of the wrong length would resize the list instead of failing
+            values = [float(v) for v in value]
+            if len(values) != n:
+                raise ValueError('%d values for %d loops' % (len(values), n))
+            array[loops] = values
+            return
+
+        # scattered loops, one at a time
+        if is_scalar(value):
+            for k in loops:
+                array[k] = float(value)
+        else:
+            for k, v in zip(loops, value):
+                array[k] = float(v)
+
+
+    def indices(self, loops):
+
+        # loop indices of a slice or index sequence
+        if isinstance(loops, slice):
+            return range(*loops.indices(len(self.names)))
+        return loops
+
+
+    def loops(self, *names):
+
+        # slice over a contiguous run of named loops (an index array if they aren't contiguous)
+        first = self.index[names[0]]
+        if all(self.index[name] == first + k for k, name in enumerate(names)):
+            return slice(first, first + len(names))
+        return np.array([self.index[name] for name in names])
+
+
+    def set_gains(self, p, i, d, tau, loops=slice(None)):
+
+        # scalars or arrays that broadcast over the selected loops (and vehicles)
+        self.assign(self.kp, loops, p)
+        self.assign(self.ki, loops, i)
+        self.assign(self.kd, loops, d)
+        self.assign(self.tau, loops, tau)
+        self.fold_gains()
+
+
+    def set_limits(self, max_=None, min_=None, loops=slice(None)):
+
+        # None means no limit
+        self.assign(self.upper, loops, INF if max_ is None else max_)
+        self.assign(self.lower, loops, -INF if min_ is None else min_)
+        if self.vehicles is None:
+            self.limited = any(upper != INF for upper in self.upper) or any(lower != -INF for lower in self.lower)
+        else:
+            self.limited = bool(np.isfinite(self.upper).any() or np.isfinite(self.lower).any())
+
+
+    def fold_gains(self):
+
+        # 2*tau, ki where the loop integrates (ki > 0), 1/ki for the anti-windup (ki != 0), and kd != 0
+        if self.vehicles is None:
+            self.two_tau = [2.0*tau for tau in self.tau]
+            self.ki_pos = [ki if ki > 0.0 else 0.0 for ki in self.ki]
+            self.ki_inv = [1.0/ki if ki != 0.0 else 0.0 for ki in self.ki]
+            self.kd_nonzero = [abs(kd) > 0.0 for kd in self.kd]
+            return
+
+        self.two_tau = 2.0*self.tau
+        self.ki_pos = np.where(self.ki > 0.0, self.ki, 0.0)
+        nonzero = self.ki != 0.0
+        self.ki_inv = np.where(nonzero, 1.0/np.where(nonzero, self.ki, 1.0), 0.0)
+        self.kd_nonzero = np.abs(self.kd) > 0.0
+
+
+    def clear_integrators(self, loops=slice(None)):
+
+        self.assign(self.integrator, loops, 0.0)
+
+
+    def reset(self):
+
+        for array in (self.integrator, self.differentiator, self.last_error, self.last_state, self.output):
+            array[:] = self.new_array(0.0)
+
+
+    def update(self, loops, desired, current, dt, x_dot=None):
+
+        # one step of the selected loops (a slice or index sequence), returns their outputs
+        if self.vehicles is None:
+            return self.update_loops(loops, desired, current, dt, x_dot)
+        return self.update_batch(loops, desired, current, dt, x_dot)
+
+
+    def update_loops(self, loops, desired, current, dt, x_dot=None):
+
+        # one vehicle: plain floats, the same steps as PID.computePID, returns a list
+        output = []
+
+        # Don't do stupid things (like divide by nearly zero, gigantic control jumps)
+        if dt < 0.00001:
+            for k in self.indices(loops):
+                self.output[k] = 0.0
+                output.append(0.0)
+            return output
+
+        # a stale loop (other mode, or disarmed): no integration or derivative this time
+        stale = dt > 1.0
+        if stale:
+            dt = 0.0
+        half_dt = 0.5*dt
+
+        limited = self.limited
+        kd_nonzero = self.kd_nonzero
+        differentiator = self.differentiator
+        integrator = self.integrator
+
+        for j, k in enumerate(self.indices(loops)):
+            setpoint = desired[j]
+            state = current[j]
+            error = setpoint - state
+
+            if abs(error) > MAX_ERROR:
+                self.output[k] = 0.0
+                output.append(0.0)
+                continue
+
+            if stale:
+                differentiator[k] = 0.0
+
+            # derivative term
+            d_term = 0.0
+            if kd_nonzero[k]:
+                rate = NAN if x_dot is None else x_dot[j]
+                if rate == rate:
+                    d_term = self.kd[k]*rate
+                elif not stale:
+                    two_tau = self.two_tau[k]
+                    differentiator[k] = ((two_tau - dt)*differentiator[k] + 2.0*(state - self.last_state[k]))/(two_tau + dt)
+                    d_term = self.kd[k]*differentiator[k]
+
+            # integrator term
+            i_term = 0.0
+            ki = self.ki_pos[k]
+            if ki > 0.0:
+                integrator[k] += half_dt*(error + self.last_error[k])
+                i_term = ki*integrator[k]
+
+            self.last_error[k] = error
+            self.last_state[k] = state
+
+            u_unsat = self.kp[k]*error + i_term - d_term
+            u = u_unsat
+            if limited:
+                if u > self.upper[k]:
+                    u = self.upper[k]
+                elif u < self.lower[k]:
+                    u = self.lower[k]
+
+                # anti windup
+                integrator[k] += self.ki_inv[k]*(u - u_unsat)
+
+            self.output[k] = u
+            output.append(u)
+
+        return output
+
+
+    def update_batch(self, loops, desired, current, dt, x_dot=None):
+
+        # all vehicles at once, desired/current/x_dot are (vehicles, selected loops), returns an array
+        desired = np.asarray(desired, dtype=float)
+        current = np.asarray(current, dtype=float)
+        error = desired - current
+
+        if dt < 0.00001:
+            self.output[..., loops] = 0.0
+            return self.output[..., loops]
+
+        valid = None
+        if np.abs(error).max() > MAX_ERROR:
+            valid = np.abs(error) <= MAX_ERROR
+
+        stale = dt > 1.0
+        if stale:
+            dt = 0.0
+
+        kd = self.kd[..., loops]
+        differentiator = self.differentiator[..., loops]
+        integrator = self.integrator[..., loops]
+
+        # derivative term, the measured x_dot where there is one, otherwise the dirty derivative of the state
+        if stale:
+            differentiator = np.zeros_like(error)
+        else:
+            two_tau = self.two_tau[..., loops]
+            filtered = ((two_tau - dt)*differentiator + 2.0*(current - self.last_state[..., loops]))/(two_tau + dt)
+            update_mask = self.kd_nonzero[..., loops]
+            if x_dot is not None:
+                update_mask = update_mask & np.isnan(x_dot)
+            differentiator = np.where(update_mask, filtered, differentiator)
+
+        d_term = kd*differentiator
+        if x_dot is not None:
+            d_term = np.where(np.isnan(x_dot), d_term, kd*x_dot)
+
+        # integrator (trapezoidal, only loops with ki > 0 integrate)
+        ki_pos = self.ki_pos[..., loops]
+        integrator = integrator + (0.5*dt)*(error + self.last_error[..., loops])*(ki_pos > 0.0)
+
+        u_unsat = self.kp[..., loops]*error + ki_pos*integrator - d_term
+        u = u_unsat
+        if self.limited:
+            u = np.minimum(np.maximum(u_unsat, self.lower[..., loops]), self.upper[..., loops])
+
+            # anti windup
+            integrator = integrator + self.ki_inv[..., loops]*(u - u_unsat)
+
+        # ignored errors leave their loop untouched
+        if valid is not None:
+            u = np.where(valid, u, 0.0)
+            differentiator = np.where(valid, differentiator, self.differentiator[..., loops])
+            integrator = np.where(valid, integrator, self.integrator[..., loops])
+            error = np.where(valid, error, self.last_error[..., loops])
+            current = np.where(valid, current, self.last_state[..., loops])
+
+        self.differentiator[..., loops] = differentiator
+        self.integrator[..., loops] = integrator
+        self.last_error[..., loops] = error
+        self.last_state[..., loops] = current
+        self.output[..., loops] = u
+
+        return self.output[..., loops]
+
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+
+## Benchmark and check for PIDBank (pid_bank.py) against one simple_pid.PID per
+## loop (no ROS needed).
+##
+## 1. Equivalence: random gains (including zero and negative ki, zero kd),
+##    optional limits, measured derivatives, jittery, tiny and stale dt, and the
+##    odd huge error, through both the one-vehicle (list) path and the batched
+##    (numpy) path of the bank and through SimplePID. Reports the largest
+##    output difference.
+## 2. One vehicle, the controller.py cascade: the seven loops in three stage
+##    updates against seven computePID calls, per 200 Hz tick, and a gain
+##    change / integrator reset of the seven loops (best of 20).
+## 3. Batched: the seven loops of N simulated vehicles in one update() against
+##    7*N computePID calls, and a gain change / integrator reset of all of them
+##    (best of 20).
+##
+## usage: ./pid_bank_benchmark.py [steps] [max_vehicles]
+
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+from simple_pid import PID
+from pid_bank import PIDBank
+
+LOOPS = ('x', 'y', 'psi', 'u', 'v', 'w', 'z')
+
+INF = float('inf')
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+
+def random_gains(rng, shape):
+
+    p = rng.uniform(-0.5, 2.0, shape)
+    i = rng.choice([0.0, 0.05, 0.5, -0.3], shape)
+    d = rng.choice([0.0, 0.1, 0.4], shape)
+    tau = rng.uniform(0.02, 0.1, shape)
+    return p, i, d, tau
+
+
+def check_equivalence(steps, seed=0):
+
+    rng = np.random.RandomState(seed)
+    worst_loops = 0.0
+    worst_batch = 0.0
+    vehicles = 4
+
+    for trial in range(20):
+        p, i, d, tau = random_gains(rng, (vehicles, len(LOOPS)))
+        limits = rng.uniform(0.5, 2.0, (vehicles, len(LOOPS))) if trial % 2 else None
+
+        pids = [[PID(p[v, k], i[v, k], d[v, k], None if limits is None else limits[v, k],
+                     None if limits is None else -limits[v, k], tau[v, k]) for k in range(len(LOOPS))] for v in range(vehicles)]
+        single = PIDBank(LOOPS, p[0], i[0], d[0], tau[0], None if limits is None else limits[0], None if limits is None else -limits[0])
+        batch = PIDBank(LOOPS, p, i, d, tau, limits, None if limits is None else -limits, vehicles=vehicles)
+
+        for step in range(steps):
+            dt = rng.choice([0.005, 0.005, 0.0045, 0.0055, 2.0, 1.0e-6])
+            first = rng.randint(0, 4)
+            loops = slice(first, rng.randint(first + 1, len(LOOPS) + 1))
+            n = loops.stop - loops.start
+
+            desired = rng.normal(0.0, 2.0, (vehicles, n))
+            current = rng.normal(0.0, 2.0, (vehicles, n))
+            if rng.rand() < 0.02:
+                desired[0, 0] = 1.0e8
+            x_dot = None
+            if rng.rand() < 0.3:
+                x_dot = rng.normal(0.0, 1.0, (vehicles, n))
+                x_dot[rng.rand(vehicles, n) < 0.5] = np.nan
+
+            reference = np.array([[pids[v][k].computePID(desired[v, j], current[v, j], dt,
+                                                         None if x_dot is None or np.isnan(x_dot[v, j]) else x_dot[v, j])
+                                   for j, k in enumerate(range(loops.start, loops.stop))] for v in range(vehicles)])
+
+            out = single.update(loops, desired[0].tolist(), current[0].tolist(), dt, None if x_dot is None else x_dot[0].tolist())
+            worst_loops = max(worst_loops, np.max(np.abs(np.array(out) - reference[0])))
+
+            out = batch.update(loops, desired, current, dt, x_dot)
+            worst_batch = max(worst_batch, np.max(np.abs(out - reference)))
+
+    return worst_loops, worst_batch
+
+
+def time_single(steps, seed=1):
+
+    # the cascade of controller_core.py: x, y, psi | u, v, w (w with a measured derivative) | z
+    rng = np.random.RandomState(seed)
+    values = rng.normal(0.0, 1.0, (steps, 9)).tolist()
+    p, i, d, tau = random_gains(rng, len(LOOPS))
+
+    pids = [PID(p[k], i[k], d[k], None, None, tau[k]) for k in range(len(LOOPS))]
+    start = timer()
+    for a, b, c, e, f, g, h, m, n in values:
+        x = pids[0].computePID(a, b, 0.005)
+        y = pids[1].computePID(c, e, 0.005)
+        r = pids[2].computePID(f, g, 0.005)
+        u = pids[3].computePID(x, h, 0.005)
+        v = pids[4].computePID(y, m, 0.005)
+        w = pids[5].computePID(r, n, 0.005, a)
+        z = pids[6].computePID(w, b, 0.005)
+    simple_time = (timer() - start)/steps
+
+    bank = PIDBank(LOOPS, p, i, d, tau)
+    nan = float('nan')
+    position = slice(0, 3)
+    velocity = slice(3, 6)
+    acceleration = slice(6, 7)
+    start = timer()
+    for a, b, c, e, f, g, h, m, n in values:
+        x, y, r = bank.update(position, (a, c, f), (b, e, g), 0.005)
+        u, v, w = bank.update(velocity, (x, y, r), (h, m, n), 0.005, (nan, nan, a))
+        z = bank.update(acceleration, (w,), (b,), 0.005)[0]
+    bank_time = (timer() - start)/steps
+
+    # gain change and integrator reset of the seven loops (best of 20)
+    simple_reset = INF
+    for repeat in range(20):
+        start = timer()
+        for pid in pids:
+            pid.setGains(0.5, 0.1, 0.05, 0.04)
+            pid.clearIntegrator()
+        simple_reset = min(simple_reset, timer() - start)
+
+    bank_reset = INF
+    for repeat in range(20):
+        start = timer()
+        bank.set_gains(0.5, 0.1, 0.05, 0.04)
+        bank.clear_integrators()
+        bank_reset = min(bank_reset, timer() - start)
+
+    return simple_time, bank_time, simple_reset, bank_reset
+
+
+def time_batch(vehicles, steps, seed=2):
+
+    rng = np.random.RandomState(seed)
+    p, i, d, tau = random_gains(rng, (vehicles, len(LOOPS)))
+    desired = rng.normal(0.0, 1.0, (vehicles, len(LOOPS)))
+    current = rng.normal(0.0, 1.0, (vehicles, len(LOOPS)))
+
+    pids = [PID(p[v, k], i[v, k], d[v, k], None, None, tau[v, k]) for v in range(vehicles) for k in range(len(LOOPS))]
+    desired_list = desired.ravel().tolist()
+    current_list = current.ravel().tolist()
+    start = timer()
+    for step in range(steps):
+        for k in range(len(pids)):
+            pids[k].computePID(desired_list[k], current_list[k], 0.005)
+    simple_time = (timer() - start)/steps
+
+    simple_reset = INF
+    for repeat in range(20):
+        start = timer()
+        for pid in pids:
+            pid.setGains(0.5, 0.1, 0.05, 0.04)
+            pid.clearIntegrator()
+        simple_reset = min(simple_reset, timer() - start)
+
+    bank = PIDBank(LOOPS, p, i, d, tau, vehicles=vehicles)
+    everything = slice(None)
+    start = timer()
+    for step in range(steps):
+        bank.update(everything, desired, current, 0.005)
+    bank_time = (timer() - start)/steps
+
+    bank_reset = INF
+    for repeat in range(20):
+        start = timer()
+        bank.set_gains(0.5, 0.1, 0.05, 0.04)
+        bank.clear_integrators()
+        bank_reset = min(bank_reset, timer() - start)
+
+    return simple_time, bank_time, simple_reset, bank_reset
+
+
+def main():
+
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_vehicles = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    worst_loops, worst_batch = check_equivalence(steps//4)
+    print('largest difference from SimplePID: one-vehicle path %.3g, batched path %.3g' % (worst_loops, worst_batch))
+
+    simple_time, bank_time, simple_reset, bank_reset = time_single(steps*20)
+    print('one vehicle, 7 loops in 3 cascade stages: SimplePID %.2f us, PIDBank %.2f us per tick' % (1.0e6*simple_time, 1.0e6*bank_time))
+    print('one vehicle, gain change + reset of the 7 loops: SimplePID %.2f us, PIDBank %.2f us' % (1.0e6*simple_reset, 1.0e6*bank_reset))
+
+    print('batched, all 7 loops of N vehicles per step:')
+    vehicles = 1
+    while vehicles <= max_vehicles:
+        simple_time, bank_time, simple_reset, bank_reset = time_batch(vehicles, max(steps*10//vehicles, 20))
+        print('  N=%-6d SimplePID %9.1f us  PIDBank %7.1f us  (%6.1fx)   gain change + reset %8.1f us -> %5.1f us' % (
+            vehicles, 1.0e6*simple_time, 1.0e6*bank_time, simple_time/bank_time, 1.0e6*simple_reset, 1.0e6*bank_reset))
+        vehicles *= 10
+
+
+if __name__ == '__main__':
+    main()
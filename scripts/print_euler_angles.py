@@ -8,7 +8,7 @@ import rospy
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Vector3Stamped
 import numpy as np
-import tf
+from rotation_kernel import quaternion_to_euler
 
 
 class PrintEuler(object):
@@ -37,14 +37,10 @@ class PrintEuler(object):
     def state_callback(self, msg):
 
         # get the quaternion orientation from the message
-        quaternion = (
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w)
-
-        # convert to euler angles 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
+        orientation = msg.pose.pose.orientation
+
+        # convert to euler angles
+        euler = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
         # update class variables
         self.phi = euler[0]
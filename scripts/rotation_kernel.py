@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+## Quaternion, Euler angle and rotation matrix conversions, and the NED/ENU and
+## FLU/FRD axis swaps, for the estimate callbacks. Before this, every callback
+## called tf.transformations.euler_from_quaternion (a 4x4 numpy matrix per
+## message) and a couple of nodes had their own quaternion-to-matrix copies.
+##
+## The scalar functions take and return plain floats (tuples, nested lists for
+## matrices) and only use the math module, a few times faster than tf on one
+## message. The *_batch functions do the same on numpy arrays with any leading
+## shape (quaternions (..., 4), Euler angles and vectors (..., 3), matrices
+## (..., 3, 3)), for logs and replays.
+##
+## The conventions are tf's defaults, and the results match tf.transformations
+## (see rotation_kernel_benchmark.py):
+##   quaternions are (x, y, z, w) like geometry_msgs, and don't need to be unit
+##     length (they're normalized, and one of squared norm below EPS is the identity)
+##   Euler angles are tf's 'sxyz': roll about x, pitch about y, yaw about z, all
+##     about the fixed axes, so R = Rz(yaw) Ry(pitch) Rx(roll). That is the
+##     body-to-inertial rotation R_i_b of the UAV book for (phi, theta, psi).
+##   quaternion_to_rotation gives the same R (child frame to parent frame);
+##     quaternion_to_inverse_rotation is its transpose (parent to child), what
+##     the old get_R_from_quaternion helpers returned
+## At pitch = +/-90 deg (gimbal lock) roll and yaw aren't unique and, like tf,
+## the yaw comes back 0.
+
+import math
+import numpy as np
+
+# tf.transformations' threshold for a zero quaternion and for gimbal lock
+EPS = np.finfo(float).eps*4.0
+
+
+# Scalar (one message)
+
+def quaternion_to_rotation(x, y, z, w):
+
+    # 3x3 rotation matrix (nested lists), tf.transformations.quaternion_matrix
+    n = x*x + y*y + z*z + w*w
+    if n < EPS:
+        return [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+
+    s = 2.0/n
+    xx = s*x*x
+    yy = s*y*y
+    zz = s*z*z
+    xy = s*x*y
+    xz = s*x*z
+    yz = s*y*z
+    wx = s*w*x
+    wy = s*w*y
+    wz = s*w*z
+
+    return [[1.0 - yy - zz, xy - wz, xz + wy],
+            [xy + wz, 1.0 - xx - zz, yz - wx],
+            [xz - wy, yz + wx, 1.0 - xx - yy]]
+
+
+def quaternion_to_inverse_rotation(x, y, z, w):
+
+    # the transpose of quaternion_to_rotation
+    R = quaternion_to_rotation(x, y, z, w)
+
+    return [[R[0][0], R[1][0], R[2][0]],
+            [R[0][1], R[1][1], R[2][1]],
+            [R[0][2], R[1][2], R[2][2]]]
+
+
+def rotation_to_euler(R):
+
+    # (roll, pitch, yaw) of a rotation matrix (nested lists or array), tf.transformations.euler_from_matrix
+    cy = math.sqrt(R[0][0]*R[0][0] + R[1][0]*R[1][0])
+    if cy > EPS:
+        return math.atan2(R[2][1], R[2][2]), math.atan2(-R[2][0], cy), math.atan2(R[1][0], R[0][0])
+
+    return math.atan2(-R[1][2], R[1][1]), math.atan2(-R[2][0], cy), 0.0
+
+
+def quaternion_to_euler(x, y, z, w):
+
+    # (roll, pitch, yaw), tf.transformations.euler_from_quaternion without building the matrix
+    n = x*x + y*y + z*z + w*w
+    if n < EPS:
+        return 0.0, 0.0, 0.0
+
+    s = 2.0/n
+    r00 = 1.0 - s*(y*y + z*z)
+    r10 = s*(x*y + w*z)
+    r20 = s*(x*z - w*y)
+
+    cy = math.sqrt(r00*r00 + r10*r10)
+    if cy > EPS:
+        return (math.atan2(s*(y*z + w*x), 1.0 - s*(x*x + y*y)),
+                math.atan2(-r20, cy),
+                math.atan2(r10, r00))
+
+    return math.atan2(-s*(y*z - w*x), 1.0 - s*(x*x + z*z)), math.atan2(-r20, cy), 0.0
+
+
+def euler_to_quaternion(roll, pitch, yaw):
+
+    # (x, y, z, w), tf.transformations.quaternion_from_euler
+    ci = math.cos(0.5*roll)
+    si = math.sin(0.5*roll)
+    cj = math.cos(0.5*pitch)
+    sj = math.sin(0.5*pitch)
+    ck = math.cos(0.5*yaw)
+    sk = math.sin(0.5*yaw)
+    cc = ci*ck
+    cs = ci*sk
+    sc = si*ck
+    ss = si*sk
+
+    return cj*sc - sj*cs, cj*ss + sj*cc, cj*cs - sj*sc, cj*cc + sj*ss
+
+
+def body_to_inertial(phi, theta, psi):
+
+    # rotation matrix (nested lists) from the body frame to the vehicle frame, R_i_b = R_b_i transpose in the UAV book
+    sphi = math.sin(phi)
+    cphi = math.cos(phi)
+    stheta = math.sin(theta)
+    ctheta = math.cos(theta)
+    spsi = math.sin(psi)
+    cpsi = math.cos(psi)
+
+    return [[ctheta*cpsi, sphi*stheta*cpsi - cphi*spsi, cphi*stheta*cpsi + sphi*spsi],
+            [ctheta*spsi, sphi*stheta*spsi + cphi*cpsi, cphi*stheta*spsi - sphi*cpsi],
+            [-stheta, sphi*ctheta, cphi*ctheta]]
+
+
+def ned_to_enu(n, e, d):
+
+    # NED to ENU (the same permutation both ways)
+    return e, n, -d
+
+
+def enu_to_ned(e, n, u):
+
+    return n, e, -u
+
+
+def flu_to_frd(x, y, z):
+
+    # body front-left-up (ROS/MAVROS) to front-right-down (aircraft), its own inverse
+    return x, -y, -z
+
+
+def frd_to_flu(x, y, z):
+
+    return x, -y, -z
+
+
+# Batched (numpy arrays, components along the last axis)
+
+def quaternion_to_rotation_batch(q):
+
+    # (..., 4) quaternions (x, y, z, w) -> (..., 3, 3) matrices
+    q = np.asarray(q, dtype=float)
+    x = q[..., 0]
+    y = q[..., 1]
+    z = q[..., 2]
+    w = q[..., 3]
+
+    # s = 0 gives the identity for a zero quaternion
+    n = np.sum(q*q, axis=-1)
+    zero = n < EPS
+    s = np.where(zero, 0.0, 2.0/np.where(zero, 1.0, n))
+
+    R = np.empty(q.shape[:-1] + (3, 3))
+    R[..., 0, 0] = 1.0 - s*(y*y + z*z)
+    R[..., 0, 1] = s*(x*y - w*z)
+    R[..., 0, 2] = s*(x*z + w*y)
+    R[..., 1, 0] = s*(x*y + w*z)
+    R[..., 1, 1] = 1.0 - s*(x*x + z*z)
+    R[..., 1, 2] = s*(y*z - w*x)
+    R[..., 2, 0] = s*(x*z - w*y)
+    R[..., 2, 1] = s*(y*z + w*x)
+    R[..., 2, 2] = 1.0 - s*(x*x + y*y)
+
+    return R
+
+
+def rotation_to_euler_batch(R):
+
+    # (..., 3, 3) matrices -> (..., 3) Euler angles (roll, pitch, yaw)
+    R = np.asarray(R, dtype=float)
+    cy = np.sqrt(R[..., 0, 0]**2 + R[..., 1, 0]**2)
+    locked = cy <= EPS
+
+    euler = np.empty(R.shape[:-2] + (3,))
+    euler[..., 0] = np.where(locked, np.arctan2(-R[..., 1, 2], R[..., 1, 1]), np.arctan2(R[..., 2, 1], R[..., 2, 2]))
+    euler[..., 1] = np.arctan2(-R[..., 2, 0], cy)
+    euler[..., 2] = np.where(locked, 0.0, np.arctan2(R[..., 1, 0], R[..., 0, 0]))
+
+    return euler
+
+
+def quaternion_to_euler_batch(q):
+
+    # (..., 4) quaternions (x, y, z, w) -> (..., 3) Euler angles (roll, pitch, yaw)
+    return rotation_to_euler_batch(quaternion_to_rotation_batch(q))
+
+
+def euler_to_quaternion_batch(euler):
+
+    # (..., 3) Euler angles -> (..., 4) quaternions (x, y, z, w)
+    half = 0.5*np.asarray(euler, dtype=float)
+    c = np.cos(half)
+    s = np.sin(half)
+    ci, cj, ck = c[..., 0], c[..., 1], c[..., 2]
+    si, sj, sk = s[..., 0], s[..., 1], s[..., 2]
+    cc = ci*ck
+    cs = ci*sk
+    sc = si*ck
+    ss = si*sk
+
+    q = np.empty(half.shape[:-1] + (4,))
+    q[..., 0] = cj*sc - sj*cs
+    q[..., 1] = cj*ss + sj*cc
+    q[..., 2] = cj*cs - sj*sc
+    q[..., 3] = cj*cc + sj*ss
+
+    return q
+
+
+def euler_to_rotation_batch(euler):
+
+    # (..., 3) Euler angles -> (..., 3, 3) body-to-inertial matrices, body_to_inertial on arrays
+    euler = np.asarray(euler, dtype=float)
+    c = np.cos(euler)
+    s = np.sin(euler)
+    cphi, ctheta, cpsi = c[..., 0], c[..., 1], c[..., 2]
+    sphi, stheta, spsi = s[..., 0], s[..., 1], s[..., 2]
+
+    R = np.empty(euler.shape[:-1] + (3, 3))
+    R[..., 0, 0] = ctheta*cpsi
+    R[..., 0, 1] = sphi*stheta*cpsi - cphi*spsi
+    R[..., 0, 2] = cphi*stheta*cpsi + sphi*spsi
+    R[..., 1, 0] = ctheta*spsi
+    R[..., 1, 1] = sphi*stheta*spsi + cphi*cpsi
+    R[..., 1, 2] = cphi*stheta*spsi - sphi*cpsi
+    R[..., 2, 0] = -stheta
+    R[..., 2, 1] = sphi*ctheta
+    R[..., 2, 2] = cphi*ctheta
+
+    return R
+
+
+def ned_to_enu_batch(v):
+
+    # (..., 3) vectors, the same permutation both ways
+    v = np.asarray(v, dtype=float)
+    return np.stack((v[..., 1], v[..., 0], -v[..., 2]), axis=-1)
+
+
+def enu_to_ned_batch(v):
+
+    return ned_to_enu_batch(v)
+
+
+def flu_to_frd_batch(v):
+
+    # (..., 3) vectors, its own inverse
+    v = np.asarray(v, dtype=float)
+    return np.stack((v[..., 0], -v[..., 1], -v[..., 2]), axis=-1)
+
+
+def frd_to_flu_batch(v):
+
+    return flu_to_frd_batch(v)
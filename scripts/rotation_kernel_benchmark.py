@@ -0,0 +1,315 @@
+#! /usr/bin/env python
+
+## Golden check and benchmark for rotation_kernel.py (no ROS needed).
+##
+## 1. Golden values: quaternion -> Euler, Euler -> quaternion and
+##    quaternion -> matrix for identity, random, non-unit, negated, gimbal
+##    locked (pitch +/-90 deg), yaw next to pi and zero quaternions, computed
+##    with the tf.transformations algorithm (Gohlke's transformations.py,
+##    2021.6.6, in tf's (x, y, z, w) order). Scalar and batched paths.
+## 2. Against tf itself on random quaternions and angles, when
+##    tf.transformations can be imported (a sourced ROS workspace).
+## 3. Cross checks: batched against scalar, body_to_inertial against
+##    quaternion_to_rotation(euler_to_quaternion(...)), round trips, and
+##    quaternion_to_inverse_rotation against the get_R_from_quaternion copies
+##    it replaced.
+## 4. Time per message of the Euler conversion against tf (or a numpy copy of
+##    tf's algorithm without ROS), of the old get_R_from_quaternion, and of
+##    the batched functions on N quaternions against a loop of scalar calls.
+## Exits with status 1 if anything is off by more than 1e-9.
+##
+## usage: ./rotation_kernel_benchmark.py [samples]
+
+from __future__ import print_function
+
+import sys
+import math
+import time
+import numpy as np
+from rotation_kernel import (EPS, quaternion_to_rotation, quaternion_to_inverse_rotation, rotation_to_euler,
+                             quaternion_to_euler, euler_to_quaternion, body_to_inertial,
+                             ned_to_enu, enu_to_ned, flu_to_frd, frd_to_flu,
+                             quaternion_to_rotation_batch, rotation_to_euler_batch, quaternion_to_euler_batch,
+                             euler_to_quaternion_batch, euler_to_rotation_batch,
+                             ned_to_enu_batch, enu_to_ned_batch, flu_to_frd_batch, frd_to_flu_batch)
+
+try:
+    import tf.transformations as tft
+except ImportError:
+    tft = None
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+TOLERANCE = 1.0e-9
+
+# (x, y, z, w) -> (roll, pitch, yaw)
+QUATERNION_TO_EULER = [
+    ((0.0, 0.0, 0.0, 1.0), (0.0, -0.0, 0.0)),
+    ((0.06146124, 0.0, 0.0, 0.99810947), (0.12300000158143692, -0.0, 0.0)),
+    ((0.9388736211458653, -0.25876939068328786, 0.0182274577962593, 0.2263238514698258), (2.707718803869248, -0.15194188465866723, -0.5043289669256751)),
+    ((-0.41006054629389005, 0.0010736281278268603, -0.0004627981413493459, -0.9120575538383967), (0.8450415478479852, -0.002337973935268006, -3.6308091026417434e-05)),
+    ((0.7549989049750849, 0.4455089228751571, -0.4640047912527651, -0.12727139042030688), (-2.2962176519110713, 0.62765107511698, 1.3561031687704492)),
+    ((0.31993327600954713, -0.16547935419729345, -0.153698009445321, -0.9201283628542225), (-0.6282066599563848, 0.4146511962745522, 0.19456894414608167)),
+    ((0.035340609509366974, 0.7062230818371107, -0.035340609509366946, 0.7062230818371108), (0.1, 1.5707963267948966, 0.0)),
+    ((0.24246536490574877, -0.6642368153159851, 0.24246536490574883, 0.6642368153159852), (0.7000000000000002, -1.5707963267948963, 0.0)),
+    ((-0.09970865084727404, 0.049729481651314786, 0.9937606691630095, 0.0049895917263424175), (0.09999999999999999, 0.20000000000000004, 3.141592652589793)),
+    ((-1.025151365734725, 0.0026840703195671507, -0.0011569953533733647, -2.280143884595992), (0.8450415478479854, -0.0023379739352680073, -3.6308091026417434e-05)),
+    ((-0.7549989049750849, -0.4455089228751571, 0.4640047912527651, 0.12727139042030688), (-2.2962176519110713, 0.62765107511698, 1.3561031687704492)),
+    ((1e-09, 0.0, 0.0, 1e-09), (0.0, -0.0, 0.0)),
+]
+
+# (roll, pitch, yaw) -> (x, y, z, w)
+EULER_TO_QUATERNION = [
+    ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0, 1.0)),
+    ((0.123, 0.0, 0.0), (0.061461239268365025, 0.0, 0.0, 0.9981094709838179)),
+    ((0.1, -0.2, 2.5), (0.11030279371362021, 0.015752145824064707, 0.9446369200524395, 0.3086199165231389)),
+    ((-3.0, 1.2, -0.7), (-0.759659864640277, 0.31981653969606194, 0.50906201211652, 0.2479720524805838)),
+    ((0.3, 1.5707963267948966, 0.2), (0.035340609509366974, 0.7062230818371107, -0.035340609509366946, 0.7062230818371108)),
+    ((1.0, 2.0, 3.0), (-0.7182870182434113, 0.31062245106570396, 0.4444351134430007, 0.4359528440735657)),
+]
+
+# (x, y, z, w) -> 3x3 rotation
+QUATERNION_TO_ROTATION = [
+    ((0.06146124, 0.0, 0.0, 0.99810947),
+     ((1.0, 0.0, 0.0), (0.0, 0.992445031941167, -0.12269009159380456), (0.0, 0.12269009159380456, 0.992445031941167))),
+    ((0.9388736211458653, -0.25876939068328786, 0.0182274577962593, 0.2263238514698258),
+     ((0.865412324455371, -0.49415412664696146, -0.08290481167296875), (-0.47765289284314905, -0.7636318334025286, -0.4344124042575954), (0.15135792889479838, 0.415545571667022, -0.8968905480762999))),
+    ((0.31993327600954713, -0.16547935419729345, -0.153698009445321, -0.9201283628542225),
+     ((0.8979870104539853, -0.3887284994103207, 0.20617827917148351), (0.17695909180918348, 0.7480392415886898, 0.6396270576433479), (-0.40287070988343504, -0.537891668265663, 0.7405185644724912))),
+    ((-1.025151365734725, 0.0026840703195671507, -0.0011569953533733647, -2.280143884595992),
+     ((0.999997266281047, -0.0017247021546664203, -0.001578870770664709), (-3.6307991786255515e-05, 0.6637002683820735, -0.7479986313030884), (0.0023379718053267483, 0.7479966438106802, 0.6636983913915991))),
+]
+
+
+def numpy_euler_from_quaternion(quaternion):
+
+    # tf.transformations.euler_from_quaternion (axes 'sxyz'), what the callbacks paid per message
+    q = np.array(quaternion[:4], dtype=np.float64, copy=True)
+    nq = np.dot(q, q)
+    if nq < EPS:
+        M = np.identity(4)
+    else:
+        q *= math.sqrt(2.0/nq)
+        q = np.outer(q, q)
+        M = np.array((
+            (1.0 - q[1, 1] - q[2, 2], q[0, 1] - q[2, 3], q[0, 2] + q[1, 3], 0.0),
+            (q[0, 1] + q[2, 3], 1.0 - q[0, 0] - q[2, 2], q[1, 2] - q[0, 3], 0.0),
+            (q[0, 2] - q[1, 3], q[1, 2] + q[0, 3], 1.0 - q[0, 0] - q[1, 1], 0.0),
+            (0.0, 0.0, 0.0, 1.0)), dtype=np.float64)
+
+    M = np.array(M, dtype=np.float64, copy=False)[:3, :3]
+    cy = math.sqrt(M[0, 0]*M[0, 0] + M[1, 0]*M[1, 0])
+    if cy > EPS:
+        ax = math.atan2(M[2, 1], M[2, 2])
+        ay = math.atan2(-M[2, 0], cy)
+        az = math.atan2(M[1, 0], M[0, 0])
+    else:
+        ax = math.atan2(-M[1, 2], M[1, 1])
+        ay = math.atan2(-M[2, 0], cy)
+        az = 0.0
+    return ax, ay, az
+
+
+def legacy_get_R_from_quaternion(w, x, y, z):
+
+    # the copy in ibvs_state_machine_uw.py and aruco_angle.py
+    wx = w*x
+    wy = w*y
+    wz = w*z
+    xx = x*x
+    xy = x*y
+    xz = x*z
+    yy = y*y
+    yz = y*z
+    zz = z*z
+
+    return np.array([[1. - 2.*yy - 2.*zz, 2.*xy + 2.*wz, 2.*xz - 2.*wy],
+                     [2.*xy - 2.*wz, 1. - 2.*xx - 2.*zz, 2.*yz + 2.*wx],
+                     [2.*xz + 2.*wy, 2.*yz - 2.*wx, 1. - 2.*xx - 2.*yy]])
+
+
+def angle_error(a, b):
+
+    # largest difference between two sets of angles, with +/-pi the same angle
+    d = np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float))
+    return float(np.max(np.minimum(d, 2.0*np.pi - d)))
+
+
+def random_quaternions(rng, samples):
+
+    # unit, scaled and negated quaternions, and some right at gimbal lock
+    q = rng.normal(0.0, 1.0, (samples, 4))
+    q /= np.linalg.norm(q, axis=1)[:, None]
+    q[::3] *= rng.uniform(0.1, 10.0, (q[::3].shape[0], 1))
+    q[1::5] *= -1.0
+    locked = euler_to_quaternion_batch(np.column_stack((rng.uniform(-np.pi, np.pi, samples//20),
+                                                        rng.choice([-np.pi/2, np.pi/2], samples//20),
+                                                        rng.uniform(-np.pi, np.pi, samples//20))))
+    q[:samples//20] = locked
+    return q
+
+
+def check_golden():
+
+    worst = {}
+    quaternions = np.array([q for q, e in QUATERNION_TO_EULER])
+    euler = np.array([e for q, e in QUATERNION_TO_EULER])
+    worst['quaternion_to_euler'] = max(angle_error(quaternion_to_euler(*q), e) for q, e in QUATERNION_TO_EULER)
+    worst['quaternion_to_euler_batch'] = angle_error(quaternion_to_euler_batch(quaternions), euler)
+
+    angles = np.array([e for e, q in EULER_TO_QUATERNION])
+    quaternions = np.array([q for e, q in EULER_TO_QUATERNION])
+    worst['euler_to_quaternion'] = max(float(np.max(np.abs(np.array(euler_to_quaternion(*e)) - q))) for e, q in EULER_TO_QUATERNION)
+    worst['euler_to_quaternion_batch'] = float(np.max(np.abs(euler_to_quaternion_batch(angles) - quaternions)))
+
+    quaternions = np.array([q for q, R in QUATERNION_TO_ROTATION])
+    rotations = np.array([R for q, R in QUATERNION_TO_ROTATION])
+    worst['quaternion_to_rotation'] = max(float(np.max(np.abs(np.array(quaternion_to_rotation(*q)) - R))) for q, R in QUATERNION_TO_ROTATION)
+    worst['quaternion_to_rotation_batch'] = float(np.max(np.abs(quaternion_to_rotation_batch(quaternions) - rotations)))
+
+    return worst
+
+
+def check_tf(rng, samples):
+
+    worst = {}
+    quaternions = random_quaternions(rng, samples)
+    angles = rng.uniform(-np.pi, np.pi, (samples, 3))
+    angles[:, 1] *= 0.5
+
+    worst['quaternion_to_euler'] = max(angle_error(quaternion_to_euler(*q), tft.euler_from_quaternion(q)) for q in quaternions)
+    worst['euler_to_quaternion'] = max(float(np.max(np.abs(np.array(euler_to_quaternion(*e)) - tft.quaternion_from_euler(*e)))) for e in angles)
+    worst['quaternion_to_rotation'] = max(float(np.max(np.abs(np.array(quaternion_to_rotation(*q)) - tft.quaternion_matrix(q)[:3, :3]))) for q in quaternions)
+    worst['body_to_inertial'] = max(float(np.max(np.abs(np.array(body_to_inertial(*e)) - tft.euler_matrix(*e)[:3, :3]))) for e in angles)
+    worst['rotation_to_euler'] = max(angle_error(rotation_to_euler(tft.euler_matrix(*e)), tft.euler_from_matrix(tft.euler_matrix(*e))) for e in angles)
+
+    return worst
+
+
+def check_consistency(rng, samples):
+
+    worst = {}
+    quaternions = random_quaternions(rng, samples)
+    angles = rng.uniform(-np.pi, np.pi, (samples, 3))
+    angles[:, 1] *= 0.5
+    vectors = rng.normal(0.0, 10.0, (samples, 3))
+
+    scalar = np.array([quaternion_to_euler(*q) for q in quaternions])
+    worst['quaternion_to_euler against tf algorithm'] = max(angle_error(e, numpy_euler_from_quaternion(q)) for q, e in zip(quaternions, scalar))
+    worst['quaternion_to_euler_batch against scalar'] = angle_error(quaternion_to_euler_batch(quaternions), scalar)
+    worst['quaternion_to_rotation_batch against scalar'] = float(np.max(np.abs(
+        quaternion_to_rotation_batch(quaternions) - np.array([quaternion_to_rotation(*q) for q in quaternions]))))
+    worst['rotation_to_euler_batch against scalar'] = angle_error(
+        rotation_to_euler_batch(euler_to_rotation_batch(angles)), [rotation_to_euler(body_to_inertial(*e)) for e in angles])
+    worst['euler_to_quaternion_batch against scalar'] = float(np.max(np.abs(
+        euler_to_quaternion_batch(angles) - np.array([euler_to_quaternion(*e) for e in angles]))))
+    worst['euler_to_rotation_batch against body_to_inertial'] = float(np.max(np.abs(
+        euler_to_rotation_batch(angles) - np.array([body_to_inertial(*e) for e in angles]))))
+    worst['body_to_inertial against quaternion_to_rotation'] = float(np.max(np.abs(
+        np.array([body_to_inertial(*e) for e in angles]) - np.array([quaternion_to_rotation(*euler_to_quaternion(*e)) for e in angles]))))
+    worst['Euler -> quaternion -> Euler'] = angle_error([quaternion_to_euler(*euler_to_quaternion(*e)) for e in angles], angles)
+
+    unit = quaternions/np.linalg.norm(quaternions, axis=1)[:, None]
+    worst['quaternion_to_inverse_rotation against get_R_from_quaternion'] = float(np.max(np.abs(
+        np.array([quaternion_to_inverse_rotation(*q) for q in unit]) - np.array([legacy_get_R_from_quaternion(q[3], q[0], q[1], q[2]) for q in unit]))))
+
+    swaps = 0.0
+    for v in vectors:
+        swaps = max(swaps, float(np.max(np.abs(np.array(enu_to_ned(*ned_to_enu(*v))) - v))),
+                    float(np.max(np.abs(np.array(frd_to_flu(*flu_to_frd(*v))) - v))))
+    swaps = max(swaps, float(np.max(np.abs(enu_to_ned_batch(ned_to_enu_batch(vectors)) - vectors))),
+                float(np.max(np.abs(frd_to_flu_batch(flu_to_frd_batch(vectors)) - vectors))),
+                float(np.max(np.abs(ned_to_enu_batch(vectors) - np.array([ned_to_enu(*v) for v in vectors])))),
+                float(np.max(np.abs(flu_to_frd_batch(vectors) - np.array([flu_to_frd(*v) for v in vectors])))))
+    worst['NED/ENU and FLU/FRD swaps'] = swaps
+
+    return worst
+
+
+def best_time(function, repeats=5):
+
+    best = float('inf')
+    for repeat in range(repeats):
+        start = timer()
+        function()
+        best = min(best, timer() - start)
+    return best
+
+
+def time_conversions(rng, samples):
+
+    quaternions = random_quaternions(rng, samples)
+    as_lists = quaternions.tolist()
+    reference = tft.euler_from_quaternion if tft is not None else numpy_euler_from_quaternion
+    reference_name = 'tf' if tft is not None else 'tf algorithm (numpy copy)'
+
+    def run_reference():
+        for q in as_lists:
+            reference(q)
+
+    def run_kernel():
+        for x, y, z, w in as_lists:
+            quaternion_to_euler(x, y, z, w)
+
+    def run_legacy_R():
+        for x, y, z, w in as_lists:
+            legacy_get_R_from_quaternion(w, x, y, z)
+
+    def run_inverse_R():
+        for x, y, z, w in as_lists:
+            np.array(quaternion_to_inverse_rotation(x, y, z, w))
+
+    reference_time = best_time(run_reference)/samples
+    kernel_time = best_time(run_kernel)/samples
+    print('Euler angles from one quaternion: %s %.2f us, quaternion_to_euler %.2f us (%.1fx)' % (
+        reference_name, 1.0e6*reference_time, 1.0e6*kernel_time, reference_time/kernel_time))
+
+    legacy_time = best_time(run_legacy_R)/samples
+    inverse_time = best_time(run_inverse_R)/samples
+    print('rotation from one quaternion: get_R_from_quaternion %.2f us, quaternion_to_inverse_rotation + np.array %.2f us' % (
+        1.0e6*legacy_time, 1.0e6*inverse_time))
+
+    print('batched, N quaternions:')
+    for n in (10, 100, 1000, 10000):
+        q = quaternions[:n] if n <= samples else random_quaternions(rng, n)
+        q_lists = q.tolist()
+        loop_time = best_time(lambda: [quaternion_to_euler(*v) for v in q_lists])
+        batch_time = best_time(lambda: quaternion_to_euler_batch(q))
+        print('  N=%-6d quaternion_to_euler loop %8.1f us, quaternion_to_euler_batch %7.1f us (%.1fx)' % (
+            n, 1.0e6*loop_time, 1.0e6*batch_time, loop_time/batch_time))
+
+
+def report(title, worst):
+
+    print(title)
+    failed = False
+    for name in sorted(worst):
+        flag = '' if worst[name] <= TOLERANCE else '   <-- FAILED'
+        failed = failed or bool(flag)
+        print('  %-62s %.3g%s' % (name, worst[name], flag))
+    return failed
+
+
+def main():
+
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = np.random.RandomState(0)
+
+    failed = report('golden values (tf.transformations algorithm), largest difference:', check_golden())
+    if tft is not None:
+        failed = report('against tf.transformations, %d samples, largest difference:' % samples, check_tf(rng, samples)) or failed
+    else:
+        print('tf.transformations not found, checked against the golden values and the numpy copy of its algorithm only')
+    failed = report('consistency, %d samples, largest difference:' % samples, check_consistency(rng, samples)) or failed
+
+    time_conversions(rng, samples)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
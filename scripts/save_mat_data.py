@@ -9,9 +9,9 @@ from aruco_localization.msg import FloatList
 import numpy as np
 import scipy.io
 import cv2
-import tf
 import time
 from os import path
+from rotation_kernel import quaternion_to_euler
 
 
 class SaveMatData(object):
@@ -335,15 +335,9 @@ class SaveMatData(object):
 
     def attitude_callback(self, msg):
 
-        # get the quaternion orientation from the message
-        quaternion = (
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w)
-
-        # convert to euler angles 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
+        # get the quaternion orientation from the message and convert to euler angles
+        orientation = msg.pose.pose.orientation
+        euler = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
         # update class variables
         self.phi = euler[0]
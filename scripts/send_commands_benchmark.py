@@ -0,0 +1,401 @@
+#! /usr/bin/env python
+
+## Benchmark for the per-tick command shaping of the state machine nodes
+## (send_commands in ibvs_state_machine.py / ibvs_state_machine_uw.py). Flies a
+## StateMachineCore on a simulated clock through RENDEZVOUS and then IBVS on
+## the outer and inner markers. Every tick takes a new attitude and one NED
+## IBVS velocity command (mapped to ENU like the mavros callbacks do) and then
+## shapes the setpoint the way the nodes used to and the way they do now:
+##   legacy: np.dot with the 3x3 NED->ENU matrix per IBVS command, np.cos/np.sin
+##           of psi four times per setpoint, np.radians in the yaw wrap
+##   frame:  rotation_kernel.ned_to_enu and the heading trig cached once per tick (frame_context.py)
+## Reports the CPU time per tick and what that is as a share of one core at the
+## command rates given (no ROS needed). It also times compute_rendezvous_offset
+## against the old version that rebuilt the camera mount rotations every call.
+##
+## If mavros_msgs is importable it also compares allocating a PositionTarget
+## every tick against filling in the one the nodes keep now.
+##
+## usage: ./send_commands_benchmark.py [ticks] [rate_hz ...]
+
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+from state_machine_core import StateMachineCore
+from rotation_kernel import ned_to_enu
+
+
+class BenchCore(StateMachineCore):
+
+    # StateMachineCore with the mavros setpoint shaping of the nodes, the setpoint goes into self.setpoint
+    def __init__(self, clock, msg_factory=None):
+
+        StateMachineCore.__init__(self, clock=clock, wind_calc_completed=True, heading_correction_completed=True)
+
+        self.u_max = 1.0
+        self.v_max = 1.0
+        self.w_max = 0.5
+        self.u_max_inner = 0.5
+        self.v_max_inner = 0.5
+        self.w_max_inner = 0.3
+
+        self.ibvs_x = self.ibvs_y = self.ibvs_F = self.ibvs_z = 0.0
+        self.ibvs_x_inner = self.ibvs_y_inner = self.ibvs_F_inner = self.ibvs_z_inner = 0.0
+        self.target_VN = 0.8
+        self.target_VE = -0.4
+        self.heading_command = 0.3
+
+        self.setpoint = None
+        self.msg_factory = msg_factory
+
+
+    def log(self, text):
+        pass
+
+
+    def saturate(self, x, x_max, x_min):
+
+        if x > x_max:
+            return x_max
+        elif x < x_min:
+            return x_min
+        else:
+            return x
+
+
+    def ibvs_command(self, target, n, e, d, r):
+
+        # what the mavros IBVS callbacks do with a Twist
+        if target == 'outer':
+            self.ibvs_x, self.ibvs_y, self.ibvs_F = ned_to_enu(n, e, d)
+            self.ibvs_z = -r
+        else:
+            self.ibvs_x_inner, self.ibvs_y_inner, self.ibvs_F_inner = ned_to_enu(n, e, d)
+            self.ibvs_z_inner = -r
+
+
+    def send_ibvs_command(self, flag):
+
+        if flag == 'inner':
+            x = self.saturate(self.ibvs_x_inner, self.u_max_inner, -self.u_max_inner)
+            y = self.saturate(self.ibvs_y_inner, self.v_max_inner, -self.v_max_inner)
+            F = self.saturate(self.ibvs_F_inner, self.w_max_inner, -self.w_max_inner)
+            z = self.ibvs_z_inner
+        else:
+            x = self.saturate(self.ibvs_x, self.u_max, -self.u_max)
+            y = self.saturate(self.ibvs_y, self.v_max, -self.v_max)
+            F = self.saturate(self.ibvs_F, self.w_max, -self.w_max)
+            z = self.ibvs_z
+
+        ff_x, ff_y = self.frame.heading_right_forward(self.target_VN, self.target_VE)
+        self.setpoint = (x + ff_x, y + ff_y, F, z)
+
+        if self.msg_factory is not None:
+            self.msg_factory.ibvs(self.setpoint)
+
+
+    def send_waypoint_command(self):
+
+        yaw = -self.heading_command + 0.5*np.pi
+        while yaw > np.pi:  yaw = yaw - 2.0*np.pi
+        while yaw < -np.pi:  yaw = yaw + 2.0*np.pi
+        self.setpoint = (self.wp_E, self.wp_N, self.rendezvous_height, yaw)
+
+        if self.msg_factory is not None:
+            self.msg_factory.waypoint(self.setpoint)
+
+
+class LegacyBenchCore(BenchCore):
+
+    # The same shaping the way the nodes used to do it
+    def __init__(self, clock, msg_factory=None):
+
+        BenchCore.__init__(self, clock, msg_factory)
+
+        self.ned_vel_vec_inner = np.array([[0.0], [0.0], [0.0]], dtype=np.float32)
+        self.ned_vel_vec_outer = np.array([[0.0], [0.0], [0.0]], dtype=np.float32)
+        self.R_ned_enu = np.array([[0., 1., 0.],
+                                   [1., 0., 0.],
+                                   [0., 0., -1.]])
+
+
+    def ibvs_command(self, target, n, e, d, r):
+
+        if target == 'outer':
+            self.ned_vel_vec_outer[0][0] = n
+            self.ned_vel_vec_outer[1][0] = e
+            self.ned_vel_vec_outer[2][0] = d
+            enu_vec = np.dot(self.R_ned_enu, self.ned_vel_vec_outer)
+            self.ibvs_x = enu_vec[0][0]
+            self.ibvs_y = enu_vec[1][0]
+            self.ibvs_F = enu_vec[2][0]
+            self.ibvs_z = -r
+        else:
+            self.ned_vel_vec_inner[0][0] = n
+            self.ned_vel_vec_inner[1][0] = e
+            self.ned_vel_vec_inner[2][0] = d
+            enu_vec = np.dot(self.R_ned_enu, self.ned_vel_vec_inner)
+            self.ibvs_x_inner = enu_vec[0][0]
+            self.ibvs_y_inner = enu_vec[1][0]
+            self.ibvs_F_inner = enu_vec[2][0]
+            self.ibvs_z_inner = -r
+
+
+    def send_ibvs_command(self, flag):
+
+        if flag == 'inner':
+            self.setpoint = (self.saturate(self.ibvs_x_inner, self.u_max_inner, -self.u_max_inner) + self.target_VE*np.cos(self.psi) - self.target_VN*np.sin(self.psi),
+                             self.saturate(self.ibvs_y_inner, self.v_max_inner, -self.v_max_inner) + self.target_VN*np.cos(self.psi) + self.target_VE*np.sin(self.psi),
+                             self.saturate(self.ibvs_F_inner, self.w_max_inner, -self.w_max_inner),
+                             self.ibvs_z_inner)
+        else:
+            self.setpoint = (self.saturate(self.ibvs_x, self.u_max, -self.u_max) + self.target_VE*np.cos(self.psi) - self.target_VN*np.sin(self.psi),
+                             self.saturate(self.ibvs_y, self.v_max, -self.v_max) + self.target_VN*np.cos(self.psi) + self.target_VE*np.sin(self.psi),
+                             self.saturate(self.ibvs_F, self.w_max, -self.w_max),
+                             self.ibvs_z)
+
+        if self.msg_factory is not None:
+            self.msg_factory.ibvs(self.setpoint)
+
+
+    def send_waypoint_command(self):
+
+        yaw = -self.heading_command + np.radians(90.0)
+        while yaw > np.radians(180.0):  yaw = yaw - np.radians(360.0)
+        while yaw < np.radians(-180.0):  yaw = yaw + np.radians(360.0)
+        self.setpoint = (self.wp_E, self.wp_N, self.rendezvous_height, yaw)
+
+        if self.msg_factory is not None:
+            self.msg_factory.waypoint(self.setpoint)
+
+
+def legacy_rendezvous_offset(core, phi, theta):
+
+    # compute_rendezvous_offset the way it used to be
+    sphi = np.sin(phi)
+    cphi = np.cos(phi)
+    stheta = np.sin(theta)
+    ctheta = np.cos(theta)
+    spsi = np.sin(core.psi)
+    cpsi = np.cos(core.psi)
+
+    phi_m = 0.0
+    theta_m = 0.0
+    psi_m = 0.0
+
+    sphi_m = np.sin(phi_m)
+    cphi_m = np.cos(phi_m)
+    stheta_m = np.sin(theta_m)
+    ctheta_m = np.cos(theta_m)
+    spsi_m = np.sin(psi_m )
+    cpsi_m = np.cos(psi_m )
+
+    R_b_i = np.array([[ctheta*cpsi, ctheta*spsi, -stheta],
+                      [sphi*stheta*cpsi - cphi*spsi, sphi*stheta*spsi + cphi*cpsi, sphi*ctheta],
+                      [cphi*stheta*cpsi + sphi*spsi, cphi*stheta*spsi - sphi*cpsi, cphi*ctheta]]).T
+    R_m_b = np.array([[ctheta_m*cpsi_m, ctheta_m*spsi_m, -stheta_m],
+                      [sphi_m*stheta_m*cpsi_m-cphi_m*spsi_m, sphi_m*stheta_m*spsi_m+cphi_m*cpsi_m, sphi_m*ctheta_m],
+                      [cphi_m*stheta_m*cpsi_m+sphi_m*spsi_m, cphi_m*stheta_m*spsi_m-sphi_m*cpsi_m, cphi_m*ctheta_m]]).T
+    R_c_m = np.array([[0., 1., 0.],
+                      [-1., 0., 0.],
+                      [0., 0., 1.]]).T
+
+    R_c_i = R_b_i.dot(R_m_b.dot(R_c_m))
+    el_hat_c = np.array([[0.0], [0.0], [1.0]])
+    k_i = np.array([[0.0], [0.0], [1.0]])
+
+    numerator = R_c_i.dot(el_hat_c)
+    denominator = np.dot(k_i.T, numerator)
+    P_target = np.array([[0.0], [0.0], [0.0]])
+
+    return P_target - core.rendezvous_height*numerator/denominator
+
+
+class MessageFactory(object):
+
+    # Builds the mavros setpoint messages, either new ones every tick (reuse=False) or by filling in kept ones
+    def __init__(self, reuse):
+
+        from mavros_msgs.msg import PositionTarget
+        self.PositionTarget = PositionTarget
+        self.reuse = reuse
+        self.ibvs_msg = self.new_ibvs_msg()
+        self.waypoint_msg = self.new_waypoint_msg()
+
+
+    def new_ibvs_msg(self):
+
+        msg = self.PositionTarget()
+        msg.coordinate_frame = self.PositionTarget.FRAME_BODY_NED
+        msg.type_mask = self.PositionTarget.IGNORE_PX | self.PositionTarget.IGNORE_PY | self.PositionTarget.IGNORE_PZ
+        return msg
+
+
+    def new_waypoint_msg(self):
+
+        msg = self.PositionTarget()
+        msg.coordinate_frame = self.PositionTarget.FRAME_LOCAL_NED
+        msg.type_mask = self.PositionTarget.IGNORE_VX | self.PositionTarget.IGNORE_VY | self.PositionTarget.IGNORE_VZ
+        return msg
+
+
+    def ibvs(self, setpoint):
+
+        msg = self.ibvs_msg if self.reuse else self.new_ibvs_msg()
+        msg.velocity.x, msg.velocity.y, msg.velocity.z, msg.yaw_rate = setpoint
+
+
+    def waypoint(self, setpoint):
+
+        msg = self.waypoint_msg if self.reuse else self.new_waypoint_msg()
+        msg.position.x, msg.position.y, msg.position.z, msg.yaw = setpoint
+
+
+class Mission(object):
+
+    # Precomputed inputs, so both versions see exactly the same ticks
+    def __init__(self, ticks, tick, seed=0):
+
+        rng = np.random.RandomState(seed)
+        self.tick = tick
+        self.t = np.arange(ticks)*tick
+        self.phi = 0.05*np.sin(0.7*self.t) + rng.normal(0.0, 0.01, ticks)
+        self.theta = 0.05*np.cos(0.5*self.t) + rng.normal(0.0, 0.01, ticks)
+        self.psi = np.pi*np.sin(0.05*self.t)
+        self.ibvs = rng.normal(0.0, 0.6, (ticks, 4))
+
+        # RENDEZVOUS for the first fifth, then IBVS on the outer marker and, from halfway, the inner one
+        self.rendezvous_ticks = ticks//5
+        self.inner_from = ticks//2
+
+        self.phi = self.phi.tolist()
+        self.theta = self.theta.tolist()
+        self.psi = self.psi.tolist()
+        self.ibvs = self.ibvs.tolist()
+
+
+def run(core_class, mission, msg_factory=None):
+
+    clock = [0.0]
+    core = core_class(lambda: clock[0], msg_factory)
+    core.set_target(0.0, 0.0)
+    ticks = len(mission.t)
+    setpoints = []
+
+    start = time.perf_counter() if hasattr(time, 'perf_counter') else time.time()
+    for k in range(ticks):
+        clock[0] = mission.t[k]
+
+        # at the rendezvous point once RENDEZVOUS is over, then the markers show up
+        if k < mission.rendezvous_ticks:
+            core.set_state(20.0, 10.0, -core.rendezvous_height, mission.phi[k], mission.theta[k], mission.psi[k])
+        else:
+            core.set_state(0.0, 0.0, -core.rendezvous_height, mission.phi[k], mission.theta[k], mission.psi[k])
+            target = 'inner' if k >= mission.inner_from else 'outer'
+            n, e, d, r = mission.ibvs[k]
+            core.ibvs_command(target, n, e, d, r)
+            core.marker_seen('outer')
+            if target == 'inner':
+                core.marker_seen('inner')
+                core.p_des_error_outer = 0.0
+
+        core.step()
+        setpoints.append(core.setpoint)
+
+    elapsed = (time.perf_counter() if hasattr(time, 'perf_counter') else time.time()) - start
+    return elapsed/ticks, setpoints, core
+
+
+def run_shaping(core_class, mission):
+
+    # just the node side of a tick: map the IBVS command to ENU and build the setpoint
+    clock = [0.0]
+    core = core_class(lambda: clock[0])
+    ticks = len(mission.t)
+
+    start = time.perf_counter() if hasattr(time, 'perf_counter') else time.time()
+    for k in range(ticks):
+        core.psi = mission.psi[k]
+        core.frame.update(mission.psi[k])
+        n, e, d, r = mission.ibvs[k]
+        core.ibvs_command('outer', n, e, d, r)
+        core.send_ibvs_command('outer')
+
+    return ((time.perf_counter() if hasattr(time, 'perf_counter') else time.time()) - start)/ticks
+
+
+def report(name, per_tick, rates):
+
+    share = ', '.join(['%.2f%% at %d Hz' % (100.0*per_tick*rate, rate) for rate in rates])
+    print('  %-34s %7.2f us/tick  (%s)' % (name, 1.0e6*per_tick, share))
+
+
+def main():
+
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rates = [int(a) for a in sys.argv[2:]] or [100, 200, 500]
+    mission = Mission(ticks, 1.0/max(rates))
+
+    print('send_commands shaping, %d ticks (RENDEZVOUS, IBVS outer, IBVS inner)' % ticks)
+
+    # one warm-up pass each, then the best of three
+    results = {}
+    for name, core_class in (('legacy', LegacyBenchCore), ('frame', BenchCore)):
+        run(core_class, Mission(1000, mission.tick))
+        best = None
+        for i in range(3):
+            per_tick, setpoints, core = run(core_class, mission)
+            if best is None or per_tick < best[0]:
+                best = (per_tick, setpoints, core)
+        results[name] = best
+
+    report('legacy (np trig, np.dot NED->ENU)', results['legacy'][0], rates)
+    report('frame context', results['frame'][0], rates)
+    print('  speedup %.2fx' % (results['legacy'][0]/results['frame'][0]))
+
+    # the node side alone (the rest of the tick is the state machine itself)
+    legacy_shaping = min(run_shaping(LegacyBenchCore, mission) for i in range(3))
+    frame_shaping = min(run_shaping(BenchCore, mission) for i in range(3))
+    print('IBVS setpoint shaping only')
+    report('legacy', legacy_shaping, rates)
+    report('frame context', frame_shaping, rates)
+    print('  speedup %.2fx' % (legacy_shaping/frame_shaping))
+
+    # both have to send the same setpoints (the legacy NED->ENU went through a float32 vector)
+    worst = 0.0
+    for a, b in zip(results['legacy'][1], results['frame'][1]):
+        worst = max(worst, max(abs(x - y) for x, y in zip(a, b)))
+    print('  largest setpoint difference %.3g' % worst)
+    print('  final status %s, target %s' % (results['frame'][2].status_flag, results['frame'][2].current_target))
+
+    # compute_rendezvous_offset, once per wind calibration but the same kind of code
+    core = results['frame'][2]
+    angles = [(0.1*np.sin(k), 0.1*np.cos(0.7*k)) for k in range(2000)]
+    start = time.time()
+    for phi, theta in angles:
+        legacy_rendezvous_offset(core, phi, theta)
+    legacy_time = (time.time() - start)/len(angles)
+    start = time.time()
+    for phi, theta in angles:
+        core.compute_rendezvous_offset(phi, theta)
+    frame_time = (time.time() - start)/len(angles)
+    worst = max(np.max(np.abs(legacy_rendezvous_offset(core, phi, theta) - core.compute_rendezvous_offset(phi, theta))) for phi, theta in angles)
+    print('compute_rendezvous_offset: legacy %.1f us, now %.1f us, largest difference %.3g m' % (1.0e6*legacy_time, 1.0e6*frame_time, worst))
+
+    # message allocation against reuse, needs the real message classes
+    try:
+        MessageFactory(True)
+    except ImportError:
+        print('mavros_msgs not found, skipping the message allocation comparison')
+        return
+
+    print('setpoint messages (frame context shaping)')
+    for name, reuse in (('new PositionTarget every tick', False), ('reused PositionTarget', True)):
+        best = min(run(BenchCore, mission, MessageFactory(reuse))[0] for i in range(3))
+        report(name, best, rates)
+
+
+if __name__ == '__main__':
+    main()
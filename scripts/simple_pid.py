@@ -76,14 +76,15 @@ class PID:
 		# print "New Gains:\nP:", p, "\nI:", i, "\nD:", d
 
 	def saturate(self, value, up_limit, low_limit):
+		# no limits set (checked first, python 3 can't compare a float with None)
+		if (up_limit == None) or (low_limit == None):
+			return value
 		if(value > up_limit):
 			rVal = up_limit
 		elif(value < low_limit):
 			rVal = low_limit
 		else:
 			rVal = value
-		if (up_limit == None) or (low_limit == None):
-			rVal = value
 
 		return rVal
 
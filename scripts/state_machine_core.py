@@ -0,0 +1,682 @@
+#!/usr/bin/env python
+
+## Mission logic of the IBVS state machine without ROS, so it can run in
+## regression at CPU speed (see state_machine_scenarios.py).
+##
+##   RENDEZVOUS -> WIND_CALIBRATION -> RENDEZVOUS -> HEADING_CORRECTION ->
+##   RENDEZVOUS -> IBVS (outer <-> inner marker) -> LAND
+##
+## Time comes from an injectable clock (a callable returning seconds, rospy.get_time
+## in the nodes) and the inputs are plain attributes and event methods
+## (set_state, set_target, marker_seen, set_marker_angle, ...). Everything the
+## state machine does to the outside world goes through the hook methods at the
+## bottom (send_waypoint_command, send_ibvs_command, execute_landing, ...), which
+## do nothing here. set_state can be called from another thread (the estimate
+## subscriber): it writes a StateSnapshot (state_snapshot.py) and step() takes
+## one consistent pose from it at the start of every tick.
+## ibvs_state_machine.py and ibvs_state_machine_uw.py subclass StateMachineCore
+## and override the hooks with their publishers and services.
+
+from __future__ import print_function
+
+import time
+import math
+import numpy as np
+from heading_remap import remap_euler
+from wind_calibration import WindCalibration
+from marker_visibility import MarkerVisibility
+from frame_context import FrameContext
+from rotation_kernel import body_to_inertial
+from state_snapshot import StateSnapshot
+
+
+class StateMachineCore(object):
+
+    def __init__(self, clock=time.time, rendezvous_height=10.0, wp_threshold=1.0, landing_distance_threshold=0.4,
+                 p_des_error_outer_threshold=50.0, p_des_error_inner_threshold=50.0, inner_error_condition=False,
+                 max_boat_angle=15.0, wind_calc_completed=False, heading_correction_completed=False,
+                 wind_window_seconds=5.0, wind_calc_duration=10.0, wind_calc_min_duration=3.0,
+                 wind_calc_tolerance=np.radians(0.5), wind_estimator=None, visibility_timeout=1.0,
+                 visibility_tau=1.0, visibility_enter_rate=5.0, visibility_exit_rate=2.0,
+                 heading_threshold=np.radians(30.0), intercept_planner=None, intercept_rate=10.0,
+                 calibration_store=None):
+
+        # callable returning the current time (s)
+        self.clock = clock
+
+        # Initialize status flags
+        self.status_flag = 'RENDEZVOUS'
+        self.prev_status = 'MISSION'
+
+        # Initialize current target flag
+        self.current_target = 'aruco_outer'
+
+        # Initialize visibility flags
+        self.outer_target_is_visible = False
+        self.inner_target_is_visible = False
+        self.current_target_is_visible = False
+        self.other_target_is_visible = False
+
+        self.rendezvous_height = rendezvous_height
+        self.wp_threshold = wp_threshold
+
+        self.landing_distance_threshold = landing_distance_threshold
+        self.p_des_error_outer_threshold = p_des_error_outer_threshold
+        self.p_des_error_inner_threshold = p_des_error_inner_threshold
+
+        # if set True, landing also needs the inner marker near its desired image location
+        self.inner_error_condition = inner_error_condition
+
+        # Max attitude angle between target and camera frame (same units as set_marker_angle)
+        self.max_boat_angle = max_boat_angle
+
+        # Flag for wheter or not is is a good time to land
+        self.safe_to_land = False
+
+        self.wp_error = 1.0e3
+        self.p_des_error_outer = 1.0e3
+        self.p_des_error_inner = 1.0e3
+
+        # initialize target location, when it was reported (s) and its velocity (m/s)
+        self.target_N = 0.0
+        self.target_E = 0.0
+        self.target_time = self.clock()
+        self.target_VN = 0.0
+        self.target_VE = 0.0
+
+        # InterceptPlanner (intercept_planner.py), if set the rendezvous point leads a moving target by the time it
+        # takes to get there. It's re-planned at intercept_rate (Hz) while flying waypoints.
+        self.intercept_planner = intercept_planner
+        self.intercept_interval = 1.0/intercept_rate
+        self.intercept_time = None
+
+        # Initialize waypoint setpoint
+        self.wp_N = 5.0
+        self.wp_E = 5.0
+        self.wp_D = -rendezvous_height
+        self.wp_VN = 0.0
+        self.wp_VE = 0.0
+        self.heading_command = np.radians(0.0)
+
+        # heading of the outer marker relative to the copter (rad), HEADING_CORRECTION ends once it's under heading_threshold
+        self.relative_heading = 0.0
+        self.heading_threshold = heading_threshold
+
+        # Wind calibration ends once the average roll and pitch are known to within wind_calc_tolerance (rad),
+        # but not before wind_calc_min_duration and no later than wind_calc_duration (s)
+        self.wind_calc_completed = wind_calc_completed
+        self.wind_calc_duration = wind_calc_duration
+        self.wind_calc_min_duration = wind_calc_min_duration
+        self.wind_calc_tolerance = wind_calc_tolerance
+        self.wind_calc_time = 0.0
+        self.wind_offset = np.zeros((3,1), dtype=np.float32)
+
+        self.heading_correction_completed = heading_correction_completed
+
+        # CalibrationStore (calibration_store.py), if set the calibration is saved to it as each stage finishes
+        # and load_calibration() picks it back up after a restart
+        self.calibration_store = calibration_store
+
+        # Streaming roll and pitch statistics over the last wind_window_seconds (room for state estimates at up to 500 Hz)
+        self.wind_calibration = WindCalibration(wind_window_seconds, int(500*wind_window_seconds))
+
+        # OnlineWindEstimator (wind_estimator.py), if set RENDEZVOUS uses it to skip the WIND_CALIBRATION hover
+        self.wind_estimator = wind_estimator
+
+        # Average roll and pitch values in the wind
+        self.roll_avg = 0.0
+        self.pitch_avg = 0.0
+
+        # Initialize state variables, set_state writes the snapshot and step() copies it into pn, ..., psi
+        self.state = StateSnapshot()
+        self.pn = 0.0
+        self.pe = 0.0
+        self.pd = 0.0
+        self.phi = 0.0
+        self.theta = 0.0
+        self.psi = 0.0
+
+        # A marker becomes visible once its IBVS commands come in at visibility_enter_rate (Hz) and stops
+        # being visible below visibility_exit_rate or after visibility_timeout (s) without one (see marker_visibility.py)
+        self.visibility_timeout = visibility_timeout
+        self.outer_visibility = MarkerVisibility(visibility_tau, visibility_enter_rate, visibility_exit_rate, visibility_timeout)
+        self.inner_visibility = MarkerVisibility(visibility_tau, visibility_enter_rate, visibility_exit_rate, visibility_timeout)
+
+        # distance to the inner marker (m)
+        self.distance = 10.0
+
+        # heading trig for the command builders, updated once per tick (see frame_context.py)
+        self.frame = FrameContext()
+
+        # mounting angle offsets of the camera
+        phi_m = 0.0    # roll relative to the body frame
+        theta_m = 0.0  # pitch '...'
+        psi_m = 0.0    # yaw '...'
+
+        ## define fixed rotations
+        sphi_m = np.sin(phi_m)
+        cphi_m = np.cos(phi_m)
+        stheta_m = np.sin(theta_m)
+        ctheta_m = np.cos(theta_m)
+        spsi_m = np.sin(psi_m )
+        cpsi_m = np.cos(psi_m )
+
+        R_m_b = np.array([[ctheta_m*cpsi_m, ctheta_m*spsi_m, -stheta_m],
+                          [sphi_m*stheta_m*cpsi_m-cphi_m*spsi_m, sphi_m*stheta_m*spsi_m+cphi_m*cpsi_m, sphi_m*ctheta_m],
+                          [cphi_m*stheta_m*cpsi_m+sphi_m*spsi_m, cphi_m*stheta_m*spsi_m-sphi_m*cpsi_m, cphi_m*ctheta_m]]).T
+        R_c_m = np.array([[0., 1., 0.],
+                          [-1., 0., 0.],
+                          [0., 0., 1.]]).T
+
+        # optical axis of the camera in the body frame, it doesn't change so it's only built once
+        el_hat_c = np.array([[0.0],
+                             [0.0],
+                             [1.0]])
+        self.camera_axis_b = tuple(float(x) for x in R_m_b.dot(R_c_m).dot(el_hat_c)[:, 0])
+
+
+    def step(self):
+
+        # one tick of the state machine (the send_commands timer in the nodes)
+        self.state.load_pose(self)
+        self.frame.update(self.psi)
+        self.update_marker_visibility_status()
+        self.update_state_machine_status_and_send_command()
+
+
+    def update_state_machine_status_and_send_command(self):
+
+        if self.intercept_planner is not None and self.status_flag != 'IBVS' and self.status_flag != 'LAND':
+            self.update_intercept()
+
+        self.update_wp_error()
+
+        if self.status_flag == 'RENDEZVOUS':
+
+            # Is a target in view?
+            if self.outer_target_is_visible or self.inner_target_is_visible:
+
+                # Were we just in IBVS mode?
+                if self.prev_status == 'IBVS':
+
+                    # Go back into IBVS
+                    self.status_flag = 'IBVS'
+                    self.prev_status = 'RENDEZVOUS'
+
+        # RENDEZVOUS MODE
+        if self.status_flag == 'RENDEZVOUS':
+
+            # Use the online wind estimate as soon as it's good enough, the rendezvous point moves before we get there
+            if self.wind_estimator is not None and self.wind_calc_completed == False:
+                self.use_online_wind_estimate()
+
+            # Is waypoint error sufficiently small?
+            if self.wp_error <= self.wp_threshold:
+
+                # Has Wind Calibration occured yet?
+                if self.wind_calc_completed == False:
+
+                    # Switch to wind calibration status
+                    self.status_flag = 'WIND_CALIBRATION'
+                    self.prev_status = 'RENDEZVOUS'
+                    self.wind_calc_time = self.clock()
+                    self.wind_calibration.reset(self.wind_calc_time)
+
+                elif self.wind_calc_completed == True and self.heading_correction_completed == False:
+
+                    # Perform initial heading correction
+                    self.status_flag = 'HEADING_CORRECTION'
+                    self.prev_status = 'RENDEZVOUS'
+
+                else:
+
+                    # Is the target in view?
+                    if self.outer_target_is_visible:
+
+                        # Enter IBVS Mode
+                        self.status_flag = 'IBVS'
+                        self.prev_status = 'RENDEZVOUS'
+
+                    else:
+
+                        self.log("Fail. Returning to mode RENDEZVOUS")
+
+            else:
+                self.status_flag = 'RENDEZVOUS'
+
+        # WIND CALIBRATION MODE
+        if self.status_flag == 'WIND_CALIBRATION':
+
+            now = self.clock()
+            self.send_wind_calibration()
+
+            converged = self.wind_calibration.converged(self.wind_calc_min_duration, self.wind_calc_tolerance)
+            if converged or now - self.wind_calc_time > self.wind_calc_duration:
+                self.roll_avg, self.pitch_avg = self.wind_calibration.mean()
+                self.wind_offset = self.compute_rendezvous_offset(self.roll_avg, self.pitch_avg)
+                self.wp_N = self.target_N + self.wind_offset[0][0]
+                self.wp_E = self.target_E + self.wind_offset[1][0]
+                self.wind_calc_completed = True
+                self.status_flag = 'RENDEZVOUS'
+                self.prev_status = 'WIND_CALIBRATION'
+                self.log("Average roll angle (pre-hc): %f \nAverage pitch angle  (pre-hc): %f" % (np.degrees(self.roll_avg), np.degrees(self.pitch_avg)))
+                roll_uncertainty, pitch_uncertainty = self.wind_calibration.uncertainty()
+                self.log("Wind calibration %s after %.1f s (uncertainty roll %.2f deg, pitch %.2f deg)" % (
+                    'converged' if converged else 'timed out', now - self.wind_calc_time, np.degrees(roll_uncertainty), np.degrees(pitch_uncertainty)))
+                self.wind_calibration_completed()
+
+        # HEADING CORRECTION MODE
+        if self.status_flag == 'HEADING_CORRECTION':
+
+            if self.heading_correction_completed == False:
+                des_heading = self.psi + self.relative_heading
+                while des_heading > np.radians(180.0):  des_heading = des_heading - np.radians(360.0)
+                while des_heading < np.radians(-180.0):  des_heading = des_heading + np.radians(360.0)
+                self.heading_command = des_heading
+
+                # Update average roll and pitch angles after the yaw manuver
+                self.roll_avg, self.pitch_avg = self.remap_average_attitude(des_heading)
+                self.log("Average roll angle (post-hc): %f \nAverage pitch angle  (post-hc): %f" % (np.degrees(self.roll_avg), np.degrees(self.pitch_avg)))
+
+                # the averages above are remapped now, a restart mustn't remap them again
+                self.heading_correction_completed = True
+                self.heading_correction_started()
+            if abs(self.relative_heading) <= self.heading_threshold:
+                self.status_flag = 'RENDEZVOUS'
+                self.prev_status = 'HEADING_CORRECTION'
+
+        # IMAGE-BASED VISUAL SERVOING MODE
+        if self.status_flag == 'IBVS':
+
+            self.publish_ibvs_active(True)
+            self.enter_ibvs_state_machine()
+
+        # WAYPOINT MODE (RENDEZVOUS, etc.)
+        elif self.status_flag == 'RENDEZVOUS' or self.status_flag == 'WIND_CALIBRATION' or self.status_flag == 'HEADING_CORRECTION':
+
+            self.publish_ibvs_active(False)
+            self.send_waypoint_command()
+
+        # LAND MODE
+        else:
+
+            self.publish_ibvs_active(False)
+            self.update_landing()
+
+        self.publish_status()
+
+
+    def enter_ibvs_state_machine(self):
+
+        # Is the current target still visible?
+        if self.current_target_is_visible:
+
+            if self.current_target == 'aruco_outer':
+
+                # Is the inner target visible?
+                if self.inner_target_is_visible:
+
+                    # Has the outer target been driven to its desired location?
+                    if self.p_des_error_outer <= self.p_des_error_outer_threshold:
+
+                        # Switch to controlling off of the inner ArUco
+                        self.execute_ibvs('inner')
+                    else:
+
+                        # Execute IBVS(outer)
+                        self.execute_ibvs('outer')
+
+                else:
+
+                    # Execute IBVS(outer)
+                    self.execute_ibvs('outer')
+
+            elif self.current_target == 'aruco_inner':
+
+                # Execute IBVS(inner)
+                self.execute_ibvs('inner')
+
+            else:
+
+                self.log("State Machine: Invalid current_target flag.")
+
+        else:
+
+            # Is the other target visible?
+            if self.other_target_is_visible:
+
+                # Execute IBVS(other)
+                self.execute_ibvs('other')
+
+            else:
+
+                # Return to mode RENDEZVOUS
+                self.status_flag = 'RENDEZVOUS'
+                self.prev_status = 'IBVS'
+
+                # Maybe should set current_target = 'aruco_outer' here
+
+
+    def execute_ibvs(self, target_flag):
+
+        # Is target flag == 'outer'
+        if target_flag == 'outer':
+
+            # Set the current target flag
+            self.current_target = 'aruco_outer'
+
+            # Send the command
+            self.send_ibvs_command('outer')
+
+        # Is target flag == 'inner'
+        elif target_flag == 'inner':
+
+            # Is the distance to the ArUco sufficiently small and the target sufficiently level?
+            if self.distance <= self.landing_distance_threshold and self.safe_to_land:
+
+                # Execute Landing!!!
+                self.execute_landing()
+
+            else:
+
+                # Set the current target flag
+                self.current_target = 'aruco_inner'
+
+                # Send the command
+                self.send_ibvs_command('inner')
+
+        # Target flag == 'other'
+        else:
+
+            # Send other ibvs
+            if self.current_target == 'aruco_outer':
+
+                self.current_target = 'aruco_inner'
+                self.send_ibvs_command('inner')
+
+            else:
+
+                self.current_target = 'aruco_outer'
+                self.send_ibvs_command('outer')
+
+
+    def forward_ibvs_command(self, target):
+
+        # send the IBVS command for the 'outer' or 'inner' marker right away if it's the one being tracked,
+        # the transitions (and landing) still only happen in step()
+        if self.status_flag != 'IBVS' or self.current_target != 'aruco_' + target:
+            return False
+
+        self.state.load_pose(self)
+        self.frame.update(self.psi)
+        self.send_ibvs_command(target)
+        return True
+
+
+    def update_marker_visibility_status(self):
+
+        now = self.clock()
+
+        self.outer_target_is_visible = self.outer_visibility.update(now)
+        self.inner_target_is_visible = self.inner_visibility.update(now)
+
+        if self.current_target == 'aruco_outer':
+            self.current_target_is_visible = self.outer_target_is_visible
+            self.other_target_is_visible = self.inner_target_is_visible
+
+        elif self.current_target == 'aruco_inner':
+            self.current_target_is_visible = self.inner_target_is_visible
+            self.other_target_is_visible = self.outer_target_is_visible
+
+        else:
+
+            self.log('State Machine: Invalid target flag.')
+
+
+    def update_wp_error(self):
+
+        self.wp_error = math.sqrt((self.pn - self.wp_N)**2 + (self.pe - self.wp_E)**2
+            + (-self.pd - self.rendezvous_height)**2)
+
+
+    def update_intercept(self):
+
+        # re-plan at the fixed intercept rate
+        now = self.clock()
+        if self.intercept_time is not None and now - self.intercept_time < self.intercept_interval:
+            return
+        self.intercept_time = now
+
+        # the rendezvous point keeps its wind offset from the target
+        self.wp_N, self.wp_E = self.intercept_planner.plan(now, self.pn, self.pe,
+                                                           self.target_N + self.wind_offset[0][0],
+                                                           self.target_E + self.wind_offset[1][0],
+                                                           self.target_time, self.target_VN, self.target_VE)
+
+        # the rendezvous point moves with the target, so the waypoint carries its velocity as a feed-forward
+        self.wp_VN = self.target_VN
+        self.wp_VE = self.target_VE
+        self.send_intercept()
+
+
+    def use_online_wind_estimate(self):
+
+        # the rendezvous point moves with the target, so the copter has to keep pace with it rather than hover
+        confident = self.wind_estimator.confident(self.wind_calc_min_duration, self.wind_calc_tolerance,
+                                                  self.target_VN, self.target_VE)
+        self.send_wind_estimate()
+
+        if confident:
+            self.roll_avg, self.pitch_avg = self.wind_estimator.hover_attitude(self.psi, self.target_VN, self.target_VE)
+            self.wind_offset = self.compute_rendezvous_offset(self.roll_avg, self.pitch_avg)
+            self.wp_N = self.target_N + self.wind_offset[0][0]
+            self.wp_E = self.target_E + self.wind_offset[1][0]
+            self.update_wp_error()
+            self.wind_calc_completed = True
+            wind_N, wind_E = self.wind_estimator.wind()
+            self.log("Average roll angle (pre-hc): %f \nAverage pitch angle  (pre-hc): %f" % (np.degrees(self.roll_avg), np.degrees(self.pitch_avg)))
+            self.log("Online wind estimate: N %.2f m/s, E %.2f m/s, drag %.3f 1/s (uncertainty %.2f deg), skipping wind calibration" % (
+                wind_N, wind_E, self.wind_estimator.k,
+                np.degrees(self.wind_estimator.tilt_uncertainty(self.target_VN, self.target_VE))))
+            self.wind_calibration_completed()
+
+
+    def calibration(self):
+
+        # what a restart needs to skip the calibration stages it already went through (see calibration_store.py)
+        return {'wind_calc_completed': bool(self.wind_calc_completed),
+                'heading_correction_completed': bool(self.heading_correction_completed),
+                'roll_avg': float(self.roll_avg),
+                'pitch_avg': float(self.pitch_avg),
+                'wind_offset': [float(x) for x in self.wind_offset[:, 0]],
+                'heading_command': float(self.heading_command)}
+
+
+    def restore_calibration(self, calibration):
+
+        # pick up where a previous run left off, returns False (and changes nothing) if there's nothing to restore
+        if not calibration.get('wind_calc_completed', False):
+            return False
+
+        self.roll_avg = calibration['roll_avg']
+        self.pitch_avg = calibration['pitch_avg']
+        self.wind_offset = np.array(calibration['wind_offset'], dtype=np.float32).reshape((3, 1))
+        self.wp_N = self.target_N + self.wind_offset[0][0]
+        self.wp_E = self.target_E + self.wind_offset[1][0]
+        self.wind_calc_completed = True
+
+        # the roll and pitch above are remapped to this heading once heading correction is done
+        if calibration.get('heading_correction_completed', False):
+            self.heading_command = calibration['heading_command']
+            self.heading_correction_completed = True
+
+        return True
+
+
+    def load_calibration(self):
+
+        # skip the calibration stages a previous run already went through, unless they were set by hand
+        if self.calibration_store is None or self.wind_calc_completed:
+            return False
+
+        calibration = self.calibration_store.load()
+        if calibration is None or not self.restore_calibration(calibration):
+            return False
+
+        age = self.calibration_store.age()
+        self.log("State Machine: resuming with the calibration in %s (%s old), wind calibration%s done." % (
+            self.calibration_store.path, '%.0f s' % age if age is not None else 'unknown age',
+            ' and heading correction' if self.heading_correction_completed else ''))
+
+        return True
+
+
+    def save_calibration(self):
+
+        # hand the calibration to the store's background writer
+        if self.calibration_store is not None:
+            self.calibration_store.save(self.calibration())
+
+
+    def remap_average_attitude(self, des_heading):
+
+        # average roll and pitch at the new heading (same thrust vector)
+        return remap_euler(self.roll_avg, self.pitch_avg, self.psi, des_heading)
+
+
+    def compute_rendezvous_offset(self, phi, theta):
+
+        # Flat-earth geolocation to compute the rendezvous offset: where the camera axis hits the ground from
+        # rendezvous_height with the copter at roll phi, pitch theta and the current heading.
+        # From EQ 13.9 and 13.18 in the UAV book with the target at the center of the image frame.
+        R_i_b = body_to_inertial(phi, theta, self.psi)
+        c_x, c_y, c_z = self.camera_axis_b
+        numerator = [R[0]*c_x + R[1]*c_y + R[2]*c_z for R in R_i_b]
+
+        # EQ 13.18 rearranged (P_target at the origin)
+        scale = -self.rendezvous_height/numerator[2]
+
+        return np.array([[scale*numerator[0]],
+                         [scale*numerator[1]],
+                         [scale*numerator[2]]])
+
+
+    # Input events
+
+    def set_state(self, pn, pe, pd, phi, theta, psi):
+
+        # NED position and Euler angles of the copter (one estimate), also feeds the roll and pitch statistics
+        now = self.clock()
+        self.state.write_pose(now, pn, pe, pd, phi, theta, psi)
+
+        self.wind_calibration.add(now, phi, theta)
+
+
+    def set_velocity(self, t, u, v, w, body=True):
+
+        # velocity of the copter (body frame or NED) at time t, for the online wind estimate
+        if self.wind_estimator is None or self.wind_calc_completed:
+            return
+
+        # with the attitude of the latest estimate, not of the last tick
+        pn, pe, pd, phi, theta, psi = self.state.pose()
+        if body:
+            self.wind_estimator.add_body(t, phi, theta, psi, u, v, w)
+        else:
+            self.wind_estimator.add(t, phi, theta, psi, u, v, w)
+
+
+    def set_target(self, target_N, target_E):
+
+        # the rendezvous point follows the target (or the intercept point, see update_intercept)
+        self.target_N = target_N
+        self.target_E = target_E
+        self.target_time = self.clock()
+
+        if self.intercept_planner is not None:
+            return
+
+        self.wp_N = self.target_N + self.wind_offset[0][0]
+        self.wp_E = self.target_E + self.wind_offset[1][0]
+
+
+    def set_target_velocity(self, target_VN, target_VE):
+
+        # NE velocity of the target (m/s) from the target EKF
+        self.target_VN = target_VN
+        self.target_VE = target_VE
+
+
+    def marker_seen(self, target):
+
+        # an IBVS command came in for the 'outer' or 'inner' marker
+        if target == 'outer':
+            self.outer_visibility.add(self.clock())
+        else:
+            self.inner_visibility.add(self.clock())
+
+
+    def set_marker_angle(self, angle):
+
+        # angle between the inner marker and the camera, it's safe to land if the target is level enough
+        if self.inner_error_condition:
+            self.safe_to_land = (angle <= self.max_boat_angle) and (self.p_des_error_inner <= self.p_des_error_inner_threshold)
+        else:
+            self.safe_to_land = angle <= self.max_boat_angle
+
+
+    # Output hooks, the nodes override these
+
+    def send_waypoint_command(self):
+        pass
+
+
+    def send_ibvs_command(self, flag):
+        pass
+
+
+    def execute_landing(self):
+
+        self.status_flag = 'LAND'
+
+
+    def update_landing(self):
+
+        # called every tick in LAND mode
+        pass
+
+
+    def publish_ibvs_active(self, active):
+        pass
+
+
+    def publish_status(self):
+        pass
+
+
+    def send_wind_calibration(self):
+        pass
+
+
+    def send_wind_estimate(self):
+        pass
+
+
+    def send_intercept(self):
+        pass
+
+
+    def wind_calibration_completed(self):
+
+        self.save_calibration()
+
+
+    def heading_correction_started(self):
+
+        # called once the heading command and the remapped averages are set
+        self.save_calibration()
+
+
+    def log(self, text):
+
+        print(text)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+## Publishing helpers shared by the state machine nodes (ibvs_state_machine.py
+## and ibvs_state_machine_uw.py). They need the ROS message types, so they live
+## here instead of in the ROS-free StateMachineCore. The nodes mix this class in
+## ahead of StateMachineCore:
+##
+##   class StateMachine(StateMachinePublishers, StateMachineCore)
+##
+## and it reads the core's clock, marker visibility and intercept planner.
+
+from diagnostic_msgs.msg import DiagnosticArray
+from diagnostic_msgs.msg import DiagnosticStatus
+from diagnostic_msgs.msg import KeyValue
+
+
+class StateMachinePublishers(object):
+
+    def publish_marker_visibility(self, publisher, stamp, hardware_id):
+
+        # Detection rate (Hz), time since the last detection and gap between the last two (s) of each marker,
+        # as a DiagnosticArray from the node named hardware_id
+        now = self.clock()
+
+        diagnostics_msg = DiagnosticArray()
+        diagnostics_msg.header.stamp = stamp
+
+        for name, visibility in (('outer', self.outer_visibility), ('inner', self.inner_visibility)):
+            status = DiagnosticStatus()
+            status.name = 'marker_visibility_' + name
+            status.hardware_id = hardware_id
+            status.level = DiagnosticStatus.OK
+            status.message = 'visible' if visibility.visible else 'not visible'
+            status.values = [KeyValue('rate', '%.2f' % visibility.rate(now)),
+                             KeyValue('age', '%.3f' % min(visibility.age(now), 999.0)),
+                             KeyValue('gap', '%.3f' % min(visibility.gap, 999.0)),
+                             KeyValue('detections', str(visibility.detection_count)),
+                             KeyValue('transitions', str(visibility.transition_count))]
+            diagnostics_msg.status.append(status)
+
+        publisher.publish(diagnostics_msg)
+
+
+    def publish_intercept(self, publisher, msg, stamp):
+
+        # Intercept point (N, E in m) and time to intercept (s) in the node's Vector3Stamped msg
+        msg.header.stamp = stamp
+        msg.vector.x = self.intercept_planner.intercept_N
+        msg.vector.y = self.intercept_planner.intercept_E
+        msg.vector.z = self.intercept_planner.time_to_intercept
+
+        publisher.publish(msg)
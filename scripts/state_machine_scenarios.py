@@ -0,0 +1,584 @@
+#! /usr/bin/env python
+
+## Runs scripted landing missions through StateMachineCore (state_machine_core.py)
+## without ROS, on a simulated clock, as fast as the CPU allows.
+##
+## Each scenario is a random timeline: rendezvous distance, wind tilt, marker
+## heading, target drift, dropouts of the outer and inner markers, lost IBVS
+## messages and a rolling boat. A simple kinematic copter follows whatever the
+## state machine commands. Every tick goes into a trace of (time, status, target,
+## command) that is checked against the rules the state machine has to keep:
+##   - only the allowed status transitions, LAND is final
+##   - WIND_CALIBRATION once, before HEADING_CORRECTION, and no longer than wind_calc_duration
+##   - HEADING_CORRECTION once, before the first IBVS
+##   - waypoint commands outside IBVS, IBVS commands only for a marker seen within the visibility timeout
+##   - landing only close to the inner marker with the boat level enough
+##   - every mission lands before the deadline
+##
+## usage: ./state_machine_scenarios.py [num_scenarios] [seed] [--uw] [--under-way] [--intercept] [--resume] [--online-wind]
+##   --uw runs with the ibvs_state_machine_uw.py settings (fixed-length wind calibration, 2D attitude remap)
+##   --under-way makes the target a boat under way (0.5 to 1.5 m/s instead of drifting at up to 0.3 m/s)
+##   --intercept flies to the intercept point from intercept_planner.py instead of the last target position
+##   --resume flies each scenario twice. The first run saves its calibration through a CalibrationStore
+##            (calibration_store.py) in a temporary directory, the second one loads it back the way the nodes do
+##            at startup, and the restart has to skip the calibration stages and end with the same calibration
+##   --online-wind flies against a wind with drag (linear, plus quadratic in half the scenarios) and feeds the
+##            velocity to an OnlineWindEstimator (wind_estimator.py), from a hover after takeoff on. The attitude
+##            comes from the acceleration the copter needs instead of a fixed tilt. The roll and pitch the state machine ends up with, from the
+##            estimate or from the WIND_CALIBRATION hover it falls back to, have to match the attitude that keeps
+##            pace with the target (with quadratic drag the estimate's drift test has to hold it back until it's
+##            right), and with linear drag the estimate has to converge to the still-air hover attitude by the end
+##            of the wind calibration
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+from state_machine_core import StateMachineCore
+from intercept_planner import InterceptPlanner
+from calibration_store import CalibrationStore
+from wind_estimator import OnlineWindEstimator
+from wind_estimator import GRAVITY
+
+# state machine tick (the send_commands timer) and the scenario limits (s)
+TICK = 0.05
+DEADLINE = 300.0
+
+# top horizontal speed of the simulated copter (m/s)
+SPEED = 3.0
+
+# --online-wind: time constant of the copter's velocity response (s) and how far off the hover roll and pitch may be
+# (rad, three times the default wind_calc_tolerance)
+VELOCITY_TAU = 0.5
+
+# --online-wind: hover after takeoff (s) before the state machine starts, the node gets state estimates from takeoff on
+TAKEOFF_HOVER = 5.0
+WIND_ATTITUDE_TOLERANCE = np.radians(1.5)
+
+ALLOWED_TRANSITIONS = set([('RENDEZVOUS', 'WIND_CALIBRATION'),
+                           ('WIND_CALIBRATION', 'RENDEZVOUS'),
+                           ('RENDEZVOUS', 'HEADING_CORRECTION'),
+                           ('HEADING_CORRECTION', 'RENDEZVOUS'),
+                           ('RENDEZVOUS', 'IBVS'),
+                           ('IBVS', 'RENDEZVOUS'),
+                           ('IBVS', 'LAND'),
+                           # back into IBVS and straight down in the same tick, the landing checks still apply
+                           ('RENDEZVOUS', 'LAND')])
+
+
+class SimClock(object):
+
+    def __init__(self, t=0.0):
+
+        self.t = t
+
+
+    def __call__(self):
+
+        return self.t
+
+
+class ScenarioStateMachine(StateMachineCore):
+
+    def __init__(self, clock, uw=False, intercept=False, calibration_store=None, wind_estimator=None):
+
+        # the planner flies at the top speed of the simulated copter
+        intercept_planner = InterceptPlanner(SPEED) if intercept else None
+
+        if uw:
+            StateMachineCore.__init__(self, clock, max_boat_angle=np.radians(15.0), wind_window_seconds=5.0,
+                                      wind_calc_duration=10.0, wind_calc_min_duration=10.0,
+                                      intercept_planner=intercept_planner, calibration_store=calibration_store,
+                                      wind_estimator=wind_estimator)
+        else:
+            StateMachineCore.__init__(self, clock, max_boat_angle=np.radians(15.0), intercept_planner=intercept_planner,
+                                      calibration_store=calibration_store, wind_estimator=wind_estimator)
+
+        self.uw = uw
+
+        # whether heading correction was already done when the mission started (restored from a calibration)
+        self.heading_done_at_start = False
+
+        # (heading, roll, pitch, hovered, waypoint error) when the wind calibration finished
+        self.wind_result = None
+
+        # what the state machine asked for this tick
+        self.command = None
+
+
+    def remap_average_attitude(self, des_heading):
+
+        if not self.uw:
+            return StateMachineCore.remap_average_attitude(self, des_heading)
+
+        # ibvs_state_machine_uw.py rotates roll and pitch by the relative heading
+        psi = self.relative_heading
+        R = np.array([[np.cos(psi), -np.sin(psi)],[np.sin(psi), np.cos(psi)]]).T
+        roll_pitch = np.dot(R, np.array([[self.roll_avg],[self.pitch_avg]]))
+
+        return roll_pitch[0][0], roll_pitch[1][0]
+
+
+    def send_waypoint_command(self):
+
+        self.command = 'waypoint'
+
+
+    def send_ibvs_command(self, flag):
+
+        self.command = 'ibvs_' + flag
+
+
+    def execute_landing(self):
+
+        StateMachineCore.execute_landing(self)
+        self.command = 'land'
+
+
+    def wind_calibration_completed(self):
+
+        # from the WIND_CALIBRATION hover or from the online estimate on the way
+        self.wind_result = (self.psi, self.roll_avg, self.pitch_avg, self.prev_status == 'WIND_CALIBRATION', self.wp_error)
+        StateMachineCore.wind_calibration_completed(self)
+
+
+    def log(self, text):
+        pass
+
+
+def wrap(angle):
+
+    return (angle + np.pi) % (2.0*np.pi) - np.pi
+
+
+class Scenario(object):
+
+    def __init__(self, seed, under_way=False, online_wind=False):
+
+        rng = np.random.RandomState(seed)
+        self.seed = seed
+        self.rng = rng
+
+        # where the copter starts relative to the target (m) and its heading
+        distance = rng.uniform(5.0, 60.0)
+        bearing = rng.uniform(-np.pi, np.pi)
+        self.start = (distance*np.cos(bearing), distance*np.sin(bearing))
+        self.psi0 = rng.uniform(-np.pi, np.pi)
+
+        # target drift (m/s) and the heading of the outer marker
+        self.target_velocity = rng.uniform(-0.3, 0.3, 2)
+        if under_way:
+            course = rng.uniform(-np.pi, np.pi)
+            self.target_velocity = rng.uniform(0.5, 1.5)*np.array([np.cos(course), np.sin(course)])
+        self.marker_heading = rng.uniform(-np.pi, np.pi)
+
+        # hover roll and pitch in the wind (rad) and how much they wobble
+        self.tilt = rng.uniform(-np.radians(8.0), np.radians(8.0), 2)
+        self.tilt_noise = np.radians(rng.uniform(0.2, 2.0))
+
+        # how often the target reports its position (s), GPS over the radio for a boat
+        self.report_period = 1.0 if under_way else TICK
+
+        # marker dropouts, (start, end) windows in seconds
+        self.outer_dropouts = self.windows(rng.randint(0, 4), 0.2, 4.0)
+        self.inner_dropouts = self.windows(rng.randint(0, 4), 0.2, 4.0)
+
+        # fraction of IBVS commands lost on the way
+        self.message_loss = rng.uniform(0.0, 0.5)
+
+        # the boat rolls with this amplitude (deg) and period (s)
+        self.boat_amplitude = rng.uniform(3.0, 25.0)
+        self.boat_period = rng.uniform(4.0, 12.0)
+
+        # --online-wind: wind (m/s), linear drag (1/s), quadratic drag (1/m, none in half the scenarios) and the noise
+        # of the attitude (rad) and velocity (m/s) estimates. Drawn last so the other modes keep their random numbers.
+        self.wind = None
+        if online_wind:
+            direction = rng.uniform(-np.pi, np.pi)
+            self.wind = rng.uniform(0.0, 6.0)*np.array([np.cos(direction), np.sin(direction)])
+            self.drag = rng.uniform(0.2, 0.5)
+            self.quadratic_drag = rng.uniform(0.02, 0.05) if rng.rand() < 0.5 else 0.0
+            self.attitude_noise = np.radians(rng.uniform(0.1, 0.5))
+            self.velocity_noise = 0.05
+
+
+    def windows(self, count, min_length, max_length):
+
+        windows = []
+        for i in range(count):
+            start = self.rng.uniform(0.0, 120.0)
+            windows.append((start, start + self.rng.uniform(min_length, max_length)))
+
+        return windows
+
+
+    def in_window(self, t, windows):
+
+        for start, end in windows:
+            if start <= t < end:
+                return True
+
+        return False
+
+
+    def boat_angle(self, t):
+
+        # angle between the inner marker and the camera (deg)
+        return abs(self.boat_amplitude*np.sin(2.0*np.pi*t/self.boat_period))
+
+
+    def drag_acceleration(self, v_n, v_e):
+
+        # NE acceleration (m/s^2) from the air on a copter flying at v_n, v_e (m/s)
+        r_n = v_n - self.wind[0]
+        r_e = v_e - self.wind[1]
+        k = self.drag + self.quadratic_drag*np.hypot(r_n, r_e)
+
+        return -k*r_n, -k*r_e
+
+
+    def attitude(self, h_n, h_e, psi):
+
+        # roll and pitch at heading psi for a horizontal thrust acceleration h_n, h_e (m/s^2) at constant height,
+        # like OnlineWindEstimator.hover_attitude
+        norm = np.sqrt(h_n*h_n + h_e*h_e + GRAVITY*GRAVITY)
+        w_x = (-np.cos(psi)*h_n - np.sin(psi)*h_e)/norm
+        w_y = (np.sin(psi)*h_n - np.cos(psi)*h_e)/norm
+
+        return np.arcsin(-w_y), np.arctan2(w_x, GRAVITY/norm)
+
+
+    def hover_attitude(self, psi, v_n=0.0, v_e=0.0):
+
+        # roll and pitch flying at a steady v_n, v_e (m/s), the thrust cancels the drag
+        d_n, d_e = self.drag_acceleration(v_n, v_e)
+        return self.attitude(-d_n, -d_e, psi)
+
+
+def run_scenario(scenario, uw=False, intercept=False, calibration_store=None, resume=False):
+
+    # with resume set, start from what's in calibration_store like a restarted node, returns None if there's nothing
+    clock = SimClock()
+    wind_estimator = OnlineWindEstimator() if scenario.wind is not None else None
+    sm = ScenarioStateMachine(clock, uw, intercept, calibration_store, wind_estimator)
+    if resume and not sm.load_calibration():
+        return sm, None
+    sm.heading_done_at_start = sm.heading_correction_completed
+    rng = scenario.rng
+
+    # copter and target, NED (m)
+    pn, pe = scenario.start
+    pd = -sm.rendezvous_height
+    psi = scenario.psi0
+    target = np.zeros(2)
+
+    # --online-wind: NE velocity (m/s) and acceleration (m/s^2) of the copter
+    velocity = np.zeros(2)
+    acceleration = np.zeros(2)
+
+    # last time each marker actually produced an IBVS command
+    seen = {'outer': -100.0, 'inner': -100.0}
+
+    if scenario.wind is not None:
+        # holding position after takeoff, the estimator sees the hover before the transit speeds up
+        t = -TAKEOFF_HOVER
+        while t < 0.0:
+            clock.t = t
+            phi, theta = scenario.hover_attitude(psi)
+            sm.set_state(pn, pe, pd, phi + scenario.attitude_noise*rng.randn(), theta + scenario.attitude_noise*rng.randn(), psi)
+            sm.set_velocity(t, scenario.velocity_noise*rng.randn(), scenario.velocity_noise*rng.randn(),
+                            scenario.velocity_noise*rng.randn(), body=False)
+            t += TICK
+        clock.t = 0.0
+
+    trace = []
+    t = 0.0
+    next_report = 0.0
+    while t < DEADLINE:
+
+        target += TICK*scenario.target_velocity
+        if t >= next_report:
+            sm.set_target(target[0], target[1])
+            next_report += scenario.report_period
+        sm.set_target_velocity(scenario.target_velocity[0] + 0.05*rng.randn(), scenario.target_velocity[1] + 0.05*rng.randn())
+
+        if scenario.wind is None:
+            # wind tilt while holding a waypoint
+            phi = scenario.tilt[0] + scenario.tilt_noise*rng.randn()
+            theta = scenario.tilt[1] + scenario.tilt_noise*rng.randn()
+            sm.set_state(pn, pe, pd, phi, theta, psi)
+
+        else:
+            # the tilt that gives this tick's acceleration against the drag, and the velocity for the wind estimate
+            d_n, d_e = scenario.drag_acceleration(velocity[0], velocity[1])
+            phi, theta = scenario.attitude(acceleration[0] - d_n, acceleration[1] - d_e, psi)
+            sm.set_state(pn, pe, pd, phi + scenario.attitude_noise*rng.randn(), theta + scenario.attitude_noise*rng.randn(), psi)
+            sm.set_velocity(t, velocity[0] + scenario.velocity_noise*rng.randn(), velocity[1] + scenario.velocity_noise*rng.randn(),
+                            scenario.velocity_noise*rng.randn(), body=False)
+
+        # what the camera sees: the outer marker within 8 m horizontally, the inner one below 6 m
+        horizontal = np.hypot(pn - target[0], pe - target[1])
+        height = -pd
+        outer = horizontal <= 8.0 and height > 0.5 and not scenario.in_window(t, scenario.outer_dropouts)
+        inner = horizontal <= 3.0 and height <= 6.0 and not scenario.in_window(t, scenario.inner_dropouts)
+
+        if outer and rng.rand() >= scenario.message_loss:
+            sm.marker_seen('outer')
+            seen['outer'] = t
+            sm.relative_heading = wrap(scenario.marker_heading - psi)
+            sm.p_des_error_outer = 400.0*horizontal/max(height, 0.5)
+        if inner and rng.rand() >= scenario.message_loss:
+            sm.marker_seen('inner')
+            seen['inner'] = t
+            sm.distance = height
+            sm.set_marker_angle(np.radians(scenario.boat_angle(t)))
+
+        sm.command = None
+        sm.step()
+        trace.append((t, sm.status_flag, sm.current_target, sm.command, sm.distance, sm.safe_to_land, dict(seen),
+                      sm.heading_correction_completed))
+
+        if sm.status_flag == 'LAND':
+            break
+
+        # copter kinematics
+        vn = 0.0
+        ve = 0.0
+        if sm.command == 'waypoint':
+            # position P loop plus the waypoint velocity feed-forward, limited to SPEED
+            vn = sm.wp_N - pn + sm.wp_VN
+            ve = sm.wp_E - pe + sm.wp_VE
+            speed = np.hypot(vn, ve)
+            if speed > SPEED:
+                vn *= SPEED/speed
+                ve *= SPEED/speed
+            pd += TICK*np.clip(-sm.rendezvous_height - pd, -1.0, 1.0)
+            psi = wrap(psi + TICK*np.clip(wrap(sm.heading_command - psi), -np.radians(45.0), np.radians(45.0)))
+
+        elif sm.command in ('ibvs_outer', 'ibvs_inner'):
+            # IBVS centres the marker, descends and lines up with it
+            vn = 0.5*(target[0] - pn) + scenario.target_velocity[0]
+            ve = 0.5*(target[1] - pe) + scenario.target_velocity[1]
+            pd += TICK*(0.5 if sm.command == 'ibvs_outer' and height > 3.0 else 0.3 if height > 0.3 else 0.0)
+            psi = wrap(psi + TICK*np.clip(wrap(scenario.marker_heading - psi), -np.radians(45.0), np.radians(45.0)))
+
+        if scenario.wind is not None:
+            # the velocity follows the command with a lag, so the copter has to tilt to speed up and slow down
+            acceleration[0] = (vn - velocity[0])/VELOCITY_TAU
+            acceleration[1] = (ve - velocity[1])/VELOCITY_TAU
+            velocity += TICK*acceleration
+            vn, ve = velocity
+
+        pn += TICK*vn
+        pe += TICK*ve
+
+        t += TICK
+        clock.t = t
+
+    return sm, trace
+
+
+def check_trace(sm, trace):
+
+    failures = []
+
+    prev_status = 'RENDEZVOUS'
+    wind_start = None
+    wind_count = 0
+    heading_count = 0
+    heading_done = sm.heading_done_at_start
+
+    for t, status, target, command, distance, safe_to_land, seen, heading_completed in trace:
+
+        # heading correction can start and end within one tick (heading already close), it never shows as a status then
+        if heading_completed:
+            heading_done = True
+
+        if status != prev_status:
+            if (prev_status, status) not in ALLOWED_TRANSITIONS:
+                failures.append('%.2f s: %s -> %s' % (t, prev_status, status))
+
+            if status == 'WIND_CALIBRATION':
+                wind_count += 1
+                wind_start = t
+                if heading_count > 0:
+                    failures.append('%.2f s: wind calibration after heading correction' % t)
+            if prev_status == 'WIND_CALIBRATION':
+                if t - wind_start > sm.wind_calc_duration + 2.0*TICK:
+                    failures.append('%.2f s: wind calibration took %.2f s' % (t, t - wind_start))
+            if status == 'HEADING_CORRECTION':
+                heading_count += 1
+                heading_done = True
+            if status == 'IBVS' and not heading_done:
+                failures.append('%.2f s: IBVS before heading correction' % t)
+
+        if status == 'IBVS' or status == 'LAND':
+            if command == 'waypoint':
+                failures.append('%.2f s: waypoint command in %s' % (t, status))
+        elif command is not None and command != 'waypoint':
+            failures.append('%.2f s: %s command in %s' % (t, command, status))
+
+        if command in ('ibvs_outer', 'ibvs_inner'):
+            marker = command[5:]
+            if t - seen[marker] > sm.visibility_timeout:
+                failures.append('%.2f s: %s command without the %s marker for %.2f s' % (t, command, marker, t - seen[marker]))
+
+        if command == 'land':
+            if distance > sm.landing_distance_threshold or not safe_to_land:
+                failures.append('%.2f s: landed at %.2f m, safe_to_land %s' % (t, distance, safe_to_land))
+
+        prev_status = status
+
+    if wind_count > 1:
+        failures.append('wind calibration ran %d times' % wind_count)
+    if heading_count > 1:
+        failures.append('heading correction ran %d times' % heading_count)
+    if trace[-1][1] != 'LAND':
+        failures.append('no landing after %.0f s (ended in %s)' % (DEADLINE, trace[-1][1]))
+
+    return failures
+
+
+def check_wind(sm, scenario):
+
+    # the roll and pitch the rendezvous offset was built from, against the attitude that keeps pace with the target
+    if sm.wind_result is None:
+        return ['no wind calibration']
+
+    psi, roll, pitch, hovered, wp_error = sm.wind_result
+    true_roll, true_pitch = scenario.hover_attitude(psi, scenario.target_velocity[0], scenario.target_velocity[1])
+    error = np.hypot(roll - true_roll, pitch - true_pitch)
+
+    failures = []
+    if error > WIND_ATTITUDE_TOLERANCE:
+        failures.append('hover attitude off by %.2f deg (%s)' % (np.degrees(error), 'hover' if hovered else 'online estimate'))
+
+    # the model is exact with linear drag, so the estimate of the still-air hover has to get there (it stops taking data here)
+    if scenario.quadratic_drag == 0.0:
+        hover_roll, hover_pitch = scenario.hover_attitude(psi)
+        estimate_roll, estimate_pitch = sm.wind_estimator.hover_attitude(psi)
+        estimate_error = np.hypot(estimate_roll - hover_roll, estimate_pitch - hover_pitch)
+        if estimate_error > WIND_ATTITUDE_TOLERANCE:
+            failures.append('online estimate off by %.2f deg with linear drag' % np.degrees(estimate_error))
+
+    return failures
+
+
+def main():
+
+    num_scenarios = 1000
+    seed = 0
+    uw = '--uw' in sys.argv
+    under_way = '--under-way' in sys.argv
+    intercept = '--intercept' in sys.argv
+    resume = '--resume' in sys.argv
+    online_wind = '--online-wind' in sys.argv
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) > 0:
+        num_scenarios = int(args[0])
+    if len(args) > 1:
+        seed = int(args[1])
+
+    ticks = 0
+    sim_time = 0.0
+    landing_times = []
+    rendezvous_times = []
+    failed = 0
+
+    # --online-wind: hover attitude errors (rad) and how far from the rendezvous point the estimate was used (m),
+    # per drag model
+    wind_errors = {'linear': [], 'quadratic': []}
+    wind_skips = {'linear': [], 'quadratic': []}
+
+    # the first run of each scenario saves its calibration here and the restart loads it back
+    calibration_store = None
+    if resume:
+        calibration_directory = tempfile.mkdtemp(prefix='ibvs_scenarios_')
+        calibration_store = CalibrationStore(os.path.join(calibration_directory, 'ibvs_calibration.json'), 600.0, 'scenarios')
+
+    then = time.time()
+    for i in range(num_scenarios):
+        scenario = Scenario(seed + i, under_way, online_wind)
+        sm, trace = run_scenario(scenario, uw, intercept, calibration_store)
+        failures = check_trace(sm, trace)
+
+        if online_wind:
+            failures += check_wind(sm, scenario)
+            if sm.wind_result is not None:
+                psi, roll, pitch, hovered, wp_error = sm.wind_result
+                drag = 'quadratic' if scenario.quadratic_drag > 0.0 else 'linear'
+                true_roll, true_pitch = scenario.hover_attitude(psi, scenario.target_velocity[0], scenario.target_velocity[1])
+                wind_errors[drag].append(np.hypot(roll - true_roll, pitch - true_pitch))
+                if not hovered:
+                    wind_skips[drag].append(wp_error)
+
+        if resume and not failures:
+            # restart from what the first run saved, once it's on disk
+            calibration = sm.calibration()
+            ticks += len(trace)
+            sim_time += trace[-1][0]
+            if not calibration_store.flush():
+                failures.append('calibration not written')
+            scenario = Scenario(seed + i, under_way, online_wind)
+            sm, trace = run_scenario(scenario, uw, intercept, calibration_store, resume=True)
+            if trace is None:
+                failed += 1
+                print("scenario %d (seed %d): nothing to resume from (%s)" % (i, scenario.seed, calibration_store.last_error or 'no valid file'))
+                continue
+            failures = check_trace(sm, trace)
+            for row in trace:
+                if row[1] in ('WIND_CALIBRATION', 'HEADING_CORRECTION'):
+                    failures.append('%.2f s: %s after the restart' % (row[0], row[1]))
+                    break
+
+            # nothing the first run found may change after the restart (the averages aren't remapped twice)
+            for key, value in sorted(calibration.items()):
+                if not np.allclose(sm.calibration()[key], value):
+                    failures.append('restart ended with %s %s instead of %s' % (key, sm.calibration()[key], value))
+
+        ticks += len(trace)
+        sim_time += trace[-1][0]
+        if trace[-1][1] == 'LAND':
+            landing_times.append(trace[-1][0])
+
+        # the first RENDEZVOUS ends when the copter reaches the rendezvous point
+        for row in trace:
+            if row[1] != 'RENDEZVOUS':
+                rendezvous_times.append(row[0])
+                break
+
+        if failures:
+            failed += 1
+            print("scenario %d (seed %d): %s" % (i, scenario.seed, '; '.join(failures[:5])))
+    elapsed = time.time() - then
+
+    if resume:
+        shutil.rmtree(calibration_directory)
+
+    options = [name for name, flag in (('uw settings', uw), ('under way', under_way), ('intercept', intercept),
+                                       ('resumed', resume), ('online wind', online_wind)) if flag]
+    print("%d scenarios%s: %d failed, %d ticks, %.0f s of missions in %.2f s (%.0fx real time, %.1f us per tick)"
+          % (num_scenarios, ' (%s)' % ', '.join(options) if options else '', failed, ticks, sim_time, elapsed, sim_time/elapsed, 1.0e6*elapsed/ticks))
+    if rendezvous_times:
+        print("first rendezvous: median %.1f s, p95 %.1f s, max %.1f s"
+              % (np.median(rendezvous_times), np.percentile(rendezvous_times, 95), np.max(rendezvous_times)))
+    if landing_times:
+        print("landing time: median %.1f s, p95 %.1f s, max %.1f s"
+              % (np.median(landing_times), np.percentile(landing_times, 95), np.max(landing_times)))
+    for drag in ('linear', 'quadratic'):
+        if wind_errors[drag]:
+            print("%s drag: hover skipped in %d of %d scenarios (median %.1f m before the rendezvous point), "
+                  "hover attitude error median %.2f deg, max %.2f deg"
+                  % (drag, len(wind_skips[drag]), len(wind_errors[drag]), np.median(wind_skips[drag]) if wind_skips[drag] else 0.0,
+                     np.degrees(np.median(wind_errors[drag])), np.degrees(np.max(wind_errors[drag]))))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
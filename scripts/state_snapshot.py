@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+## Consistent copy of the vehicle state between the estimate callbacks and the
+## timers that use it. rospy runs every subscriber and timer in its own thread,
+## so a timer that reads pn, pe, ..., r while a callback is assigning them one
+## at a time can see half of one estimate and half of the next.
+##
+## StateSnapshot keeps two preallocated StateRecords. A callback fills in the
+## back record and then swaps the front and back references (one attribute
+## assignment each, atomic under the GIL), so readers only ever look at a
+## finished record. Each record carries the sequence number of its write, -1
+## while it's being filled in. A reader copies the fields out and checks the
+## number didn't change, which only happens if two writes landed in the middle
+## of its copy (it then copies the new front record). Readers never lock, so
+## nothing in the control loop waits on a callback. Writers serialize on a
+## lock among themselves, which only matters when more than one callback
+## writes the same snapshot (target_ekf.py: position and attitude come from
+## different topics).
+##
+## The quaternion is converted by the callback, once per estimate. The record
+## holds Euler angles and the readers never see the quaternion.
+
+import threading
+
+# record fields, in the order of write() and state()
+POSE_FIELDS = ('pn', 'pe', 'pd', 'phi', 'theta', 'psi')
+TWIST_FIELDS = ('u', 'v', 'w', 'p', 'q', 'r')
+
+
+class StateRecord(object):
+
+    __slots__ = ('seq', 'stamp') + POSE_FIELDS + TWIST_FIELDS
+
+    def __init__(self):
+
+        self.seq = 0
+        self.stamp = 0.0
+        self.pn = 0.0
+        self.pe = 0.0
+        self.pd = 0.0
+        self.phi = 0.0
+        self.theta = 0.0
+        self.psi = 0.0
+        self.u = 0.0
+        self.v = 0.0
+        self.w = 0.0
+        self.p = 0.0
+        self.q = 0.0
+        self.r = 0.0
+
+
+    def copy_from(self, other):
+
+        self.stamp = other.stamp
+        self.pn = other.pn
+        self.pe = other.pe
+        self.pd = other.pd
+        self.phi = other.phi
+        self.theta = other.theta
+        self.psi = other.psi
+        self.u = other.u
+        self.v = other.v
+        self.w = other.w
+        self.p = other.p
+        self.q = other.q
+        self.r = other.r
+
+
+class StateSnapshot(object):
+
+    def __init__(self):
+
+        # readers only look at front, writers fill in back and swap
+        self.front = StateRecord()
+        self.back = StateRecord()
+
+        # number of writes, and how many reads had to copy a newer record
+        self.count = 0
+        self.retries = 0
+
+        self.write_lock = threading.Lock()
+
+
+    # Writers (estimate callbacks)
+
+    def begin(self):
+
+        # the back record, marked as being written and holding the front record's values
+        record = self.back
+        record.seq = -1
+        record.copy_from(self.front)
+        return record
+
+
+    def commit(self, record):
+
+        self.count += 1
+        record.seq = self.count
+        self.back = self.front
+        self.front = record
+
+
+    def write(self, stamp, pn, pe, pd, phi, theta, psi, u, v, w, p, q, r):
+
+        # a full estimate: NED position, Euler angles, body velocities and rates
+        with self.write_lock:
+            record = self.back
+            record.seq = -1
+            record.stamp = stamp
+            record.pn = pn
+            record.pe = pe
+            record.pd = pd
+            record.phi = phi
+            record.theta = theta
+            record.psi = psi
+            record.u = u
+            record.v = v
+            record.w = w
+            record.p = p
+            record.q = q
+            record.r = r
+            self.commit(record)
+
+
+    def write_pose(self, stamp, pn, pe, pd, phi, theta, psi):
+
+        # position and attitude, the velocities and rates stay as they were
+        with self.write_lock:
+            record = self.begin()
+            record.stamp = stamp
+            record.pn = pn
+            record.pe = pe
+            record.pd = pd
+            record.phi = phi
+            record.theta = theta
+            record.psi = psi
+            self.commit(record)
+
+
+    def write_position(self, stamp, pn, pe, pd):
+
+        with self.write_lock:
+            record = self.begin()
+            record.stamp = stamp
+            record.pn = pn
+            record.pe = pe
+            record.pd = pd
+            self.commit(record)
+
+
+    def write_attitude(self, stamp, phi, theta, psi):
+
+        with self.write_lock:
+            record = self.begin()
+            record.stamp = stamp
+            record.phi = phi
+            record.theta = theta
+            record.psi = psi
+            self.commit(record)
+
+
+    # Readers (timers, other callbacks), never block
+
+    def pose(self):
+
+        # (pn, pe, pd, phi, theta, psi) of one estimate
+        while True:
+            record = self.front
+            seq = record.seq
+            pose = (record.pn, record.pe, record.pd, record.phi, record.theta, record.psi)
+            if seq >= 0 and record.seq == seq:
+                return pose
+            self.retries += 1
+
+
+    def state(self):
+
+        # (pn, pe, pd, phi, theta, psi, u, v, w, p, q, r) of one estimate
+        while True:
+            record = self.front
+            seq = record.seq
+            state = (record.pn, record.pe, record.pd, record.phi, record.theta, record.psi,
+                     record.u, record.v, record.w, record.p, record.q, record.r)
+            if seq >= 0 and record.seq == seq:
+                return state
+            self.retries += 1
+
+
+    def load_pose(self, target):
+
+        # copy one estimate's position and attitude into target.pn, ..., target.psi
+        target.pn, target.pe, target.pd, target.phi, target.theta, target.psi = self.pose()
+
+
+    def load(self, target):
+
+        # copy one estimate into target.pn, ..., target.r
+        (target.pn, target.pe, target.pd, target.phi, target.theta, target.psi,
+         target.u, target.v, target.w, target.p, target.q, target.r) = self.state()
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+## Check and benchmark for StateSnapshot (state_snapshot.py), no ROS needed.
+##
+## A writer thread stands in for state_callback: estimate k sets all twelve
+## state fields to k, as fast as it can, with a Python call between the
+## position and velocities and the angles, like the quaternion conversion in
+## the old callbacks (the interpreter only switches threads at calls and
+## jumps). The main thread stands in for the control timer and reads the
+## state over and over through
+##   plain:     the twelve attributes, the way the nodes used to read them
+##   lock:      a copy under a threading.Lock the writer also takes
+##   snapshot:  StateSnapshot.load()
+## A read is torn if its fields don't all come from the same estimate. The
+## thread switch interval is turned down so the writer gets preempted mid
+## estimate far more often than it would at 200 Hz, which makes torn plain
+## reads show up within a few seconds. It reports the torn reads and the
+## p50/p99/max time per read with the writer running (the max is a thread
+## switch). With the lock, a reader that comes in while the writer is
+## preempted inside its critical section waits for the writer, the snapshot
+## reader never does.
+##
+## usage: ./state_snapshot_benchmark.py [reads]
+
+from __future__ import print_function
+
+import sys
+import time
+import threading
+import numpy as np
+from state_snapshot import StateSnapshot
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+FIELDS = ('pn', 'pe', 'pd', 'phi', 'theta', 'psi', 'u', 'v', 'w', 'p', 'q', 'r')
+
+
+class Target(object):
+
+    # what a node or core has: the twelve state attributes
+    def __init__(self):
+
+        for name in FIELDS:
+            setattr(self, name, 0.0)
+
+
+def euler(k):
+
+    # stands in for tf.transformations.euler_from_quaternion
+    return k, k, k
+
+
+class Writer(threading.Thread):
+
+    def __init__(self, mode, target, snapshot, lock):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mode = mode
+        self.target = target
+        self.snapshot = snapshot
+        self.lock = lock
+        self.running = True
+        self.count = 0
+
+
+    def run(self):
+
+        t = self.target
+        k = 0.0
+        while self.running:
+            k += 1.0
+            if self.mode == 'snapshot':
+                phi, theta, psi = euler(k)
+                self.snapshot.write(k, k, k, k, phi, theta, psi, k, k, k, k, k, k)
+            elif self.mode == 'lock':
+                with self.lock:
+                    t.pn = k; t.pe = k; t.pd = k; t.u = k; t.v = k; t.w = k
+                    t.phi, t.theta, t.psi = euler(k)
+                    t.p = k; t.q = k; t.r = k
+            else:
+                t.pn = k; t.pe = k; t.pd = k; t.u = k; t.v = k; t.w = k
+                t.phi, t.theta, t.psi = euler(k)
+                t.p = k; t.q = k; t.r = k
+        self.count = int(k)
+
+
+def run(mode, reads):
+
+    shared = Target()
+    snapshot = StateSnapshot()
+    lock = threading.Lock()
+    reader = Target()
+
+    writer = Writer(mode, shared, snapshot, lock)
+    writer.start()
+
+    times = [0.0]*reads
+    torn = 0
+    for n in range(reads):
+        start = timer()
+        if mode == 'snapshot':
+            snapshot.load(reader)
+            s = reader
+            state = (s.pn, s.pe, s.pd, s.phi, s.theta, s.psi, s.u, s.v, s.w, s.p, s.q, s.r)
+        elif mode == 'lock':
+            with lock:
+                s = shared
+                state = (s.pn, s.pe, s.pd, s.phi, s.theta, s.psi, s.u, s.v, s.w, s.p, s.q, s.r)
+        else:
+            s = shared
+            state = (s.pn, s.pe, s.pd, s.phi, s.theta, s.psi, s.u, s.v, s.w, s.p, s.q, s.r)
+        times[n] = timer() - start
+
+        if min(state) != max(state):
+            torn += 1
+
+    writer.running = False
+    writer.join()
+
+    return np.array(times), torn, writer.count, snapshot.retries
+
+
+def main():
+
+    reads = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+
+    # preempt much more often than the 5 ms default, so tears show up
+    if hasattr(sys, 'setswitchinterval'):
+        sys.setswitchinterval(0.00001)
+    else:
+        sys.setcheckinterval(1)
+
+    print('%d reads of the 12-field state while another thread writes estimates as fast as it can' % reads)
+    for mode in ('plain', 'lock', 'snapshot'):
+        times, torn, writes, retries = run(mode, reads)
+        p50, p99 = np.percentile(times, [50.0, 99.0])
+        print('  %-8s torn reads %6d   read p50 %5.2f us  p99 %6.2f us  max %8.1f us   (%d estimates written%s)' % (
+            mode, torn, 1.0e6*p50, 1.0e6*p99, 1.0e6*times.max(), writes,
+            ', %d reads copied a newer record' % retries if mode == 'snapshot' else ''))
+
+
+if __name__ == '__main__':
+    main()
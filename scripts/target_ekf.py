@@ -14,8 +14,10 @@ from geometry_msgs.msg import Vector3Stamped
 from geometry_msgs.msg import PoseStamped
 from geometry_msgs.msg import Point32
 import numpy as np
-import tf
 import time
+import threading
+from target_ekf_core import TargetEKFCore, POSITION_MEASUREMENT, VELOCITY_MEASUREMENT
+from state_snapshot import StateSnapshot
 
 ## TODO:
 #       - Move propagate step into the target callback since velocity doesn't change during propagate steps -- Done
@@ -37,92 +39,31 @@ class TargetEKF(object):
         self.r_aruco = rospy.get_param('~R_aruco', 1.0)
         self.r_gps = rospy.get_param('~R_gps', 1.0)
 
+        # Out-of-sequence measurements: how many to keep and how late (s) one can be and still get fused
+        self.history_length = rospy.get_param('~history_length', 200)
+        self.lag_window = rospy.get_param('~lag_window', 0.25)
 
-        ## Static Transformations
-        # Transform from camera to mount frame
-        self.T_c_m = np.array([[0, -1, 0, 0],
-                               [1, 0, 0, 0],
-                               [0, 0, 1, 0],
-                               [0, 0, 0, 1]], dtype=np.float32)
+        # Rate (Hz) of the prediction-only target state on /target_ekf/prediction, 0 turns it off
+        self.prediction_rate = rospy.get_param('~prediction_rate', 100.0)
 
-        # Transform from mount to body frame (assumes camera mount is perfectly aligned with body frame)
-        self.T_m_b = np.array([[1, 0, 0, self.delta_x],
-                               [0, 1, 0, self.delta_y],
-                               [0, 0, 1, self.delta_z],
-                               [0, 0, 0, 1]], dtype=np.float32)
 
-        
-        ## Other Transformations
-        # Transform from body to vehicle-1 frame
-        self.T_b_v = np.array([[1, 0, 0, 0],
-                               [0, 1, 0, 0],
-                               [0, 0, 1, 0],
-                               [0, 0, 0, 1]], dtype=np.float32)
-
-        # Transform from vehicle-1 to inertial frame
-        # Transform from body to vehicle-1 frame
-        self.T_v_i = np.array([[1, 0, 0, 0],
-                               [0, 1, 0, 0],
-                               [0, 0, 1, 0],
-                               [0, 0, 0, 1]], dtype=np.float32)
-
-        self.R_b_v = np.eye(3, dtype=np.float32)
-        self.R_v_b = np.eye(3, dtype=np.float32)
-
-        # Initialize euler angles
-        self.phi = 0.0
-        self.theta = 0.0
-        self.psi = 0.0
-
-        # Initialize position
-        self.Pn = 0.0
-        self.Pe = 0.0
-        self.Pd = 0.0
-
-        # 4x1 Vectors to hold our measurements
-        self.Z_c = np.array([0, 0, 0, 1], dtype=np.float32).reshape(4,1)
-        self.Z_i = np.array([0, 0, 0, 1], dtype=np.float32).reshape(4,1)
-
-        # 2x1 vector to hold gps velocity measurements
-        self.Z_i_gps = np.zeros((2,1), dtype=np.float32)
-
-        
-        ## EKF Data
-
-        # State vector.
-        self.x_hat = np.zeros((4,1), dtype=np.float32)
+        # EKF math (preallocated, see target_ekf_core.py)
+        self.ekf = TargetEKFCore(self.r_aruco, self.r_gps, self.delta_x, self.delta_y, self.delta_z,
+                                 history_length=self.history_length, lag_window=self.lag_window)
+        self.too_late_count = 0
 
-        # Propagation Jacobian
-        self.F = np.eye(4, dtype=np.float32)
+        # the measurement callbacks and the prediction timer run in different threads. publish_estimate copies the
+        # estimate under ekf_lock and then holds publish_lock for the low-pass filter and the reused messages, which
+        # both measurement callbacks share
+        self.ekf_lock = threading.Lock()
+        self.publish_lock = threading.Lock()
 
-        # Covariance Matrix
-        self.P = np.diag([1.e10, 1.e10, 1.e10, 1.e10])
+        # Copter euler angles and NED position, written by their callbacks and read by target_callback
+        # as one consistent pose (see state_snapshot.py)
+        self.state = StateSnapshot()
 
-        # Model Input Uncertainty
-        self.Q = np.diag([1.e0, 1.e0])
-
-        # Gamma(T)
-        self.Gamma = np.zeros((4,2), dtype=np.float32)
-        
-        # Kalman gain.
-        self.K = np.zeros((4,2), dtype=np.float32)
-
-        # Measurement Jacobian
-        self.H = np.array([[1, 0, 0, 0],
-                           [0, 1, 0, 0]], dtype=np.float32)
-
-        # Measurement Uncertainty
-        self.R = np.diag([self.r_aruco, self.r_aruco])
-
-        # Measurement Jacobian for GPS velocity updates
-        self.H_gps = np.array([[0, 0, 1, 0],
-                           [0, 0, 0, 1]], dtype=np.float32)
-
-        # Measurement Uncertainty for GPS velocity updates
-        self.R_gps = np.diag([self.r_gps, self.r_gps])
-
-        # Identity
-        self.I = np.eye(4, dtype=np.float32)
+        # 2x1 vector to hold gps velocity measurements
+        self.Z_i_gps = np.zeros(2)
 
         ## Low pass filter params
         self.a = 5.0
@@ -130,19 +71,19 @@ class TargetEKF(object):
         self.VN_lpf = 0.0
         self.VE_lpf = 0.0
 
-        self.first_time = True
-        self.t_prev = 0.0
-        self.dt = 0.0
         self.ready_to_propigate = False
 
         self.position_msg = Point32()
         self.velocity_msg = Point32()
         self.velocity_lpf_msg = Point32()
+        self.prediction_msg = Odometry()
+        self.prediction_msg.header.frame_id = 'ned'
 
         # Publisher for Estimate data
         self.position_estimate_pub = rospy.Publisher('/target_ekf/position', Point32, queue_size=1)
         self.velocity_estimate_pub = rospy.Publisher('/target_ekf/velocity', Point32, queue_size=1)
         self.velocity_lpf_estimate_pub = rospy.Publisher('/target_ekf/velocity_lpf', Point32, queue_size=1)
+        self.prediction_pub = rospy.Publisher('/target_ekf/prediction', Odometry, queue_size=1)
 
         # Subscribe to the ArUco's pose in the camera frame
         self.target_sub = rospy.Subscriber('/aruco/estimate', PoseStamped, self.target_callback)
@@ -154,44 +95,59 @@ class TargetEKF(object):
         self.target_ne_pos_sub = rospy.Subscriber('/target_position', Odometry, self.target_ne_pos_callback)
 
 
-        # self.estimate_rate = 50.0
-        # self.estimate_timer = rospy.Timer(rospy.Duration(1.0/self.estimate_rate), self.send_estimate)
+        # Prediction-only timer, propagates a copy of the filter to now (no update step)
+        if self.prediction_rate > 0.0:
+            self.prediction_timer = rospy.Timer(rospy.Duration(1.0/self.prediction_rate), self.send_prediction)
 
 
-    # def send_estimate(self, event):
+    def send_prediction(self, event):
 
-    #     # Propagate
-    #     now = rospy.get_time()
-    #     self.propagate(now)
+        # Propagate a copy of the filter to now
+        now = rospy.get_rostime()
+        with self.ekf_lock:
+            if not self.ekf.predict(now.to_sec()):
+                return
+            x_pred = self.ekf.x_pred
+            P_pred = self.ekf.P_pred
 
-    #     print "Target North: %f" % self.x_hat[0][0]
-    #     print "Target East: %f" % self.x_hat[1][0]
-    #     print "Target VN: %f" % self.x_hat[2][0]
-    #     print "Target VE: %f" % self.x_hat[3][0]
-    #     print "\n"
+            # Fill out the prediction, the position and velocity blocks of P go in the NE slots
+            # of the pose and twist covariances (the cross terms don't fit in an Odometry msg)
+            msg = self.prediction_msg
+            msg.header.stamp = now
+            msg.pose.pose.position.x = x_pred[0]
+            msg.pose.pose.position.y = x_pred[1]
+            msg.twist.twist.linear.x = x_pred[2]
+            msg.twist.twist.linear.y = x_pred[3]
+            msg.pose.covariance = (P_pred[0, 0], P_pred[0, 1], 0.0, 0.0, 0.0, 0.0,
+                                   P_pred[1, 0], P_pred[1, 1]) + (0.0,)*28
+            msg.twist.covariance = (P_pred[2, 2], P_pred[2, 3], 0.0, 0.0, 0.0, 0.0,
+                                    P_pred[3, 2], P_pred[3, 3]) + (0.0,)*28
+
+        # Publish.
+        self.prediction_pub.publish(msg)
 
     
     def target_callback(self, msg):
 
-        # Get the time.
-        now = rospy.get_time()
-
-        # Grab the ArUco's position in the camera frame.
-        self.Z_c[0][0] = msg.pose.position.x
-        self.Z_c[1][0] = msg.pose.position.y
-        self.Z_c[2][0] = msg.pose.position.z
+        # Get the time the image was taken (it gets here later than GPS data from the same time).
+        stamp = msg.header.stamp.to_sec()
+        if stamp == 0.0:
+            stamp = rospy.get_time()
 
-        # Transform the ArUco's position to be expressed in the inertial frame.
-        self.transform_c_to_i()
+        # Transform the ArUco's position in the camera frame to be expressed in the inertial frame.
+        Pn, Pe, Pd, phi, theta, psi = self.state.pose()
+        Z_i = self.ekf.transform_c_to_i(msg.pose.position.x, msg.pose.position.y, msg.pose.position.z,
+                                        phi, theta, psi, Pn, Pe, Pd)
 
-        # Propagate.
-        self.propagate(now)
+        # Propagate and run a measurement update step on our EKF at the time of the image.
+        with self.ekf_lock:
+            fused = self.ekf.process(stamp, POSITION_MEASUREMENT, Z_i[0], Z_i[1])
 
-        # Run a measurement update step on our EKF.
-        self.update_step()
-
-        # Publish.
-        self.publish_estimate()
+        if fused:
+            # Publish.
+            self.publish_estimate()
+        else:
+            self.report_too_late()
 
         # print "Target North: %f" % self.x_hat[0][0]
         # print "Target East: %f" % self.x_hat[1][0]
@@ -203,8 +159,8 @@ class TargetEKF(object):
     def target_ne_pos_callback(self, msg):
 
         # Initialize x_hat to be the first received location of the target
-        self.x_hat[0][0] = msg.pose.pose.position.x
-        self.x_hat[1][0] = msg.pose.pose.position.y
+        with self.ekf_lock:
+            self.ekf.initialize_position(msg.pose.pose.position.x, msg.pose.pose.position.y)
 
         print "Target_EKF: Got initial target location."
 
@@ -220,153 +176,75 @@ class TargetEKF(object):
         now = rospy.get_time()
 
         # Get the gps velocity message data
-        self.Z_i_gps[0][0] = msg.x
-        self.Z_i_gps[1][0] = msg.y
+        self.Z_i_gps[0] = msg.x
+        self.Z_i_gps[1] = msg.y
 
 
-        # Propagate.
+        # Propagate and run a measurement update step on our EKF.
         if self.ready_to_propigate:
-            self.propagate(now)
-
-            # Run a measurement update step on our EKF.
-            self.update_step_gps()
-
-            # Publish.
-            self.publish_estimate()
+            with self.ekf_lock:
+                fused = self.ekf.process(now, VELOCITY_MEASUREMENT, self.Z_i_gps[0], self.Z_i_gps[1])
+
+            if fused:
+                # Publish.
+                self.publish_estimate()
+            else:
+                self.report_too_late()
         else:
             pass
 
 
-    def propagate(self, t):
+    def report_too_late(self):
 
-        if not self.first_time:
-            self.dt = t - self.t_prev
-        else:
-            # dt = 1.0/self.estimate_rate
-            self.first_time = False
-            self.t_prev = rospy.get_time()
-            return
-
-        # Update elements of F and Gamma
-        self.F[0][2] = self.dt
-        self.F[1][3] = self.dt
-
-        self.Gamma[0][0] = (self.dt**2.0)/2.0
-        self.Gamma[1][1] = (self.dt**2.0)/2.0
-        self.Gamma[2][0] = self.dt
-        self.Gamma[3][1] = self.dt
-
-        # Propagate our state.
-        self.x_hat = np.dot(self.F, self.x_hat)
-
-        # Propagate our covariance
-        self.P = np.dot(self.F, np.dot(self.P, self.F.T)) + np.dot(self.Gamma, np.dot(self.Q, self.Gamma.T))
-
-        self.t_prev = t
-
-
-    def transform_c_to_i(self):
-
-        # Update transformations.
-        self.T_v_i[0][3] = self.Pn
-        self.T_v_i[1][3] = self.Pe
-        self.T_v_i[2][3] = self.Pd
-
-        # Pre-evaluate sines and cosines.
-        sphi = np.sin(self.phi)
-        cphi = np.cos(self.phi)
-        stheta = np.sin(self.theta)
-        ctheta = np.cos(self.theta)
-        spsi = np.sin(self.psi)
-        cpsi = np.cos(self.psi)
-
-        # Update rotation from vehicle to body frame.
-        self.R_v_b[0][0] = ctheta * cpsi
-        self.R_v_b[0][1] = ctheta * spsi
-        self.R_v_b[0][2] = -stheta
-        self.R_v_b[1][0] = sphi * stheta *cpsi - cphi * spsi
-        self.R_v_b[1][1] = sphi * stheta * spsi + cphi*cpsi
-        self.R_v_b[1][2] = sphi * ctheta
-        self.R_v_b[2][0] = cphi * stheta * cpsi + sphi * spsi
-        self.R_v_b[2][1] = cphi * stheta * spsi - sphi * cpsi
-        self.R_v_b[2][2] = cphi * ctheta
-
-        self.R_b_v = self.R_v_b.T
-        self.T_b_v[0:3,0:3] = self.R_b_v
-
-        # Compute the whole transformation from camera frame to inertial frame.
-        self.T_c_i = np.dot(self.T_v_i, np.dot(self.T_b_v, np.dot(self.T_m_b, self.T_c_m)))
-
-        # Transform the measurement expressed in the camera frame to be expressed in the inertial frame.
-        self.Z_i = np.dot(self.T_c_i, self.Z_c)
-
-
-    def update_step(self):
-
-        # Compute the Kalman Gain.
-        self.K = np.dot(self.P, np.dot(self.H.T, np.linalg.inv(np.dot(self.H, np.dot(self.P, self.H.T)) + self.R)))
-
-        # Update the estimate.
-        self.x_hat = self.x_hat + np.dot(self.K, (self.Z_i[0:2] - self.x_hat[0:2]))
-
-        # Update covariance.
-        self.P = np.dot((self.I - np.dot(self.K, self.H)), self.P)
-
-        # print "Update ArUco"
-
-
-    def update_step_gps(self):
-
-        # Compute the Kalman Gain.
-        self.K = np.dot(self.P, np.dot(self.H_gps.T, np.linalg.inv(np.dot(self.H_gps, np.dot(self.P, self.H_gps.T)) + self.R_gps)))
-
-        # Update the estimate.
-        self.x_hat = self.x_hat + np.dot(self.K, (self.Z_i_gps - self.x_hat[2:4]))
-
-        # Update covariance.
-        self.P = np.dot((self.I - np.dot(self.K, self.H_gps)), self.P)
-
-        # print "Update GPS"
+        # Don't flood the console, one line per 10 dropped measurements
+        if self.ekf.too_late_count - self.too_late_count >= 10:
+            self.too_late_count = self.ekf.too_late_count
+            print("Target_EKF: dropped %d measurements older than the %.2f s lag window (%d fused late)."
+                  % (self.ekf.too_late_count, self.lag_window, self.ekf.late_count))
 
 
     def publish_estimate(self):
 
-        # Fill out the raw estimate messages.
-        self.position_msg.x = self.x_hat[0][0]
-        self.position_msg.y = self.x_hat[1][0]
+        # Copy the estimate so the other callback or the prediction timer can't change it while we publish.
+        with self.ekf_lock:
+            x_hat = self.ekf.x_hat.copy()
+            dt = self.ekf.dt
 
-        self.velocity_msg.x = self.x_hat[2][0]
-        self.velocity_msg.y = self.x_hat[3][0]
+        # The low-pass filter and the messages are shared by both measurement callbacks.
+        with self.publish_lock:
+            # Fill out the raw estimate messages.
+            self.position_msg.x = x_hat[0]
+            self.position_msg.y = x_hat[1]
 
-        # Low pass filter like in Small Unmanned Aircraft T&P 8.2
-        self.alpha = np.exp(-self.a * self.dt)
-        self.VN_lpf = self.alpha*self.VN_lpf + (1.0 - self.alpha)*self.x_hat[2][0]
-        self.VE_lpf = self.alpha*self.VE_lpf + (1.0 - self.alpha)*self.x_hat[3][0]
+            self.velocity_msg.x = x_hat[2]
+            self.velocity_msg.y = x_hat[3]
 
-        # Fill out the low-pass filtered estimate message.
-        self.velocity_lpf_msg.x = self.VN_lpf
-        self.velocity_lpf_msg.y = self.VE_lpf
+            # Low pass filter like in Small Unmanned Aircraft T&P 8.2
+            self.alpha = np.exp(-self.a * dt)
+            self.VN_lpf = self.alpha*self.VN_lpf + (1.0 - self.alpha)*x_hat[2]
+            self.VE_lpf = self.alpha*self.VE_lpf + (1.0 - self.alpha)*x_hat[3]
 
-        # Publish.
-        self.position_estimate_pub.publish(self.position_msg)
-        self.velocity_estimate_pub.publish(self.velocity_msg)
-        self.velocity_lpf_estimate_pub.publish(self.velocity_lpf_msg)
+            # Fill out the low-pass filtered estimate message.
+            self.velocity_lpf_msg.x = self.VN_lpf
+            self.velocity_lpf_msg.y = self.VE_lpf
+
+            # Publish.
+            self.position_estimate_pub.publish(self.position_msg)
+            self.velocity_estimate_pub.publish(self.velocity_msg)
+            self.velocity_lpf_estimate_pub.publish(self.velocity_lpf_msg)
 
 
     def euler_callback(self, msg):
 
         # Pull off the euler angles.
-        self.phi = msg.vector.x
-        self.theta = msg.vector.y
-        self.psi = msg.vector.z
+        self.state.write_attitude(msg.header.stamp.to_sec(), msg.vector.x, msg.vector.y, msg.vector.z)
 
 
     def position_callback(self, msg):
 
         # Pull off the NED position data
-        self.Pn = msg.pose.pose.position.x
-        self.Pe = msg.pose.pose.position.y
-        self.Pd = msg.pose.pose.position.z
+        position = msg.pose.pose.position
+        self.state.write_position(msg.header.stamp.to_sec(), position.x, position.y, position.z)
 
 
 
@@ -0,0 +1,295 @@
+#! /usr/bin/env python
+
+## Benchmark for the target EKF core in target_ekf_core.py. Replays a
+## synthetic boat (constant velocity plus a slow turn) seen by a hovering
+## quadcopter: noisy ArUco positions in the camera frame and noisy GPS NE
+## velocities, both at 1 kHz, through the original TargetEKF math
+## (np.dot chains and np.linalg.inv) and through TargetEKFCore. Reports the
+## time per measurement cycle, the worst disagreement between the two
+## estimates, the estimation error and the covariance symmetry (no ROS needed).
+##
+## Then it delays the ArUco stream (like the real detection pipeline does) and
+## compares fusing each measurement when it arrives against the out-of-sequence
+## handling in TargetEKFCore.process().
+##
+## usage: ./target_ekf_benchmark.py [duration_s] [gps_every_n_ticks] [aruco_delay_s]
+
+import sys
+import time
+import numpy as np
+from target_ekf_core import TargetEKFCore, POSITION_MEASUREMENT, VELOCITY_MEASUREMENT
+
+# replay rate (Hz)
+RATE = 1000.0
+
+# measurement noise (std dev) and the R the filters are told about
+ARUCO_NOISE = 0.3
+GPS_NOISE = 0.1
+
+
+class LegacyTargetEKF(object):
+
+    # The EKF math the way target_ekf.py used to do it
+    def __init__(self, r_aruco, r_gps):
+
+        self.T_c_m = np.array([[0, -1, 0, 0],
+                               [1, 0, 0, 0],
+                               [0, 0, 1, 0],
+                               [0, 0, 0, 1]], dtype=np.float32)
+        self.T_m_b = np.eye(4, dtype=np.float32)
+        self.T_b_v = np.eye(4, dtype=np.float32)
+        self.T_v_i = np.eye(4, dtype=np.float32)
+        self.R_v_b = np.eye(3, dtype=np.float32)
+        self.Z_c = np.array([0, 0, 0, 1], dtype=np.float32).reshape(4,1)
+        self.Z_i_gps = np.zeros((2,1), dtype=np.float32)
+        self.x_hat = np.zeros((4,1), dtype=np.float32)
+        self.F = np.eye(4, dtype=np.float32)
+        self.P = np.diag([1.e10, 1.e10, 1.e10, 1.e10])
+        self.Q = np.diag([1.e0, 1.e0])
+        self.Gamma = np.zeros((4,2), dtype=np.float32)
+        self.H = np.array([[1, 0, 0, 0],
+                           [0, 1, 0, 0]], dtype=np.float32)
+        self.R = np.diag([r_aruco, r_aruco])
+        self.H_gps = np.array([[0, 0, 1, 0],
+                               [0, 0, 0, 1]], dtype=np.float32)
+        self.R_gps = np.diag([r_gps, r_gps])
+        self.I = np.eye(4, dtype=np.float32)
+        self.first_time = True
+        self.t_prev = 0.0
+        self.dt = 0.0
+
+
+    def propagate(self, t):
+
+        if not self.first_time:
+            self.dt = t - self.t_prev
+        else:
+            self.first_time = False
+            self.t_prev = t
+            return
+
+        self.F[0][2] = self.dt
+        self.F[1][3] = self.dt
+        self.Gamma[0][0] = (self.dt**2.0)/2.0
+        self.Gamma[1][1] = (self.dt**2.0)/2.0
+        self.Gamma[2][0] = self.dt
+        self.Gamma[3][1] = self.dt
+        self.x_hat = np.dot(self.F, self.x_hat)
+        self.P = np.dot(self.F, np.dot(self.P, self.F.T)) + np.dot(self.Gamma, np.dot(self.Q, self.Gamma.T))
+        self.t_prev = t
+
+
+    def transform_c_to_i(self, x_c, y_c, z_c, phi, theta, psi, pn, pe, pd):
+
+        self.Z_c[0][0] = x_c
+        self.Z_c[1][0] = y_c
+        self.Z_c[2][0] = z_c
+        self.T_v_i[0][3] = pn
+        self.T_v_i[1][3] = pe
+        self.T_v_i[2][3] = pd
+        sphi = np.sin(phi)
+        cphi = np.cos(phi)
+        stheta = np.sin(theta)
+        ctheta = np.cos(theta)
+        spsi = np.sin(psi)
+        cpsi = np.cos(psi)
+        self.R_v_b[0][0] = ctheta * cpsi
+        self.R_v_b[0][1] = ctheta * spsi
+        self.R_v_b[0][2] = -stheta
+        self.R_v_b[1][0] = sphi * stheta *cpsi - cphi * spsi
+        self.R_v_b[1][1] = sphi * stheta * spsi + cphi*cpsi
+        self.R_v_b[1][2] = sphi * ctheta
+        self.R_v_b[2][0] = cphi * stheta * cpsi + sphi * spsi
+        self.R_v_b[2][1] = cphi * stheta * spsi - sphi * cpsi
+        self.R_v_b[2][2] = cphi * ctheta
+        self.T_b_v[0:3,0:3] = self.R_v_b.T
+        T_c_i = np.dot(self.T_v_i, np.dot(self.T_b_v, np.dot(self.T_m_b, self.T_c_m)))
+
+        return np.dot(T_c_i, self.Z_c)
+
+
+    def update_step(self, Z_i):
+
+        self.K = np.dot(self.P, np.dot(self.H.T, np.linalg.inv(np.dot(self.H, np.dot(self.P, self.H.T)) + self.R)))
+        self.x_hat = self.x_hat + np.dot(self.K, (Z_i[0:2] - self.x_hat[0:2]))
+        self.P = np.dot((self.I - np.dot(self.K, self.H)), self.P)
+
+
+    def update_step_gps(self, vn, ve):
+
+        self.Z_i_gps[0][0] = vn
+        self.Z_i_gps[1][0] = ve
+        self.K = np.dot(self.P, np.dot(self.H_gps.T, np.linalg.inv(np.dot(self.H_gps, np.dot(self.P, self.H_gps.T)) + self.R_gps)))
+        self.x_hat = self.x_hat + np.dot(self.K, (self.Z_i_gps - self.x_hat[2:4]))
+        self.P = np.dot((self.I - np.dot(self.K, self.H_gps)), self.P)
+
+
+def synthetic_streams(duration, gps_every):
+
+    # boat and quadcopter trajectories sampled at RATE, with the measurements each one would produce
+    np.random.seed(0)
+    t = np.arange(0.0, duration, 1.0/RATE)
+    heading = 0.02*t
+    vn = 3.0*np.cos(heading)
+    ve = 3.0*np.sin(heading)
+    boat_n = 5.0 + np.cumsum(vn)/RATE
+    boat_e = -2.0 + np.cumsum(ve)/RATE
+
+    # quadcopter 10 m above the boat, lagging it by a couple of meters and wobbling a bit
+    quad_n = boat_n - 2.0
+    quad_e = boat_e + 1.0
+    quad_d = -10.0*np.ones_like(t)
+    phi = 0.05*np.sin(2.0*np.pi*0.5*t)
+    theta = 0.05*np.cos(2.0*np.pi*0.3*t)
+    psi = 0.3 + 0.1*np.sin(2.0*np.pi*0.1*t)
+
+    # the ArUco in the camera frame (inverse of transform_c_to_i)
+    core = TargetEKFCore()
+    aruco = np.zeros((len(t), 3))
+    for i in range(len(t)):
+        core.transform_c_to_i(0.0, 0.0, 0.0, phi[i], theta[i], psi[i], 0.0, 0.0, 0.0)
+        p_i = np.array([boat_n[i] - quad_n[i], boat_e[i] - quad_e[i], 0.0 - quad_d[i]])
+        p_b = np.dot(core.R_v_b, p_i)
+        aruco[i] = np.dot(core.R_c_b.T, p_b - core.t_c_b)
+    aruco[:, 0:2] += ARUCO_NOISE*np.random.randn(len(t), 2)
+
+    gps = np.column_stack((vn, ve)) + GPS_NOISE*np.random.randn(len(t), 2)
+    is_gps = (np.arange(len(t)) % gps_every) == 0
+
+    return t, aruco, gps, is_gps, (phi, theta, psi, quad_n, quad_e, quad_d), np.column_stack((boat_n, boat_e, vn, ve))
+
+
+def run_legacy(ekf, t, aruco, gps, is_gps, attitude):
+
+    phi, theta, psi, quad_n, quad_e, quad_d = attitude
+    x_hat = np.zeros((len(t), 4))
+    for i in range(len(t)):
+        Z_i = ekf.transform_c_to_i(aruco[i, 0], aruco[i, 1], aruco[i, 2], phi[i], theta[i], psi[i],
+                                   quad_n[i], quad_e[i], quad_d[i])
+        ekf.propagate(t[i])
+        ekf.update_step(Z_i)
+        if is_gps[i]:
+            ekf.propagate(t[i])
+            ekf.update_step_gps(gps[i, 0], gps[i, 1])
+        x_hat[i] = ekf.x_hat[:, 0]
+
+    return x_hat
+
+
+def run_core(ekf, t, aruco, gps, is_gps, attitude):
+
+    phi, theta, psi, quad_n, quad_e, quad_d = attitude
+    x_hat = np.zeros((len(t), 4))
+    for i in range(len(t)):
+        Z_i = ekf.transform_c_to_i(aruco[i, 0], aruco[i, 1], aruco[i, 2], phi[i], theta[i], psi[i],
+                                   quad_n[i], quad_e[i], quad_d[i])
+        ekf.propagate(t[i])
+        ekf.update_position(Z_i[0], Z_i[1])
+        if is_gps[i]:
+            ekf.propagate(t[i])
+            ekf.update_velocity(gps[i, 0], gps[i, 1])
+        x_hat[i] = ekf.x_hat
+
+    return x_hat
+
+
+def run_delayed(t, aruco, gps, is_gps, attitude, delay, r_aruco, r_gps, out_of_sequence):
+
+    # the ArUco measurement taken at t[i] shows up at t[i] + delay, GPS shows up right away
+    phi, theta, psi, quad_n, quad_e, quad_d = attitude
+    ekf = TargetEKFCore(r_aruco, r_gps)
+
+    events = []
+    for i in range(len(t)):
+        events.append((t[i] + delay, 0, i))
+        if is_gps[i]:
+            events.append((t[i], 1, i))
+    events.sort()
+
+    x_hat = np.zeros((len(t), 4))
+    x_hat[:] = np.nan
+    then = time.time()
+    for arrival, kind, i in events:
+        if kind == 0:
+            Z_i = ekf.transform_c_to_i(aruco[i, 0], aruco[i, 1], aruco[i, 2], phi[i], theta[i], psi[i],
+                                       quad_n[i], quad_e[i], quad_d[i])
+            measurement_type, z0, z1 = POSITION_MEASUREMENT, Z_i[0], Z_i[1]
+        else:
+            measurement_type, z0, z1 = VELOCITY_MEASUREMENT, gps[i, 0], gps[i, 1]
+
+        if out_of_sequence:
+            ekf.process(t[i], measurement_type, z0, z1)
+        else:
+            # fuse it as if it was taken when it arrived
+            ekf.process(arrival, measurement_type, z0, z1)
+
+        # estimate at the time it's published, moved back to the tick it arrived on
+        k = min(len(t) - 1, int(round(arrival*RATE)))
+        x_hat[k] = ekf.x_hat
+        x_hat[k, 0:2] -= (ekf.t_prev - t[k])*ekf.x_hat[2:4]
+
+    return x_hat, time.time() - then, ekf
+
+
+def main():
+
+    duration = 20.0
+    gps_every = 1
+    delay = 0.04
+
+    if len(sys.argv) > 1:
+        duration = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        gps_every = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        delay = float(sys.argv[3])
+
+    t, aruco, gps, is_gps, attitude, truth = synthetic_streams(duration, gps_every)
+    num_measurements = len(t) + int(np.sum(is_gps))
+
+    print("Target EKF benchmark: %.1f s at %.0f Hz, %d ArUco + %d GPS measurements"
+          % (duration, RATE, len(t), int(np.sum(is_gps))))
+
+    r_aruco = ARUCO_NOISE**2
+    r_gps = GPS_NOISE**2
+
+    legacy = LegacyTargetEKF(r_aruco, r_gps)
+    then = time.time()
+    x_legacy = run_legacy(legacy, t, aruco, gps, is_gps, attitude)
+    t_legacy = time.time() - then
+
+    core = TargetEKFCore(r_aruco, r_gps)
+    then = time.time()
+    x_core = run_core(core, t, aruco, gps, is_gps, attitude)
+    t_core = time.time() - then
+
+    # skip the first second while both filters are still converging from P = 1e10
+    settled = t >= 1.0
+    rms_legacy = np.sqrt(np.mean((x_legacy[settled] - truth[settled])**2, axis=0))
+    rms_core = np.sqrt(np.mean((x_core[settled] - truth[settled])**2, axis=0))
+
+    print("  per measurement:  legacy %8.2f us   core %8.2f us   speedup %.2fx"
+          % (1.0e6*t_legacy/num_measurements, 1.0e6*t_core/num_measurements, t_legacy/t_core))
+    print("  max |legacy - core| after 1 s: pos %.2e m, vel %.2e m/s"
+          % (np.max(np.abs(x_legacy[settled, 0:2] - x_core[settled, 0:2])),
+             np.max(np.abs(x_legacy[settled, 2:4] - x_core[settled, 2:4]))))
+    print("  rms error [n, e, vn, ve]:  legacy [%s]   core [%s]"
+          % (", ".join("%.3f" % x for x in rms_legacy), ", ".join("%.3f" % x for x in rms_core)))
+    print("  final P asymmetry:  legacy %.2e   core %.2e"
+          % (np.max(np.abs(legacy.P - legacy.P.T)), np.max(np.abs(core.P - core.P.T))))
+    print("  final P min eigenvalue:  legacy %.2e   core %.2e"
+          % (np.min(np.linalg.eigvalsh(0.5*(legacy.P + legacy.P.T))), np.min(np.linalg.eigvalsh(core.P))))
+
+    # delayed ArUco stream
+    print("ArUco delayed by %.0f ms:" % (1.0e3*delay))
+    for name, out_of_sequence in (('fused on arrival', False), ('out of sequence', True)):
+        x_hat, elapsed, ekf = run_delayed(t, aruco, gps, is_gps, attitude, delay, r_aruco, r_gps, out_of_sequence)
+        valid = settled & ~np.isnan(x_hat[:, 0])
+        rms = np.sqrt(np.mean((x_hat[valid] - truth[valid])**2, axis=0))
+        print("  %-17s rms error [n, e, vn, ve] [%s]   %6.2f us per measurement   %d fused late, %d too late"
+              % (name, ", ".join("%.3f" % x for x in rms), 1.0e6*elapsed/num_measurements, ekf.late_count, ekf.too_late_count))
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+## ROS-free core of the target velocity EKF in target_ekf.py. The state vector is
+## x_hat = [n, e, vn, ve].T with a constant-velocity model driven by acceleration
+## noise, and both measurement types observe two states directly:
+##   ArUco: target NE position (camera frame measurement rotated into the inertial frame)
+##   GPS:   target NE velocity
+##
+## Everything is preallocated in the constructor and updated in place, so a
+## propagate/update cycle doesn't create any new arrays:
+##   - F and Gamma*Q*Gamma.T only have their dt-dependent elements rewritten
+##   - the 2x2 innovation covariance is inverted in closed form
+##   - the covariance update uses the Joseph form (I - KH)P(I - KH).T + KRK.T,
+##     which keeps P symmetric and positive definite with float round-off
+##   - the constant camera to body transform T_m_b*T_c_m is computed once
+##
+## ArUco measurements show up tens of milliseconds after the image they came
+## from, later than GPS velocities taken at the same time. process() keeps a
+## bounded history of the measurements it fused along with the state and
+## covariance just before each one. A measurement older than the newest one in
+## the history is fused at its own time: the filter goes back to the state
+## before the first newer measurement, fuses the late one and replays the newer
+## ones on top of it. Measurements older than lag_window (or than the oldest
+## entry in the history) are dropped and counted in too_late_count.
+##
+## predict() propagates a copy of the filter to any time (the fixed-rate
+## prediction publisher in target_ekf.py) without touching the filter itself.
+##
+## Source:
+## Mingfeng "Vision-Based Tracking and Estimation of Ground Moving Target Using Unmanned Aerial Vehicle"
+
+import math
+import numpy as np
+
+
+# measurement types kept in the history
+POSITION_MEASUREMENT = 0
+VELOCITY_MEASUREMENT = 1
+
+# default number of measurements kept for out-of-sequence updates and how late (s) one can be
+DEFAULT_HISTORY_LENGTH = 200
+DEFAULT_LAG_WINDOW = 0.25
+
+
+class TargetEKFCore(object):
+
+    def __init__(self, r_aruco=1.0, r_gps=1.0, delta_x=0.0, delta_y=0.0, delta_z=0.0, q=1.0, p0=1.e10,
+                 history_length=DEFAULT_HISTORY_LENGTH, lag_window=DEFAULT_LAG_WINDOW):
+
+        ## Static Transformations
+        # Transform from camera to mount frame
+        T_c_m = np.array([[0, -1, 0, 0],
+                          [1, 0, 0, 0],
+                          [0, 0, 1, 0],
+                          [0, 0, 0, 1]], dtype=np.float64)
+
+        # Transform from mount to body frame (assumes camera mount is perfectly aligned with body frame)
+        T_m_b = np.array([[1, 0, 0, delta_x],
+                          [0, 1, 0, delta_y],
+                          [0, 0, 1, delta_z],
+                          [0, 0, 0, 1]], dtype=np.float64)
+
+        # Camera to body frame, constant so only compute it once
+        T_c_b = np.dot(T_m_b, T_c_m)
+        self.R_c_b = T_c_b[0:3, 0:3].copy()
+        self.t_c_b = T_c_b[0:3, 3].copy()
+
+        # Rotation from vehicle to body frame
+        self.R_v_b = np.eye(3)
+
+        # Measurement in the camera frame, the body frame and the inertial frame (3x1)
+        self.Z_c = np.zeros(3)
+        self.Z_b = np.zeros(3)
+        self.Z_i = np.zeros(3)
+
+        ## EKF Data
+        # State vector [n, e, vn, ve]
+        self.x_hat = np.zeros(4)
+
+        # Covariance Matrix
+        self.P = np.diag([p0, p0, p0, p0])
+
+        # Model input (acceleration) uncertainty, Q = diag(q, q)
+        self.q = q
+
+        # Measurement Uncertainty
+        self.R = np.diag([r_aruco, r_aruco])
+        self.R_gps = np.diag([r_gps, r_gps])
+
+        # Propagation Jacobian F = [[I, dt*I], [0, I]] and the process noise Gamma*Q*Gamma.T
+        # with Gamma = [[dt^2/2*I], [dt*I]] and Q = q*I
+        self.F = np.eye(4)
+        self.GQG = np.zeros((4,4))
+
+        # Measurement Jacobians, each picks out two states
+        self.H = np.array([[1, 0, 0, 0],
+                           [0, 1, 0, 0]], dtype=np.float64)
+        self.H_gps = np.array([[0, 0, 1, 0],
+                               [0, 0, 0, 1]], dtype=np.float64)
+
+        # Kalman gain
+        self.K = np.zeros((4,2))
+
+        # Prediction (see predict()) and its own workspaces, so it can run from another thread than the updates
+        self.x_pred = np.zeros(4)
+        self.P_pred = np.zeros((4,4))
+        self.F_pred = np.eye(4)
+        self.GQG_pred = np.zeros((4,4))
+        self.work_pred = np.zeros((4,4))
+
+        # Innovation and its covariance (and inverse) from the last update
+        self.innovation = np.zeros(2)
+        self.S = np.zeros((2,2))
+        self.S_inv = np.zeros((2,2))
+
+        # Workspaces
+        self.dx = np.zeros(4)
+        self.KR = np.zeros((4,2))
+        self.KH = np.zeros((4,4))
+        self.IKH = np.eye(4)
+        self.I = np.eye(4)
+        self.work = np.zeros((4,4))
+        self.work2 = np.zeros((4,4))
+
+        self.first_time = True
+        self.t_prev = 0.0
+        self.dt = 0.0
+
+        ## Measurement history for out-of-sequence updates, oldest first. Entry k holds a measurement
+        ## and the filter (x_hat, P, t_prev) just before it was fused. Twice history_length is
+        ## allocated so dropping the oldest entries is one block copy every history_length measurements.
+        capacity = 2*history_length
+        self.history_length = history_length
+        self.lag_window = lag_window
+        self.history_t = np.zeros(capacity)
+        self.history_type = np.zeros(capacity, dtype=np.int8)
+        self.history_z = np.zeros((capacity, 2))
+        self.history_x = np.zeros((capacity, 4))
+        self.history_P = np.zeros((capacity, 4, 4))
+        self.history_t_prev = np.zeros(capacity)
+        self.history_first_time = np.zeros(capacity, dtype=bool)
+        self.num_history = 0
+
+        # measurements fused out of sequence and measurements dropped for being too late
+        self.late_count = 0
+        self.too_late_count = 0
+
+
+    def initialize_position(self, n, e):
+
+        self.x_hat[0] = n
+        self.x_hat[1] = e
+
+        # don't replay anything from before the reset
+        self.num_history = 0
+
+
+    def propagate(self, t):
+
+        # The first call only starts the clock
+        if self.first_time:
+            self.first_time = False
+            self.t_prev = t
+            return
+
+        dt = t - self.t_prev
+        self.dt = dt
+
+        # x = F*x
+        x_hat = self.x_hat
+        x_hat[0] += dt*x_hat[2]
+        x_hat[1] += dt*x_hat[3]
+
+        # P = F*P*F.T + Gamma*Q*Gamma.T
+        self.propagate_covariance(self.P, dt, self.F, self.GQG, self.work, self.P)
+
+        self.t_prev = t
+
+
+    def predict(self, t):
+
+        # Propagate a copy of the filter to time t into x_pred and P_pred, returns False until the filter has started
+        if self.first_time:
+            return False
+
+        # never predict backwards (a late measurement can leave t_prev a bit ahead of t)
+        dt = max(0.0, t - self.t_prev)
+
+        x_pred = self.x_pred
+        x_pred[:] = self.x_hat
+        x_pred[0] += dt*x_pred[2]
+        x_pred[1] += dt*x_pred[3]
+
+        self.propagate_covariance(self.P, dt, self.F_pred, self.GQG_pred, self.work_pred, self.P_pred)
+
+        return True
+
+
+    def propagate_covariance(self, P, dt, F, GQG, work, P_out):
+
+        # P_out = F*P*F.T + Gamma*Q*Gamma.T (P_out can be P)
+
+        # Update the dt-dependent elements of F and Gamma*Q*Gamma.T
+        F[0, 2] = dt
+        F[1, 3] = dt
+
+        q_pp = self.q*dt**4/4.0
+        q_pv = self.q*dt**3/2.0
+        q_vv = self.q*dt**2
+        GQG[0, 0] = q_pp
+        GQG[1, 1] = q_pp
+        GQG[2, 2] = q_vv
+        GQG[3, 3] = q_vv
+        GQG[0, 2] = q_pv
+        GQG[2, 0] = q_pv
+        GQG[1, 3] = q_pv
+        GQG[3, 1] = q_pv
+
+        np.dot(F, P, out=work)
+        np.dot(work, F.T, out=P_out)
+        P_out += GQG
+
+
+    def transform_c_to_i(self, x_c, y_c, z_c, phi, theta, psi, pn, pe, pd):
+
+        # Pre-evaluate sines and cosines.
+        sphi = math.sin(phi)
+        cphi = math.cos(phi)
+        stheta = math.sin(theta)
+        ctheta = math.cos(theta)
+        spsi = math.sin(psi)
+        cpsi = math.cos(psi)
+
+        # Update rotation from vehicle to body frame.
+        R_v_b = self.R_v_b
+        R_v_b[0, 0] = ctheta * cpsi
+        R_v_b[0, 1] = ctheta * spsi
+        R_v_b[0, 2] = -stheta
+        R_v_b[1, 0] = sphi * stheta * cpsi - cphi * spsi
+        R_v_b[1, 1] = sphi * stheta * spsi + cphi * cpsi
+        R_v_b[1, 2] = sphi * ctheta
+        R_v_b[2, 0] = cphi * stheta * cpsi + sphi * spsi
+        R_v_b[2, 1] = cphi * stheta * spsi - sphi * cpsi
+        R_v_b[2, 2] = cphi * ctheta
+
+        # Camera frame -> body frame (cached T_m_b*T_c_m) -> inertial frame (R_b_v = R_v_b.T, then the position)
+        self.Z_c[0] = x_c
+        self.Z_c[1] = y_c
+        self.Z_c[2] = z_c
+        np.dot(self.R_c_b, self.Z_c, out=self.Z_b)
+        self.Z_b += self.t_c_b
+        np.dot(R_v_b.T, self.Z_b, out=self.Z_i)
+        self.Z_i[0] += pn
+        self.Z_i[1] += pe
+        self.Z_i[2] += pd
+
+        return self.Z_i
+
+
+    def process(self, t, measurement_type, z0, z1):
+
+        # Fuse a measurement taken at time t, returns False if it was too late to use
+        n = self.num_history
+
+        if n == 0 or t >= self.history_t[n - 1]:
+            # in order
+            self.fuse(n, t, measurement_type, z0, z1)
+            self.num_history = n + 1
+
+            if self.num_history == len(self.history_t):
+                self.trim_history()
+
+            return True
+
+        if self.history_t[n - 1] - t > self.lag_window or t < self.history_t[0]:
+            self.too_late_count += 1
+            return False
+
+        # go back to just before the first measurement newer than this one
+        j = np.searchsorted(self.history_t[0:n], t, side='right')
+        self.x_hat[:] = self.history_x[j]
+        self.P[:, :] = self.history_P[j]
+        self.t_prev = self.history_t_prev[j]
+        self.first_time = self.history_first_time[j]
+
+        # slot the late measurement in, then replay the newer ones
+        self.history_t[j + 1:n + 1] = self.history_t[j:n]
+        self.history_type[j + 1:n + 1] = self.history_type[j:n]
+        self.history_z[j + 1:n + 1] = self.history_z[j:n]
+
+        self.fuse(j, t, measurement_type, z0, z1)
+        for k in range(j + 1, n + 1):
+            self.fuse(k, self.history_t[k], self.history_type[k], self.history_z[k, 0], self.history_z[k, 1])
+
+        self.num_history = n + 1
+        self.late_count += 1
+
+        if self.num_history == len(self.history_t):
+            self.trim_history()
+
+        return True
+
+
+    def fuse(self, k, t, measurement_type, z0, z1):
+
+        # Save the measurement and the filter before it in history slot k, then propagate and update
+        self.history_t[k] = t
+        self.history_type[k] = measurement_type
+        self.history_z[k, 0] = z0
+        self.history_z[k, 1] = z1
+        self.history_x[k] = self.x_hat
+        self.history_P[k] = self.P
+        self.history_t_prev[k] = self.t_prev
+        self.history_first_time[k] = self.first_time
+
+        self.propagate(t)
+
+        if measurement_type == POSITION_MEASUREMENT:
+            self.update_position(z0, z1)
+        else:
+            self.update_velocity(z0, z1)
+
+
+    def trim_history(self):
+
+        # keep the newest history_length entries
+        start = self.num_history - self.history_length
+        end = self.num_history
+        m = self.history_length
+
+        self.history_t[0:m] = self.history_t[start:end]
+        self.history_type[0:m] = self.history_type[start:end]
+        self.history_z[0:m] = self.history_z[start:end]
+        self.history_x[0:m] = self.history_x[start:end]
+        self.history_P[0:m] = self.history_P[start:end]
+        self.history_t_prev[0:m] = self.history_t_prev[start:end]
+        self.history_first_time[0:m] = self.history_first_time[start:end]
+        self.num_history = m
+
+
+    def update_position(self, n, e):
+
+        # ArUco update, measures the NE position of the target
+        self.update(n, e, 0, self.H, self.R)
+
+
+    def update_velocity(self, vn, ve):
+
+        # GPS update, measures the NE velocity of the target
+        self.update(vn, ve, 2, self.H_gps, self.R_gps)
+
+
+    def update(self, z0, z1, i, H, R):
+
+        # z0 and z1 measure states i and i + 1 (H picks them out)
+        P = self.P
+        S = self.S
+        S_inv = self.S_inv
+        K = self.K
+
+        # S = H*P*H.T + R
+        s00 = P.item(i, i) + R.item(0, 0)
+        s01 = P.item(i, i + 1) + R.item(0, 1)
+        s10 = P.item(i + 1, i) + R.item(1, 0)
+        s11 = P.item(i + 1, i + 1) + R.item(1, 1)
+        S[0, 0] = s00
+        S[0, 1] = s01
+        S[1, 0] = s10
+        S[1, 1] = s11
+
+        # Closed-form 2x2 inverse
+        det = s00*s11 - s01*s10
+        S_inv[0, 0] = s11 / det
+        S_inv[0, 1] = -s01 / det
+        S_inv[1, 0] = -s10 / det
+        S_inv[1, 1] = s00 / det
+
+        # Compute the Kalman Gain (P*H.T is just the columns of P for those states).
+        np.dot(P[:, i:i + 2], S_inv, out=K)
+
+        # Update the estimate.
+        self.innovation[0] = z0 - self.x_hat.item(i)
+        self.innovation[1] = z1 - self.x_hat.item(i + 1)
+        np.dot(K, self.innovation, out=self.dx)
+        self.x_hat += self.dx
+
+        # Update covariance (Joseph form).
+        np.dot(K, H, out=self.KH)
+        np.subtract(self.I, self.KH, out=self.IKH)
+        np.dot(self.IKH, P, out=self.work)
+        np.dot(self.work, self.IKH.T, out=P)
+        np.dot(K, R, out=self.KR)
+        np.dot(self.KR, K.T, out=self.work2)
+        P += self.work2
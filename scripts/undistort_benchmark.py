@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+
+## Benchmark for the undistortion lookup table in level_frame.py. For each
+## calibration it builds the table, measures its worst error against
+## cv2.undistortPoints over a dense grid of the whole image, and times the
+## per-message corner undistortion (4 corners) with both methods (no ROS
+## needed). Only the per-message lookup is timed: for big arrays of points
+## cv2.undistortPoints is as fast as the vectorized table lookup or faster
+## (0.6-1.0x), so the table isn't used for those.
+##
+## Calibrations: the camera_info YAMLs in params/ (962x720 and 1288x964) plus
+## the chameleon3 calibration scaled down to 640x480.
+##
+## usage: ./undistort_benchmark.py [num_iterations]
+##        ./undistort_benchmark.py --yaml ../params/llnl_chameleon_resized_962x720.yaml [more.yaml ...]
+
+import os
+import sys
+import time
+import timeit
+import numpy as np
+import cv2
+from level_frame import UndistortionLUT, load_camera_yaml, DEFAULT_LUT_STEP, DEFAULT_LUT_TOLERANCE
+
+PARAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'params')
+
+CALIBRATION_FILES = ('llnl_chameleon_resized_962x720.yaml',
+                     'ir_chameleon_resized_962x720.yaml',
+                     'chameleon3_LLNL.yaml')
+
+def scaled_calibration(K, d, width, height, new_width, new_height):
+
+    # same lens, smaller image (distortion coefficients don't change with the image size)
+    K = K.copy()
+    K[0, :] *= float(new_width) / width
+    K[1, :] *= float(new_height) / height
+
+    return K, d, new_width, new_height
+
+
+def cv2_corners(corners, K, d, fx, fy):
+
+    # the way level_frame_mapper.py used to do it
+    undist = cv2.undistortPoints(corners, K, d).reshape(4,2)
+    undist[:, 0] *= fx
+    undist[:, 1] *= fy
+
+    return undist
+
+
+def benchmark(name, K, d, width, height, iterations):
+
+    then = time.time()
+    lut = UndistortionLUT(K, d, width, height)
+    build_ms = 1.0e3 * (time.time() - then)
+
+    # dense check over the whole image (every 2 pixels)
+    u, v = np.meshgrid(np.arange(0.0, width, 2.0), np.arange(0.0, height, 2.0))
+    u = u.ravel()
+    v = v.ravel()
+    max_error = np.max(np.abs(lut.interpolate(u, v) - lut.exact(u, v)))
+
+    # a marker somewhere off-center
+    data = [0.31*width, 0.28*height, 0.52*width, 0.27*height, 0.53*width, 0.55*height, 0.30*width, 0.56*height]
+    corners = np.array(data).reshape(4,1,2)
+    out = np.zeros((4,2))
+
+    lut.undistort_corners(data, 0, out)
+    corner_error = np.max(np.abs(out - cv2_corners(corners, lut.K, lut.d, lut.fx, lut.fy)))
+
+    t_cv2 = timeit.timeit(lambda: cv2_corners(corners, lut.K, lut.d, lut.fx, lut.fy), number=iterations)
+    t_lut = timeit.timeit(lambda: lut.undistort_corners(data, 0, out), number=iterations)
+
+    print("%s (%dx%d)" % (name, width, height))
+    print("  table: step %.1f px, %d cells, built in %.1f ms" % (lut.step, len(lut.cells), build_ms))
+    print("  max error vs cv2: %.4f px over the image (build check %.4f px, tolerance %.3f px), %.4f px on the test corners"
+          % (max_error, lut.max_error, DEFAULT_LUT_TOLERANCE, corner_error))
+    print("  4 corners:      cv2 %8.2f us   lut %8.2f us   speedup %.2fx"
+          % (1.0e6*t_cv2/iterations, 1.0e6*t_lut/iterations, t_cv2/t_lut))
+
+
+def main():
+
+    iterations = 20000
+    filenames = [os.path.join(PARAMS_DIR, f) for f in CALIBRATION_FILES]
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--yaml':
+        filenames = sys.argv[2:]
+    elif len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    print("Undistortion lookup table benchmark (%d iterations, starting step %.0f px)" % (iterations, DEFAULT_LUT_STEP))
+
+    for filename in filenames:
+        K, d, width, height = load_camera_yaml(filename)
+        benchmark(os.path.basename(filename), K, d, width, height, iterations)
+
+        # the 640x480 case from the big chameleon3 calibration
+        if os.path.basename(filename) == 'chameleon3_LLNL.yaml':
+            K, d, width, height = scaled_calibration(K, d, width, height, 640, 480)
+            benchmark('chameleon3_LLNL.yaml scaled', K, d, width, height, iterations)
+
+
+if __name__ == '__main__':
+    main()
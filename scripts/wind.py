@@ -7,7 +7,7 @@ import rospy
 from geometry_msgs.msg import Vector3
 from nav_msgs.msg import Odometry
 import numpy as np
-import tf
+from rotation_kernel import quaternion_to_euler
 
 
 class Wind(object):
@@ -117,15 +117,9 @@ class Wind(object):
 
     def state_callback(self, msg):
 
-        # get the quaternion orientation from the message
-        quaternion = (
-            msg.pose.pose.orientation.x,
-            msg.pose.pose.orientation.y,
-            msg.pose.pose.orientation.z,
-            msg.pose.pose.orientation.w)
-
-        # convert to euler angles 
-        euler = tf.transformations.euler_from_quaternion(quaternion)
+        # get the quaternion orientation from the message and convert to euler angles
+        orientation = msg.pose.pose.orientation
+        euler = quaternion_to_euler(orientation.x, orientation.y, orientation.z, orientation.w)
 
         # update class variables
         self.phi = euler[0]
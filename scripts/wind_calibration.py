@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+## Streaming roll/pitch statistics for the WIND_CALIBRATION state. While the
+## copter holds the rendezvous point, the average roll and pitch it needs tell
+## us how hard the wind is pushing (see compute_rendezvous_offset in
+## ibvs_state_machine.py).
+##
+## Samples sit in a preallocated ring buffer that only covers the last 'window'
+## seconds. Running sums (shifted by the first sample so the variance doesn't
+## lose precision) give the mean and variance in O(1) per sample. The buffer is
+## split at the middle of the time it spans. Samples only ever cross that split
+## from the newer half into the older half, so the mean of each half is O(1)
+## as well.
+##
+## The estimate has converged once both halves agree: the uncertainty of each
+## angle is the larger of the standard error of the mean and the difference
+## between the two half-window means (hover oscillations make neighbouring
+## samples far from independent, so the standard error alone is optimistic).
+
+import numpy as np
+
+
+class WindCalibration(object):
+
+    def __init__(self, window=5.0, capacity=2500):
+
+        # only samples from the last 'window' seconds are used, capacity should cover the window at the state rate
+        self.window = window
+        self.capacity = capacity
+
+        self.t = np.zeros(capacity)
+        self.phi = np.zeros(capacity)
+        self.theta = np.zeros(capacity)
+
+        self.reset()
+
+
+    def reset(self, t=None):
+
+        # ring buffer: tail is the oldest sample, boundary the oldest sample in the newer half, head the next free slot
+        self.tail = 0
+        self.boundary = 0
+        self.head = 0
+        self.count = 0
+
+        # running sums of the older and newer halves (n, sum, sum of squares), shifted by the reference angles
+        self.n_old = 0
+        self.phi_sum_old = 0.0
+        self.phi_sq_old = 0.0
+        self.theta_sum_old = 0.0
+        self.theta_sq_old = 0.0
+
+        self.n_new = 0
+        self.phi_sum_new = 0.0
+        self.phi_sq_new = 0.0
+        self.theta_sum_new = 0.0
+        self.theta_sq_new = 0.0
+
+        self.phi_ref = 0.0
+        self.theta_ref = 0.0
+
+        # when the calibration started and the latest sample (s)
+        self.t_start = t
+        self.t_latest = 0.0
+
+
+    def add(self, t, phi, theta):
+
+        if self.count == 0:
+            self.phi_ref = phi
+            self.theta_ref = theta
+            if self.t_start is None:
+                self.t_start = t
+
+        if self.count == self.capacity:
+            self.evict()
+
+        # new samples go in the newer half
+        head = self.head
+        self.t[head] = t
+        self.phi[head] = phi
+        self.theta[head] = theta
+        self.head = (head + 1) % self.capacity
+        self.count += 1
+        self.t_latest = t
+
+        dphi = phi - self.phi_ref
+        dtheta = theta - self.theta_ref
+        self.n_new += 1
+        self.phi_sum_new += dphi
+        self.phi_sq_new += dphi*dphi
+        self.theta_sum_new += dtheta
+        self.theta_sq_new += dtheta*dtheta
+
+        # drop samples that have left the window
+        while self.count > 1 and t - self.t[self.tail] > self.window:
+            self.evict()
+
+        # move samples older than the middle of the window into the older half
+        t_mid = 0.5*(self.t[self.tail] + t)
+        while self.n_new > 1 and self.t[self.boundary] < t_mid:
+            i = self.boundary
+            dphi = self.phi[i] - self.phi_ref
+            dtheta = self.theta[i] - self.theta_ref
+
+            self.n_new -= 1
+            self.phi_sum_new -= dphi
+            self.phi_sq_new -= dphi*dphi
+            self.theta_sum_new -= dtheta
+            self.theta_sq_new -= dtheta*dtheta
+
+            self.n_old += 1
+            self.phi_sum_old += dphi
+            self.phi_sq_old += dphi*dphi
+            self.theta_sum_old += dtheta
+            self.theta_sq_old += dtheta*dtheta
+
+            self.boundary = (i + 1) % self.capacity
+
+
+    def evict(self):
+
+        # remove the oldest sample from whichever half it's in
+        i = self.tail
+        dphi = self.phi[i] - self.phi_ref
+        dtheta = self.theta[i] - self.theta_ref
+
+        if self.n_old > 0:
+            self.n_old -= 1
+            self.phi_sum_old -= dphi
+            self.phi_sq_old -= dphi*dphi
+            self.theta_sum_old -= dtheta
+            self.theta_sq_old -= dtheta*dtheta
+        else:
+            self.n_new -= 1
+            self.phi_sum_new -= dphi
+            self.phi_sq_new -= dphi*dphi
+            self.theta_sum_new -= dtheta
+            self.theta_sq_new -= dtheta*dtheta
+            self.boundary = (i + 1) % self.capacity
+
+        self.tail = (i + 1) % self.capacity
+        self.count -= 1
+
+
+    def mean(self):
+
+        # average roll and pitch over the window
+        n = self.n_old + self.n_new
+        if n == 0:
+            return 0.0, 0.0
+
+        return (self.phi_ref + (self.phi_sum_old + self.phi_sum_new)/n,
+                self.theta_ref + (self.theta_sum_old + self.theta_sum_new)/n)
+
+
+    def std(self):
+
+        # sample standard deviation of roll and pitch over the window
+        n = self.n_old + self.n_new
+        if n < 2:
+            return 0.0, 0.0
+
+        phi_mean = (self.phi_sum_old + self.phi_sum_new)/n
+        theta_mean = (self.theta_sum_old + self.theta_sum_new)/n
+        phi_var = ((self.phi_sq_old + self.phi_sq_new)/n - phi_mean*phi_mean)*n/(n - 1.0)
+        theta_var = ((self.theta_sq_old + self.theta_sq_new)/n - theta_mean*theta_mean)*n/(n - 1.0)
+
+        return np.sqrt(max(phi_var, 0.0)), np.sqrt(max(theta_var, 0.0))
+
+
+    def uncertainty(self):
+
+        # how far off the mean roll and pitch could be (rad), inf until both halves have samples
+        if self.n_old == 0 or self.n_new == 0:
+            return np.inf, np.inf
+
+        n = self.n_old + self.n_new
+        phi_std, theta_std = self.std()
+        phi_drift = abs(self.phi_sum_old/self.n_old - self.phi_sum_new/self.n_new)
+        theta_drift = abs(self.theta_sum_old/self.n_old - self.theta_sum_new/self.n_new)
+
+        return max(phi_std/np.sqrt(n), phi_drift), max(theta_std/np.sqrt(n), theta_drift)
+
+
+    def elapsed(self):
+
+        if self.t_start is None:
+            return 0.0
+
+        return self.t_latest - self.t_start
+
+
+    def converged(self, min_duration, tolerance):
+
+        # calibrated for at least min_duration (s) and both angles known to within tolerance (rad)
+        if self.elapsed() < min_duration:
+            return False
+
+        phi_uncertainty, theta_uncertainty = self.uncertainty()
+
+        return phi_uncertainty <= tolerance and theta_uncertainty <= tolerance
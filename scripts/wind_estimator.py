@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+## Online wind estimate for the rendezvous offset, so the state machine doesn't
+## have to hover in WIND_CALIBRATION to learn the roll and pitch it needs at the
+## rendezvous point. It runs on every state estimate during the transit.
+##
+## Model (horizontal NE, linear drag):
+##   dv/dt = h - k*(v - w)
+## where h is the horizontal acceleration from the thrust vector
+##   h = -f*[z_x, z_y],  f = (g - dv_d/dt)/z_z,  z = body z-axis in the vehicle frame
+## k is the drag coefficient (1/s) and w the wind (m/s). Rearranged,
+##   y = h - dv/dt = k*v + b,  b = -k*w
+## is linear in (k, b_n, b_e). At the rendezvous hover (v = 0, dv/dt = 0) the
+## thrust has to give h = b, so b is exactly the hover tilt we need. Following a
+## target that moves at a steady v takes h = k*v + b instead.
+##
+## h, v and v_d go through the same first-order low-pass (time constant tau)
+## and dv/dt is taken from the filter state, (v - v_filtered)/tau, so the model
+## holds for the filtered signals without differentiating noisy velocities.
+## The least-squares sums forget old data with time constant 'memory' and the
+## 3x3 normal equations are solved in closed form. k is only observable while
+## the speed changes, which it does on the way to the rendezvous point.
+##
+## The filters start from the first sample as if it were steady, so the first
+## 'warmup' time constants are left out of the fit.
+##
+## Confidence: the residual variance gives the standard deviation of k*v + b,
+## counting one independent sample per tau seconds. Drag that isn't linear in v
+## still fits, but k and b then move as the transit slows down, so k*v + b is
+## also compared with its value 'drift_interval' seconds earlier (like the
+## half-window test in wind_calibration.py). The larger of the two, divided by g,
+## is the uncertainty of the tilt that holds v (rad), comparable to
+## WindCalibration.uncertainty(). Neither test sees the curvature of nonlinear
+## drag at speeds the transit never flew, so k*v + b is only trusted within
+## 'extrapolation' speed standard deviations of the mean fitted velocity.
+
+import math
+import numpy as np
+
+
+GRAVITY = 9.81
+
+
+class OnlineWindEstimator(object):
+
+    def __init__(self, tau=0.5, memory=20.0, k_min=0.05, k_max=2.0, warmup=5.0, drift_interval=2.0,
+                 extrapolation=1.5):
+
+        # low-pass time constant and forgetting time constant (s)
+        self.tau = tau
+        self.memory = memory
+
+        # number of time constants to let the filters settle before fitting
+        self.warmup = warmup
+
+        # how often (s) the solution is compared with the previous one to catch model errors
+        self.drift_interval = drift_interval
+
+        # how far (in speed standard deviations) k*v + b may be used away from the mean fitted velocity
+        self.extrapolation = extrapolation
+
+        # drag coefficients (1/s) outside this range mean the fit isn't trustworthy yet
+        self.k_min = k_min
+        self.k_max = k_max
+
+        self.reset()
+
+
+    def reset(self):
+
+        # filtered horizontal thrust acceleration, velocity and down velocity
+        self.h_n = 0.0
+        self.h_e = 0.0
+        self.v_n = 0.0
+        self.v_e = 0.0
+        self.v_d = 0.0
+        self.t_prev = None
+        self.t_start = None
+
+        # time-weighted least-squares sums (s)
+        self.s1 = 0.0       # sum of weights (per axis)
+        self.sv_n = 0.0     # sum of v_n
+        self.sv_e = 0.0     # sum of v_e
+        self.svv = 0.0      # sum of v_n^2 + v_e^2
+        self.sy_n = 0.0     # sum of y_n
+        self.sy_e = 0.0     # sum of y_e
+        self.svy = 0.0      # sum of v_n*y_n + v_e*y_e
+        self.syy = 0.0      # sum of y_n^2 + y_e^2
+
+        # latest solution (see solve()), with the residual variance, the weight and mean velocity of the fit and
+        # the Schur complement of its normal equations for the standard deviations
+        self.k = 0.0
+        self.b_n = 0.0
+        self.b_e = 0.0
+        self.b_std = np.inf
+        self.speed_std = 0.0
+        self.sigma2 = np.inf
+        self.weight = 0.0
+        self.mean_v_n = 0.0
+        self.mean_v_e = 0.0
+        self.schur = 0.0
+
+        # solution at the last drift check and how far k and b moved since the one before
+        self.t_drift = None
+        self.k_drift = 0.0
+        self.b_n_drift = 0.0
+        self.b_e_drift = 0.0
+        self.drift_k = np.inf
+        self.drift_b_n = np.inf
+        self.drift_b_e = np.inf
+        self.drift = np.inf
+
+
+    def add(self, t, phi, theta, psi, v_n, v_e, v_d):
+
+        # body z-axis in the vehicle frame
+        sphi = math.sin(phi)
+        cphi = math.cos(phi)
+        stheta = math.sin(theta)
+        ctheta = math.cos(theta)
+        spsi = math.sin(psi)
+        cpsi = math.cos(psi)
+        z_x = cphi*stheta*cpsi + sphi*spsi
+        z_y = cphi*stheta*spsi - sphi*cpsi
+        z_z = cphi*ctheta
+
+        if self.t_prev is None:
+            # start the filters on the first sample
+            self.t_prev = t
+            self.t_start = t
+            self.v_n = v_n
+            self.v_e = v_e
+            self.v_d = v_d
+            self.h_n = -GRAVITY*z_x/z_z
+            self.h_e = -GRAVITY*z_y/z_z
+            return
+
+        dt = t - self.t_prev
+        if dt <= 0.0:
+            return
+        self.t_prev = t
+
+        # step the filters, the change of each filtered velocity over dt is exactly (v - v_filtered)/tau
+        alpha = dt/(self.tau + dt)
+        self.v_n += alpha*(v_n - self.v_n)
+        self.v_e += alpha*(v_e - self.v_e)
+        self.v_d += alpha*(v_d - self.v_d)
+        a_n = (v_n - self.v_n)/self.tau
+        a_e = (v_e - self.v_e)/self.tau
+        a_d = (v_d - self.v_d)/self.tau
+
+        f = (GRAVITY - a_d)/z_z
+        self.h_n += alpha*(-f*z_x - self.h_n)
+        self.h_e += alpha*(-f*z_y - self.h_e)
+
+        # the filters start from the first sample as if it were steady, which it usually isn't
+        # (the transit starts with a big tilt), so leave that transient out of the sums
+        if t - self.t_start < self.warmup*self.tau:
+            return
+
+        y_n = self.h_n - a_n
+        y_e = self.h_e - a_e
+        x_n = self.v_n
+        x_e = self.v_e
+
+        # forget old data, then add this sample weighted by dt
+        decay = math.exp(-dt/self.memory)
+        self.s1 = decay*self.s1 + dt
+        self.sv_n = decay*self.sv_n + dt*x_n
+        self.sv_e = decay*self.sv_e + dt*x_e
+        self.svv = decay*self.svv + dt*(x_n*x_n + x_e*x_e)
+        self.sy_n = decay*self.sy_n + dt*y_n
+        self.sy_e = decay*self.sy_e + dt*y_e
+        self.svy = decay*self.svy + dt*(x_n*y_n + x_e*y_e)
+        self.syy = decay*self.syy + dt*(y_n*y_n + y_e*y_e)
+
+        # drag that isn't linear makes the intercept move as the speeds change, so watch how far it moves
+        if self.t_drift is None or t - self.t_drift >= self.drift_interval:
+            if self.solve():
+                if self.t_drift is not None:
+                    self.drift_k = self.k - self.k_drift
+                    self.drift_b_n = self.b_n - self.b_n_drift
+                    self.drift_b_e = self.b_e - self.b_e_drift
+                    self.drift = math.hypot(self.drift_b_n, self.drift_b_e)
+                self.t_drift = t
+                self.k_drift = self.k
+                self.b_n_drift = self.b_n
+                self.b_e_drift = self.b_e
+
+
+    def add_body(self, t, phi, theta, psi, u, v, w):
+
+        # same as add() with the velocity in the body frame (the twist of the 'estimate' Odometry)
+        sphi = math.sin(phi)
+        cphi = math.cos(phi)
+        stheta = math.sin(theta)
+        ctheta = math.cos(theta)
+        spsi = math.sin(psi)
+        cpsi = math.cos(psi)
+
+        v_n = ctheta*cpsi*u + (sphi*stheta*cpsi - cphi*spsi)*v + (cphi*stheta*cpsi + sphi*spsi)*w
+        v_e = ctheta*spsi*u + (sphi*stheta*spsi + cphi*cpsi)*v + (cphi*stheta*spsi - sphi*cpsi)*w
+        v_d = -stheta*u + sphi*ctheta*v + cphi*ctheta*w
+
+        self.add(t, phi, theta, psi, v_n, v_e, v_d)
+
+
+    def solve(self):
+
+        # least-squares k, b_n, b_e and the standard deviation of b (m/s^2), returns False if not solvable yet
+        s1 = self.s1
+        if s1 <= 0.0:
+            return False
+
+        # Schur complement of the normal equations (time-weighted speed variance times s1)
+        d = self.svv - (self.sv_n*self.sv_n + self.sv_e*self.sv_e)/s1
+        self.speed_std = math.sqrt(max(d, 0.0)/(2.0*s1))
+        if d <= 1.0e-9*s1:
+            return False
+
+        k = (self.svy - (self.sv_n*self.sy_n + self.sv_e*self.sy_e)/s1)/d
+        b_n = (self.sy_n - k*self.sv_n)/s1
+        b_e = (self.sy_e - k*self.sv_e)/s1
+
+        # residual variance per axis, then the variance of b with one independent sample per tau seconds
+        rss = self.syy - k*self.svy - b_n*self.sy_n - b_e*self.sy_e
+        sigma2 = max(rss, 0.0)/(2.0*s1)
+        b_n_var = sigma2*self.tau*(1.0/s1 + self.sv_n*self.sv_n/(s1*s1*d))
+        b_e_var = sigma2*self.tau*(1.0/s1 + self.sv_e*self.sv_e/(s1*s1*d))
+
+        self.k = k
+        self.b_n = b_n
+        self.b_e = b_e
+        self.b_std = math.sqrt(max(b_n_var, b_e_var))
+        self.sigma2 = sigma2
+        self.weight = s1
+        self.mean_v_n = self.sv_n/s1
+        self.mean_v_e = self.sv_e/s1
+        self.schur = d
+
+        return True
+
+
+    def acceleration_std(self, v_n=0.0, v_e=0.0):
+
+        # standard deviation of k*v + b (m/s^2) from the latest solve(), b_std at v = 0
+        if self.schur <= 0.0:
+            return np.inf
+
+        scale = self.sigma2*self.tau
+        var_n = scale*(1.0/self.weight + (self.mean_v_n - v_n)**2/self.schur)
+        var_e = scale*(1.0/self.weight + (self.mean_v_e - v_e)**2/self.schur)
+
+        return math.sqrt(max(var_n, var_e))
+
+
+    def drift_at(self, v_n=0.0, v_e=0.0):
+
+        # how far k*v + b moved over the last drift_interval (m/s^2), drift at v = 0
+        if self.drift == np.inf:
+            return np.inf
+
+        return math.hypot(self.drift_k*v_n + self.drift_b_n, self.drift_k*v_e + self.drift_b_e)
+
+
+    def wind(self):
+
+        # wind NE velocity (m/s) from the latest solve()
+        if self.k <= 0.0:
+            return 0.0, 0.0
+
+        return -self.b_n/self.k, -self.b_e/self.k
+
+
+    def tilt_uncertainty(self, v_n=0.0, v_e=0.0):
+
+        # uncertainty of the tilt that holds v_n, v_e (rad, see hover_attitude), the larger of the statistical one and the last drift
+        return max(self.acceleration_std(v_n, v_e), self.drift_at(v_n, v_e))/GRAVITY
+
+
+    def hover_attitude(self, psi, v_n=0.0, v_e=0.0):
+
+        # roll and pitch at heading psi that hold a steady NE velocity v_n, v_e (m/s, 0 to hold position, the target's
+        # to keep pace with it) in this wind: dv/dt = 0 needs h = k*v + b, so thrust along [-h_n, -h_e, g]
+        z_x = -(self.k*v_n + self.b_n)
+        z_y = -(self.k*v_e + self.b_e)
+        z_z = GRAVITY
+        norm = math.sqrt(z_x*z_x + z_y*z_y + z_z*z_z)
+
+        # un-yaw the z-axis, then phi = asin(-w_y), theta = atan2(w_x, w_z) like heading_remap.py
+        spsi = math.sin(psi)
+        cpsi = math.cos(psi)
+        w_x = (cpsi*z_x + spsi*z_y)/norm
+        w_y = (-spsi*z_x + cpsi*z_y)/norm
+
+        return math.asin(-w_y), math.atan2(w_x, z_z/norm)
+
+
+    def confident(self, min_duration, tolerance, v_n=0.0, v_e=0.0):
+
+        # solved with enough data, v_n, v_e within the fitted speeds, a plausible drag coefficient and the tilt
+        # that holds v_n, v_e known to within tolerance (rad)
+        if self.t_start is None or self.t_prev - self.t_start < min_duration:
+            return False
+
+        if not self.solve():
+            return False
+
+        if math.hypot(v_n - self.mean_v_n, v_e - self.mean_v_e) > self.extrapolation*self.speed_std:
+            return False
+
+        return self.k_min <= self.k <= self.k_max and self.tilt_uncertainty(v_n, v_e) <= tolerance